@@ -1,16 +1,33 @@
 import streamlit as st
 import pandas as pd
-import folium
-from streamlit_folium import st_folium
+import numpy as np
 from datetime import datetime, timedelta, time
-from math import radians, cos, sin, asin, sqrt
+from math import radians, cos
 import math
 import io
+import os
 import re
+import json
+import sqlite3
+import tempfile
 import time as time_module
-import requests
 import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait
 from supabase import create_client, Client
+# Pianificatore, TSP, motori percorsi e tabella clienti: modulo senza Streamlit
+# (giro_engine/, misurato da bench/planner.py, usabile da riga di comando con python -m giro_engine)
+from giro_engine import (
+    haversine,
+    calcola_agenda_settimanale, calcola_piano_giornaliero, calcola_agenda_multisettimana,
+    normalizza_df_clienti, df_clienti_da_righe, config_predefinita,
+    GoogleRoutingBackend, crea_routing_backend, ottimizza_ordine_percorso, applica_legs_a_tappe,
+    route_valida_per_tappe, decode_google_polyline, decode_polyline_array, id_percorso
+)
+from giro_engine.misure import chiamate_rerun, registra_chiamata, misura_chiamata
+# folium, streamlit_folium e requests si importano dentro le funzioni/tab che li usano:
+# un nuovo processo non li carica finché non serve una mappa o una chiamata HTTP
+# (profilo: python bench/importtime.py)
 
 # --- 1. CONFIGURAZIONE ---
 st.set_page_config(page_title="Giro Visite CRM Pro", layout="wide", page_icon="🚀")
@@ -64,6 +81,20 @@ LOCATIONIQ_KEY = st.secrets.get("LOCATIONIQ_KEY", "")
 GOOGLE_MAPS_API_KEY = st.secrets.get("GOOGLE_MAPS_API_KEY", "")
 ADMIN_EMAIL = st.secrets.get("ADMIN_EMAIL", "")
 
+# Motore percorsi: 'google' | 'osrm' | 'locale' | 'nessuno' (default: google se c'è la chiave)
+ROUTING_BACKEND = st.secrets.get("ROUTING_BACKEND", "google" if GOOGLE_MAPS_API_KEY else "nessuno")
+OSRM_URL = st.secrets.get("OSRM_URL", "http://router.project-osrm.org")  # es. istanza self-hosted
+# Motore usato dal pianificatore per gli orari finali (default: stima interna)
+ROUTING_BACKEND_PIANIFICAZIONE = st.secrets.get("ROUTING_BACKEND_PIANIFICAZIONE", "")
+# Ogni quanti secondi controllare se i dati sul server sono cambiati (sql/003_data_versioni.sql)
+DATA_POLL_SECONDI = int(st.secrets.get("DATA_POLL_SECONDI", 30))
+# Finestra riletta prima dell'ultima sincronizzazione (transazioni rese visibili dopo il loro timestamp)
+SYNC_SOVRAPPOSIZIONE_SECONDI = int(st.secrets.get("SYNC_SOVRAPPOSIZIONE_SECONDI", 60))
+# Job in background (geocodifica, import): file SQLite con stato e checkpoint, worker e polling della UI
+JOB_DB_PATH = st.secrets.get("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "giro_visite_jobs.sqlite3"))
+JOB_WORKERS = int(st.secrets.get("JOB_WORKERS", 2))
+JOB_POLL_SECONDI = 2
+
 # Verifica che i secrets siano configurati
 if not SUPABASE_URL or not SUPABASE_KEY:
     st.error("⚠️ **Configurazione mancante!** Vai su Streamlit Cloud → Settings → Secrets e aggiungi le credenziali.")
@@ -72,24 +103,149 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 # Durata trial in giorni
 TRIAL_DAYS = 14
 
+# Ogni quanti secondi rileggere abbonamento/admin dell'utente (cache di sessione)
+SUBSCRIPTION_TTL_SECONDI = 300
+# Dopo una lettura fallita si riprova prima (intanto resta l'ultimo valore letto)
+SUBSCRIPTION_TTL_ERRORE_SECONDI = 15
+
 @st.cache_resource
 def get_supabase_client():
     return create_client(SUPABASE_URL, SUPABASE_KEY)
 
 supabase: Client = get_supabase_client()
 
+# --- MISURE PRESTAZIONI (opt-in: ?perf=1 o interruttore admin) ---
+# Conta le chiamate di rete di ogni rerun: query Supabase (.execute()), geocodifica
+# LocationIQ, Google Routes e OSRM (giro_engine/routing.py, anche via get_route_osrm) e le
+# risposte servite dalle cache (motori percorsi, abbonamento in sessione). Spento di
+# default: execute() viene avvolto solo la prima volta che le misure si accendono e, fuori
+# da un rerun misurato, il wrapper legge soltanto una ContextVar (giro_engine/misure.py).
+# I thread di bootstrap_sessione (avviati con copy_context) contano nel rerun che li ha
+# lanciati; job in background e rerun dei soli fragment no.
+PERF_SOGLIA_N_PIU_1 = 3   # stessa query con parametri diversi almeno N volte nello stesso rerun
+PERF_STORICO_RERUN = 20   # rerun recenti tenuti in sessione
+
+def _descrivi_query_supabase(request):
+    """(operazione, firma, dettaglio) di una richiesta PostgREST. La firma tiene tabella e
+    colonne filtrate ma non i valori: N query uguali su id diversi hanno la stessa firma"""
+    from urllib.parse import unquote
+    tabella = str(request.path).rsplit('/rest/v1/', 1)[-1]
+    operazione = f"{request.http_method} {tabella}"
+    filtri = sorted(f"{k}={v.split('.', 1)[0]}" for k, v in request.params.multi_items()
+                    if k not in ('select', 'order', 'limit', 'offset'))
+    firma = operazione + ('?' + '&'.join(filtri) if filtri else '')
+    return operazione, firma, unquote(f"{operazione}?{request.params}")[:300]
+
+def _execute_misurato(execute_originale):
+    def execute(self):
+        if chiamate_rerun.get() is None:
+            return execute_originale(self)
+        operazione, firma, dettaglio = _descrivi_query_supabase(self.request)
+        t0 = time_module.perf_counter()
+        risposta = None
+        try:
+            risposta = execute_originale(self)
+            return risposta
+        finally:
+            # Byte stimati dal JSON dei dati restituiti (la risposta HTTP grezza non è esposta)
+            dati = getattr(risposta, 'data', None)
+            byte = len(json.dumps(dati, separators=(',', ':'), default=str)) if dati else 0
+            registra_chiamata('supabase', operazione, (time_module.perf_counter() - t0) * 1000, byte=byte,
+                              firma=firma, dettaglio=dettaglio if risposta is not None else f"❌ {dettaglio}")
+    return execute
+
+@st.cache_resource
+def _installa_misure_supabase():
+    """Avvolge execute() dei request builder PostgREST (una volta per processo)"""
+    from postgrest import SyncQueryRequestBuilder, SyncSingleRequestBuilder, SyncMaybeSingleRequestBuilder
+    for classe in (SyncQueryRequestBuilder, SyncSingleRequestBuilder, SyncMaybeSingleRequestBuilder):
+        classe.execute = _execute_misurato(classe.execute)
+    return True
+
+def misure_attive():
+    """Misure accese per questo rerun: ?perf=1 nell'URL o interruttore nella sidebar admin"""
+    return st.query_params.get('perf') == '1' or st.session_state.get('_perf_admin', False)
+
+def avvia_misure_rerun():
+    """Inizio rerun: (token ContextVar, istante di avvio) o None se le misure sono spente"""
+    if not misure_attive():
+        return None
+    _installa_misure_supabase()
+    return chiamate_rerun.set([]), time_module.perf_counter()
+
+def chiudi_misure_rerun(avvio, interrotto=False):
+    """Fine rerun (anche interrotto da st.rerun): somma le chiamate ai totali di sessione
+    e ritorna il riepilogo del rerun"""
+    if avvio is None:
+        return None
+    token, t0 = avvio
+    chiamate = chiamate_rerun.get() or []
+    chiamate_rerun.reset(token)
+    rerun = {'ora': ora_italiana.strftime('%H:%M:%S'), 'ms': (time_module.perf_counter() - t0) * 1000,
+             'interrotto': interrotto, 'chiamate': chiamate}
+    totali = st.session_state.setdefault('_perf_sessione', {})
+    for c in chiamate:
+        voce = totali.setdefault((c['categoria'], c['operazione']), [0, 0, 0.0, 0])
+        voce[0] += 1
+        voce[1] += c['cache']
+        voce[2] += c['ms']
+        voce[3] += c['byte']
+    storico = st.session_state.setdefault('_perf_storico', [])
+    storico.append({k: v for k, v in rerun.items() if k != 'chiamate'} | {
+        'n': sum(not c['cache'] for c in chiamate), 'cache': sum(c['cache'] for c in chiamate),
+        'ms_rete': sum(c['ms'] for c in chiamate), 'byte': sum(c['byte'] for c in chiamate)})
+    del storico[:-PERF_STORICO_RERUN]
+    return rerun
+
 # --- 2. GESTIONE ABBONAMENTI/UTENTI ---
+def leggi_user_subscription(user_id):
+    """Abbonamento di un utente (None se non ne ha uno); gli errori di Supabase vengono rilanciati"""
+    response = supabase.table('user_subscriptions').select('*').eq('user_id', user_id).execute()
+    if response.data:
+        return response.data[0]
+    return None
+
 def get_user_subscription(user_id, email=None):
     """Ottiene lo stato abbonamento di un utente"""
     try:
-        response = supabase.table('user_subscriptions').select('*').eq('user_id', user_id).execute()
-        if response.data:
-            return response.data[0]
-        return None
+        return leggi_user_subscription(user_id)
     except Exception as e:
         # Tabella potrebbe non esistere ancora
         return None
 
+# --- CACHE ABBONAMENTI IN SESSIONE ---
+# Badge admin e controlli d'accesso vengono ridisegnati a ogni rerun: leggono la copia in
+# sessione e interrogano Supabase solo dopo SUBSCRIPTION_TTL_SECONDI o dopo una modifica
+# fatta da questa sessione (approve_user, update_user_subscription, ...). Una lettura fallita
+# non cancella l'abbonamento: resta l'ultimo valore e si riprova dopo SUBSCRIPTION_TTL_ERRORE_SECONDI.
+def memorizza_subscription(user_id, subscription, ttl=SUBSCRIPTION_TTL_SECONDI):
+    cache = st.session_state.setdefault('_cache_abbonamenti', {})
+    cache[user_id] = (time_module.time(), subscription, ttl)
+
+def invalida_cache_abbonamento(user_id=None):
+    """Dimentica l'abbonamento in cache di un utente (o di tutti se user_id è None)"""
+    cache = st.session_state.get('_cache_abbonamenti', {})
+    if user_id is None:
+        cache.clear()
+    else:
+        cache.pop(user_id, None)
+
+def get_subscription_sessione(user_id):
+    """Abbonamento dalla cache di sessione; riletto da Supabase se scaduto il TTL o invalidato"""
+    voce = st.session_state.get('_cache_abbonamenti', {}).get(user_id)
+    if voce and time_module.time() - voce[0] < voce[2]:
+        registra_chiamata('supabase', 'GET user_subscriptions', 0, cache=True)
+        return voce[1]
+    try:
+        subscription = leggi_user_subscription(user_id)
+    except Exception:
+        # Errore transitorio: si tiene l'ultimo valore letto, per poco
+        subscription = voce[1] if voce else None
+        memorizza_subscription(user_id, subscription, ttl=SUBSCRIPTION_TTL_ERRORE_SECONDI)
+        return subscription
+    memorizza_subscription(user_id, subscription)
+    return subscription
+
 def create_user_subscription(user_id, email, is_trial=True, tipo_account='agente_singolo', 
                              nome_azienda='', nome_referente='', telefono='', notes=''):
     """Crea un nuovo record abbonamento per un utente"""
@@ -143,6 +299,7 @@ def approve_user(user_id):
             'trial_end': (today + timedelta(days=TRIAL_DAYS)).isoformat()
         }
         response = supabase.table('user_subscriptions').update(update_data).eq('user_id', user_id).execute()
+        invalida_cache_abbonamento(user_id)
         return True
     except Exception as e:
         st.error(f"Errore approvazione: {str(e)}")
@@ -157,6 +314,7 @@ def reject_user(user_id):
             'blocked_reason': 'Richiesta rifiutata'
         }
         response = supabase.table('user_subscriptions').update(update_data).eq('user_id', user_id).execute()
+        invalida_cache_abbonamento(user_id)
         return True
     except Exception as e:
         return False
@@ -170,6 +328,7 @@ def delete_user_account(user_id):
         supabase.table('config_utente').delete().eq('user_id', user_id).execute()
         # Elimina l'abbonamento
         supabase.table('user_subscriptions').delete().eq('user_id', user_id).execute()
+        invalida_cache_abbonamento(user_id)
         return True
     except Exception as e:
         st.error(f"Errore eliminazione: {str(e)}")
@@ -179,6 +338,7 @@ def update_user_subscription(user_id, update_data):
     """Aggiorna lo stato abbonamento di un utente"""
     try:
         response = supabase.table('user_subscriptions').update(update_data).eq('user_id', user_id).execute()
+        invalida_cache_abbonamento(user_id)
         return True
     except Exception as e:
         return False
@@ -224,9 +384,9 @@ def check_subscription_status(subscription):
     return False, "Stato account non riconosciuto."
 
 def is_admin(user_id):
-    """Verifica se l'utente è admin"""
+    """Verifica se l'utente è admin (abbonamento dalla cache di sessione)"""
     try:
-        sub = get_user_subscription(user_id)
+        sub = get_subscription_sessione(user_id)
         return sub.get('is_admin', False) if sub else False
     except:
         return False
@@ -754,6 +914,18 @@ def get_user_id():
         return st.session_state.user.id
     return None
 
+def _query_clienti(user_id, team_info, colonne='*'):
+    """Query sui clienti visibili all'utente: standalone=tutti i propri, agente=assegnati, responsabile=tutti del team"""
+    query = supabase.table('clienti').select(colonne)
+    if team_info and team_info['ruolo'] == 'agente':
+        # AGENTE: vede solo i clienti assegnati a lui
+        return query.eq('agente_id', user_id)
+    if team_info and team_info['ruolo'] == 'responsabile':
+        # RESPONSABILE: vede tutti i clienti del team + i propri standalone
+        return query.or_(f"team_id.eq.{team_info['team_id']},user_id.eq.{user_id}")
+    # STANDALONE: come prima
+    return query.eq('user_id', user_id)
+        
 def fetch_clienti():
     """Carica clienti: standalone=tutti i propri, agente=assegnati, responsabile=tutti del team"""
     try:
@@ -761,84 +933,230 @@ def fetch_clienti():
         if not user_id:
             return pd.DataFrame()
         
-        team_info = st.session_state.get('team_info')
-        
-        if team_info and team_info['ruolo'] == 'agente':
-            # AGENTE: vede solo i clienti assegnati a lui
-            response = supabase.table('clienti').select('*').eq('agente_id', user_id).order('id').execute()
-        elif team_info and team_info['ruolo'] == 'responsabile':
-            # RESPONSABILE: vede tutti i clienti del team + i propri standalone
-            response = supabase.table('clienti').select('*').or_(
-                f"team_id.eq.{team_info['team_id']},user_id.eq.{user_id}"
-            ).order('id').execute()
-        else:
-            # STANDALONE: come prima
-            response = supabase.table('clienti').select('*').eq('user_id', user_id).order('id').execute()
-        
-        if response.data:
-            df = pd.DataFrame(response.data)
-            
-            # Escludi record speciali (usati per storage interno)
-            df = df[~df['nome_cliente'].str.startswith('__', na=False)]
-            
-            # Converti colonne datetime
-            if 'ultima_visita' in df.columns:
-                df['ultima_visita'] = pd.to_datetime(df['ultima_visita'], errors='coerce')
-            else:
-                df['ultima_visita'] = pd.NaT
-                
-            if 'appuntamento' in df.columns:
-                df['appuntamento'] = pd.to_datetime(df['appuntamento'], errors='coerce')
-            else:
-                df['appuntamento'] = pd.NaT
-            
-            # Converti coordinate
-            if 'latitude' in df.columns:
-                df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
-            else:
-                df['latitude'] = 0.0
-                
-            if 'longitude' in df.columns:
-                df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
-            else:
-                df['longitude'] = 0.0
-            
-            # Frequenza giorni
-            if 'frequenza_giorni' in df.columns:
-                df['frequenza_giorni'] = pd.to_numeric(df['frequenza_giorni'], errors='coerce').fillna(30).astype(int)
-            else:
-                df['frequenza_giorni'] = 30
-            
-            # Campo visitare - IMPORTANTE per il giro
-            if 'visitare' in df.columns:
-                df['visitare'] = df['visitare'].fillna('SI').astype(str).str.upper().str.strip()
-            else:
-                df['visitare'] = 'SI'
-            
-            # Stato cliente
-            if 'stato_cliente' in df.columns:
-                df['stato_cliente'] = df['stato_cliente'].fillna('CLIENTE ATTIVO')
-            else:
-                df['stato_cliente'] = 'CLIENTE ATTIVO'
-            
-            # Città
-            if 'citta' in df.columns:
-                df['citta'] = df['citta'].fillna('')
-            else:
-                df['citta'] = ''
-            
-            return df
-        return pd.DataFrame()
+        versione, righe = _scarica_clienti(user_id, st.session_state.get('team_info'))
+        inizia_sincronizzazione(versione, righe)
+        return df_clienti_da_righe(righe)
     except Exception as e:
         st.error(f"❌ Errore caricamento clienti: {str(e)}")
         return pd.DataFrame()
 
+def _scarica_clienti(user_id, team_info):
+    """Versione dati (letta prima della query) e righe clienti grezze; non usa st.session_state"""
+    versione = fetch_versione_dati(user_id, team_info)
+    response = _query_clienti(user_id, team_info).order('id').execute()
+    return versione, response.data or []
+
+# --- DATI CLIENTI IN SESSIONE (write-through) ---
+# Ogni scrittura confermata dal server viene applicata subito a st.session_state.df_clienti
+# e incrementa df_version (indici di ricerca, griglie e mappe si aggiornano da soli).
+# Il ricaricamento completo resta per il pulsante 🔃 e quando il server non conferma la riga.
+def _segna_dati_modificati():
+    st.session_state.df_version = st.session_state.get('df_version', 0) + 1
+
+def _valore_colonna_cliente(df, col, valore):
+    """Converte un valore arrivato dal server nel tipo della colonna di df_clienti (come normalizza_df_clienti)"""
+    if col in ('ultima_visita', 'appuntamento'):
+        valore = pd.to_datetime(valore, errors='coerce')
+        tz = getattr(df[col].dtype, 'tz', None) if col in df.columns else None
+        if tz is not None and pd.notnull(valore) and valore.tzinfo is None:
+            valore = valore.tz_localize(tz)
+        elif tz is None and pd.notnull(valore) and valore.tzinfo is not None:
+            valore = valore.tz_convert(None)
+        return valore
+    if col in ('latitude', 'longitude'):
+        try:
+            return float(valore)
+        except (TypeError, ValueError):
+            return np.nan
+    if col == 'frequenza_giorni':
+        try:
+            return int(valore)
+        except (TypeError, ValueError):
+            return 30
+    if col == 'visitare':
+        return str(valore if valore is not None else 'SI').upper().strip()
+    if col == 'stato_cliente':
+        return valore if valore is not None else 'CLIENTE ATTIVO'
+    if col == 'citta':
+        return valore if valore is not None else ''
+    return valore
+
+def aggiorna_cliente_locale(cliente_ids, campi):
+    """Applica a df_clienti i campi già salvati sul server per uno o più clienti"""
+    df = st.session_state.get('df_clienti')
+    if df is None or df.empty or not campi:
+        return False
+    ids = cliente_ids if isinstance(cliente_ids, (list, tuple, set)) else [cliente_ids]
+    mask = df['id'].isin(ids)
+    if not mask.any():
+        st.session_state.reload_data = True
+        return False
+    for col, valore in campi.items():
+        if col == 'id':
+            continue
+        if col not in df.columns:
+            df[col] = None
+        df.loc[mask, col] = _valore_colonna_cliente(df, col, valore)
+    _segna_dati_modificati()
+    return True
+
+def aggiorna_clienti_da_server(righe):
+    """Applica a df_clienti le righe complete restituite dal server dopo un update"""
+    for riga in righe:
+        aggiorna_cliente_locale(riga['id'], riga)
+
+def aggiungi_cliente_locale(riga):
+    """Aggiunge a df_clienti il cliente appena inserito (riga restituita dal server)"""
+    if str(riga.get('nome_cliente', '')).startswith('__'):
+        return
+    nuovo = normalizza_df_clienti(pd.DataFrame([riga]))
+    df = st.session_state.get('df_clienti')
+    if df is None or df.empty:
+        st.session_state.df_clienti = nuovo
+    else:
+        nuovo.index = [df.index.max() + 1]
+        for col in ('ultima_visita', 'appuntamento'):
+            nuovo[col] = pd.Series([_valore_colonna_cliente(df, col, v) for v in nuovo[col]], index=nuovo.index, dtype=df[col].dtype)
+        st.session_state.df_clienti = pd.concat([df, nuovo])
+    _segna_dati_modificati()
+
+def rimuovi_cliente_locale(cliente_id):
+    """Toglie da df_clienti un cliente eliminato"""
+    df = st.session_state.get('df_clienti')
+    if df is None or df.empty:
+        return
+    st.session_state.df_clienti = df[df['id'] != cliente_id]
+    _segna_dati_modificati()
+
+# --- SINCRONIZZAZIONE A DELTA ---
+# I trigger di sql/003_data_versioni.sql incrementano un contatore per utente/team a ogni
+# modifica di clienti, giri salvati, scambi e config. main_app lo legge al massimo ogni
+# DATA_POLL_SECONDI: se non cambia non si scarica nulla, altrimenti solo le righe nuove.
+# aggiornato_il è l'istante della scrittura ma la riga si vede solo al commit: ogni delta
+# rilegge SYNC_SOVRAPPOSIZIONE_SECONDI prima dell'ultimo timestamp visto e salta i clienti
+# già applicati con lo stesso aggiornato_il (_sync_clienti_visti).
+# Senza le tabelle (migrazione non eseguita) il controllo resta spento.
+def _ambiti_versione_dati(user_id, team_info):
+    ambiti = [f"user:{user_id}"]
+    if team_info and team_info.get('team_id') is not None:
+        ambiti.append(f"team:{team_info['team_id']}")
+    return ambiti
+
+def fetch_versione_dati(user_id=None, team_info=None):
+    """Versione corrente dei dati visibili all'utente (una riga per ambito), None se non disponibile"""
+    if user_id is None:
+        user_id, team_info = get_user_id(), st.session_state.get('team_info')
+    try:
+        resp = supabase.table('data_versioni').select('ambito, versione').in_('ambito', _ambiti_versione_dati(user_id, team_info)).execute()
+        return tuple(sorted((r['ambito'], r['versione']) for r in resp.data or []))
+    except Exception:
+        return None
+
+def _max_timestamp(valori, corrente=None):
+    """Timestamp più recente (stringa ISO del server) tra quelli dati"""
+    ts = pd.to_datetime(pd.Series(list(valori) + ([corrente] if corrente else []), dtype=object), errors='coerce', utc=True, format='ISO8601').max()
+    return ts.isoformat() if pd.notnull(ts) else corrente
+
+def _rilettura_dal(dal):
+    """Inizio della finestra di rilettura prima del timestamp dal"""
+    return (pd.Timestamp(dal) - pd.Timedelta(seconds=SYNC_SOVRAPPOSIZIONE_SECONDI)).isoformat()
+
+def _visti_in_finestra(visti, dal):
+    """{cliente_id: aggiornato_il} applicati, solo quelli che la prossima rilettura da dal ritroverà"""
+    if not visti or not dal:
+        return {}
+    ts = pd.to_datetime(pd.Series(visti, dtype=object), errors='coerce', utc=True, format='ISO8601')
+    return {cid: visti[cid] for cid in ts.index[ts >= pd.Timestamp(_rilettura_dal(dal))]}
+
+def inizia_sincronizzazione(versione, righe_clienti):
+    """Dopo un caricamento completo: versione (letta prima della query) e istante da cui chiedere le differenze"""
+    st.session_state._versione_dati = versione
+    st.session_state._versione_dati_ts = time_module.time()
+    dal = _max_timestamp(r.get('aggiornato_il') for r in righe_clienti) if righe_clienti else None
+    st.session_state._sync_clienti_dal = dal
+    st.session_state._sync_rimossi_dal = dal
+    st.session_state._sync_clienti_visti = _visti_in_finestra(
+        {r['id']: r['aggiornato_il'] for r in righe_clienti if r.get('aggiornato_il')}, dal)
+
+def sincronizza_delta():
+    """Scarica solo i clienti modificati/rimossi dall'ultima sincronizzazione e li applica a df_clienti"""
+    user_id = get_user_id()
+    dal_clienti = st.session_state.get('_sync_clienti_dal')
+    dal_rimossi = st.session_state.get('_sync_rimossi_dal')
+    if not user_id or not dal_clienti:
+        st.session_state.reload_data = True
+        return
+    try:
+        team_info = st.session_state.get('team_info')
+        modificati = _query_clienti(user_id, team_info).gte('aggiornato_il', _rilettura_dal(dal_clienti)) \
+            .order('aggiornato_il').execute().data or []
+        filtro = f"user_id.eq.{user_id},agente_id.eq.{user_id}"
+        if team_info and team_info['ruolo'] == 'responsabile':
+            filtro += f",team_id.eq.{team_info['team_id']}"
+        rimossi = supabase.table('clienti_rimossi').select('cliente_id, rimosso_il').or_(filtro) \
+            .gte('rimosso_il', _rilettura_dal(dal_rimossi)).order('rimosso_il').execute().data or []
+    except Exception:
+        st.session_state.reload_data = True
+        return
+
+    visti = st.session_state.get('_sync_clienti_visti', {})
+    # Ultima modifica nota di ogni cliente: una rimozione non più recente è superata
+    # (cliente riassegnato e ancora visibile, o rimosso e poi tornato)
+    ultima_modifica = {**visti, **{r['id']: r['aggiornato_il'] for r in modificati}}
+
+    # Prima le rimozioni: un cliente passato a un altro agente del team resta visibile al responsabile
+    df = st.session_state.get('df_clienti')
+    for r in rimossi:
+        modifica = ultima_modifica.get(r['cliente_id'])
+        if modifica and pd.Timestamp(modifica) >= pd.Timestamp(r['rimosso_il']):
+            continue
+        if df is not None and not df.empty and (df['id'] == r['cliente_id']).any():
+            rimuovi_cliente_locale(r['cliente_id'])
+            df = st.session_state.df_clienti
+    for riga in modificati:
+        if str(riga.get('nome_cliente', '')).startswith('__'):
+            continue
+        df = st.session_state.get('df_clienti')
+        if df is not None and not df.empty and (df['id'] == riga['id']).any():
+            if visti.get(riga['id']) == riga['aggiornato_il']:
+                continue  # già applicata (riletta nella finestra)
+            aggiorna_cliente_locale(riga['id'], riga)
+        else:
+            aggiungi_cliente_locale(riga)
+
+    st.session_state._sync_clienti_dal = _max_timestamp((r.get('aggiornato_il') for r in modificati), dal_clienti)
+    st.session_state._sync_rimossi_dal = _max_timestamp((r.get('rimosso_il') for r in rimossi), dal_rimossi)
+    st.session_state._sync_clienti_visti = _visti_in_finestra(
+        {**visti, **{r['id']: r['aggiornato_il'] for r in modificati}}, st.session_state._sync_clienti_dal)
+    # Scambi giorni, giro salvato e config sono piccoli: si rileggono al prossimo accesso
+    st.session_state.pop('scambi_giorni', None)
+    st.session_state.pop('config', None)
+    segna_giro_salvato_modificato()
+
+def controlla_versione_dati():
+    """Al massimo ogni DATA_POLL_SECONDI legge il contatore; se è cambiato sincronizza le differenze"""
+    if DATA_POLL_SECONDI <= 0 or st.session_state.get('_versione_dati') is None:
+        return
+    ora = time_module.time()
+    if ora - st.session_state.get('_versione_dati_ts', 0) < DATA_POLL_SECONDI:
+        return
+    st.session_state._versione_dati_ts = ora
+    versione = fetch_versione_dati()
+    if versione is None or versione == st.session_state._versione_dati:
+        return
+    st.session_state._versione_dati = versione
+    sincronizza_delta()
+
 def save_cliente(cliente_data):
     """Salva un nuovo cliente"""
     try:
         user_id = get_user_id()
         cliente_data['user_id'] = user_id
         response = supabase.table('clienti').insert(cliente_data).execute()
+        if response.data:
+            aggiungi_cliente_locale(response.data[0])
+        else:
+            st.session_state.reload_data = True
         return True
     except Exception as e:
         st.error(f"❌ Errore salvataggio: {str(e)}")
@@ -848,6 +1166,27 @@ def update_cliente(cliente_id, update_data):
     """Aggiorna un cliente esistente"""
     try:
         response = supabase.table('clienti').update(update_data).eq('id', cliente_id).execute()
+        if response.data:
+            aggiorna_clienti_da_server(response.data)
+        else:
+            # Nessuna riga confermata (eliminato altrove o non più visibile): meglio ricaricare
+            st.session_state.reload_data = True
+        return True
+    except Exception as e:
+        st.error(f"❌ Errore aggiornamento: {str(e)}")
+        return False
+
+def update_clienti(cliente_ids, update_data):
+    """Aggiorna più clienti con gli stessi valori in una sola richiesta"""
+    if not cliente_ids:
+        return True
+    try:
+        ids = [int(cid) for cid in cliente_ids]
+        response = supabase.table('clienti').update(update_data).in_('id', ids).execute()
+        if response.data:
+            aggiorna_clienti_da_server(response.data)
+        if len(response.data or []) != len(ids):
+            st.session_state.reload_data = True
         return True
     except Exception as e:
         st.error(f"❌ Errore aggiornamento: {str(e)}")
@@ -857,15 +1196,194 @@ def delete_cliente(cliente_id):
     """Elimina un cliente"""
     try:
         response = supabase.table('clienti').delete().eq('id', cliente_id).execute()
+        rimuovi_cliente_locale(cliente_id)
         return True
     except Exception as e:
         st.error(f"❌ Errore eliminazione: {str(e)}")
         return False
 
-def fetch_config():
+# --- STORICO VISITE (tabella `visite`, append-only — vedi sql/001_visite.sql) ---
+ICONE_TIPO_VISITA = {'VISITA': '🚗', 'TELEFONATA': '📞'}
+VISITE_PER_PAGINA = 20
+
+def parse_storico_report(storico):
+    """Vecchio blob storico_report ("[dd/mm/YYYY] [TIPO] testo" separati da riga vuota) → lista di voci"""
+    voci = []
+    for entry in str(storico or '').split('\n\n'):
+        entry_text = entry.strip()
+        if not entry_text:
+            continue
+        data_rep, tipo_rep, testo_rep = "", "", entry_text
+        if entry_text.startswith('['):
+            # Prima parentesi: data, seconda (opzionale): tipo
+            end_data = entry_text.find(']')
+            if end_data > 0:
+                data_rep = entry_text[1:end_data]
+                resto = entry_text[end_data+1:].strip()
+                testo_rep = resto
+                if resto.startswith('['):
+                    end_tipo = resto.find(']')
+                    if end_tipo > 0:
+                        tipo_rep = resto[1:end_tipo]
+                        testo_rep = resto[end_tipo+1:].strip()
+        try:
+            data_visita = datetime.strptime(data_rep.strip(), '%d/%m/%Y').date()
+        except ValueError:
+            data_visita = None
+        voci.append({'data_visita': data_visita, 'data_testo': data_rep, 'tipo': tipo_rep.strip().upper(), 'testo': testo_rep})
+    return voci
+
+def _campi_visita_storico(cliente_id, data_visita, tipo, testo):
+    """Fallback se la tabella visite non esiste ancora: campi da salvare col report anteposto al blob storico_report"""
+    campi = {'ultima_visita': data_visita.isoformat()}
+    if testo.strip():
+        try:
+            resp = supabase.table('clienti').select('storico_report').eq('id', cliente_id).execute()
+            vecchio = str((resp.data[0].get('storico_report') if resp.data else '') or '')
+        except Exception:
+            vecchio = ''
+        nuovo = f"[{data_visita.strftime('%d/%m/%Y')}] [{tipo}] {testo.strip()}"
+        campi['storico_report'] = nuovo + "\n\n" + vecchio if vecchio.strip() else nuovo
+    return campi
+
+def _rpc_mancante(errore):
+    """True se PostgREST non trova la funzione (migrazione SQL non applicata)"""
+    return getattr(errore, 'code', None) in ('PGRST202', '42883')  # 404 di PostgREST / undefined_function
+
+def registra_visita(cliente_id, data_visita, tipo='VISITA', testo=''):
+    """Registra una visita/telefonata con la RPC atomica (sql/002_registra_visita.sql).
+    Aggiorna anche df_clienti; ritorna i campi del cliente cambiati (es. {'ultima_visita': ...}) o None se fallisce
+    (errore già mostrato con st.error). Solo se la RPC non è installata si ripiega su insert + update separati:
+    con qualsiasi altro errore (permessi, timeout forse dopo il commit) non si riprova, per non registrare
+    la visita due volte"""
+    from postgrest.exceptions import APIError
+    testo = (testo or '').strip()
+    try:
+        resp = supabase.rpc('registra_visita', {
+            'p_cliente_id': int(cliente_id),
+            'p_data': data_visita.isoformat(),
+            'p_tipo': tipo,
+            'p_testo': testo
+        }).execute()
+        risultato = resp.data if isinstance(resp.data, dict) else {}
+        campi = {'ultima_visita': risultato.get('ultima_visita') or data_visita.isoformat()}
+        aggiorna_cliente_locale(cliente_id, campi)
+        return campi
+    except APIError as e:
+        if not _rpc_mancante(e):
+            st.error(f"❌ Visita non registrata: {e.message or str(e)}")
+            return None
+    except Exception as e:
+        # Rete/timeout: la RPC potrebbe aver già salvato la visita
+        st.error(f"❌ Visita non confermata dal server ({str(e)[:120]}): controlla lo storico prima di riprovare")
+        return None
+    
+    # RPC non installata: insert + update separati (o vecchio blob se manca anche la tabella visite)
+    campi = {'ultima_visita': data_visita.isoformat()}
+    try:
+        supabase.table('visite').insert({
+            'cliente_id': int(cliente_id),
+            'agente_id': get_user_id(),
+            'data_visita': data_visita.isoformat(),
+            'tipo': tipo,
+            'testo': testo
+        }).execute()
+    except Exception:
+        campi = _campi_visita_storico(cliente_id, data_visita, tipo, testo)
+    return campi if update_cliente(cliente_id, campi) else None
+
+def fetch_visite_cliente(cliente_id, limite=VISITE_PER_PAGINA, offset=0):
+    """Pagina dello storico di un cliente (più recenti prima): (righe, totale), None se la tabella non è disponibile"""
+    try:
+        resp = supabase.table('visite').select('id,data_visita,tipo,testo', count='exact') \
+            .eq('cliente_id', int(cliente_id)) \
+            .order('data_visita', desc=True).order('id', desc=True) \
+            .range(offset, offset + limite - 1).execute()
+        return resp.data or [], resp.count or 0
+    except Exception:
+        return None
+
+def fetch_visite_periodo(data_da, data_a, pagina=1000, con_testo=False):
+    """Tutte le visite visibili nel periodo (cliente_id, data_visita, tipo e, con con_testo, testo),
+    None se la tabella non è disponibile"""
+    colonne = ['cliente_id', 'data_visita', 'tipo'] + (['testo'] if con_testo else [])
+    try:
+        righe = []
+        while True:
+            resp = supabase.table('visite').select(','.join(colonne)) \
+                .gte('data_visita', data_da.isoformat()).lte('data_visita', data_a.isoformat()) \
+                .order('data_visita', desc=True).order('id', desc=True) \
+                .range(len(righe), len(righe) + pagina - 1).execute()
+            blocco = resp.data or []
+            righe.extend(blocco)
+            if len(blocco) < pagina:
+                break
+        df_visite = pd.DataFrame(righe, columns=colonne)
+        df_visite['data_visita'] = pd.to_datetime(df_visite['data_visita'], errors='coerce')
+        return df_visite
+    except Exception:
+        return None
+
+def _voci_storico_migrate(pagina=1000):
+    """Righe già migrate (origine='storico'): {cliente_id: Counter((data_visita, tipo, testo))}"""
+    from collections import Counter
+    per_cliente, letti = {}, 0
+    while True:
+        resp = supabase.table('visite').select('cliente_id,data_visita,tipo,testo').eq('origine', 'storico') \
+            .order('id').range(letti, letti + pagina - 1).execute()
+        blocco = resp.data or []
+        for r in blocco:
+            per_cliente.setdefault(r['cliente_id'], Counter())[(str(r['data_visita'])[:10], r['tipo'], r['testo'])] += 1
+        letti += len(blocco)
+        if len(blocco) < pagina:
+            break
+    return per_cliente
+
+def migra_storico_report(df, progress=None):
+    """Migrazione una tantum dei blob storico_report nella tabella visite.
+    Un insert per cliente (una sola istruzione, quindi tutto o niente); il controllo di idempotenza
+    è per cliente: si inseriscono solo le voci che mancano, così un cliente rimasto a metà da
+    un'esecuzione precedente viene completato invece di essere considerato migrato.
+    Ritorna (clienti_migrati, visite_inserite)"""
+    gia_migrate = _voci_storico_migrate()
+    da_migrare = df[df['storico_report'].fillna('').astype(str).str.strip() != ''] if 'storico_report' in df.columns else df.iloc[0:0]
+    user_id = get_user_id()
+    oggi = ora_italiana.date()
+
+    clienti_migrati, inserite = 0, 0
+    for i, (cid, storico, ultima) in enumerate(zip(da_migrare['id'], da_migrare['storico_report'], da_migrare['ultima_visita'])):
+        presenti = gia_migrate.get(int(cid), {}).copy()
+        righe = []
+        for voce in parse_storico_report(storico):
+            data_voce = voce['data_visita']
+            if data_voce is None:
+                # Voce senza data leggibile: conservata come nota alla data dell'ultima visita
+                data_voce = ultima.date() if pd.notnull(ultima) else oggi
+            riga = {
+                'cliente_id': int(cid),
+                'agente_id': user_id,
+                'data_visita': data_voce.isoformat(),
+                'tipo': voce['tipo'] or ('VISITA' if voce['data_visita'] else 'NOTA'),
+                'testo': voce['testo'] if voce['data_visita'] or not voce['data_testo'] else f"[{voce['data_testo']}] {voce['testo']}",
+                'origine': 'storico'
+            }
+            chiave = (riga['data_visita'], riga['tipo'], riga['testo'])
+            if presenti.get(chiave, 0) > 0:
+                presenti[chiave] -= 1  # voce già migrata
+            else:
+                righe.append(riga)
+        if righe:
+            supabase.table('visite').insert(righe).execute()
+            inserite += len(righe)
+            clienti_migrati += 1
+        if progress is not None:
+            progress.progress((i + 1) / len(da_migrare))
+    return clienti_migrati, inserite
+
+def fetch_config(user_id=None):
     """Carica la configurazione dell'utente"""
     try:
-        user_id = get_user_id()
+        user_id = user_id or get_user_id()
         if not user_id:
             return None
         
@@ -921,11 +1439,11 @@ def save_scambi_giorni(scambi_dict):
     except Exception as e:
         return False
 
-def load_scambi_giorni():
+def load_scambi_giorni(user_id=None):
     """Carica scambi giorni da Supabase"""
     import json
     try:
-        user_id = get_user_id()
+        user_id = user_id or get_user_id()
         if not user_id:
             return {}
         resp = supabase.table('clienti').select('note').eq('user_id', user_id).eq('nome_cliente', '__SCAMBI_GIORNI__').execute()
@@ -941,21 +1459,31 @@ def check_scambi_column_exists():
     return True
 
 # --- PERSISTENZA GIRO DEL GIORNO ---
-def save_giro_giorno(data_str, client_ids, variante=0, esclusi=[]):
-    """Salva il giro del giorno su Supabase"""
+def save_giro_giorno(data_str, client_ids, variante=0, esclusi=[], route=None):
+    """Salva il giro del giorno su Supabase (con il percorso ottimizzato, se disponibile)"""
     import json
     try:
         user_id = get_user_id()
         if not user_id:
             return False
-        payload = json.dumps({
+        giro = {
             'v': 16,  # versione algoritmo — incrementare per invalidare giri vecchi
             'data': data_str,
             'ids': client_ids,
             'variante': variante,
             'esclusi': esclusi,
             'ts': datetime.now().isoformat()
-        })
+        }
+        # Percorso ottimizzato: valido solo per questa sequenza esatta di ids
+        if route and route.get('polyline'):
+            giro['route'] = {
+                'ids': list(client_ids),
+                'polyline': route.get('polyline', ''),
+                'duration_s': route.get('duration_s', 0),
+                'distance_m': route.get('distance_m', 0),
+                'legs': route.get('legs', [])
+            }
+        payload = json.dumps(giro)
         resp = supabase.table('clienti').select('id').eq('user_id', user_id).eq('nome_cliente', '__GIRO_SALVATO__').execute()
         if resp.data:
             supabase.table('clienti').update({'note': payload}).eq('id', resp.data[0]['id']).execute()
@@ -966,15 +1494,16 @@ def save_giro_giorno(data_str, client_ids, variante=0, esclusi=[]):
                 'visitare': 'NO',
                 'note': payload
             }).execute()
+        segna_giro_salvato_modificato()
         return True
     except:
         return False
 
-def load_giro_giorno(data_str):
+def load_giro_giorno(data_str, user_id=None):
     """Carica il giro salvato per la data specificata. Ritorna dict o None"""
     import json
     try:
-        user_id = get_user_id()
+        user_id = user_id or get_user_id()
         if not user_id:
             return None
         resp = supabase.table('clienti').select('note').eq('user_id', user_id).eq('nome_cliente', '__GIRO_SALVATO__').execute()
@@ -986,6 +1515,17 @@ def load_giro_giorno(data_str):
         pass
     return None
 
+def route_salvata_per_ids(giro, client_ids):
+    """Ritorna il percorso salvato col giro se è stato calcolato per la stessa sequenza di ids, altrimenti None"""
+    if not giro:
+        return None
+    route = giro.get('route')
+    if not route or not route.get('polyline'):
+        return None
+    if list(route.get('ids', [])) != list(client_ids):
+        return None  # le tappe sono cambiate → il percorso non è più valido
+    return route
+
 def ricostruisci_tappe_da_ids(df, client_ids, config):
     """Ricostruisce le tappe con orari dai client_ids salvati"""
     base_lat = float(config.get('lat_base', 41.9028))
@@ -1055,10 +1595,10 @@ def ricostruisci_tappe_da_ids(df, client_ids, config):
 
 # --- 3b. TEAM MANAGEMENT FUNCTIONS ---
 
-def get_user_team_info():
+def get_user_team_info(user_id=None):
     """Ritorna info team dell'utente: {ruolo, team_id, team_nome, ...} o None"""
     try:
-        user_id = get_user_id()
+        user_id = user_id or get_user_id()
         if not user_id:
             return None
         
@@ -1189,13 +1729,11 @@ def assegna_clienti_a_agente(cliente_ids, agente_id, team_id):
     """Assegna una lista di clienti a un agente"""
     try:
         user_id = get_user_id()
-        for cid in cliente_ids:
-            supabase.table('clienti').update({
-                'agente_id': agente_id,
-                'assegnato_da': user_id,
-                'data_assegnazione': datetime.now().isoformat()
-            }).eq('id', cid).execute()
-        return True
+        return update_clienti(cliente_ids, {
+            'agente_id': agente_id,
+            'assegnato_da': user_id,
+            'data_assegnazione': datetime.now().isoformat()
+        })
     except Exception as e:
         st.error(f"❌ Errore assegnazione: {str(e)}")
         return False
@@ -1203,22 +1741,19 @@ def assegna_clienti_a_agente(cliente_ids, agente_id, team_id):
 def rimuovi_assegnazione(cliente_ids):
     """Rimuove l'assegnazione di clienti (tornano non assegnati)"""
     try:
-        for cid in cliente_ids:
-            supabase.table('clienti').update({
-                'agente_id': None,
-                'assegnato_da': None,
-                'data_assegnazione': None
-            }).eq('id', cid).execute()
-        return True
+        return update_clienti(cliente_ids, {
+            'agente_id': None,
+            'assegnato_da': None,
+            'data_assegnazione': None
+        })
     except:
         return False
 
-def importa_clienti_team(df_import, team_id):
-    """Importa clienti nel team (dal responsabile)"""
-    try:
-        user_id = get_user_id()
-        count = 0
-        for _, row in df_import.iterrows():
+def righe_import_team(df_import, team_id, user_id):
+    """Elementi del job import_team (dal responsabile): un cliente per riga o {'_riga', '_errore'}"""
+    elementi = []
+    for idx, row in df_import.iterrows():
+        try:
             cliente_data = {
                 'user_id': user_id,
                 'team_id': team_id,
@@ -1232,7 +1767,8 @@ def importa_clienti_team(df_import, team_id):
                 'note': str(row.get('note', '')),
                 'visitare': str(row.get('visitare', 'SI')).upper(),
                 'frequenza_giorni': int(row.get('frequenza_giorni', 30)),
-                'stato_cliente': str(row.get('stato_cliente', 'CLIENTE ATTIVO'))
+                'stato_cliente': str(row.get('stato_cliente', 'CLIENTE ATTIVO')),
+                '_riga': idx + 2
             }
             # Geocodifica se ha coordinate
             lat = row.get('latitude', row.get('lat', 0))
@@ -1240,13 +1776,10 @@ def importa_clienti_team(df_import, team_id):
             if pd.notna(lat) and pd.notna(lon) and float(lat) != 0:
                 cliente_data['latitude'] = float(lat)
                 cliente_data['longitude'] = float(lon)
-            
-            supabase.table('clienti').insert(cliente_data).execute()
-            count += 1
-        return count
-    except Exception as e:
-        st.error(f"❌ Errore importazione: {str(e)}")
-        return 0
+            elementi.append(cliente_data)
+        except Exception as e:
+            elementi.append({'_riga': idx + 2, '_errore': f"Riga {idx+2}: {str(e)[:50]}"})
+    return elementi
 
 def get_obiettivi_team(team_id, periodo=None):
     """Carica obiettivi del team"""
@@ -1284,12 +1817,6 @@ def save_obiettivo(team_id, agente_id, periodo, tipo, valore_target):
 # --- 4. UTILITY FUNCTIONS ---
 ora_italiana = datetime.now() + timedelta(hours=1)
 
-def haversine(lat1, lon1, lat2, lon2):
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat, dlon = lat2 - lat1, lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    return 2 * 6371 * asin(sqrt(a))
-
 def calcola_km_tempo_giro(tappe, start_lat, start_lon, durata_visita_min=45, velocita_media_kmh=50):
     if not tappe:
         return 0, 0, 0
@@ -1358,6 +1885,7 @@ def get_clienti_trascurati(df, soglia_warning_giorni=7, soglia_critico_giorni=14
 
 def get_coords(address):
     """Geocodifica indirizzo -> coordinate usando LocationIQ (veloce!)"""
+    import requests
     try:
         url = "https://us1.locationiq.com/v1/search.php"
         params = {
@@ -1366,7 +1894,9 @@ def get_coords(address):
             'format': 'json',
             'limit': 1
         }
-        response = requests.get(url, params=params, timeout=10)
+        with misura_chiamata('locationiq', 'search', dettaglio=address) as m:
+            response = requests.get(url, params=params, timeout=10)
+            m['byte'] = len(response.content)
         if response.status_code == 200:
             data = response.json()
             if data:
@@ -1377,6 +1907,7 @@ def get_coords(address):
 
 def reverse_geocode(lat, lon):
     """Coordinate -> indirizzo usando LocationIQ (veloce!)"""
+    import requests
     try:
         url = "https://us1.locationiq.com/v1/reverse.php"
         params = {
@@ -1386,7 +1917,9 @@ def reverse_geocode(lat, lon):
             'format': 'json',
             'accept-language': 'it'
         }
-        response = requests.get(url, params=params, timeout=10)
+        with misura_chiamata('locationiq', 'reverse', dettaglio=f"{lat},{lon}") as m:
+            response = requests.get(url, params=params, timeout=10)
+            m['byte'] = len(response.content)
         if response.status_code == 200:
             data = response.json()
             addr = data.get('address', {})
@@ -1401,43 +1934,20 @@ def reverse_geocode(lat, lon):
     except:
         return None
 
-@st.cache_data(ttl=3600)  # Cache per 1 ora
 def get_route_osrm(waypoints):
     """
-    Ottiene il percorso stradale reale da OSRM (gratuito).
+    Ottiene il percorso stradale reale da OSRM (istanza in OSRM_URL).
     waypoints: lista di tuple (lat, lon)
     Ritorna: lista di coordinate del percorso stradale
     """
     if len(waypoints) < 2:
         return waypoints
     
-    try:
-        # Formato OSRM: lon,lat;lon,lat;...
-        coords_str = ";".join([f"{lon},{lat}" for lat, lon in waypoints])
-        
-        url = f"http://router.project-osrm.org/route/v1/driving/{coords_str}"
-        params = {
-            'overview': 'full',
-            'geometries': 'geojson'
-        }
-        
-        response = requests.get(url, params=params, timeout=15)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('code') == 'Ok' and data.get('routes'):
-                # Estrai le coordinate dal percorso GeoJSON
-                geometry = data['routes'][0]['geometry']
-                coords = geometry['coordinates']
-                # GeoJSON è [lon, lat], convertiamo in [lat, lon] per Folium
-                route_points = [(lat, lon) for lon, lat in coords]
-                return route_points
-        
-        # Fallback: ritorna i waypoints originali (linee rette)
-        return waypoints
-    except Exception as e:
-        # In caso di errore, usa linee rette
-        return waypoints
+    route = get_routing_backend('osrm').route(waypoints)
+    if route and route.get('polyline'):
+        return decode_google_polyline(route['polyline'])
+    # Fallback: ritorna i waypoints originali (linee rette)
+    return waypoints
 
 def batch_geocode(addresses, progress_callback=None):
     """Geocodifica multipla veloce"""
@@ -1450,1115 +1960,1629 @@ def batch_geocode(addresses, progress_callback=None):
         time_module.sleep(0.2)  # Rate limit LocationIQ free: 2 req/sec
     return results
 
-# --- GPS COMPONENT (FUNZIONANTE CON STREAMLIT) ---
-def render_gps_button(button_id, target_key="gps_coords"):
-    """
-    Componente GPS che comunica le coordinate a Streamlit tramite query params URL.
-    Le coordinate vengono scritte nell'URL e lette da Streamlit al prossimo rerun.
-    """
-    html_code = f"""
-    <div id="gps-container-{button_id}" style="width:100%; font-family: sans-serif;">
-        <button id="btn-{button_id}" onclick="getLocation_{button_id}()" 
-                style="padding:14px 24px; background:linear-gradient(135deg, #FF4B4B, #E63946); 
-                       color:white; border:none; border-radius:10px; cursor:pointer; 
-                       font-size:16px; width:100%; font-weight:700; 
-                       box-shadow: 0 4px 12px rgba(230,57,70,0.3); transition: all 0.3s;">
-            📍 Rileva Posizione GPS
-        </button>
-        <div id="status-{button_id}" style="margin-top:10px; font-size:14px; padding:10px; 
-                                            border-radius:8px; text-align:center; display:none;"></div>
-    </div>
-    
-    <script>
-    function getLocation_{button_id}() {{
-        const status = document.getElementById('status-{button_id}');
-        const btn = document.getElementById('btn-{button_id}');
-        status.style.display = 'block';
-        
-        if (!navigator.geolocation) {{
-            status.innerHTML = '❌ Geolocalizzazione non supportata dal browser';
-            status.style.backgroundColor = '#ffebee';
-            status.style.color = '#c62828';
-            return;
-        }}
-        
-        btn.disabled = true;
-        btn.style.opacity = '0.6';
-        btn.innerHTML = '⏳ Acquisizione in corso...';
-        status.innerHTML = '🔄 Attendo segnale GPS... (consenti l\\'accesso alla posizione)';
-        status.style.backgroundColor = '#fff3e0';
-        status.style.color = '#e65100';
-        
-        navigator.geolocation.getCurrentPosition(
-            function(position) {{
-                const lat = position.coords.latitude;
-                const lon = position.coords.longitude;
-                const acc = position.coords.accuracy;
-                
-                status.innerHTML = '✅ Posizione: ' + lat.toFixed(6) + ', ' + lon.toFixed(6) + ' (±' + Math.round(acc) + 'm)<br><b>Premi il pulsante qui sotto per confermare</b>';
-                status.style.backgroundColor = '#e8f5e9';
-                status.style.color = '#2e7d32';
-                btn.innerHTML = '✅ Posizione Acquisita';
-                btn.style.background = 'linear-gradient(135deg, #2e7d32, #4caf50)';
-                
-                // Scrivi coordinate nei query params dell'URL padre (Streamlit)
-                const url = new URL(window.parent.location.href);
-                url.searchParams.set('gps_lat', lat.toFixed(8));
-                url.searchParams.set('gps_lon', lon.toFixed(8));
-                url.searchParams.set('gps_acc', Math.round(acc).toString());
-                url.searchParams.set('gps_ts', Date.now().toString());
-                window.parent.history.replaceState(null, '', url.toString());
-            }},
-            function(error) {{
-                let msg = '❌ ';
-                switch(error.code) {{
-                    case 1: msg += 'Permesso negato. Consenti la posizione nelle impostazioni del browser.'; break;
-                    case 2: msg += 'Posizione non disponibile. Verifica che il GPS sia attivo.'; break;
-                    case 3: msg += 'Timeout. Riprova in un luogo con migliore segnale GPS.'; break;
-                    default: msg += 'Errore sconosciuto.';
-                }}
-                status.innerHTML = msg;
-                status.style.backgroundColor = '#ffebee';
-                status.style.color = '#c62828';
-                btn.disabled = false;
-                btn.style.opacity = '1';
-                btn.innerHTML = '📍 Rileva Posizione GPS';
-                btn.style.background = 'linear-gradient(135deg, #FF4B4B, #E63946)';
-            }},
-            {{ 
-                enableHighAccuracy: true, 
-                timeout: 30000, 
-                maximumAge: 0 
-            }}
-        );
-    }}
-    </script>
-    """
-    return st.components.v1.html(html_code, height=130)
+# --- MAPPE: OGGETTI FOLIUM RIUSABILI TRA I RERUN ---
+@st.cache_resource
+def _classe_mappa_renderizzata():
+    """Classe creata al primo uso, così folium si importa solo quando serve una mappa"""
+    import folium
 
-def read_gps_from_url():
-    """Legge le coordinate GPS dai query params (scritti dal componente JS)"""
-    try:
-        lat = st.query_params.get("gps_lat")
-        lon = st.query_params.get("gps_lon")
-        acc = st.query_params.get("gps_acc")
-        ts = st.query_params.get("gps_ts")
-        
-        if lat and lon:
-            return {
-                'latitude': float(lat),
-                'longitude': float(lon),
-                'accuracy': int(acc) if acc else None,
-                'timestamp': int(ts) if ts else None
-            }
-    except (ValueError, TypeError):
-        pass
+    class MappaRenderizzata(folium.Map):
+        """
+        folium.Map che si renderizza una sola volta.
+        Il render di folium non è idempotente (Marker.render aggiunge un SetIcon a ogni chiamata),
+        quindi una mappa riusata cambierebbe HTML a ogni rerun e st_folium la ricaricherebbe.
+        """
+        renderizzata = False
+
+        def render(self, **kwargs):
+            if self.renderizzata:
+                return
+            super().render(**kwargs)
+            self.renderizzata = True
+
+    return MappaRenderizzata
+
+def mappa_renderizzata(**kwargs):
+    """Nuova MappaRenderizzata (stessi argomenti di folium.Map)"""
+    return _classe_mappa_renderizzata()(**kwargs)
+
+def mappa_da_cache(nome, chiave):
+    """Mappa già costruita (session_state) se la chiave non è cambiata, altrimenti None"""
+    memo = st.session_state.get(f"_mappa_cache_{nome}")
+    if memo is not None and memo[0] == chiave:
+        return memo[1]
     return None
 
-def clear_gps_from_url():
-    """Rimuove i dati GPS dall'URL mantenendo gli altri params"""
-    for key in ['gps_lat', 'gps_lon', 'gps_acc', 'gps_ts']:
-        if key in st.query_params:
-            del st.query_params[key]
+def salva_mappa_cache(nome, chiave, m):
+    """Tiene in session_state l'ultima mappa costruita per questa vista"""
+    st.session_state[f"_mappa_cache_{nome}"] = (chiave, m)
 
-# --- 5. CALCOLO GIRO OTTIMIZZATO (v8 — CLUSTER CITTÀ + ANELLI) ---
-def calcola_agenda_settimanale(df, config, esclusi=[], settimana_offset=0, variante=0):
+# --- MAPPA CLIENTI: URGENZA VETTORIALE E LAYER GEOJSON ---
+# Colori marker (stessi toni delle icone folium) per i layer disegnati lato client
+COLORI_MARKER = {'red': '#d63e2a', 'orange': '#f69730', 'green': '#72b026', 'blue': '#38aadd', 'lightgray': '#a3a3a3'}
+SOGLIA_MARKER_GEOJSON = 300  # oltre questo numero di clienti la mappa usa un unico layer GeoJSON
+
+def haversine_np(lat1, lon1, lats, lons):
+    """Haversine vettoriale: distanza in km da un punto a un array di punti"""
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lats, lons = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+    a = np.sin((lats - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lats) * np.sin((lons - lon1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * 6371
+
+def classifica_urgenza_clienti(df, oggi=None):
     """
-    ALGORITMO v10 — K-Means geografico + appuntamento come baricentro.
-    
-    1. Pool: clienti scaduti o in scadenza entro 10 giorni + mai visitati
-    2. APPUNTAMENTO = BARICENTRO: se c'è un appuntamento, quel giorno prende
-       i clienti del pool PIÙ VICINI all'appuntamento (ignora le zone)
-    3. GIORNI SENZA APP: K-Means su pool rimanente → zone compatte
-    4. Google Maps ottimizza l'ORDINE dentro ogni giorno (TSP + polyline)
-    5. Rotazione settimanale zone ↔ giorni
+    Categoria di urgenza di ogni cliente in un colpo solo (niente iterrows).
+    Ritorna un DataFrame (stesso index di df) con: cat, ritardo_gg, color, badge, stato
     """
-    if df.empty:
-        return {}
-    
-    from collections import defaultdict
-    from math import atan2, degrees as math_degrees
-    import random as _rnd
-    
-    base_lat = float(config.get('lat_base', 41.9028))
-    base_lon = float(config.get('lon_base', 12.4964))
-    durata_visita = int(config.get('durata_visita', 45))
-    giorni_lavorativi = config.get('giorni_lavorativi', [0, 1, 2, 3, 4])
+    if oggi is None:
+        oggi = ora_italiana.date()
+    ultima = pd.to_datetime(df['ultima_visita'], errors='coerce')
+    if getattr(ultima.dt, 'tz', None) is not None:
+        ultima = ultima.dt.tz_localize(None)
+    freq = pd.to_numeric(df['frequenza_giorni'], errors='coerce').fillna(30).astype(int) if 'frequenza_giorni' in df.columns else 30
+    mai = (ultima.isna() | (ultima.dt.year < 2001)).to_numpy()
+    prossima = ultima.dt.normalize() + pd.to_timedelta(freq, unit='D')
+    ritardo = (pd.Timestamp(oggi) - prossima).dt.days.fillna(0).astype(int).to_numpy().copy()
+    ritardo[mai] = 0
+    fuori = (df['visitare'].astype(str).str.upper() != 'SI').to_numpy() if 'visitare' in df.columns else np.zeros(len(df), dtype=bool)
     
-    if isinstance(giorni_lavorativi, str):
-        giorni_lavorativi = [int(x) for x in giorni_lavorativi.strip('{}').split(',')]
+    cat = np.select([mai, ritardo > 0, ritardo >= -7], ["🔵 Mai visitati", "🔴 In ritardo", "🟡 In scadenza"], "🟢 In regola")
+    color = np.select([fuori, mai, ritardo > 0, ritardo >= -7], ['lightgray', 'blue', 'red', 'orange'], 'green')
+    badge = np.select([fuori, mai, ritardo > 0, ritardo >= -7], ["⚪", "🔵", "🔴", "🟡"], "🟢")
+    stato = np.where(fuori, "Fuori giro",
+             np.where(mai, "Mai visitato",
+             np.where(ritardo > 0, np.char.add(np.char.add("In ritardo di ", ritardo.astype(str)), "gg"),
+             np.where(ritardo >= -7, np.char.add(np.char.add("Scade tra ", np.abs(ritardo).astype(str)), "gg"),
+                      np.char.add(np.char.add("OK (tra ", np.abs(ritardo).astype(str)), "gg)")))))
+    return pd.DataFrame({'cat': cat, 'ritardo_gg': ritardo, 'color': color, 'badge': badge, 'stato': stato}, index=df.index)
+
+def costruisci_geojson_clienti(df_map):
+    """FeatureCollection dei clienti (df_map deve avere distanza_km, color, badge, stato)"""
+    features = []
+    for r in df_map[['id', 'nome_cliente', 'indirizzo', 'latitude', 'longitude', 'distanza_km', 'color', 'badge', 'stato']].itertuples(index=False):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(float(r.longitude), 6), round(float(r.latitude), 6)]},
+            'properties': {
+                'id': r.id,
+                'nome': r.nome_cliente,
+                'indirizzo': r.indirizzo if isinstance(r.indirizzo, str) else '',
+                'distanza': f"{r.distanza_km:.1f} km da te",
+                'stato': f"{r.badge} {r.stato}",
+                'color': r.color
+            }
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+def aggiungi_layer_clienti(m, df_map, modalita='marker'):
+    """Aggiunge i clienti alla mappa: un Marker per riga oppure un unico layer GeoJSON (popup costruiti dal browser)"""
+    import folium
+    if modalita == 'geojson':
+        folium.GeoJson(
+            costruisci_geojson_clienti(df_map),
+            name="Clienti",
+            marker=folium.CircleMarker(radius=7, weight=1, fill=True, fill_opacity=0.85),
+            style_function=lambda f: {
+                'color': COLORI_MARKER.get(f['properties']['color'], '#38aadd'),
+                'fillColor': COLORI_MARKER.get(f['properties']['color'], '#38aadd')
+            },
+            tooltip=folium.GeoJsonTooltip(fields=['nome', 'distanza'], labels=False),
+            popup=folium.GeoJsonPopup(fields=['nome', 'indirizzo', 'distanza', 'stato'], labels=False, max_width=250)
+        ).add_to(m)
+        return
     
-    # Ferie
-    ferie_attive = config.get('attiva_ferie', False)
-    ferie_inizio, ferie_fine = None, None
-    if ferie_attive:
-        try:
-            fi, ff = config.get('ferie_inizio'), config.get('ferie_fine')
-            if fi:
-                ferie_inizio = datetime.strptime(str(fi)[:10], '%Y-%m-%d').date() if isinstance(fi, str) else (fi.date() if hasattr(fi, 'date') else fi)
-            if ff:
-                ferie_fine = datetime.strptime(str(ff)[:10], '%Y-%m-%d').date() if isinstance(ff, str) else (ff.date() if hasattr(ff, 'date') else ff)
-        except:
-            pass
+    for r in df_map.itertuples(index=False):
+        ind_c = r.indirizzo if isinstance(r.indirizzo, str) else ''
+        popup_html = f"""<div style="min-width:180px;font-size:13px;">
+        <b>{r.nome_cliente}</b><br>
+        📍 {ind_c}<br>
+        🚗 {r.distanza_km:.1f} km da te<br>
+        {r.badge} {r.stato}
+        </div>"""
+        folium.Marker(
+            [r.latitude, r.longitude],
+            popup=folium.Popup(popup_html, max_width=250),
+            tooltip=f"{r.nome_cliente} ({r.distanza_km:.1f}km)",
+            icon=folium.Icon(color=r.color, icon='briefcase', prefix='fa')
+        ).add_to(m)
+
+# --- MAPPA CLIENTI: INDICE SPAZIALE E CARICAMENTO PER AREA VISIBILE ---
+SOGLIA_VIEWPORT = 2000     # oltre questo numero di clienti la mappa carica solo l'area visibile
+CELLA_INDICE_GRADI = 0.05  # lato cella dell'indice spaziale (~5 km)
+ZOOM_DETTAGLIO_MAPPA = 11  # sotto questo zoom si mostrano i conteggi per cella
+MAX_MARKER_VIEWPORT = 800  # oltre, anche a zoom alto si aggrega (celle più fini)
+
+def _memo_sessione(nome, versione, fn):
+    """Memoizza in session_state il risultato di fn() finché la versione non cambia"""
+    chiave = f"_memo_{nome}"
+    memo = st.session_state.get(chiave)
+    if memo is not None and memo[0] == versione:
+        return memo[1]
+    valore = fn()
+    st.session_state[chiave] = (versione, valore)
+    return valore
+
+# --- DATI DERIVATI PER TAB (lazy) ---
+# Ogni tab chiede solo quello che usa; i valori restano in sessione finché non cambiano
+# i dati (df_version), la data o il giro salvato. Config e Nuovo Cliente non pagano
+# il pianificatore né il giro salvato.
+def segna_giro_salvato_modificato():
+    st.session_state._giro_salvato_versione = st.session_state.get('_giro_salvato_versione', 0) + 1
+
+def nomi_visitati_il(df, data_str):
+    """Nomi dei clienti con ultima_visita nel giorno data_str ('%Y-%m-%d')"""
+    if df.empty or 'ultima_visita' not in df.columns:
+        return []
+    uv = df['ultima_visita']
+    if not pd.api.types.is_datetime64_any_dtype(uv):
+        uv = pd.to_datetime(uv, errors='coerce')
+    return df.loc[(uv.dt.strftime('%Y-%m-%d') == data_str).to_numpy(), 'nome_cliente'].tolist()
+
+def dati_visitati_oggi(df):
+    """Lista visitati_oggi in sessione, completata con i clienti che risultano visitati oggi su df"""
+    oggi_str = ora_italiana.strftime('%Y-%m-%d')
+    da_db = _memo_sessione('visitati_oggi', (st.session_state.get('df_version', 0), oggi_str),
+                           lambda: nomi_visitati_il(df, oggi_str))
+    visitati = st.session_state.setdefault('visitati_oggi', [])
+    gia = set(visitati)
+    visitati.extend(n for n in da_db if n not in gia)
+    return visitati
+
+def dati_giro_salvato(data_str):
+    """Giro salvato per data_str (load_giro_giorno), riletto solo dopo un salvataggio o una sincronizzazione"""
+    versione = st.session_state.get('_giro_salvato_versione', 0)
+    return _memo_sessione(f'giro_salvato_{data_str}', versione, lambda: load_giro_giorno(data_str))
+
+def dati_scambi_giorni():
+    """Scambi giorni in sessione (caricati da Supabase al primo accesso)"""
+    if 'scambi_giorni' not in st.session_state:
+        st.session_state.scambi_giorni = load_scambi_giorni()
+    return st.session_state.scambi_giorni
+
+def dati_agenda_settimana(df, config, esclusi, settimana_offset):
+    """Agenda della settimana (calcola_agenda_settimanale) memoizzata; ritorna una copia modificabile"""
+    routing = get_routing_backend_pianificazione()
+    versione = (st.session_state.get('df_version', 0), repr(sorted(config.items())), tuple(esclusi),
+                settimana_offset, ora_italiana.date().isoformat())
+
+    def calcola():
+        traccia = {}
+        agenda = calcola_agenda_settimanale(df, config, list(esclusi), settimana_offset, routing=routing,
+                                            oggi=ora_italiana.date(), traccia=traccia)
+        memorizza_traccia_pianificatore("📅 Agenda", traccia, esclusi=esclusi)
+        return agenda
     
-    # Orari
-    def get_time(val, default):
-        if val is None: return default
-        if isinstance(val, str):
-            try: return datetime.strptime(val[:5], '%H:%M').time()
-            except: return default
-        return val if hasattr(val, 'hour') else default
+    agenda = _memo_sessione('agenda_settimana', versione, calcola)
+    return {g: [dict(t) for t in tappe] for g, tappe in agenda.items()}
+
+def costruisci_indice_spaziale(df, cella=CELLA_INDICE_GRADI):
+    """Indice a griglia sui clienti geolocalizzati: {(ix, iy): array di etichette dell'index di df}"""
+    lat = pd.to_numeric(df['latitude'], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(df['longitude'], errors='coerce').to_numpy(dtype=float)
+    ok = np.isfinite(lat) & np.isfinite(lon) & (lat != 0) & (lon != 0)
+    etichette = df.index.to_numpy()[ok]
+    ix = np.floor(lat[ok] / cella).astype(np.int64)
+    iy = np.floor(lon[ok] / cella).astype(np.int64)
+    ordine = np.lexsort((iy, ix))
+    ix, iy, etichette = ix[ordine], iy[ordine], etichette[ordine]
+    cambi = np.flatnonzero((np.diff(ix) != 0) | (np.diff(iy) != 0)) + 1
+    celle = {}
+    for inizio, fine in zip(np.r_[0, cambi], np.r_[cambi, len(ix)]):
+        if fine > inizio:
+            celle[(int(ix[inizio]), int(iy[inizio]))] = etichette[inizio:fine]
+    return {'cella': cella, 'celle': celle}
+
+def cerca_in_bounds(indice, sud, ovest, nord, est):
+    """Etichette dei clienti nelle celle dell'indice che intersecano il riquadro"""
+    c = indice['cella']; celle = indice['celle']
+    ix0, ix1 = math.floor(sud / c), math.floor(nord / c)
+    iy0, iy1 = math.floor(ovest / c), math.floor(est / c)
+    if (ix1 - ix0 + 1) * (iy1 - iy0 + 1) > len(celle):
+        trovate = [v for (ix, iy), v in celle.items() if ix0 <= ix <= ix1 and iy0 <= iy <= iy1]
+    else:
+        trovate = [celle[(ix, iy)] for ix in range(ix0, ix1 + 1) for iy in range(iy0, iy1 + 1) if (ix, iy) in celle]
+    return np.concatenate(trovate) if trovate else np.array([], dtype=object)
+
+def bounds_da_mappa(map_state):
+    """(sud, ovest, nord, est) dai bounds restituiti da st_folium, o None"""
+    try:
+        b = map_state['bounds']
+        sud, ovest = float(b['_southWest']['lat']), float(b['_southWest']['lng'])
+        nord, est = float(b['_northEast']['lat']), float(b['_northEast']['lng'])
+        if nord <= sud or est <= ovest:
+            return None
+        return (sud, ovest, nord, est)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def aggrega_per_cella(df_map, cella):
+    """Clienti raggruppati per cella: centroide, numero clienti, quanti in ritardo"""
+    g = pd.DataFrame({
+        'ix': np.floor(df_map['latitude'].to_numpy(dtype=float) / cella).astype(np.int64),
+        'iy': np.floor(df_map['longitude'].to_numpy(dtype=float) / cella).astype(np.int64),
+        'lat': df_map['latitude'].to_numpy(dtype=float),
+        'lon': df_map['longitude'].to_numpy(dtype=float),
+        'ritardo': (df_map['cat'] == "🔴 In ritardo").to_numpy() if 'cat' in df_map.columns else False
+    })
+    return g.groupby(['ix', 'iy']).agg(lat=('lat', 'mean'), lon=('lon', 'mean'), n=('lat', 'size'), in_ritardo=('ritardo', 'sum')).reset_index()
+
+def layer_clienti_viewport(df_vis, zoom):
+    """FeatureGroup con i clienti dell'area visibile: conteggi per cella da lontano, marker da vicino"""
+    import folium
+    fg = folium.FeatureGroup(name="Clienti")
+    if zoom >= ZOOM_DETTAGLIO_MAPPA and len(df_vis) <= MAX_MARKER_VIEWPORT:
+        aggiungi_layer_clienti(fg, df_vis, 'geojson' if len(df_vis) > SOGLIA_MARKER_GEOJSON else 'marker')
+        return fg
     
-    ora_inizio = get_time(config.get('h_inizio'), time(9, 0))
-    ora_fine = get_time(config.get('h_fine'), time(18, 0))
-    pausa_da = get_time(config.get('pausa_inizio'), time(13, 0))
-    pausa_a = get_time(config.get('pausa_fine'), time(14, 0))
+    # Celle di circa 64 px (32 px se siamo già vicini ma i clienti sono troppi)
+    px = 64 if zoom < ZOOM_DETTAGLIO_MAPPA else 32
+    cella = px * 360 / (256 * 2 ** zoom)
+    for r in aggrega_per_cella(df_vis, cella).itertuples(index=False):
+        if r.n == 1:
+            folium.CircleMarker([r.lat, r.lon], radius=5, weight=1, color='#38aadd', fill=True, fill_opacity=0.8).add_to(fg)
+            continue
+        colore = COLORI_MARKER['red'] if r.in_ritardo else COLORI_MARKER['blue']
+        lato = int(min(56, 22 + 6 * math.log10(r.n) * 2))
+        folium.Marker(
+            [r.lat, r.lon],
+            tooltip=f"{r.n} clienti ({int(r.in_ritardo)} in ritardo) — zoom per i dettagli",
+            icon=folium.DivIcon(
+                icon_size=(lato, lato), icon_anchor=(lato // 2, lato // 2),
+                html=f'<div style="width:{lato}px;height:{lato}px;border-radius:50%;background:{colore};opacity:0.85;'
+                     f'color:white;font-weight:bold;font-size:12px;display:flex;align-items:center;justify-content:center;'
+                     f'border:2px solid white;">{r.n}</div>'
+            )
+        ).add_to(fg)
+    return fg
+
+# --- MAPPA CLIENTI: GRIGLIA DI COPERTURA (HEATMAP / CHOROPLETH) ---
+RISOLUZIONI_GRIGLIA = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5)  # lato cella in gradi (~1 km … ~50 km)
+
+def _righe_copertura(df, oggi):
+    """Per ogni cliente geolocalizzato: coordinate, in ritardo (0/1), indice di urgenza e cella a ogni risoluzione"""
+    lat = pd.to_numeric(df['latitude'], errors='coerce')
+    lon = pd.to_numeric(df['longitude'], errors='coerce')
+    ok = lat.notna() & lon.notna() & (lat != 0) & (lon != 0)
+    d = df[ok]
+    lat, lon = lat[ok].to_numpy(dtype=float), lon[ok].to_numpy(dtype=float)
+    urg = classifica_urgenza_clienti(d, oggi)
+    freq = pd.to_numeric(d['frequenza_giorni'], errors='coerce').fillna(30).clip(lower=1).to_numpy(dtype=float)
+    mai = (urg['cat'] == "🔵 Mai visitati").to_numpy()
+    nel_giro = (d['visitare'].astype(str).str.upper() == 'SI').to_numpy()
+    # Indice urgenza: 1 = visita dovuta oggi, 2 = un periodo di ritardo (mai visitati = 2)
+    indice = np.where(mai, 2.0, np.clip(1 + urg['ritardo_gg'].to_numpy() / freq, 0, 3))
+    righe = pd.DataFrame({
+        'lat': lat, 'lon': lon,
+        'in_ritardo': ((urg['cat'] == "🔴 In ritardo").to_numpy() & nel_giro).astype(int),
+        'urg': indice
+    }, index=d['id'].to_numpy())
+    for res in RISOLUZIONI_GRIGLIA:
+        righe[f'ix_{res}'] = np.floor(lat / res).astype(np.int64)
+        righe[f'iy_{res}'] = np.floor(lon / res).astype(np.int64)
+    return righe
+
+def _aggrega_righe(righe, res):
+    """Somme per cella (n, in ritardo, somma urgenza) delle righe alla risoluzione res"""
+    if righe.empty:
+        # Stessi nomi di indice delle celle piene: sub()/add() devono potersi allineare
+        vuoto = np.array([], dtype=np.int64)
+        return pd.DataFrame(columns=['n', 'in_ritardo', 'somma_urg'], dtype=float,
+                            index=pd.MultiIndex.from_arrays([vuoto, vuoto], names=['ix', 'iy']))
+    g = righe.groupby([f'ix_{res}', f'iy_{res}'])
+    out = pd.DataFrame({'n': g.size(), 'in_ritardo': g['in_ritardo'].sum(), 'somma_urg': g['urg'].sum()})
+    out.index.names = ['ix', 'iy']
+    return out.astype(float)
+
+def aggiorna_griglia_copertura(df, stato=None, oggi=None):
+    """
+    Griglia di copertura a più risoluzioni, aggiornata in modo incrementale:
+    confronta la firma di ogni cliente con quella precedente e applica solo le differenze alle celle.
+    """
+    if oggi is None:
+        oggi = ora_italiana.date()
+    colonne_firma = [c for c in ('latitude', 'longitude', 'ultima_visita', 'frequenza_giorni', 'visitare') if c in df.columns]
+    firme = pd.Series(pd.util.hash_pandas_object(df[colonne_firma], index=False).to_numpy(), index=df['id'].to_numpy())
     
-    oggi = ora_italiana.date()
-    lunedi = oggi - timedelta(days=oggi.weekday()) + timedelta(weeks=settimana_offset)
-    fine_settimana = lunedi + timedelta(days=6)
+    if stato is None or stato.get('oggi') != oggi:
+        # Primo calcolo (o cambio giorno: cambia l'urgenza di tutti)
+        righe = _righe_copertura(df, oggi)
+        return {
+            'oggi': oggi, 'firme': firme, 'righe': righe,
+            'celle': {res: _aggrega_righe(righe, res) for res in RISOLUZIONI_GRIGLIA},
+            'modificati': len(firme)
+        }
     
-    agenda = {g: [] for g in range(7)}
+    vecchie = stato['firme']
+    comuni = vecchie.index.intersection(firme.index)
+    cambiati = comuni[vecchie.loc[comuni].to_numpy() != firme.loc[comuni].to_numpy()]
+    rimossi = vecchie.index.difference(firme.index).union(cambiati)
+    aggiunti = firme.index.difference(vecchie.index).union(cambiati)
+    if len(rimossi) == 0 and len(aggiunti) == 0:
+        return dict(stato, firme=firme, modificati=0)
     
-    # Parametri temporali per simulazione giro
-    ore_disponibili = (datetime.combine(oggi, ora_fine) - datetime.combine(oggi, ora_inizio)).seconds / 60  # in minuti
-    pausa_min = (datetime.combine(oggi, pausa_a) - datetime.combine(oggi, pausa_da)).seconds / 60
-    minuti_lavoro = ore_disponibili - pausa_min  # minuti netti
-    velocita_media = 50  # km/h media stradale
+    righe_vecchie = stato['righe'][stato['righe'].index.isin(rimossi)]
+    righe_nuove = _righe_copertura(df[df['id'].isin(aggiunti)], oggi)
+    celle = {}
+    for res in RISOLUZIONI_GRIGLIA:
+        c = stato['celle'][res].sub(_aggrega_righe(righe_vecchie, res), fill_value=0)
+        c = c.add(_aggrega_righe(righe_nuove, res), fill_value=0)
+        celle[res] = c[c['n'] > 0]
+    righe = pd.concat([stato['righe'][~stato['righe'].index.isin(rimossi)], righe_nuove])
+    return {'oggi': oggi, 'firme': firme, 'righe': righe, 'celle': celle, 'modificati': len(rimossi.union(aggiunti))}
+
+def get_griglia_copertura(df):
+    """Griglia di copertura allineata alla versione corrente dei dati (session_state)"""
+    versione = st.session_state.get('df_version', 0)
+    stato = st.session_state.get('_griglia_copertura')
+    if stato is None or stato.get('versione') != versione:
+        stato = aggiorna_griglia_copertura(df, stato)
+        stato['versione'] = versione
+        st.session_state._griglia_copertura = stato
+    return stato
+
+def risoluzione_per_zoom(zoom, px=40):
+    """Risoluzione della griglia con celle di circa `px` pixel allo zoom indicato"""
+    target = px * 360 / (256 * 2 ** zoom)
+    return min(RISOLUZIONI_GRIGLIA, key=lambda r: abs(math.log(r / target)))
+
+def aggiungi_layer_copertura(m, griglia, tipo, zoom):
+    """Overlay di copertura: heatmap (tutti / in ritardo) o griglia colorata per urgenza media"""
+    import folium
+    from folium.plugins import HeatMap
+    import branca.colormap as cm
+    res = risoluzione_per_zoom(zoom)
+    celle = griglia['celle'][res]
+    if celle.empty:
+        return
+    ix = celle.index.get_level_values('ix').to_numpy()
+    iy = celle.index.get_level_values('iy').to_numpy()
+    lat_c = (ix + 0.5) * res
+    lon_c = (iy + 0.5) * res
     
-    # Stima visite/giorno per calcoli intermedi (il vero limite è il tempo simulato)
-    max_visite = max(4, int(minuti_lavoro / (durata_visita + 15)))  # 15min spostamento medio
+    if tipo in ('heatmap', 'heatmap_ritardo'):
+        peso = celle['n'].to_numpy() if tipo == 'heatmap' else celle['in_ritardo'].to_numpy()
+        sel = peso > 0
+        if not sel.any():
+            return
+        dati = np.column_stack([lat_c[sel], lon_c[sel], peso[sel] / peso[sel].max()]).round(5).tolist()
+        HeatMap(dati, name="Copertura", radius=18, blur=22, min_opacity=0.25).add_to(m)
+        return
     
-    # ========================================
-    # 1. RACCOGLI CLIENTI + PARSE APPUNTAMENTI
-    # ========================================
-    tutti = []
-    for _, r in df.iterrows():
-        if str(r.get('visitare', 'SI')).upper() != 'SI':
-            continue
-        if r['nome_cliente'] in esclusi:
+    scala = cm.LinearColormap(['#72b026', '#f69730', '#d63e2a'], vmin=0, vmax=2, caption="Urgenza media (1 = visita dovuta)")
+    media = (celle['somma_urg'] / celle['n']).to_numpy()
+    features = []
+    for la, lo, n, rit, u in zip(ix * res, iy * res, celle['n'].to_numpy(), celle['in_ritardo'].to_numpy(), media):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[
+                [round(lo, 5), round(la, 5)], [round(lo + res, 5), round(la, 5)],
+                [round(lo + res, 5), round(la + res, 5)], [round(lo, 5), round(la + res, 5)], [round(lo, 5), round(la, 5)]
+            ]]},
+            'properties': {'clienti': int(n), 'in_ritardo': int(rit), 'urgenza': round(float(u), 2), 'colore': scala(min(float(u), 2))}
+        })
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        name="Copertura",
+        style_function=lambda f: {'fillColor': f['properties']['colore'], 'color': f['properties']['colore'],
+                                  'weight': 0.5, 'fillOpacity': 0.35},
+        tooltip=folium.GeoJsonTooltip(fields=['clienti', 'in_ritardo', 'urgenza'],
+                                      aliases=['Clienti', 'In ritardo', 'Urgenza media'])
+    ).add_to(m)
+    scala.add_to(m)
+
+# --- RICERCA CLIENTI (indice trigrammi + prefissi, aggiornamento incrementale) ---
+CAMPI_RICERCA = ('nome_cliente', 'indirizzo', 'citta', 'telefono', 'cellulare', 'contatto')
+# Tetto delle espansioni per prefisso: la parola che genera i candidati ne raccoglie al massimo
+# tanti (le altre li filtrano), e una parola con più token di così ('0', '051'...) non cerca
+# anche per trigrammi
+MAX_CANDIDATI_PREFISSO = 500
+
+def normalizza_testo_ricerca(testo):
+    """Minuscolo, senza accenti, solo lettere/numeri separati da spazi"""
+    import unicodedata
+    testo = unicodedata.normalize('NFKD', str(testo or '')).encode('ascii', 'ignore').decode('ascii').lower()
+    return re.sub(r'[^a-z0-9]+', ' ', testo).strip()
+
+def _trigrammi(token):
+    t = f"  {token} "
+    return {t[i:i + 3] for i in range(len(t) - 2)}
+
+def _token_documento(row):
+    """Token del cliente: (token del nome, tutti i token). I telefoni sono indicizzati anche come sole cifre.
+    I campi vuoti (None/NaN) non producono token: niente 'nan' nel vocabolario."""
+    nome_cliente = row.get('nome_cliente')
+    nome = set(normalizza_testo_ricerca(nome_cliente).split()) if pd.notna(nome_cliente) else set()
+    tutti = set(nome)
+    for campo in CAMPI_RICERCA[1:]:
+        valore = row.get(campo)
+        if not pd.notna(valore):
             continue
-        lat, lon = r.get('latitude'), r.get('longitude')
-        if pd.isna(lat) or pd.isna(lon) or lat == 0 or lon == 0:
+        tutti.update(normalizza_testo_ricerca(valore).split())
+        if campo in ('telefono', 'cellulare'):
+            cifre = re.sub(r'\D', '', str(valore))
+            if cifre:
+                tutti.add(cifre)
+    return nome, tutti
+
+def _indice_aggiungi(indice, cid, nome_cliente, token_nome, token_tutti, firma):
+    import bisect
+    indice['docs'][cid] = (nome_cliente, token_nome, token_tutti, firma)
+    for tok in token_tutti:
+        if tok not in indice['token']:
+            indice['token'][tok] = {}
+            bisect.insort(indice['token_ordinati'], tok)
+            for tri in _trigrammi(tok):
+                indice['trigrammi'].setdefault(tri, set()).add(tok)
+        indice['token'][tok][cid] = tok in token_nome  # True se il token viene dal nome
+
+def _indice_rimuovi(indice, cid):
+    import bisect
+    doc = indice['docs'].pop(cid, None)
+    if not doc:
+        return
+    for tok in doc[2]:
+        ids = indice['token'].get(tok)
+        if ids is None:
             continue
+        ids.pop(cid, None)
+        if ids:
+            continue
+        # Token non più usato da nessun cliente: fuori dal vocabolario
+        del indice['token'][tok]
+        i = bisect.bisect_left(indice['token_ordinati'], tok)
+        if i < len(indice['token_ordinati']) and indice['token_ordinati'][i] == tok:
+            indice['token_ordinati'].pop(i)
+        for tri in _trigrammi(tok):
+            toks = indice['trigrammi'].get(tri)
+            if toks is not None:
+                toks.discard(tok)
+                if not toks:
+                    del indice['trigrammi'][tri]
+
+def aggiorna_indice_ricerca(df, indice=None):
+    """Crea o aggiorna l'indice: reindicizza solo i clienti nuovi/modificati (firma per riga) e toglie quelli spariti"""
+    if indice is None:
+        indice = {'docs': {}, 'token': {}, 'token_ordinati': [], 'trigrammi': {}, 'modificati': 0}
+    if df.empty:
+        for cid in list(indice['docs']):
+            _indice_rimuovi(indice, cid)
+        return indice
+    campi = [c for c in CAMPI_RICERCA if c in df.columns]
+    firme = pd.util.hash_pandas_object(df[campi].astype(str), index=False).to_numpy()
+    ids = df['id'].tolist()
+    presenti = set(ids)
+    modificati = 0
+    for cid in [c for c in indice['docs'] if c not in presenti]:
+        _indice_rimuovi(indice, cid)
+        modificati += 1
+    docs = indice['docs']
+    da_indicizzare = [i for i, (cid, firma) in enumerate(zip(ids, firme)) if cid not in docs or docs[cid][3] != firma]
+    righe = df[campi].iloc[da_indicizzare].to_dict('records')
+    for i, row in zip(da_indicizzare, righe):
+        cid, firma = ids[i], firme[i]
+        if cid in docs:
+            _indice_rimuovi(indice, cid)
+        token_nome, token_tutti = _token_documento(row)
+        nome_cliente = row.get('nome_cliente')
+        _indice_aggiungi(indice, cid, nome_cliente if pd.notna(nome_cliente) else '', token_nome, token_tutti, firma)
+        modificati += 1
+    indice['modificati'] = modificati
+    return indice
+
+def get_indice_ricerca(df):
+    """Indice di ricerca allineato alla versione corrente dei dati (session_state)"""
+    versione = st.session_state.get('df_version', 0)
+    stato = st.session_state.get('_indice_ricerca')
+    if stato is None or stato[0] != versione:
+        indice = aggiorna_indice_ricerca(df, stato[1] if stato else None)
+        st.session_state._indice_ricerca = (versione, indice)
+        return indice
+    return stato[1]
+
+def cerca_clienti(indice, query, limite=50, soglia=0.5):
+    """
+    Ricerca tollerante agli errori. Ritorna [(id, punteggio)] in ordine di rilevanza.
+    Ogni parola cercata viene confrontata col vocabolario dei token (parola intera > prefisso > trigrammi);
+    i token del nome pesano più di indirizzo/città/telefono/referente. Tutte le parole devono trovare qualcosa.
+    La parola con meno token per prefisso genera al massimo MAX_CANDIDATI_PREFISSO candidati (migliori
+    token prima), le altre li filtrano: su ricerche molto generiche può mancare qualche cliente in coda.
+    """
+    import bisect
+    import heapq
+    import itertools
+    from collections import Counter
+    parole = normalizza_testo_ricerca(query).split()
+    if not parole:
+        return []
+    ordinati = indice['token_ordinati']
+    docs = indice['docs']
+    # Intervallo dei token con quel prefisso ('{' viene dopo lettere e cifre)
+    intervalli = {p: (bisect.bisect_left(ordinati, p), bisect.bisect_left(ordinati, p + '{')) for p in parole}
+    parole.sort(key=lambda p: intervalli[p][1] - intervalli[p][0])
+    
+    punteggi = None
+    for parola in parole:
+        i0, i1 = intervalli[parola]
+        n_prefisso = i1 - i0
+        # Trigrammi solo se servono: parole lunghe (possibili errori) o nessun prefisso trovato,
+        # e non quando i prefissi bastano già (es. inizio di un numero di telefono)
+        fuzzy = (len(parola) >= 4 or (len(parola) == 3 and not n_prefisso)) and n_prefisso < MAX_CANDIDATI_PREFISSO
+        
+        if punteggi is not None and not fuzzy and n_prefisso > len(punteggi):
+            # Pochi candidati e tanti token: si guardano i token dei candidati
+            per_parola = {}
+            for cid in punteggi:
+                _, token_nome, token_tutti, _ = docs[cid]
+                for tok in token_tutti:
+                    if tok.startswith(parola):
+                        sim = 1.0 if tok == parola else 0.9
+                        valore = sim if tok in token_nome else sim * 0.8
+                        if per_parola.get(cid, 0) < valore:
+                            per_parola[cid] = valore
+        else:
+            # 1. Token simili nel vocabolario, dal più simile: parola intera, prefissi, trigrammi
+            # (generatore: con il tetto di candidati non si scorre tutto l'intervallo)
+            simili = ((ordinati[i], 1.0 if ordinati[i] == parola else 0.9) for i in range(i0, i1))
+            if fuzzy:
+                tri_q = _trigrammi(parola)
+                comuni = Counter()
+                for tri in tri_q:
+                    comuni.update(indice['trigrammi'].get(tri, ()))
+                prefissi = set(ordinati[i0:i1])
+                dice = {tok: 2 * n / (len(tri_q) + len(tok) + 1) for tok, n in comuni.items() if tok not in prefissi}
+                simili = itertools.chain(simili, sorted(((tok, 0.8 * d) for tok, d in dice.items() if d >= soglia),
+                                                        key=lambda x: -x[1]))
+            # 2. Clienti che contengono quei token: {id: miglior punteggio}
+            per_parola = {}
+            tetto = MAX_CANDIDATI_PREFISSO if punteggi is None else None
+            for tok, sim in simili:
+                clienti_tok = indice['token'][tok]
+                if punteggi is not None:
+                    ids = [cid for cid in punteggi if cid in clienti_tok] if len(clienti_tok) > len(punteggi) else \
+                        [cid for cid in clienti_tok if cid in punteggi]
+                else:
+                    ids = clienti_tok
+                for cid in ids:
+                    valore = sim if clienti_tok[cid] else sim * 0.8
+                    if per_parola.get(cid, 0) < valore:
+                        per_parola[cid] = valore
+                        if tetto and len(per_parola) >= tetto:
+                            break
+                if tetto and len(per_parola) >= tetto:
+                    break
         
-        citta = str(r.get('citta', '') or '').strip().upper() or 'ALTRO'
-        freq = int(r.get('frequenza_giorni', 30))
-        ultima = r.get('ultima_visita')
-        
-        if pd.isnull(ultima) or (hasattr(ultima, 'year') and ultima.year < 2001):
-            giorni_ritardo = 999
-            urgenza = 85.0  # Alta ma non massima — clienti scaduti 90+ giorni competono
-            prossima_visita = None
+        if not per_parola:
+            return []
+        punteggi = per_parola if punteggi is None else {cid: punteggi[cid] + v for cid, v in per_parola.items()}
+    
+    # Solo i migliori `limite` (heap), senza ordinare tutti i candidati
+    migliori = heapq.nsmallest(limite, punteggi.items(), key=lambda x: (-x[1], docs[x[0]][0]))
+    return [(cid, v / len(parole)) for cid, v in migliori]
+
+# --- ESPORTAZIONE DATI (generazione su richiesta, workbook write-only) ---
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def valore_export(v):
+    """Converte un valore pandas/numpy in un tipo semplice scrivibile su CSV/Excel"""
+    if isinstance(v, (list, dict)):
+        return str(v)
+    if v is None or pd.isna(v):
+        return None
+    if hasattr(v, 'item'):
+        return v.item()
+    return v
+
+def data_export(v):
+    """Data in formato gg/mm/aaaa (vuota se assente o non valida)"""
+    if v is None or isinstance(v, (list, dict)) or pd.isna(v):
+        return ''
+    try:
+        return pd.Timestamp(v).strftime('%d/%m/%Y')
+    except (ValueError, TypeError):
+        return str(v)
+
+def righe_da_dataframe(df, formattatori=None):
+    """Generatore di righe dal DataFrame (una alla volta, senza copie né DataFrame intermedi)"""
+    formattatori = formattatori or {}
+    fmt = [formattatori.get(c, valore_export) for c in df.columns]
+    for riga in df.itertuples(index=False, name=None):
+        yield [f(v) for f, v in zip(fmt, riga)]
+
+def genera_csv(colonne, righe):
+    """CSV scritto in streaming dalle righe del generatore"""
+    import csv
+    output = io.BytesIO()
+    testo = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv.writer(testo)
+    writer.writerow(colonne)
+    writer.writerows(righe)
+    testo.flush()
+    testo.detach()
+    return output.getvalue()
+
+def genera_excel(fogli):
+    """Excel con workbook write-only: fogli = [(titolo, colonne, righe)], ogni riga è scritta e scartata subito"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for titolo, colonne, righe in fogli:
+        ws = wb.create_sheet(title=str(titolo)[:31])
+        ws.append(colonne)
+        for riga in righe:
+            ws.append(riga)
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+def pulsanti_export(nome, chiave, nome_file, genera):
+    """Pulsanti CSV/Excel: il file si genera solo al click e resta pronto finché la chiave
+    (versione dati + filtri) non cambia. genera(formato) -> bytes, formato 'csv' o 'xlsx'"""
+    cache = st.session_state.setdefault('_export_cache', {})
+    if nome not in cache or cache[nome][0] != chiave:
+        cache[nome] = (chiave, {})
+    pronti = cache[nome][1]
+    formati = [('csv', "CSV", "text/csv"), ('xlsx', "Excel", MIME_XLSX)]
+    for col, (formato, etichetta, mime) in zip(st.columns(2), formati):
+        with col:
+            if formato in pronti:
+                st.download_button(
+                    f"📥 Scarica {etichetta}",
+                    pronti[formato],
+                    f"{nome_file}.{formato}",
+                    mime,
+                    key=f"scarica_{nome}_{formato}",
+                    on_click="ignore",
+                    use_container_width=True
+                )
+            elif st.button(f"⚙️ Prepara {etichetta}", key=f"prepara_{nome}_{formato}", use_container_width=True):
+                with st.spinner(f"Preparazione file {etichetta}..."):
+                    pronti[formato] = genera(formato)
+                st.rerun()
+
+# --- JOB IN BACKGROUND (operazioni lunghe) ---
+# Rigenerazione coordinate, aggiornamento città e import girano su un pool di thread del
+# server invece che nel rerun: se il telefono mette in pausa la scheda il lavoro continua.
+# Lo stato sta in una tabella SQLite (JOB_DB_PATH) aggiornata a ogni blocco: la UI la rilegge
+# con una query locale ogni JOB_POLL_SECONDI e un job interrotto da un riavvio del server
+# riparte dall'ultimo blocco salvato. I worker non toccano st.session_state.
+STATI_JOB_ATTIVI = ('in_coda', 'in_corso')
+
+def _sql_job(query, parametri=()):
+    """Esegue una query su JOB_DB_PATH -> (righe come dict, lastrowid). Connessione nuova a ogni chiamata (anche dai worker)"""
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            cur = conn.execute(query, parametri)
+            return [dict(r) for r in cur.fetchall()], cur.lastrowid
+    finally:
+        conn.close()
+
+@st.cache_resource
+def _pool_job():
+    """Pool dei worker (uno per processo). Al primo uso crea la tabella e segna come
+    'interrotto' i job rimasti a metà dal processo precedente"""
+    _sql_job("PRAGMA journal_mode=WAL")
+    _sql_job("""CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        stato TEXT NOT NULL,                    -- in_coda | in_corso | completato | annullato | errore | interrotto
+        elementi TEXT NOT NULL,                 -- JSON: lista degli elementi da elaborare
+        totale INTEGER NOT NULL,
+        fatti INTEGER NOT NULL DEFAULT 0,       -- checkpoint: elementi già elaborati
+        successi INTEGER NOT NULL DEFAULT 0,
+        errori INTEGER NOT NULL DEFAULT 0,
+        dettagli_errori TEXT NOT NULL DEFAULT '[]',
+        messaggio TEXT NOT NULL DEFAULT '',
+        annulla INTEGER NOT NULL DEFAULT 0,
+        creato_il REAL NOT NULL,
+        aggiornato_il REAL NOT NULL
+    )""")
+    _sql_job("CREATE INDEX IF NOT EXISTS jobs_utente_tipo ON jobs (user_id, tipo, id)")
+    _sql_job("UPDATE jobs SET stato = 'interrotto' WHERE stato IN ('in_coda', 'in_corso')")
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+def _aggiorna_job(job_id, **campi):
+    """Aggiorna i campi indicati del job (e aggiornato_il)"""
+    campi['aggiornato_il'] = time_module.time()
+    assegnazioni = ', '.join(f"{c} = ?" for c in campi)
+    _sql_job(f"UPDATE jobs SET {assegnazioni} WHERE id = ?", (*campi.values(), job_id))
+
+def _job_geocodifica(blocco):
+    """Coordinate dall'indirizzo. Un esito per elemento: None se ok, altrimenti il messaggio d'errore"""
+    esiti = []
+    for el in blocco:
+        coords = get_coords(el['indirizzo']) if el.get('indirizzo') else None
+        if coords:
+            supabase.table('clienti').update({'latitude': coords[0], 'longitude': coords[1]}).eq('id', el['id']).execute()
+            esiti.append(None)
         else:
-            ultima_date = ultima.date() if hasattr(ultima, 'date') else ultima
-            if isinstance(ultima_date, str):
+            esiti.append(f"{el['nome']}: indirizzo non trovato" if el.get('indirizzo') else f"{el['nome']}: indirizzo mancante")
+        time_module.sleep(0.5)  # Rate limiting LocationIQ (2 req/sec)
+    return esiti
+
+def _job_citta(blocco):
+    """Città (e via/CAP/provincia se vuoti) dalle coordinate"""
+    esiti = []
+    for el in blocco:
+        addr = reverse_geocode(el['lat'], el['lon'])
+        if addr and addr.get('citta'):
+            update_data = {'citta': addr['citta']}
+            for campo, chiave in (('indirizzo', 'via'), ('cap', 'cap'), ('provincia', 'provincia')):
+                if campo in el['vuoti'] and addr.get(chiave):
+                    update_data[campo] = addr[chiave]
+            supabase.table('clienti').update(update_data).eq('id', el['id']).execute()
+            esiti.append(None)
+        else:
+            esiti.append(f"{el['nome']}: città non trovata")
+        time_module.sleep(0.5)  # Rate limiting LocationIQ (2 req/sec)
+    return esiti
+
+def _job_inserisci_clienti(blocco):
+    """Inserisce un blocco di clienti con una sola richiesta; se fallisce riprova riga per riga
+    per isolare quelle non valide. Gli elementi con '_errore' sono righe scartate in preparazione"""
+    esiti = [el.get('_errore') for el in blocco]
+    righe = [(i, {k: v for k, v in el.items() if not k.startswith('_')}) for i, el in enumerate(blocco) if not el.get('_errore')]
+    if not righe:
+        return esiti
+    try:
+        # default_to_null=False: le colonne assenti in una riga prendono il default del DB
+        supabase.table('clienti').insert([r for _, r in righe], default_to_null=False).execute()
+        return esiti
+    except Exception:
+        pass
+    for i, riga in righe:
+        try:
+            supabase.table('clienti').insert(riga).execute()
+        except Exception as e:
+            esiti[i] = f"Riga {blocco[i].get('_riga', '?')}: {str(e)[:50]}"
+    return esiti
+
+# tipo -> etichetta, funzione (blocco di elementi -> esiti) e dimensione del blocco (= frequenza dei checkpoint)
+TIPI_JOB = {
+    'geocodifica': {'etichetta': "🌍 Rigenerazione coordinate", 'funzione': _job_geocodifica, 'blocco': 1},
+    'citta': {'etichetta': "🏙️ Aggiornamento città", 'funzione': _job_citta, 'blocco': 1},
+    'import_csv': {'etichetta': "📥 Importazione CSV", 'funzione': _job_inserisci_clienti, 'blocco': 50},
+    'import_team': {'etichetta': "📥 Importazione nel team", 'funzione': _job_inserisci_clienti, 'blocco': 50},
+}
+
+def _esegui_job(job_id):
+    """Worker: elabora gli elementi a blocchi dal checkpoint 'fatti', salvando l'avanzamento e
+    controllando la richiesta di annullamento dopo ogni blocco"""
+    try:
+        job = _sql_job("SELECT * FROM jobs WHERE id = ?", (job_id,))[0][0]
+        tipo = TIPI_JOB[job['tipo']]
+        elementi = json.loads(job['elementi'])
+        fatti, successi, errori = job['fatti'], job['successi'], job['errori']
+        dettagli = json.loads(job['dettagli_errori'])
+        _aggiorna_job(job_id, stato='in_corso')
+        while fatti < len(elementi):
+            blocco = elementi[fatti:fatti + tipo['blocco']]
+            esiti = tipo['funzione'](blocco)
+            fatti += len(blocco)
+            nuovi_errori = [e for e in esiti if e]
+            successi += len(blocco) - len(nuovi_errori)
+            errori += len(nuovi_errori)
+            dettagli = (dettagli + nuovi_errori)[-50:]
+            _aggiorna_job(job_id, fatti=fatti, successi=successi, errori=errori, dettagli_errori=json.dumps(dettagli))
+            if _sql_job("SELECT annulla FROM jobs WHERE id = ?", (job_id,))[0][0]['annulla']:
+                _aggiorna_job(job_id, stato='annullato')
+                return
+        _aggiorna_job(job_id, stato='completato')
+    except Exception as e:
+        _aggiorna_job(job_id, stato='errore', messaggio=str(e)[:200])
+
+def avvia_job(tipo, elementi, user_id=None):
+    """Registra un job e lo mette in coda sul pool. Ritorna l'id"""
+    pool = _pool_job()
+    ora = time_module.time()
+    _, job_id = _sql_job(
+        "INSERT INTO jobs (user_id, tipo, stato, elementi, totale, creato_il, aggiornato_il) VALUES (?, ?, 'in_coda', ?, ?, ?, ?)",
+        (user_id or get_user_id(), tipo, json.dumps(elementi, default=str), len(elementi), ora, ora)
+    )
+    pool.submit(_esegui_job, job_id)
+    return job_id
+
+def riprendi_job(job_id):
+    """Rimette in coda un job interrotto: riparte dal checkpoint"""
+    pool = _pool_job()
+    _aggiorna_job(job_id, stato='in_coda', annulla=0)
+    pool.submit(_esegui_job, job_id)
+
+def annulla_job(job_id):
+    """Chiede al worker di fermarsi dopo il blocco in corso (un job interrotto si chiude subito)"""
+    _pool_job()
+    _sql_job("UPDATE jobs SET stato = 'annullato', aggiornato_il = ? WHERE id = ? AND stato = 'interrotto'",
+             (time_module.time(), job_id))
+    _aggiorna_job(job_id, annulla=1)
+
+def ultimo_job(tipo, user_id=None):
+    """Ultimo job dell'utente per tipo, senza la lista elementi (lettura leggera per il polling)"""
+    _pool_job()
+    righe, _ = _sql_job(
+        "SELECT id, tipo, stato, totale, fatti, successi, errori, dettagli_errori, messaggio, annulla, aggiornato_il "
+        "FROM jobs WHERE user_id = ? AND tipo = ? ORDER BY id DESC LIMIT 1",
+        (user_id or get_user_id(), tipo)
+    )
+    return righe[0] if righe else None
+
+def _sincronizza_dopo_job(job_id):
+    """I job scrivono direttamente sul DB: una volta per job si forza il controllo versione
+    (sincronizzazione a delta) o, senza contatore versioni, un ricaricamento completo"""
+    applicati = st.session_state.setdefault('_job_sincronizzati', set())
+    if job_id in applicati:
+        return
+    applicati.add(job_id)
+    if st.session_state.get('_versione_dati') is None:
+        st.session_state.reload_data = True
+    else:
+        st.session_state._versione_dati_ts = 0
+
+@st.fragment(run_every=JOB_POLL_SECONDI)
+def _avanzamento_job(tipo):
+    """Barra di avanzamento aggiornata ogni JOB_POLL_SECONDI; a job concluso rerun completo"""
+    job = ultimo_job(tipo)
+    if not job or job['stato'] not in STATI_JOB_ATTIVI:
+        if job:
+            _sincronizza_dopo_job(job['id'])
+        st.rerun()
+    etichetta = TIPI_JOB[tipo]['etichetta']
+    st.progress(job['fatti'] / job['totale'] if job['totale'] else 0.0)
+    stato = "in coda" if job['stato'] == 'in_coda' else f"{job['fatti']}/{job['totale']}"
+    st.caption(f"⏳ {etichetta}: {stato} ({job['successi']} ✅ | {job['errori']} ❌) — puoi chiudere l'app, continua sul server")
+    if job['annulla']:
+        st.caption("⏹️ Annullamento in corso...")
+    elif st.button("⏹️ Annulla", key=f"job_annulla_{job['id']}"):
+        annulla_job(job['id'])
+        st.rerun(scope="fragment")
+
+def pannello_job(tipo):
+    """Stato dell'ultimo job di questo tipo: avanzamento, Riprendi/Annulla o esito.
+    Ritorna True se il job non è concluso (il pulsante di avvio va disattivato)"""
+    job = ultimo_job(tipo)
+    if not job:
+        return False
+    etichetta = TIPI_JOB[tipo]['etichetta']
+    if job['stato'] in STATI_JOB_ATTIVI:
+        _avanzamento_job(tipo)
+        return True
+    if job['stato'] == 'interrotto':
+        st.warning(f"⏸️ {etichetta} interrotta a {job['fatti']}/{job['totale']} (riavvio del server). Puoi riprenderla da dove si era fermata.")
+        col_r1, col_r2 = st.columns(2)
+        if col_r1.button("▶️ Riprendi", key=f"job_riprendi_{job['id']}", type="primary", use_container_width=True):
+            riprendi_job(job['id'])
+            st.rerun()
+        if col_r2.button("⏹️ Annulla", key=f"job_annulla_{job['id']}", use_container_width=True):
+            annulla_job(job['id'])
+            st.rerun()
+        return True
+
+    _sincronizza_dopo_job(job['id'])
+    chiusi = st.session_state.setdefault('_job_chiusi', set())
+    if job['id'] in chiusi:
+        return False
+    esito = f"{etichetta}: {job['successi']} ✅ | {job['errori']} ❌ su {job['totale']}"
+    if job['stato'] == 'completato':
+        (st.success if not job['errori'] else st.warning)(f"🎉 {esito}")
+    elif job['stato'] == 'annullato':
+        st.info(f"⏹️ Annullato a {job['fatti']}/{job['totale']} — {esito}")
+    else:
+        st.error(f"❌ {etichetta} interrotta da un errore: {job['messaggio']}")
+    dettagli = json.loads(job['dettagli_errori'])
+    if dettagli:
+        with st.expander("Dettagli errori"):
+            for err in dettagli[-20:]:
+                st.write(f"- {err}")
+    if st.button("✖️ Chiudi", key=f"job_chiudi_{job['id']}"):
+        chiusi.add(job['id'])
+        st.rerun()
+    return False
+
+def righe_import_csv(df_import, user_id):
+    """Elementi del job import_csv: un cliente per riga (o {'_riga', '_errore'} se la riga va scartata)"""
+    elementi = []
+    for idx, row in df_import.iterrows():
+        try:
+            # Funzione helper per estrarre valori
+            def get_val(col_name, default=''):
+                val = row.get(col_name)
+                if pd.isna(val) or val is None or str(val).lower() == 'nan':
+                    return default
+                return str(val).strip()
+            
+            def get_float(col_name):
+                val = row.get(col_name)
+                if pd.isna(val) or val is None:
+                    return None
                 try:
-                    ultima_date = datetime.strptime(ultima_date[:10], '%Y-%m-%d').date()
+                    return float(str(val).replace(',', '.'))
                 except:
-                    ultima_date = oggi
-            prossima_visita = ultima_date + timedelta(days=freq)
-            
-            # Aggiusta se cade in giorno non lavorativo
-            pv_weekday = prossima_visita.weekday()
-            in_ferie_pv = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= prossima_visita <= ferie_fine
+                    return None
             
-            if pv_weekday not in giorni_lavorativi or in_ferie_pv:
-                if pv_weekday == 5:
-                    for delta in range(1, 8):
-                        candidata = prossima_visita - timedelta(days=delta)
-                        c_ferie = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= candidata <= ferie_fine
-                        if candidata.weekday() in giorni_lavorativi and not c_ferie:
-                            prossima_visita = candidata; break
-                elif pv_weekday == 6:
-                    for delta in range(1, 8):
-                        candidata = prossima_visita + timedelta(days=delta)
-                        c_ferie = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= candidata <= ferie_fine
-                        if candidata.weekday() in giorni_lavorativi and not c_ferie:
-                            prossima_visita = candidata; break
-                else:
-                    for delta in range(1, 8):
-                        cand_indietro = prossima_visita - timedelta(days=delta)
-                        cf1 = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= cand_indietro <= ferie_fine
-                        if cand_indietro.weekday() in giorni_lavorativi and not cf1:
-                            prossima_visita = cand_indietro; break
-                        cand_avanti = prossima_visita + timedelta(days=delta)
-                        cf2 = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= cand_avanti <= ferie_fine
-                        if cand_avanti.weekday() in giorni_lavorativi and not cf2:
-                            prossima_visita = cand_avanti; break
+            # Estrai nome cliente
+            nome = get_val('nome cliente')
             
-            giorni_ritardo = (oggi - prossima_visita).days
+            if not nome:
+                elementi.append({'_riga': idx + 2, '_errore': f"Riga {idx+2}: Nome cliente mancante"})
+                continue
             
-            # Urgenza PROPORZIONALE ai giorni reali di ritardo
-            if giorni_ritardo > 90:
-                urgenza = min(100, 88 + min(giorni_ritardo - 90, 120) / 10)
-            elif giorni_ritardo > 30:
-                urgenza = 75 + (giorni_ritardo - 30) * 0.22
-            elif giorni_ritardo > 7:
-                urgenza = 58 + (giorni_ritardo - 7) * 0.74
-            elif giorni_ritardo > 0:
-                urgenza = 48 + giorni_ritardo * 1.4
-            elif giorni_ritardo >= -3:
-                urgenza = 40 + (3 + giorni_ritardo) * 2.5
-            elif giorni_ritardo >= -7:
-                urgenza = 30 + (7 + giorni_ritardo) * 2.5
-            elif giorni_ritardo >= -14:
-                urgenza = 20 + (14 + giorni_ritardo) * 1.4
-            else:
-                urgenza = max(5, 20 + giorni_ritardo / 5)
-        
-        # Parse appuntamento
-        app_raw = r.get('appuntamento')
-        app_parsed = None
-        if pd.notna(app_raw):
-            if hasattr(app_raw, 'date') and hasattr(app_raw, 'hour'):
-                app_parsed = app_raw
-            elif isinstance(app_raw, str) and app_raw.strip():
-                s = app_raw.strip()
-                for sl, fmt in [(16, '%Y-%m-%dT%H:%M'), (19, '%Y-%m-%dT%H:%M:%S'),
-                                (19, '%Y-%m-%d %H:%M:%S'), (10, '%Y-%m-%d')]:
+            # Converti data ultima visita
+            ultima_visita = None
+            data_str = get_val('ultima visita')
+            if data_str:
+                try:
+                    data_str = data_str.split(' ')[0]
+                    ultima_visita = datetime.strptime(data_str, '%d/%m/%Y').isoformat()
+                except:
                     try:
-                        app_parsed = datetime.strptime(s[:sl], fmt)
-                        break
+                        ultima_visita = datetime.strptime(data_str, '%Y-%m-%d').isoformat()
                     except:
-                        continue
-        
-        flat, flon = float(lat), float(lon)
-        
-        tutti.append({
-            'id': r['id'],
-            'nome': r['nome_cliente'],
-            'lat': flat, 'lon': flon,
-            'ind': r.get('indirizzo', ''),
-            'citta': citta,
-            'cell': str(r.get('cellulare', '')),
-            'app': app_parsed,
-            'dist_base': haversine(base_lat, base_lon, flat, flon),
-            'urgenza': urgenza,
-            'giorni_ritardo': giorni_ritardo,
-            'frequenza': freq,
-            'prossima_visita': prossima_visita
-        })
+                        pass
+            
+            # Converti frequenza
+            freq = 30
+            freq_val = row.get('frequenza giorni') or row.get('frequenza (giorni)')
+            if pd.notna(freq_val):
+                try:
+                    freq = int(float(freq_val))
+                except:
+                    pass
+            
+            # Prepara dati cliente
+            cliente = {
+                'user_id': user_id,
+                'nome_cliente': nome,
+                'indirizzo': get_val('indirizzo'),
+                'citta': get_val('citta'),
+                'cap': get_val('cap'),
+                'provincia': get_val('provincia'),
+                'latitude': get_float('latitude'),
+                'longitude': get_float('longitude'),
+                'frequenza_giorni': freq,
+                'ultima_visita': ultima_visita,
+                'visitare': get_val('visitare', 'SI').upper(),
+                'storico_report': get_val('storico report'),
+                'telefono': get_val('telefono'),
+                'cellulare': get_val('cellulare'),
+                'mail': get_val('mail'),
+                'contatto': get_val('contatto'),
+                'referente': get_val('referente'),
+                'note': get_val('note'),
+                'stato_cliente': get_val('stato cliente', 'CLIENTE ATTIVO')
+            }
+            
+            # Rimuovi valori vuoti (tranne user_id e nome_cliente)
+            cliente_clean = {k: v for k, v in cliente.items() 
+                           if v is not None and v != ''}
+            cliente_clean['user_id'] = user_id
+            cliente_clean['nome_cliente'] = nome
+            cliente_clean['_riga'] = idx + 2
+            elementi.append(cliente_clean)
+            
+        except Exception as e:
+            elementi.append({'_riga': idx + 2, '_errore': f"Riga {idx+2}: {str(e)[:50]}"})
+    return elementi
+
+# --- GPS COMPONENT (FUNZIONANTE CON STREAMLIT) ---
+# --- GPS: COMPONENTE BIDIREZIONALE ---
+# components/gps/index.html restituisce la posizione del browser come valore del widget:
+# un solo rerun per fix e nessun parametro nell'URL. Con segui=True resta in ascolto
+# (watchPosition) e rimanda la posizione al massimo ogni intervallo_s secondi, solo se
+# ci si è spostati di almeno distanza_min_m metri.
+_componente_gps = st.components.v1.declare_component(
+    "gps_posizione", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "gps")
+)
+
+def gps_posizione(key, etichetta="📍 Rileva Posizione GPS", segui=False, intervallo_s=30, distanza_min_m=25):
+    """Ultima posizione inviata dal browser: {'latitude', 'longitude', 'accuracy', 'timestamp'} o None"""
+    return _componente_gps(etichetta=etichetta, segui=segui, intervallo_ms=int(intervallo_s * 1000),
+                           distanza_min_m=distanza_min_m, key=key, default=None)
+
+def gps_nuova_posizione(key, **kwargs):
+    """Come gps_posizione, ma ritorna ogni fix una sola volta (None nei rerun successivi)"""
+    pos = gps_posizione(key, **kwargs)
+    if not pos or st.session_state.get(f"_gps_ts_{key}") == pos.get('timestamp'):
+        return None
+    st.session_state[f"_gps_ts_{key}"] = pos.get('timestamp')
+    return pos
+
+# --- 5. CALCOLO GIRO OTTIMIZZATO (v8 — CLUSTER CITTÀ + ANELLI) ---
+# Agenda settimanale/multisettimana, pool clienti, k-means e anelli: giro_engine/planner.py.
+# Qui si passa sempre oggi=ora_italiana.date() come data di riferimento.
+
+# --- 6. GOOGLE MAPS ROUTING FUNCTIONS ---
+# Chiamate Google Routes, motori percorsi, TSP sulle tappe e polyline: giro_engine/routing.py.
+def ottimizza_ordine_con_google(tappe, base_lat, base_lon, api_key):
+    """Come ottimizza_ordine_percorso, forzando Google Routes API"""
+    if not api_key:
+        return tappe, None
+    backend = get_routing_backend('google') if api_key == GOOGLE_MAPS_API_KEY else GoogleRoutingBackend(api_key)
+    return ottimizza_ordine_percorso(tappe, base_lat, base_lon, backend)
+
+# --- GEOMETRIA PERCORSI (decodifica vettoriale + semplificazione per la mappa) ---
+def semplifica_douglas_peucker(coords, tolleranza):
+    """Douglas–Peucker iterativo su array Nx2 (lat, lon); tolleranza in gradi di latitudine"""
+    n = len(coords)
+    if n < 3 or tolleranza <= 0:
+        return coords
+    # Longitudine scalata per cos(lat) → distanze circa isotrope
+    xy = np.array(coords, dtype=float)
+    xy[:, 1] *= cos(radians(float(xy[:, 0].mean())))
+    tenere = np.zeros(n, dtype=bool)
+    tenere[0] = tenere[-1] = True
+    pila = [(0, n - 1)]
+    while pila:
+        i, j = pila.pop()
+        if j <= i + 1:
+            continue
+        a, d = xy[i], xy[j] - xy[i]
+        seg = xy[i + 1:j] - a
+        lung = math.hypot(d[0], d[1])
+        if lung == 0:
+            dist = np.hypot(seg[:, 0], seg[:, 1])
+        else:
+            dist = np.abs(d[0] * seg[:, 1] - d[1] * seg[:, 0]) / lung
+        k = int(np.argmax(dist))
+        if dist[k] > tolleranza:
+            m = i + 1 + k
+            tenere[m] = True
+            pila.append((i, m))
+            pila.append((m, j))
+    return coords[tenere]
+
+def tolleranza_per_zoom(zoom, lat, pixel=1.0):
+    """Tolleranza (gradi) pari a `pixel` pixel schermo al livello di zoom indicato"""
+    metri_per_pixel = 156543.03392 * cos(radians(lat)) / (2 ** zoom)
+    return metri_per_pixel * pixel / 111320
+
+def zoom_per_bounds(punti, larghezza_px=800, altezza_px=500):
+    """Livello di zoom approssimato che fa stare i punti nella mappa (come fit_bounds)"""
+    if not punti or len(punti) < 2:
+        return 12
+    lats = [p[0] for p in punti]; lons = [p[1] for p in punti]
+    span_lat = max(max(lats) - min(lats), 1e-6)
+    span_lon = max(max(lons) - min(lons), 1e-6)
+    z_x = math.log2(360 * larghezza_px / 256 / span_lon)
+    z_y = math.log2(180 * altezza_px / 256 / span_lat)
+    return int(max(1, min(18, math.floor(min(z_x, z_y)))))
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def semplifica_percorso(route_id, zoom, _encoded):
+    """Polyline decodificata e semplificata per lo zoom → [[lat, lon], ...] (cache per route_id + zoom)"""
+    coords = decode_polyline_array(_encoded)
+    if len(coords) == 0:
+        return []
+    tol = tolleranza_per_zoom(zoom, float(coords[:, 0].mean()))
+    return np.round(semplifica_douglas_peucker(coords, tol), 5).tolist()
+
+# --- 6b. MOTORI PERCORSI (Google / OSRM / stima locale) ---
+# Le classi stanno in giro_engine/routing.py; qui si sceglie il motore dai secrets e lo si
+# tiene per processo (cache dei percorsi condivisa tra le sessioni).
+def get_routing_backend_pianificazione():
+    """Motore per gli orari finali del pianificatore (secret ROUTING_BACKEND_PIANIFICAZIONE, None = stima interna)"""
+    if not ROUTING_BACKEND_PIANIFICAZIONE:
+        return None
+    return get_routing_backend(ROUTING_BACKEND_PIANIFICAZIONE)
+
+@st.cache_resource
+def get_routing_backend(nome=None):
+    """Motore percorsi configurato (secret ROUTING_BACKEND). None se disattivato."""
+    return crea_routing_backend(
+        nome or ROUTING_BACKEND, google_api_key=GOOGLE_MAPS_API_KEY, osrm_url=OSRM_URL,
+        fattore_deviazione=float(st.secrets.get("ROUTING_FATTORE_DEVIAZIONE", 1.3)),
+        velocita_kmh=float(st.secrets.get("ROUTING_VELOCITA_KMH", 50))
+    )
+
+# --- 7. MAIN APP ---
+# --- GIRO OGGI: LISTA TAPPE (fragment) ---
+# Le azioni sulle tappe (apri report, salva/salta, annulla, visita fuori giro) rieseguono
+# solo questo blocco: schede, contatori e riepilogo si aggiornano senza ripassare da
+# caricamento dati, giro salvato, pianificatore e percorso. I pulsanti che cambiano tab
+# fanno invece un rerun completo.
+@st.fragment
+def lista_tappe_giro(tappe_oggi, config, oggi_date, giorno_nome):
+    """Statistiche, schede tappa, navigazione, visite fuori giro e riepilogo del Giro Oggi"""
+    df = st.session_state.df_clienti
+
+    # Statistiche compatte + pulsante mappa
+    km_tot, tempo_guida, tempo_tot = calcola_km_tempo_giro(
+        tappe_oggi, 
+        config.get('lat_base', 41.9028), 
+        config.get('lon_base', 12.4964),
+        config.get('durata_visita', 45)
+    )
     
-    if not tutti:
-        return agenda
+    # Usa dati reali Google se disponibili
+    route_info_oggi = st.session_state.get('_route_info')
+    google_badge = ""
+    if route_info_oggi and route_info_oggi.get('duration_s'):
+        km_tot = round(route_info_oggi['distance_m'] / 1000, 1) if route_info_oggi.get('distance_m') else km_tot
+        tempo_guida_google = route_info_oggi['duration_s'] // 60
+        durata_visita = int(config.get('durata_visita', 45))
+        tempo_tot = tempo_guida_google + (len(tappe_oggi) * durata_visita)
+        google_badge = {'osrm': " · 🛣️ OSRM", 'locale': " · 📐 Stima"}.get(route_info_oggi.get('backend'), " · 🛣️ Google")
     
-    # ========================================
-    # 2. GIORNI DISPONIBILI
-    # ========================================
-    giorni_calcolo = []
-    for g in giorni_lavorativi:
-        data = lunedi + timedelta(days=g)
-        in_ferie = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= data <= ferie_fine
-        if not in_ferie:
-            giorni_calcolo.append(g)
+    col_stats, col_mappa = st.columns([4, 1])
+    with col_stats:
+        st.caption(f"📊 **{len(tappe_oggi)}** visite · ✅ **{len(st.session_state.visitati_oggi)}** fatte · 🛣️ **{km_tot}** km · ⏱️ **{tempo_tot//60}h{tempo_tot%60:02d}m**{google_badge}")
+    with col_mappa:
+        if st.button("🗺️ Mappa", use_container_width=True, help="Vedi clienti del giorno sulla mappa"):
+            st.session_state.mappa_giorno_selezionato = {
+                'data': oggi_date,
+                'tappe': tappe_oggi,
+                'giorno_nome': giorno_nome
+            }
+            st.session_state.active_tab = "🗺️ Mappa"
+            st.rerun()
     
-    giorni = [g for g in giorni_calcolo
-              if (settimana_offset > 0 or (lunedi + timedelta(days=g)) >= oggi)]
+    st.divider()
     
-    if not giorni:
-        return agenda
+    # === LISTA TAPPE ===
+    for i, t in enumerate(tappe_oggi, 1):
+        visitato = t['nome_cliente'] in st.session_state.visitati_oggi
     
-    # n_giorni = giorni RIMANENTI (non tutti i lavorativi!)
-    # Così il pool viene diviso solo sui giorni che verranno effettivamente mostrati
-    n_giorni = len(giorni)
+        # Dati completi del cliente
+        cliente_row = df[df['nome_cliente'] == t['nome_cliente']].iloc[0] if not df[df['nome_cliente'] == t['nome_cliente']].empty else None
     
-    # ========================================
-    # 3. SEPARA APPUNTAMENTI
-    # ========================================
-    app_per_giorno = {}
-    nomi_app = set()
+        if 'cliente_report_aperto' not in st.session_state:
+            st.session_state.cliente_report_aperto = None
     
-    for c in tutti:
-        app = c.get('app')
-        if app is not None and hasattr(app, 'date'):
-            data_app = app.date()
-            if lunedi <= data_app <= lunedi + timedelta(days=6):
-                g = data_app.weekday()
-                if g not in app_per_giorno:
-                    app_per_giorno[g] = []
-                c['ora_app'] = app.strftime('%H:%M')
-                c['is_app'] = True
-                app_per_giorno[g].append(c)
-                nomi_app.add(c['nome'])
+        if visitato:
+            # --- VISITATO (compatto) ---
+            with st.container(border=True):
+                st.markdown(f"""
+                <div style="background: linear-gradient(90deg, #d4edda 0%, #c3e6cb 100%); 
+                            padding: 8px 12px; border-radius: 8px; border-left: 4px solid #28a745;
+                            display:flex; align-items:center; justify-content:space-between;">
+                    <span style="font-size: 14px; text-decoration: line-through; color: #155724;">
+                        ✅ {i}. {t['nome_cliente']}
+                    </span>
+                    <span style="color: #155724; font-weight: bold; font-size:12px;">VISITATO</span>
+                </div>
+                """, unsafe_allow_html=True)
+        else:
+            # --- DA VISITARE ---
+            with st.container(border=True):
+                form_aperto = st.session_state.cliente_report_aperto == t['id']
     
-    # ========================================
-    # 4. COSTRUISCI POOL — TUTTI i clienti da visitare
-    # ========================================
-    scaduti = []
-    mai_visitati = []
-    non_ancora = []  # clienti con prossima visita lontana
-    numero_settimana = lunedi.isocalendar()[1]
+                if not form_aperto:
+                    # Badge urgenza
+                    ritardo = t.get('ritardo', 0)
+                    urgenza_score = t.get('urgenza', 0)
     
-    for c in tutti:
-        if c['nome'] in nomi_app:
-            continue
-        pv = c.get('prossima_visita')
-        if pv is None:
-            # Mai visitato → SEMPRE nel pool
-            mai_visitati.append(c)
-        elif pv <= fine_settimana:
-            # Scaduto o scade questa settimana → priorità massima
-            scaduti.append(c)
-        elif pv <= fine_settimana + timedelta(days=14):
-            # Scade entro 2 settimane → nel pool con priorità minore
-            scaduti.append(c)
-        else:
-            # Scade oltre 2 settimane → tenere come riserva
-            non_ancora.append(c)
+                    if ritardo == 999 or urgenza_score >= 80:
+                        urgenza_badge = "🔴"
+                    elif ritardo >= 7 or urgenza_score >= 50:
+                        urgenza_badge = "🟠"
+                    elif ritardo >= 0 or urgenza_score >= 30:
+                        urgenza_badge = "🟡"
+                    else:
+                        urgenza_badge = "🟢"
     
-    # Ordina scaduti per urgenza (i più urgenti prima)
-    scaduti.sort(key=lambda c: -c['urgenza'])
+                    # Info cliente — riga unica compatta
+                    st.markdown(f"**{t['tipo_tappa'].split()[0]} {i}. {t['nome_cliente']}** — ⏰ {t['ora_arrivo']} · {urgenza_badge} {ritardo:+d}gg · {t.get('distanza_km', 0)}km")
     
-    # Mai visitati: includi TUTTI
-    mai_visitati.sort(key=lambda c: c['dist_base'])
+                    if t.get('indirizzo'):
+                        st.caption(f"📍 {t['indirizzo']}")
     
-    # Pool: TUTTI gli scaduti + TUTTI i mai visitati (nessun taglio)
-    # Il max_visite per giorno farà da filtro naturale
-    pool = scaduti + mai_visitati
+                    # Promemoria
+                    if cliente_row is not None and pd.notnull(cliente_row.get('promemoria')) and str(cliente_row.get('promemoria')).strip():
+                        st.warning(f"📝 **Promemoria:** {cliente_row['promemoria']}")
     
-    # Se restano pochi slot, aggiungi anche i "non ancora" come riserva
-    cap_settimana = max_visite * n_giorni
-    if len(pool) < cap_settimana and non_ancora:
-        non_ancora.sort(key=lambda c: -c['urgenza'])
-        pool += non_ancora
+                    # === PULSANTE VISITA ===
+                    if st.button("✅ Registra Visita", key=f"visita_{t['id']}", type="primary", use_container_width=True):
+                        st.session_state.cliente_report_aperto = t['id']
+                        st.rerun(scope="fragment")
     
-    # Ordine: urgenza decrescente, poi distanza dalla base crescente
-    # Questo garantisce che k-means trovi zone compatte
-    pool.sort(key=lambda c: (-c['urgenza'], c['dist_base']))
+                    # === 4 PULSANTI AZIONE IN LINEA (HTML flex = sempre orizzontali su iPhone) ===
+                    nav_url = f"https://www.google.com/maps/dir/?api=1&destination={t['latitude']},{t['longitude']}"
+                    cell_val = str(t.get('cellulare', '')).strip()
+                    tel_url = f"tel:{cell_val}" if cell_val else ""
+                    mail_val = ""
+                    if cliente_row is not None and pd.notnull(cliente_row.get('mail')):
+                        mail_val = str(cliente_row.get('mail', '')).strip()
+                    mail_url = f"mailto:{mail_val}" if mail_val else ""
     
-    if not pool and not app_per_giorno:
-        return agenda
+                    btn_style = (
+                        "display:inline-flex;align-items:center;justify-content:center;"
+                        "padding:8px 4px;border-radius:8px;text-decoration:none;"
+                        "font-size:14px;font-weight:500;flex:1;text-align:center;"
+                        "min-height:38px;border:1px solid #ddd;color:#333;background:#f8f9fa;"
+                    )
+                    btn_disabled = btn_style + "opacity:0.35;pointer-events:none;color:#999;"
     
-    # ========================================
-    # 5. K-MEANS GEOGRAFICO SUL POOL → ZONE COMPATTE
-    # ========================================
-    def kmeans_geo(punti, k, max_iter=50):
-        """K-Means su (lat, lon). Ritorna lista di k gruppi."""
-        if len(punti) <= k:
-            return [[p] for p in punti] + [[] for _ in range(k - len(punti))]
-        
-        # Init: farthest-first, punto di partenza ruota con settimana + variante
-        start_idx = (variante + numero_settimana) % len(punti)
-        centers = [(punti[start_idx]['lat'], punti[start_idx]['lon'])]
-        for _ in range(k - 1):
-            max_min_d, best = 0, 0
-            for i, p in enumerate(punti):
-                min_d = min(haversine(p['lat'], p['lon'], c[0], c[1]) for c in centers)
-                if min_d > max_min_d:
-                    max_min_d = min_d
-                    best = i
-            centers.append((punti[best]['lat'], punti[best]['lon']))
-        
-        for _ in range(max_iter):
-            clusters = [[] for _ in range(k)]
-            for p in punti:
-                min_d, best = float('inf'), 0
-                for i, (clat, clon) in enumerate(centers):
-                    d = haversine(p['lat'], p['lon'], clat, clon)
-                    if d < min_d:
-                        min_d = d
-                        best = i
-                clusters[best].append(p)
-            
-            new_centers = []
-            for i, cl in enumerate(clusters):
-                if cl:
-                    new_centers.append((
-                        sum(c['lat'] for c in cl) / len(cl),
-                        sum(c['lon'] for c in cl) / len(cl)
-                    ))
-                else:
-                    new_centers.append(centers[i])
-            
-            if all(abs(a[0]-b[0]) < 0.001 and abs(a[1]-b[1]) < 0.001 
-                   for a, b in zip(centers, new_centers)):
-                break
-            centers = new_centers
-        
-        return clusters, centers
+                    html_btns = f'<div style="display:flex;gap:6px;margin:4px 0 2px 0;">'
+                    html_btns += f'<a href="{nav_url}" target="_blank" style="{btn_style}">🚗 Vai</a>'
+                    if tel_url:
+                        html_btns += f'<a href="{tel_url}" style="{btn_style}">📱 Chiama</a>'
+                    else:
+                        html_btns += f'<span style="{btn_disabled}">📱 Chiama</span>'
+                    if mail_url:
+                        html_btns += f'<a href="{mail_url}" style="{btn_style}">📧 Mail</a>'
+                    else:
+                        html_btns += f'<span style="{btn_disabled}">📧 Mail</span>'
+                    html_btns += '</div>'
+                    st.markdown(html_btns, unsafe_allow_html=True)
     
-    # Cluster il POOL sui giorni SENZA appuntamento
-    # Prima: gestisci i giorni con appuntamento (l'app è il baricentro)
+                    # Scheda cliente (richiede Streamlit per navigazione)
+                    if st.button("👤 Scheda cliente", key=f"scheda_{t['id']}", use_container_width=True):
+                        st.session_state.cliente_selezionato = t['nome_cliente']
+                        st.session_state.active_tab = "👤 Anagrafica"
+                        st.rerun()
     
-    # ========================================
-    # 5b. GIORNI CON APPUNTAMENTO → BARICENTRO
-    # ========================================
-    giorni_con_app = set()
-    nomi_usati_da_app = set()
-    risultati_app = {}
-    n_giorni_senza_app = n_giorni
+                else:
+                    # FORM REPORT APERTO
+                    st.markdown(f"### 📝 Report Visita: {t['nome_cliente']}")
+                    st.caption(f"📍 {t.get('indirizzo', '')}")
     
-    for g_app in sorted(app_per_giorno.keys()):
-        if g_app not in giorni:
-            continue
-        tappe_app = app_per_giorno[g_app]
-        giorni_con_app.add(g_app)
-        n_giorni_senza_app -= 1
-        
-        # Baricentro degli appuntamenti del giorno
-        app_lat = sum(t['lat'] for t in tappe_app) / len(tappe_app)
-        app_lon = sum(t['lon'] for t in tappe_app) / len(tappe_app)
-        
-        slot = max_visite - len(tappe_app)
-        
-        # Prendi dal pool INTERO i clienti più vicini all'appuntamento
-        candidati = [c for c in pool if c['nome'] not in nomi_usati_da_app]
-        candidati.sort(key=lambda c: (haversine(c['lat'], c['lon'], app_lat, app_lon), -c['urgenza']))
-        selezionati = candidati[:slot]
-        
-        for c in selezionati:
-            nomi_usati_da_app.add(c['nome'])
-        
-        risultati_app[g_app] = selezionati
+                    # Ultimi report del cliente (prima pagina, riletta solo se i dati cambiano)
+                    with st.expander("📜 Storico report precedenti"):
+                        risultato_storico = _memo_sessione(
+                            'storico_giro', (t['id'], st.session_state.get('df_version', 0)),
+                            lambda: fetch_visite_cliente(t['id'], limite=5)
+                        )
+                        if risultato_storico is not None and risultato_storico[1] > 0:
+                            for v in risultato_storico[0]:
+                                data_v = pd.to_datetime(v['data_visita']).strftime('%d/%m/%Y')
+                                st.markdown(f"{ICONE_TIPO_VISITA.get(v.get('tipo'), '📝')} **{data_v}** — {v.get('testo') or '_(senza report)_'}")
+                            if risultato_storico[1] > 5:
+                                st.caption(f"... altri {risultato_storico[1] - 5} nella scheda cliente")
+                        elif cliente_row is not None and str(cliente_row.get('storico_report', '') or '').strip():
+                            st.text(str(cliente_row.get('storico_report', '')))
+                        else:
+                            st.caption("Nessun report precedente")
     
-    # ========================================
-    # 5c. K-MEANS SUL POOL RIMANENTE (giorni senza app)
-    # ========================================
-    pool_rimanente = [c for c in pool if c['nome'] not in nomi_usati_da_app]
-    # Crea SEMPRE molte zone (1 zona ogni ~6-8 clienti) per granularità geografica
-    # Anche con 1 solo giorno, avere più zone permette di scegliere la più compatta
-    if pool_rimanente:
-        # Almeno 4 zone, max len(pool)/5, target = pool/6
-        n_zone = max(4, min(len(pool_rimanente) // 5, len(pool_rimanente) // 6 + n_giorni_senza_app * 2))
-    else:
-        n_zone = max(1, n_giorni_senza_app)
-    n_zone = max(1, n_zone)
+                    # Form per nuovo report
+                    nuovo_report = st.text_area(
+                        "✍️ Scrivi il report della visita:",
+                        placeholder="Es: Incontrato Mario Rossi, discusso nuovo ordine, richiesta preventivo per...",
+                        height=120,
+                        key=f"report_text_{t['id']}"
+                    )
     
-    if len(pool_rimanente) >= n_zone and n_zone > 0:
-        zone_raw, zone_centers = kmeans_geo(pool_rimanente, n_zone)
-    elif pool_rimanente:
-        zone_raw = [pool_rimanente] + [[] for _ in range(n_zone - 1)]
-        zone_centers = [(pool_rimanente[0]['lat'], pool_rimanente[0]['lon'])] + [(base_lat, base_lon)] * (n_zone - 1)
-    else:
-        zone_raw = [[] for _ in range(n_zone)]
-        zone_centers = [(base_lat, base_lon)] * n_zone
+                    col_save, col_skip, col_cancel = st.columns(3)
     
-    # Le zone contengono TUTTI i clienti del pool raggruppati per vicinanza.
-    # Lo step 11 selezionerà i max_visite più urgenti per ogni zona.
-    # NON bilanciare qui — spostare clienti tra zone crea giri assurdi.
+                    with col_save:
+                        if st.button("💾 Salva e Completa", key=f"save_report_{t['id']}", type="primary", use_container_width=True):
+                            # Nuova riga nello storico visite + ultima_visita
+                            # Se fallisce il form resta aperto col report scritto
+                            if registra_visita(t['id'], ora_italiana.date(), 'VISITA', nuovo_report):
+                                st.session_state.visitati_oggi.append(t['nome_cliente'])
+                                st.session_state.cliente_report_aperto = None
+                                st.success("✅ Visita registrata con report!")
+                                time_module.sleep(0.5)
+                                st.rerun(scope="fragment")
     
-    # Ordina zone per angolo dalla base (così sono geograficamente ordinate)
-    zone_info = []
-    for i, z in enumerate(zone_raw):
-        if not z:
-            zone_info.append({'clienti': [], 'angle': 999 + i, 'center': zone_centers[i]})
-            continue
-        cx = sum(c['lat'] for c in z) / len(z)
-        cy = sum(c['lon'] for c in z) / len(z)
-        angle = math_degrees(atan2(cx - base_lat, cy - base_lon)) % 360
-        zone_info.append({'clienti': z, 'angle': angle, 'center': (cx, cy)})
+                    with col_skip:
+                        if st.button("⏭️ Salta Report", key=f"skip_report_{t['id']}", use_container_width=True):
+                            # Salva senza report
+                            if registra_visita(t['id'], ora_italiana.date(), 'VISITA'):
+                                st.session_state.visitati_oggi.append(t['nome_cliente'])
+                                st.session_state.cliente_report_aperto = None
+                                st.rerun(scope="fragment")
     
-    zone_info.sort(key=lambda z: z['angle'])
+                    with col_cancel:
+                        if st.button("❌ Annulla", key=f"cancel_report_{t['id']}", use_container_width=True):
+                            st.session_state.cliente_report_aperto = None
+                            st.rerun(scope="fragment")
     
-    # ========================================
-    # 6. VARIANTE (Rigenera): ruota assegnazione zone
-    # ========================================
-    if variante > 0 and len(zone_info) > 1:
-        shift = variante % len(zone_info)
-        zone_info = zone_info[shift:] + zone_info[:shift]
+    # Navigazione completa
+    if tappe_oggi:
+        st.divider()
+        tappe_rimanenti = [t for t in tappe_oggi if t['nome_cliente'] not in st.session_state.visitati_oggi]
+        if tappe_rimanenti:
+            waypoints = "|".join([f"{t['latitude']},{t['longitude']}" for t in tappe_rimanenti[:-1]])
+            dest = f"{tappe_rimanenti[-1]['latitude']},{tappe_rimanenti[-1]['longitude']}"
+            origin = f"{config.get('lat_base', 41.9028)},{config.get('lon_base', 12.4964)}"
+            url = f"https://www.google.com/maps/dir/?api=1&origin={origin}&destination={dest}&waypoints={waypoints}&travelmode=driving"
+            st.link_button(f"🗺️ NAVIGA ({len(tappe_rimanenti)} tappe)", url, use_container_width=True, type="primary")
+        else:
+            st.success("🎉 Hai completato tutte le visite programmate!")
     
-    # ========================================
-    # 7. ASSEGNA ZONE → GIORNI (semplice: 1 zona migliore + vicini)
-    # ========================================
-    assegnazione = {}
-    giorni_senza_app = [g for g in giorni if g not in giorni_con_app]
-    n_gsa = len(giorni_senza_app)
+    # === SEZIONE VISITE FUORI GIRO ===
+    st.divider()
+    nomi_nel_giro = [t['nome_cliente'] for t in tappe_oggi]
+    visitati_fuori_giro = [v for v in st.session_state.visitati_oggi if v not in nomi_nel_giro]
     
-    if n_gsa > 0 and zone_info:
-        # Filtra zone vuote
-        zone_valide = [z for z in zone_info if z['clienti']]
-        
-        # Calcola score di ogni zona: urgenza media + bonus per dimensione
-        def score_zona(z):
-            cls = z['clienti']
-            urg_media = sum(c['urgenza'] for c in cls) / len(cls)
-            # Bonus dimensione: zone con almeno max_visite clienti hanno priorità
-            bonus_size = min(len(cls) / max_visite, 1.0) * 20
-            return urg_media + bonus_size
-        
-        zone_valide.sort(key=lambda z: -score_zona(z))
-        
-        # Ruota zone per varietà settimanale
-        if len(zone_valide) > n_gsa:
-            shift = numero_settimana % len(zone_valide)
-            zone_valide = zone_valide[shift:] + zone_valide[:shift]
-        
-        zone_usate = set()
-        
-        for idx_g, g in enumerate(giorni_senza_app):
-            # Trova prima zona non usata con almeno 1 cliente
-            zona_scelta = None
-            for i, z in enumerate(zone_valide):
-                if i not in zone_usate and z['clienti']:
-                    zona_scelta = z
-                    zone_usate.add(i)
-                    break
-            
-            if zona_scelta is None:
-                assegnazione[g] = {'clienti': [], 'center': (base_lat, base_lon)}
-                continue
-            
-            # Centro della zona
-            cls_zona = zona_scelta['clienti']
-            cx_z = sum(c['lat'] for c in cls_zona) / len(cls_zona)
-            cy_z = sum(c['lon'] for c in cls_zona) / len(cls_zona)
-            
-            # Se la zona ha meno di max_visite clienti, aggiungi vicini dalle altre zone
-            if len(cls_zona) < max_visite:
-                vicini = []
-                for i, z2 in enumerate(zone_valide):
-                    if i in zone_usate:
-                        continue
-                    for c in z2['clienti']:
-                        d = haversine(c['lat'], c['lon'], cx_z, cy_z)
-                        if d <= 20:  # solo entro 20km dal centro
-                            vicini.append((d, c, i))
-                
-                vicini.sort(key=lambda x: x[0])
-                # Aggiungi vicini fino a riempire max_visite (no buffer per evitare outlier)
-                target = max_visite
-                for d, c, i_zona in vicini:
-                    if len(cls_zona) >= target:
-                        break
-                    cls_zona.append(c)
-            
-            # Ricalcola centro dopo l'aggiunta
-            cx = sum(c['lat'] for c in cls_zona) / len(cls_zona)
-            cy = sum(c['lon'] for c in cls_zona) / len(cls_zona)
-            
-            assegnazione[g] = {'clienti': cls_zona, 'center': (cx, cy)}
+    # Mostra clienti visitati fuori giro
+    if visitati_fuori_giro:
+        st.subheader("➕ Visite Fuori Giro")
+        for nome_vfg in visitati_fuori_giro:
+            cliente_vfg = df[df['nome_cliente'] == nome_vfg]
+            if not cliente_vfg.empty:
+                cliente_vfg = cliente_vfg.iloc[0]
+                with st.container(border=True):
+                    col_vfg1, col_vfg2 = st.columns([4, 1])
+                    col_vfg1.markdown(f"### ✅ {nome_vfg}")
+                    if cliente_vfg.get('indirizzo'):
+                        col_vfg1.caption(f"📍 {cliente_vfg['indirizzo']}")
+                    if col_vfg2.button("👤", key=f"vfg_scheda_{nome_vfg}", help="Scheda"):
+                        st.session_state.cliente_selezionato = nome_vfg
+                        st.session_state.active_tab = "👤 Anagrafica"
+                        st.rerun()
     
-    # ========================================
-    # 9-10. COSTRUISCI ANELLO PER OGNI GIORNO
-    # ========================================
-    def circuito_dist(percorso, blat, blon):
-        if not percorso:
-            return 0
-        d = haversine(blat, blon, percorso[0]['lat'], percorso[0]['lon'])
-        for i in range(len(percorso) - 1):
-            d += haversine(percorso[i]['lat'], percorso[i]['lon'],
-                           percorso[i+1]['lat'], percorso[i+1]['lon'])
-        d += haversine(percorso[-1]['lat'], percorso[-1]['lon'], blat, blon)
-        return d
+    # Form per aggiungere visita fuori giro
+    with st.expander("➕ Registra visita a cliente fuori giro"):
+        clienti_non_visitati = [c for c in df['nome_cliente'].tolist() if c not in st.session_state.visitati_oggi] if not df.empty and 'nome_cliente' in df.columns else []
+        cliente_extra = st.selectbox("Seleziona cliente:", [""] + sorted(clienti_non_visitati), key="cliente_extra_giro")
     
-    def due_opt(percorso, blat, blon):
-        if len(percorso) < 3:
-            return percorso
-        p = list(percorso)
-        improved = True
-        it = 0
-        while improved and it < 500:
-            improved = False
-            best_d = circuito_dist(p, blat, blon)
-            for i in range(len(p) - 1):
-                for j in range(i + 2, len(p)):
-                    nuovo = p[:i+1] + p[i+1:j+1][::-1] + p[j+1:]
-                    d = circuito_dist(nuovo, blat, blon)
-                    if d < best_d - 0.01:
-                        p = nuovo
-                        best_d = d
-                        improved = True
-                        break
-                if improved:
-                    break
-            it += 1
-        p_rev = list(reversed(p))
-        if circuito_dist(p_rev, blat, blon) < circuito_dist(p, blat, blon):
-            p = p_rev
-        return p
+        if cliente_extra:
+            col_extra1, col_extra2 = st.columns(2)
+            if col_extra1.button("✅ Registra Visita", type="primary", use_container_width=True):
+                # Registra la visita (storico + ultima_visita)
+                cliente_row = df[df['nome_cliente'] == cliente_extra].iloc[0]
+                if registra_visita(cliente_row['id'], ora_italiana.date(), 'VISITA'):
+                    st.session_state.visitati_oggi.append(cliente_extra)
+                    st.success(f"✅ Visita a {cliente_extra} registrata!")
+                    st.rerun(scope="fragment")
     
-    def costruisci_anello(clienti_g, blat, blon):
-        if len(clienti_g) <= 2:
-            return sorted(clienti_g, key=lambda c: -c['dist_base'])
-        
-        # Strategia 1: Angular sweep attorno al centroide
-        cx = sum(c['lat'] for c in clienti_g) / len(clienti_g)
-        cy = sum(c['lon'] for c in clienti_g) / len(clienti_g)
-        s1 = sorted(clienti_g, key=lambda c: math_degrees(atan2(c['lat']-cx, c['lon']-cy)) % 360)
-        
-        # Strategia 2: NN dal più lontano
-        farthest = max(clienti_g, key=lambda c: c['dist_base'])
-        s2 = [farthest]
-        rem = [c for c in clienti_g if c is not farthest]
-        plat, plon = farthest['lat'], farthest['lon']
-        while rem:
-            min_d = float('inf')
-            best = -1
-            for idx, c in enumerate(rem):
-                d = haversine(plat, plon, c['lat'], c['lon'])
-                if d < min_d:
-                    min_d = d
-                    best = idx
-            picked = rem.pop(best)
-            s2.append(picked)
-            plat, plon = picked['lat'], picked['lon']
-        
-        # Strategia 3: Angular sweep dalla base
-        s3 = sorted(clienti_g, key=lambda c: math_degrees(atan2(c['lat']-blat, c['lon']-blon)) % 360)
-        
-        # Strategia 4: NN DALLA BASE (la più naturale per un venditore)
-        s4 = []
-        rem4 = list(clienti_g)
-        plat4, plon4 = blat, blon
-        while rem4:
-            min_d = float('inf')
-            best = -1
-            for idx, c in enumerate(rem4):
-                d = haversine(plat4, plon4, c['lat'], c['lon'])
-                if d < min_d:
-                    min_d = d
-                    best = idx
-            picked = rem4.pop(best)
-            s4.append(picked)
-            plat4, plon4 = picked['lat'], picked['lon']
-        
-        migliore = None
-        migliore_d = float('inf')
-        for strat in [s1, s2, s3, s4]:
-            opt = due_opt(strat, blat, blon)
-            d = circuito_dist(opt, blat, blon)
-            if d < migliore_d:
-                migliore_d = d
-                migliore = opt
-        return migliore
+            if col_extra2.button("👤 Vai alla Scheda", use_container_width=True):
+                st.session_state.cliente_selezionato = cliente_extra
+                st.session_state.active_tab = "👤 Anagrafica"
+                st.rerun()
     
-    # ========================================
-    # 11. ASSEGNA CLIENTI AI GIORNI
-    # ========================================
-    # Criterio primario: DISTANZA (clienti vicini nello stesso giorno)
-    # Criterio secondario: FREQUENZA/URGENZA (chi scade prima ha priorità)
-    # Vincolo: tempo reale (orari lavoro, spostamenti, durata visita)
+    # Riepilogo finale
+    st.divider()
+    tot_visitati = len(st.session_state.visitati_oggi)
+    tot_giro = len(tappe_oggi)
+    tot_fuori = len(visitati_fuori_giro)
     
-    risultati = {}
+    st.markdown(f"""
+    ### 📊 Riepilogo Giornata
+    | | |
+    |---|---|
+    | ✅ **Visitati totali** | **{tot_visitati}** |
+    | 🚗 Nel giro | {tot_visitati - tot_fuori} / {tot_giro} |
+    | ➕ Fuori giro | {tot_fuori} |
+    """)
+
+# --- DEBUG PIANIFICATORE (traccia dell'ultimo calcolo) ---
+# Giro Oggi e Agenda passano traccia={} a calcola_agenda_settimanale e la lasciano in
+# sessione: il Debug della tab Config mostra cosa ha fatto davvero il pianificatore
+# (tempi per fase, pool, k-means, zone, esito di ogni cliente) senza ricalcolare nulla.
+GIORNI_BREVI = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
+NOMI_FASI_PIANIFICATORE = {
+    'raccolta': "Raccolta clienti e giorni", 'pool': "Pool", 'giorni_appuntamento': "Giorni con appuntamento",
+    'zone': "Zone (k-means + assegnazione)", 'kmeans_giorni': "K-means sui giorni liberi",
+    'simulazione': "Simulazione giornate", 'anelli': "Costruzione anelli (2-opt)", 'orari': "Orari finali",
+}
+
+def memorizza_traccia_pianificatore(origine, traccia, variante=0, esclusi=()):
+    """Tiene in sessione l'ultima traccia del pianificatore per il Debug"""
+    st.session_state._traccia_pianificatore = {
+        'origine': origine, 'ora': ora_italiana.strftime('%d/%m %H:%M:%S'),
+        'variante': variante, 'esclusi': list(esclusi), 'traccia': traccia
+    }
+
+def mostra_traccia_pianificatore(voce, n_clienti_db):
+    """Rende la traccia salvata da memorizza_traccia_pianificatore"""
+    traccia = voce['traccia']
+    esiti = traccia.get('clienti', {})
+    st.caption(f"Calcolo di **{voce['origine']}** alle {voce['ora']} — settimana del {traccia.get('settimana', '?')}, "
+               f"variante {voce['variante']}, esclusi: {voce['esclusi'] or 'nessuno'}")
+    righe = []
     
-    # Clienti disponibili (esclusi quelli con appuntamento)
-    pool_per_giorni = [c for c in pool if c['nome'] not in nomi_usati_da_app]
+    # 1. CLIENTI
+    righe.append("## 📊 Stato Clienti")
+    righe.append(f"- **Totale clienti nel DB:** {n_clienti_db}")
+    righe.append(f"- **Pianificabili (nel giro, con coordinate):** {traccia.get('n_clienti', 0)}")
+    for motivo in ("fuori giro (visitare = NO)", "escluso a mano", "senza coordinate"):
+        nomi = [v['nome'] for v in esiti.values() if v['motivo'] == motivo]
+        if nomi:
+            righe.append(f"- ⚠️ **{motivo[0].upper() + motivo[1:]}:** {len(nomi)}")
+            if motivo == "senza coordinate":
+                righe += [f"  - ❌ {n}" for n in nomi[:10]]
     
-    # Gestisci prima i giorni con appuntamento
-    for giorno in giorni_calcolo:
-        data_g = lunedi + timedelta(days=giorno)
-        if giorno in risultati_app:
-            tappe_app = app_per_giorno.get(giorno, [])
-            giro_app = list(tappe_app) + risultati_app[giorno]
-            if len(giro_app) >= 3:
-                giro_app = costruisci_anello(giro_app, base_lat, base_lon)
-            risultati[giorno] = (data_g, giro_app)
-            for c in giro_app:
-                pool_per_giorni = [p for p in pool_per_giorni if p['nome'] != c['nome']]
+    # 2. POOL
+    pool = traccia.get('pool')
+    if pool:
+        righe.append("\n## 🧺 Pool della Settimana")
+        righe.append(f"- 🔴 **Scaduti o in scadenza (entro 2 settimane):** {pool['scaduti_o_in_scadenza']}")
+        righe.append(f"- 🔵 **Mai visitati:** {pool['mai_visitati']}")
+        righe.append(f"- 📌 **Con appuntamento in settimana:** {pool['appuntamenti']}")
+        righe.append(f"- ⚪ **Riserva (oltre 2 settimane):** {pool['riserva']} "
+                     f"{'→ usata' if pool['riserva_usata'] else '→ non usata, pool già pieno'}")
+        righe.append(f"- **TOTALE nel pool:** {pool['totale']} (capienza stimata: {pool['capienza_settimana']} visite, "
+                     f"~{traccia.get('max_visite', '?')}/giorno)")
     
-    # Giorni senza appuntamento
-    giorni_liberi = [g for g in giorni_calcolo if g not in risultati_app]
-    n_giorni_liberi = len(giorni_liberi)
+    # 3. GIORNI
+    if traccia.get('giorni'):
+        righe.append("\n## 📅 Giorni")
+        per_giorno = {}
+        for v in esiti.values():
+            if v['esito'] == 'pianificato':
+                per_giorno[v['giorno']] = per_giorno.get(v['giorno'], 0) + 1
+        for g, stato in traccia['giorni'].items():
+            dettaglio = f"**{GIORNI_BREVI[g]}:** {stato}, {per_giorno.get(g, 0)} visite"
+            if g in traccia.get('giorni_appuntamento', {}):
+                info = traccia['giorni_appuntamento'][g]
+                dettaglio += f" — 📌 {', '.join(info['appuntamenti'])} + {info['vicini_aggiunti']} clienti vicini"
+            elif g in traccia.get('cluster_giorni', {}):
+                info = traccia['cluster_giorni'][g]
+                dettaglio += f" — cluster di {info['clienti']} clienti, {info['selezionati']} entrano nella giornata"
+            righe.append(f"- {dettaglio}")
     
-    if n_giorni_liberi > 0 and pool_per_giorni:
-        # K-means: raggruppa TUTTI i clienti in N cluster geografici
-        if len(pool_per_giorni) >= n_giorni_liberi:
-            cluster_giorni, _ = kmeans_geo(pool_per_giorni, n_giorni_liberi)
-        else:
-            cluster_giorni = [pool_per_giorni] + [[] for _ in range(n_giorni_liberi - 1)]
-        
-        # Ordina cluster per angolo dalla base
-        cluster_con_angolo = []
-        for cl in cluster_giorni:
-            if cl:
-                cx = sum(c['lat'] for c in cl) / len(cl)
-                cy = sum(c['lon'] for c in cl) / len(cl)
-                angle = math_degrees(atan2(cx - base_lat, cy - base_lon)) % 360
-            else:
-                angle = 999
-            cluster_con_angolo.append((angle, cl))
-        cluster_con_angolo.sort(key=lambda x: x[0])
-        
-        # Ruota per settimana + variante
-        shift = (numero_settimana + variante) % max(1, len(cluster_con_angolo))
-        cluster_con_angolo = cluster_con_angolo[shift:] + cluster_con_angolo[:shift]
-        
-        # === SIMULAZIONE TEMPO REALE per ogni giorno ===
-        def simula_giornata(clienti_candidati, data_g):
-            """Simula una giornata di lavoro e ritorna i clienti che ci stanno nel tempo."""
-            if not clienti_candidati:
-                return []
-            
-            # Ordina candidati per urgenza (i più urgenti prima nella selezione)
-            candidati = sorted(clienti_candidati, key=lambda c: -c['urgenza'])
-            
-            # Costruisci il giro con nearest-neighbor rispettando il tempo
-            selezionati = []
-            usati = set()
-            
-            pos_lat, pos_lon = base_lat, base_lon
-            ora_corrente = datetime.combine(data_g, ora_inizio)
-            ora_limite = datetime.combine(data_g, ora_fine)
-            
-            while candidati:
-                # Trova il miglior candidato: urgenza alta + vicino alla posizione corrente
-                migliore = None
-                migliore_score = -999
-                migliore_idx = -1
-                
-                for idx, c in enumerate(candidati):
-                    if c['nome'] in usati:
-                        continue
-                    
-                    dist = haversine(pos_lat, pos_lon, c['lat'], c['lon'])
-                    tempo_viaggio_min = (dist / velocita_media) * 60
-                    
-                    # Score: urgenza normalizzata - penalità distanza
-                    # 1km = ~1.2 minuti = penalità proporzionale
-                    score = c['urgenza'] - tempo_viaggio_min * 1.5
-                    
-                    if score > migliore_score:
-                        migliore_score = score
-                        migliore = c
-                        migliore_idx = idx
-                
-                if migliore is None:
-                    break
-                
-                # Calcola tempo necessario per questa visita
-                dist_al_cliente = haversine(pos_lat, pos_lon, migliore['lat'], migliore['lon'])
-                tempo_viaggio = (dist_al_cliente / velocita_media) * 60  # minuti
-                
-                arrivo = ora_corrente + timedelta(minutes=tempo_viaggio)
-                
-                # Gestisci pausa pranzo
-                if arrivo.time() >= pausa_da and arrivo.time() < pausa_a:
-                    arrivo = datetime.combine(data_g, pausa_a) + timedelta(minutes=tempo_viaggio)
-                
-                fine_visita = arrivo + timedelta(minutes=durata_visita)
-                
-                # Calcola tempo di ritorno alla base dopo questa visita
-                dist_ritorno = haversine(migliore['lat'], migliore['lon'], base_lat, base_lon)
-                tempo_ritorno = (dist_ritorno / velocita_media) * 60
-                ora_rientro = fine_visita + timedelta(minutes=tempo_ritorno)
-                
-                # Se non c'è tempo per visitare + tornare, fermati
-                if ora_rientro > ora_limite + timedelta(minutes=15):  # 15min tolleranza
-                    break
-                
-                # Accetta questa visita
-                selezionati.append(migliore)
-                usati.add(migliore['nome'])
-                candidati = [c for c in candidati if c['nome'] != migliore['nome']]
-                
-                pos_lat, pos_lon = migliore['lat'], migliore['lon']
-                ora_corrente = fine_visita
-            
-            return selezionati
-        
-        # Assegna cluster ai giorni con simulazione tempo
-        for idx_g, giorno in enumerate(giorni_liberi):
-            data_g = lunedi + timedelta(days=giorno)
-            
-            if idx_g < len(cluster_con_angolo):
-                clienti_cluster = cluster_con_angolo[idx_g][1]
-            else:
-                clienti_cluster = []
-            
-            if not clienti_cluster:
-                risultati[giorno] = (data_g, [])
-                continue
-            
-            # Simula la giornata: il tempo decide quanti clienti ci stanno
-            giro = simula_giornata(clienti_cluster, data_g)
-            
-            # Ottimizza il percorso finale con 2-OPT
-            if len(giro) >= 3:
-                giro = costruisci_anello(giro, base_lat, base_lon)
-            elif len(giro) == 2:
-                d1 = circuito_dist(giro, base_lat, base_lon)
-                d2 = circuito_dist(list(reversed(giro)), base_lat, base_lon)
-                if d2 < d1:
-                    giro = list(reversed(giro))
-            
-            risultati[giorno] = (data_g, giro)
+    # 4. K-MEANS
+    if traccia.get('kmeans'):
+        righe.append("\n## 🧮 K-Means")
+        for km in traccia['kmeans']:
+            conv = "convergenza" if km['convergenza'] else "⚠️ limite di iterazioni"
+            righe.append(f"- **{km['fase']}:** {km['n']} clienti in {km['k']} gruppi, {km['iterazioni']} iterazioni ({conv})")
+    st.markdown("\n".join(righe))
     
-    # ========================================
-    # 12. CALCOLO ORARI FINALI (con tempi reali)
-    # ========================================
-    for giorno in giorni_calcolo:
-        data_g, giro = risultati.get(giorno, (lunedi + timedelta(days=giorno), []))
-        
-        tappe_finali = []
-        pos_lat, pos_lon = base_lat, base_lon
-        ora = datetime.combine(data_g, ora_inizio)
-        
-        for c in giro:
-            dist = haversine(pos_lat, pos_lon, c['lat'], c['lon'])
-            tempo = (dist / velocita_media) * 60
-            
-            if c.get('is_app'):
-                ora_arr = c.get('ora_app', '09:00')
-            else:
-                arrivo = ora + timedelta(minutes=tempo)
-                if arrivo.time() >= pausa_da and arrivo.time() < pausa_a:
-                    ora = datetime.combine(data_g, pausa_a)
-                    arrivo = ora + timedelta(minutes=tempo)
-                ora_arr = arrivo.strftime('%H:%M')
-                ora = arrivo + timedelta(minutes=durata_visita)
-            
-            tappe_finali.append({
-                'id': c['id'],
-                'nome_cliente': c['nome'],
-                'latitude': c['lat'],
-                'longitude': c['lon'],
-                'indirizzo': c.get('ind', ''),
-                'cellulare': c.get('cell', ''),
-                'ora_arrivo': ora_arr,
-                'tipo_tappa': '📌 APPUNTAMENTO' if c.get('is_app') else '🚗 Giro',
-                'distanza_km': round(dist, 1),
-                'ritardo': c.get('giorni_ritardo', 0),
-                'citta': c.get('citta', ''),
-                'urgenza': c.get('urgenza', 0)
-            })
-            pos_lat, pos_lon = c['lat'], c['lon']
-        
-        agenda[giorno] = tappe_finali
+    # 5. TEMPI PER FASE
+    tempi = traccia.get('tempi_ms', {})
+    if tempi:
+        st.markdown(f"## ⏱️ Tempi per Fase — totale {sum(tempi.values()):.0f} ms")
+        st.dataframe(pd.DataFrame([{'Fase': NOMI_FASI_PIANIFICATORE.get(f, f), 'ms': ms} for f, ms in tempi.items()]),
+                     hide_index=True, use_container_width=True)
     
-    return agenda
+    # 6. ZONE
+    if traccia.get('zone'):
+        with st.expander(f"🗺️ Zone geografiche ({len(traccia['zone'])})"):
+            st.caption("Zone del pool ordinate per angolo dalla base, con il giorno assegnato. "
+                       "I clienti dei giorni senza appuntamento vengono poi scelti dal k-means sui giorni liberi.")
+            st.dataframe(pd.DataFrame([{
+                'Clienti': z['clienti'], 'Urgenza media': z['urgenza_media'], 'Angolo': z['angolo'],
+                'Centro': f"{z['centro'][0]}, {z['centro'][1]}",
+                'Giorno': GIORNI_BREVI[z['giorno']] if z['giorno'] is not None else ''
+            } for z in traccia['zone']]), hide_index=True, use_container_width=True)
+    
+    # 7. ESITO CLIENTI
+    if esiti:
+        st.markdown("## ❓ Clienti Urgenti NON Pianificati")
+        mancanti = sorted((v for v in esiti.values() if v['esito'] == 'scartato' and v.get('urgenza', 0) >= 25),
+                          key=lambda v: -v['urgenza'])
+        if mancanti:
+            st.markdown("\n".join([f"**{len(mancanti)} clienti con urgenza ≥25 non pianificati:**"] + [
+                f"- **{v['nome']}** (urg: {v['urgenza']}) — {v['motivo']}" for v in mancanti[:20]
+            ]))
+        else:
+            st.markdown("✅ Tutti i clienti urgenti sono nell'agenda")
+        with st.expander(f"👥 Esito di tutti i clienti ({len(esiti)})"):
+            df_esiti = pd.DataFrame([{
+                'Cliente': v['nome'], 'Esito': v['esito'], 'Motivo': v['motivo'],
+                'Giorno': GIORNI_BREVI[v['giorno']] if v.get('giorno') is not None else '',
+                'Urgenza': v.get('urgenza'), 'Prossima visita': v.get('prossima_visita')
+            } for v in esiti.values()])
+            filtro = st.multiselect("Esito", ['pianificato', 'scartato'], default=['scartato'], key="dbg_filtro_esito")
+            st.dataframe(df_esiti[df_esiti['Esito'].isin(filtro)].sort_values('Urgenza', ascending=False),
+                         hide_index=True, use_container_width=True)
 
+# --- PANNELLO PRESTAZIONI (?perf=1 o interruttore admin) ---
+# In fondo alla pagina, dopo main_app: vede tutte le chiamate del rerun appena finito.
+def sospetti_n_piu_1(chiamate, soglia=PERF_SOGLIA_N_PIU_1):
+    """Avvisi per richieste ripetute nello stesso rerun: stessa firma con parametri diversi
+    (N+1, es. un conteggio per agente) o la stessa identica richiesta più volte"""
+    gruppi = {}
+    for c in chiamate:
+        if not c['cache']:
+            gruppi.setdefault((c['categoria'], c['firma']), []).append(c)
+    avvisi = []
+    for (categoria, firma), lista in gruppi.items():
+        distinti = len({c['dettaglio'] for c in lista})
+        ms = sum(c['ms'] for c in lista)
+        if distinti >= soglia:
+            avvisi.append(f"🔁 **N+1 sospetto** ({categoria}): `{firma}` × {len(lista)} con parametri diversi, "
+                          f"{ms:.0f} ms. Meglio una sola query con in_() o un conteggio aggregato.")
+        elif len(lista) > distinti:
+            avvisi.append(f"♻️ **Richiesta ripetuta** ({categoria}): `{firma}` × {len(lista)} "
+                          f"con gli stessi parametri, {ms:.0f} ms.")
+    return avvisi
 
-def calcola_piano_giornaliero(df, giorno_settimana, config, esclusi=[], variante=0):
-    """Restituisce il piano per il giorno corrente"""
-    agenda = calcola_agenda_settimanale(df, config, esclusi, settimana_offset=0, variante=variante)
-    return agenda.get(giorno_settimana, [])
+def _tabella_totali(righe):
+    """DataFrame per (categoria, operazione) da righe [categoria, operazione, n, cache, ms, byte]"""
+    df_tot = pd.DataFrame(righe, columns=['Categoria', 'Operazione', 'Chiamate', 'Cache hit', 'ms', 'byte'])
+    df_tot['ms'] = df_tot['ms'].round(1)
+    df_tot['KB'] = (df_tot.pop('byte') / 1024).round(1)
+    return df_tot.sort_values('ms', ascending=False)
 
-# --- 6. GOOGLE MAPS ROUTING FUNCTIONS ---
-def _gm_request(method, url, **kwargs):
-    """Request con retry e backoff esponenziale."""
-    kwargs.setdefault('timeout', 15)
-    for attempt in range(3):
-        try:
-            resp = requests.request(method, url, **kwargs)
-            if resp.status_code == 429 or resp.status_code >= 500:
-                time_module.sleep(1.0 * (2 ** attempt))
-                continue
-            return resp
-        except requests.exceptions.Timeout:
-            if attempt < 2:
-                time_module.sleep(1.0 * (2 ** attempt))
-                continue
-            raise
-    return resp
+def pannello_prestazioni(rerun):
+    """Chiamate del rerun appena eseguito, sospetti N+1 e totali di sessione"""
+    chiamate = rerun['chiamate']
+    rete = [c for c in chiamate if not c['cache']]
+    st.divider()
+    with st.expander(f"⏱️ Prestazioni rerun: {rerun['ms']:.0f} ms, {len(rete)} chiamate di rete", expanded=True):
+        c1, c2, c3, c4, c5 = st.columns(5)
+        c1.metric("Rerun", f"{rerun['ms']:.0f} ms")
+        c2.metric("Chiamate di rete", len(rete))
+        c3.metric("Tempo in rete", f"{sum(c['ms'] for c in rete):.0f} ms")
+        c4.metric("Payload", f"{sum(c['byte'] for c in rete) / 1024:.1f} KB")
+        c5.metric("Cache hit", len(chiamate) - len(rete))
+        for avviso in sospetti_n_piu_1(chiamate):
+            st.warning(avviso)
 
-def google_route_matrix(points, api_key):
-    """
-    Matrice NxN tempi/distanze reali via Google Routes API.
-    points: lista di (lat, lon)
-    Ritorna: (dur_matrix, dist_matrix) o (None, None)
-    """
-    if not api_key or len(points) < 2:
-        return None, None
-    url = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
-    wps = [{"waypoint": {"location": {"latLng": {"latitude": p[0], "longitude": p[1]}}}} for p in points]
-    body = {"origins": wps, "destinations": wps, "travelMode": "DRIVE", "routingPreference": "TRAFFIC_UNAWARE"}
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Goog-Api-Key': api_key,
-        'X-Goog-FieldMask': 'originIndex,destinationIndex,duration,distanceMeters,status'
-    }
-    try:
-        resp = _gm_request('POST', url, json=body, headers=headers)
-        if resp.status_code != 200:
-            st.session_state._google_last_error = f"Route Matrix HTTP {resp.status_code}: {resp.text[:200]}"
-            return None, None
-        n = len(points)
-        dur = [[0]*n for _ in range(n)]
-        dist = [[0]*n for _ in range(n)]
-        for elem in resp.json():
-            i, j = elem.get('originIndex', 0), elem.get('destinationIndex', 0)
-            d_str = elem.get('duration', '0s')
-            dur[i][j] = int(d_str.rstrip('s')) if isinstance(d_str, str) else int(d_str)
-            dist[i][j] = int(elem.get('distanceMeters', 0))
-        return dur, dist
-    except Exception as e:
-        st.session_state._google_last_error = f"Route Matrix: {str(e)[:200]}"
-        return None, None
+        tab_rerun, tab_elenco, tab_sessione = st.tabs(["📊 Rerun", "📋 Chiamate", "🗂️ Sessione"])
+        with tab_rerun:
+            if chiamate:
+                gruppi = {}
+                for c in chiamate:
+                    voce = gruppi.setdefault((c['categoria'], c['operazione']), [0, 0, 0.0, 0])
+                    voce[0] += 1
+                    voce[1] += c['cache']
+                    voce[2] += c['ms']
+                    voce[3] += c['byte']
+                st.dataframe(_tabella_totali([[*k, *v] for k, v in gruppi.items()]), hide_index=True, use_container_width=True)
+            else:
+                st.caption("Nessuna chiamata di rete in questo rerun")
+        with tab_elenco:
+            if chiamate:
+                st.dataframe(pd.DataFrame([{
+                    '#': i + 1, 'Categoria': c['categoria'], 'Richiesta': c['dettaglio'] or c['operazione'],
+                    'ms': round(c['ms'], 1), 'KB': round(c['byte'] / 1024, 1), 'Cache': '✅' if c['cache'] else ''
+                } for i, c in enumerate(chiamate)]), hide_index=True, use_container_width=True)
+            st.caption("Byte Supabase stimati dal JSON restituito; i rerun dei soli fragment e i job in background non sono misurati.")
+        with tab_sessione:
+            totali = st.session_state.get('_perf_sessione', {})
+            if totali:
+                st.dataframe(_tabella_totali([[*k, *v] for k, v in totali.items()]), hide_index=True, use_container_width=True)
+            storico = st.session_state.get('_perf_storico', [])
+            if storico:
+                st.markdown("**Ultimi rerun**")
+                st.dataframe(pd.DataFrame([{
+                    'Ora': r['ora'], 'ms': round(r['ms']), 'Chiamate': r['n'], 'Cache hit': r['cache'],
+                    'ms rete': round(r['ms_rete']), 'KB': round(r['byte'] / 1024, 1),
+                    'Esito': "↪️ interrotto (st.rerun)" if r['interrotto'] else "✅"
+                } for r in reversed(storico)]), hide_index=True, use_container_width=True)
+            if st.button("🧹 Azzera misure di sessione", key="perf_azzera"):
+                st.session_state.pop('_perf_sessione', None)
+                st.session_state.pop('_perf_storico', None)
+                st.rerun()
 
-def google_compute_route(origin, destination, waypoints, api_key):
-    """
-    Percorso dettagliato con polyline via Google Routes API.
-    origin/destination: (lat, lon)
-    waypoints: [(lat, lon), ...]
-    Ritorna: dict con polyline, duration_s, distance_m, legs o None
-    """
-    if not api_key:
-        return None
-    url = "https://routes.googleapis.com/directions/v2:computeRoutes"
-    def mkloc(p):
-        return {"location": {"latLng": {"latitude": p[0], "longitude": p[1]}}}
-    body = {
-        "origin": mkloc(origin),
-        "destination": mkloc(destination),
-        "travelMode": "DRIVE", "routingPreference": "TRAFFIC_UNAWARE",
-        "computeAlternativeRoutes": False, "polylineEncoding": "ENCODED_POLYLINE"
-    }
-    if waypoints:
-        body["intermediates"] = [mkloc(wp) for wp in waypoints]
-    headers = {
-        'Content-Type': 'application/json',
-        'X-Goog-Api-Key': api_key,
-        'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline,routes.legs.duration,routes.legs.distanceMeters'
-    }
-    try:
-        resp = _gm_request('POST', url, json=body, headers=headers)
-        if resp.status_code != 200:
-            st.session_state._google_last_error = f"Compute Route HTTP {resp.status_code}: {resp.text[:200]}"
-            return None
-        routes = resp.json().get('routes', [])
-        if not routes:
-            return None
-        r = routes[0]
-        dur_s = r.get('duration', '0s')
-        total_dur = int(dur_s.rstrip('s')) if isinstance(dur_s, str) else int(dur_s)
-        legs = []
-        for leg in r.get('legs', []):
-            ld = leg.get('duration', '0s')
-            legs.append({
-                'dur_s': int(ld.rstrip('s')) if isinstance(ld, str) else int(ld),
-                'dist_m': int(leg.get('distanceMeters', 0))
-            })
-        return {
-            'polyline': r.get('polyline', {}).get('encodedPolyline', ''),
-            'duration_s': total_dur,
-            'distance_m': int(r.get('distanceMeters', 0)),
-            'legs': legs
-        }
-    except Exception as e:
-        st.session_state._google_last_error = f"Compute Route: {str(e)[:200]}"
-        return None
+# --- AVVIO SESSIONE (query in parallelo) ---
+# Al primo render dopo il login le query indipendenti partono insieme su un pool di thread
+# con una scadenza comune: un solo giro di rete invece di sette/otto in fila.
+# I thread non toccano st.session_state (user_id passato esplicitamente); i risultati
+# vengono scritti in sessione qui, nel thread di Streamlit. Quello che non arriva entro
+# la scadenza viene caricato dopo, come prima, dai singoli blocchi di main_app.
+BOOTSTRAP_TIMEOUT_SECONDI = 8
 
-def held_karp_tsp(dist_matrix, start=0):
-    """TSP esatto Held-Karp per ≤12 punti. Ritorna (path, cost)."""
-    n = len(dist_matrix)
-    if n <= 1: return [start], 0
-    if n == 2:
-        other = 1 - start
-        return [start, other], dist_matrix[start][other] + dist_matrix[other][start]
-    INF = float('inf')
-    dp = [[INF]*n for _ in range(1 << n)]
-    parent = [[-1]*n for _ in range(1 << n)]
-    dp[1 << start][start] = 0
-    for S in range(1 << n):
-        for u in range(n):
-            if dp[S][u] == INF or not (S & (1 << u)): continue
-            for v in range(n):
-                if S & (1 << v): continue
-                nS = S | (1 << v)
-                nc = dp[S][u] + dist_matrix[u][v]
-                if nc < dp[nS][v]:
-                    dp[nS][v] = nc; parent[nS][v] = u
-    full = (1 << n) - 1
-    best_c, best_l = INF, -1
-    for u in range(n):
-        c = dp[full][u] + dist_matrix[u][start]
-        if c < best_c: best_c = c; best_l = u
-    path = []; S = full; u = best_l
-    while u != -1:
-        path.append(u); prev = parent[S][u]; S ^= (1 << u); u = prev
-    path.reverse()
-    if path and path[0] != start:
-        try:
-            idx = path.index(start); path = path[idx:] + path[:idx]
-        except: path = [start] + path
-    return path, best_c
-
-def nn_2opt_tsp(dist_matrix, start=0):
-    """TSP euristica NN + 2-opt per >12 punti."""
-    n = len(dist_matrix)
-    visited = [False]*n; path = [start]; visited[start] = True
-    for _ in range(n-1):
-        cur = path[-1]; best_n, best_d = -1, float('inf')
-        for j in range(n):
-            if not visited[j] and dist_matrix[cur][j] < best_d:
-                best_d = dist_matrix[cur][j]; best_n = j
-        if best_n == -1: break
-        path.append(best_n); visited[best_n] = True
-    def rc(p):
-        c = sum(dist_matrix[p[i]][p[i+1]] for i in range(len(p)-1))
-        return c + dist_matrix[p[-1]][start]
-    improved = True
-    while improved:
-        improved = False; bc = rc(path)
-        for i in range(1, len(path)-1):
-            for j in range(i+2, len(path)):
-                np2 = path[:i+1] + path[i+1:j+1][::-1] + path[j+1:]
-                if rc(np2) < bc - 1: path = np2; improved = True; break
-            if improved: break
-    return path, rc(path)
+def _carica_team_e_clienti(user_id):
+    """Il filtro clienti dipende dal ruolo: team e clienti restano in sequenza nello stesso thread"""
+    team_info = get_user_team_info(user_id)
+    versione, righe = _scarica_clienti(user_id, team_info)
+    return team_info, versione, righe, df_clienti_da_righe(righe)
 
-def ottimizza_ordine_con_google(tappe, base_lat, base_lon, api_key):
-    """
-    Prende le tappe calcolate dall'algoritmo e le RIORDINA
-    usando la matrice tempi reali di Google + TSP esatto.
-    Ritorna: (tappe_riordinate, route_info) — route_info ha polyline e legs.
-    """
-    if not api_key or len(tappe) < 2:
-        return tappe, None
-    
-    # Costruisci punti: [BASE] + [tappe...]
-    pts = [(base_lat, base_lon)]
-    for t in tappe:
-        pts.append((t['latitude'], t['longitude']))
-    
-    # Matrice tempi reali
-    dur_matrix, dist_matrix = google_route_matrix(pts, api_key)
-    if dur_matrix is None:
-        return tappe, None
-    
-    # TSP
-    n = len(pts)
-    if n <= 12:
-        order, cost = held_karp_tsp(dur_matrix, start=0)
-    else:
-        order, cost = nn_2opt_tsp(dur_matrix, start=0)
-    
-    # Riordina tappe (salta indice 0 = base)
-    nuove_tappe = []
-    for idx in order:
-        if idx == 0: continue
-        ti = idx - 1
-        if 0 <= ti < len(tappe):
-            nuove_tappe.append(tappe[ti])
-    
-    # Ricalcola distanze e orari nelle tappe
-    prev_lat, prev_lon = base_lat, base_lon
-    for t in nuove_tappe:
-        t['distanza_km'] = round(haversine(prev_lat, prev_lon, t['latitude'], t['longitude']), 1)
-        prev_lat, prev_lon = t['latitude'], t['longitude']
-    
-    # Percorso dettagliato con polyline
-    wps = [(t['latitude'], t['longitude']) for t in nuove_tappe]
-    route = google_compute_route((base_lat, base_lon), (base_lat, base_lon), wps, api_key)
-    
-    # Aggiorna tempi/distanze nelle tappe con dati reali Google
-    if route and route.get('legs'):
-        legs = route['legs']
-        for i, t in enumerate(nuove_tappe):
-            if i < len(legs):
-                t['distanza_km'] = round(legs[i]['dist_m'] / 1000, 1)
-                t['tempo_guida_min'] = legs[i]['dur_s'] // 60
-    
-    return nuove_tappe, route
-
-def decode_google_polyline(encoded):
-    """Decodifica polyline Google → [(lat, lon), ...]"""
-    pts = []; idx = 0; lat = 0; lng = 0
-    while idx < len(encoded):
-        for coord in ['lat', 'lng']:
-            shift = 0; result = 0
-            while True:
-                b = ord(encoded[idx]) - 63; idx += 1
-                result |= (b & 0x1F) << shift; shift += 5
-                if b < 0x20: break
-            delta = ~(result >> 1) if (result & 1) else (result >> 1)
-            if coord == 'lat': lat += delta
-            else: lng += delta
-        pts.append((lat/1e5, lng/1e5))
-    return pts
+def bootstrap_sessione():
+    """Carica in parallelo abbonamento, team+clienti, config, scambi e giro salvato di oggi.
+    Gira una sola volta per sessione; ritorna i risultati arrivati in tempo (nome → valore)"""
+    user_id = get_user_id()
+    if not user_id or st.session_state.get('_bootstrap_fatto'):
+        return {}
+    st.session_state._bootstrap_fatto = True
+    oggi_str = ora_italiana.strftime('%Y-%m-%d')
+    compiti = {
+        'subscription': (get_user_subscription, user_id),
+        'clienti': (_carica_team_e_clienti, user_id),
+        'config': (fetch_config, user_id),
+        'scambi_giorni': (load_scambi_giorni, user_id),
+        'giro_salvato': (load_giro_giorno, oggi_str, user_id),
+    }
+    pool = ThreadPoolExecutor(max_workers=len(compiti), thread_name_prefix='bootstrap')
+    # copy_context: le query dei thread finiscono nelle misure di questo rerun (?perf=1)
+    futures = {pool.submit(contextvars.copy_context().run, fn, *args): nome for nome, (fn, *args) in compiti.items()}
+    fatti, _ = wait(futures, timeout=BOOTSTRAP_TIMEOUT_SECONDI)
+    pool.shutdown(wait=False, cancel_futures=True)
+    risultati = {futures[f]: f.result() for f in fatti if f.exception() is None}
+
+    if risultati.get('subscription'):
+        st.session_state.subscription = risultati['subscription']
+        memorizza_subscription(user_id, risultati['subscription'])
+    if 'clienti' in risultati:
+        team_info, versione, righe, df = risultati['clienti']
+        st.session_state.team_info = team_info
+        inizia_sincronizzazione(versione, righe)
+        st.session_state.df_clienti = df
+        st.session_state.reload_data = False
+        st.session_state.df_version = st.session_state.get('df_version', 0) + 1
+    if 'config' in risultati:
+        st.session_state.config = risultati['config'] or config_predefinita()
+    if 'scambi_giorni' in risultati:
+        st.session_state.scambi_giorni = risultati['scambi_giorni']
+    if 'giro_salvato' in risultati:
+        st.session_state[f'_memo_giro_salvato_{oggi_str}'] = (st.session_state.get('_giro_salvato_versione', 0), risultati['giro_salvato'])
+    return risultati
 
-# --- 7. MAIN APP ---
 def main_app():
     # Verifica che l'utente sia ancora valido
     if not st.session_state.user:
@@ -2580,9 +3604,13 @@ def main_app():
         except:
             pass
     
-    # Verifica abbonamento
-    subscription = st.session_state.get('subscription')
-    user_is_admin = is_admin(st.session_state.user.id) if st.session_state.user else False
+    # Primo render: tutte le query di avvio in parallelo
+    bootstrap_sessione()
+
+    # Verifica abbonamento (cache di sessione: una query al massimo ogni SUBSCRIPTION_TTL_SECONDI)
+    subscription = get_subscription_sessione(st.session_state.user.id) or st.session_state.get('subscription')
+    st.session_state.subscription = subscription
+    user_is_admin = is_admin(st.session_state.user.id)
     
     # Carica info team (una volta)
     if 'team_info' not in st.session_state:
@@ -2666,32 +3694,26 @@ def main_app():
             if st.button("🔐 Pannello Admin", use_container_width=True, type="primary"):
                 st.session_state.active_tab = "🔐 Admin"
                 st.rerun()
+            st.toggle("⏱️ Misure prestazioni", key='_perf_admin',
+                      help="Query Supabase e chiamate esterne di ogni rerun (pannello in fondo alla pagina). Anche con ?perf=1 nell'URL.")
     
     # Carica dati
     if 'df_clienti' not in st.session_state or st.session_state.get('reload_data', False):
         st.session_state.df_clienti = fetch_clienti()
         st.session_state.reload_data = False
+        st.session_state.df_version = st.session_state.get('df_version', 0) + 1
+        segna_giro_salvato_modificato()
+    else:
+        # Controllo leggero: una riga per ambito, differenze solo se il contatore è cambiato
+        controlla_versione_dati()
+        if st.session_state.get('reload_data', False):
+            st.session_state.df_clienti = fetch_clienti()
+            st.session_state.reload_data = False
+            st.session_state.df_version = st.session_state.get('df_version', 0) + 1
     
     if 'config' not in st.session_state:
-        config = fetch_config()
-        if config:
-            st.session_state.config = config
-        else:
-            st.session_state.config = {
-                'citta_base': 'Roma',
-                'lat_base': 41.9028,
-                'lon_base': 12.4964,
-                'h_inizio': '09:00',
-                'h_fine': '18:00',
-                'pausa_inizio': '13:00',
-                'pausa_fine': '14:00',
-                'durata_visita': 45,
-                'giorni_lavorativi': [0, 1, 2, 3, 4],
-                'attiva_ferie': False,
-                'ferie_inizio': None,
-                'ferie_fine': None
-            }
-    
+        st.session_state.config = fetch_config() or config_predefinita()
+
     if 'esclusi_oggi' not in st.session_state:
         st.session_state.esclusi_oggi = []
     if 'visitati_oggi' not in st.session_state:
@@ -2699,15 +3721,7 @@ def main_app():
     if 'cliente_selezionato' not in st.session_state:
         st.session_state.cliente_selezionato = None
     
-    # Carica visitati oggi dal database
     df = st.session_state.df_clienti
-    oggi_str = ora_italiana.strftime('%Y-%m-%d')
-    for _, row in df.iterrows():
-        if pd.notnull(row.get('ultima_visita')):
-            if hasattr(row['ultima_visita'], 'strftime'):
-                if row['ultima_visita'].strftime('%Y-%m-%d') == oggi_str:
-                    if row['nome_cliente'] not in st.session_state.visitati_oggi:
-                        st.session_state.visitati_oggi.append(row['nome_cliente'])
     
     # Se è il pannello admin, mostralo
     if st.session_state.active_tab == "🔐 Admin":
@@ -2726,10 +3740,6 @@ def main_app():
     if isinstance(giorni_lavorativi, str):
         giorni_lavorativi = [int(x) for x in giorni_lavorativi.strip('{}').split(',')]
     
-    # Inizializza scambi giorni (carica da Supabase se primo accesso)
-    if 'scambi_giorni' not in st.session_state:
-        st.session_state.scambi_giorni = load_scambi_giorni()
-    
     # --- TAB: GIRO OGGI ---
     if st.session_state.active_tab == "🚀 Giro Oggi":
         col_header, col_regen, col_refresh = st.columns([4, 1, 1])
@@ -2751,7 +3761,9 @@ def main_app():
         
         # === CARICA GIRO SALVATO DA DB ===
         oggi_str = ora_italiana.strftime('%Y-%m-%d')
-        giro_salvato = load_giro_giorno(oggi_str)
+        giro_salvato = dati_giro_salvato(oggi_str)
+        dati_visitati_oggi(df)
+        scambi_giorni = dati_scambi_giorni()
         
         # Ripristina variante/esclusi dal giro salvato (persistenza cross-device)
         if giro_salvato and 'esclusi_oggi' not in st.session_state:
@@ -2870,8 +3882,8 @@ def main_app():
             chiave_sett_oggi = lunedi_oggi.isoformat()
             idx_effettivo = idx_g  # giorno effettivo da mostrare
             
-            if chiave_sett_oggi in st.session_state.get('scambi_giorni', {}):
-                for s_idx1, s_idx2 in st.session_state.scambi_giorni[chiave_sett_oggi]:
+            if chiave_sett_oggi in scambi_giorni:
+                for s_idx1, s_idx2 in scambi_giorni[chiave_sett_oggi]:
                     if s_idx1 == idx_g:
                         idx_effettivo = s_idx2
                     elif s_idx2 == idx_g:
@@ -2896,36 +3908,56 @@ def main_app():
             
             if tappe_oggi is None:
                 # Calcola nuovo giro
-                tappe_oggi = calcola_piano_giornaliero(df, idx_effettivo, config, st.session_state.esclusi_oggi, variante=variante)
+                traccia_giro = {}
+                tappe_oggi = calcola_piano_giornaliero(df, idx_effettivo, config, st.session_state.esclusi_oggi, variante=variante,
+                                                       routing=get_routing_backend_pianificazione(), oggi=ora_italiana.date(),
+                                                       traccia=traccia_giro)
+                memorizza_traccia_pianificatore("🚀 Giro Oggi", traccia_giro, variante, st.session_state.esclusi_oggi)
                 
                 # Segna che è un giro nuovo da salvare
                 _giro_da_salvare = True
             else:
                 _giro_da_salvare = False
             
-            # OTTIMIZZAZIONE ORDINE CON GOOGLE MAPS (tempi stradali reali + TSP)
-            if tappe_oggi and len(tappe_oggi) >= 2 and GOOGLE_MAPS_API_KEY:
+            # OTTIMIZZAZIONE ORDINE CON IL MOTORE PERCORSI (tempi stradali reali + TSP)
+            routing = get_routing_backend()
+            if tappe_oggi and len(tappe_oggi) >= 2 and routing is not None:
                 cache_key = f"route_{idx_effettivo}_{variante}_{len(tappe_oggi)}_{','.join(t['nome_cliente'][:5] for t in tappe_oggi[:3])}"
-                if st.session_state.get('_route_cache_key') != cache_key:
+                # Percorso già calcolato e salvato col giro (altro dispositivo / sessione precedente)
+                route_salvata = None
+                if not _giro_da_salvare and st.session_state.get('_route_cache_key') != cache_key:
+                    route_salvata = route_salvata_per_ids(giro_salvato, [t['id'] for t in tappe_oggi])
+                
+                if route_salvata:
+                    route_info = dict(route_salvata)
+                    applica_legs_a_tappe(tappe_oggi, route_info.get('legs'))
+                    st.session_state._route_cache_key = cache_key
+                    st.session_state._route_info = route_info
+                    st.session_state._route_errore = ''
+                    st.session_state._tappe_ottimizzate = tappe_oggi
+                elif st.session_state.get('_route_cache_key') != cache_key:
                     try:
-                        tappe_oggi, route_info = ottimizza_ordine_con_google(
+                        tappe_oggi, route_info = ottimizza_ordine_percorso(
                             tappe_oggi,
                             float(config.get('lat_base', 0)),
                             float(config.get('lon_base', 0)),
-                            GOOGLE_MAPS_API_KEY
+                            routing
                         )
                         st.session_state._route_cache_key = cache_key
                         st.session_state._route_info = route_info
+                        # Errore di questa chiamata ('' se riuscita): il motore è condiviso tra le sessioni
+                        st.session_state._route_errore = routing.last_error
                         st.session_state._tappe_ottimizzate = tappe_oggi
-                        _giro_da_salvare = True  # ordine cambiato da Google
+                        _giro_da_salvare = True  # ordine cambiato dal motore percorsi
                         if route_info and route_info.get('polyline'):
-                            st.toast("🛣️ Giro ottimizzato con Google Maps!", icon="✅")
+                            st.toast(f"🛣️ Giro ottimizzato con {routing.etichetta}!", icon="✅")
                         else:
-                            st.toast("⚠️ Google Route non disponibile, ordine calcolato con algoritmo interno", icon="⚠️")
+                            st.toast(f"⚠️ {routing.etichetta} non disponibile, ordine calcolato con algoritmo interno", icon="⚠️")
                     except Exception as e:
-                        st.toast(f"❌ Errore Google: {str(e)[:80]}", icon="❌")
+                        st.toast(f"❌ Errore {routing.etichetta}: {str(e)[:80]}", icon="❌")
                         st.session_state._route_cache_key = cache_key
                         st.session_state._route_info = None
+                        st.session_state._route_errore = str(e)[:200]
                         st.session_state._tappe_ottimizzate = tappe_oggi
                 else:
                     route_info = st.session_state.get('_route_info')
@@ -2934,10 +3966,12 @@ def main_app():
             # === SALVA GIRO SU DB (persiste cross-refresh e cross-device) ===
             if _giro_da_salvare and tappe_oggi:
                 ids_da_salvare = [t['id'] for t in tappe_oggi]
+                route_da_salvare = st.session_state.get('_route_info')
                 save_giro_giorno(
                     oggi_str, ids_da_salvare,
                     variante=variante,
-                    esclusi=st.session_state.esclusi_oggi
+                    esclusi=st.session_state.esclusi_oggi,
+                    route=route_da_salvare if route_valida_per_tappe(route_da_salvare, tappe_oggi) else None
                 )
             
             # Trova visitati fuori giro
@@ -2945,275 +3979,25 @@ def main_app():
             visitati_fuori_giro = [v for v in st.session_state.visitati_oggi if v not in nomi_nel_giro]
             
             if tappe_oggi or visitati_fuori_giro:
-                # Statistiche compatte + pulsante mappa
-                km_tot, tempo_guida, tempo_tot = calcola_km_tempo_giro(
-                    tappe_oggi, 
-                    config.get('lat_base', 41.9028), 
-                    config.get('lon_base', 12.4964),
-                    config.get('durata_visita', 45)
-                )
+                lista_tappe_giro(tappe_oggi, config, oggi_date, giorni_nomi[idx_g])
                 
-                # Usa dati reali Google se disponibili
-                route_info_oggi = st.session_state.get('_route_info')
-                google_badge = ""
-                if route_info_oggi and route_info_oggi.get('duration_s'):
-                    km_tot = round(route_info_oggi['distance_m'] / 1000, 1) if route_info_oggi.get('distance_m') else km_tot
-                    tempo_guida_google = route_info_oggi['duration_s'] // 60
-                    durata_visita = int(config.get('durata_visita', 45))
-                    tempo_tot = tempo_guida_google + (len(tappe_oggi) * durata_visita)
-                    google_badge = " · 🛣️ Google"
-                
-                col_stats, col_mappa = st.columns([4, 1])
-                with col_stats:
-                    st.caption(f"📊 **{len(tappe_oggi)}** visite · ✅ **{len(st.session_state.visitati_oggi)}** fatte · 🛣️ **{km_tot}** km · ⏱️ **{tempo_tot//60}h{tempo_tot%60:02d}m**{google_badge}")
-                with col_mappa:
-                    if st.button("🗺️ Mappa", use_container_width=True, help="Vedi clienti del giorno sulla mappa"):
-                        st.session_state.mappa_giorno_selezionato = {
-                            'data': oggi_date,
-                            'tappe': tappe_oggi,
-                            'giorno_nome': giorni_nomi[idx_g]
-                        }
-                        st.session_state.active_tab = "🗺️ Mappa"
-                        st.rerun()
-                
-                st.divider()
-                
-                # === LISTA TAPPE ===
-                for i, t in enumerate(tappe_oggi, 1):
-                    visitato = t['nome_cliente'] in st.session_state.visitati_oggi
-                    
-                    # Dati completi del cliente
-                    cliente_row = df[df['nome_cliente'] == t['nome_cliente']].iloc[0] if not df[df['nome_cliente'] == t['nome_cliente']].empty else None
-                    
-                    if 'cliente_report_aperto' not in st.session_state:
-                        st.session_state.cliente_report_aperto = None
-                    
-                    if visitato:
-                        # --- VISITATO (compatto) ---
-                        with st.container(border=True):
-                            st.markdown(f"""
-                            <div style="background: linear-gradient(90deg, #d4edda 0%, #c3e6cb 100%); 
-                                        padding: 8px 12px; border-radius: 8px; border-left: 4px solid #28a745;
-                                        display:flex; align-items:center; justify-content:space-between;">
-                                <span style="font-size: 14px; text-decoration: line-through; color: #155724;">
-                                    ✅ {i}. {t['nome_cliente']}
-                                </span>
-                                <span style="color: #155724; font-weight: bold; font-size:12px;">VISITATO</span>
-                            </div>
-                            """, unsafe_allow_html=True)
-                    else:
-                        # --- DA VISITARE ---
-                        with st.container(border=True):
-                            form_aperto = st.session_state.cliente_report_aperto == t['id']
-                            
-                            if not form_aperto:
-                                # Badge urgenza
-                                ritardo = t.get('ritardo', 0)
-                                urgenza_score = t.get('urgenza', 0)
-                                
-                                if ritardo == 999 or urgenza_score >= 80:
-                                    urgenza_badge = "🔴"
-                                elif ritardo >= 7 or urgenza_score >= 50:
-                                    urgenza_badge = "🟠"
-                                elif ritardo >= 0 or urgenza_score >= 30:
-                                    urgenza_badge = "🟡"
-                                else:
-                                    urgenza_badge = "🟢"
-                                
-                                # Info cliente — riga unica compatta
-                                st.markdown(f"**{t['tipo_tappa'].split()[0]} {i}. {t['nome_cliente']}** — ⏰ {t['ora_arrivo']} · {urgenza_badge} {ritardo:+d}gg · {t.get('distanza_km', 0)}km")
-                                
-                                if t.get('indirizzo'):
-                                    st.caption(f"📍 {t['indirizzo']}")
-                                
-                                # Promemoria
-                                if cliente_row is not None and pd.notnull(cliente_row.get('promemoria')) and str(cliente_row.get('promemoria')).strip():
-                                    st.warning(f"📝 **Promemoria:** {cliente_row['promemoria']}")
-                                
-                                # === PULSANTE VISITA ===
-                                if st.button("✅ Registra Visita", key=f"visita_{t['id']}", type="primary", use_container_width=True):
-                                    st.session_state.cliente_report_aperto = t['id']
-                                    st.rerun()
-                                
-                                # === 4 PULSANTI AZIONE IN LINEA (HTML flex = sempre orizzontali su iPhone) ===
-                                nav_url = f"https://www.google.com/maps/dir/?api=1&destination={t['latitude']},{t['longitude']}"
-                                cell_val = str(t.get('cellulare', '')).strip()
-                                tel_url = f"tel:{cell_val}" if cell_val else ""
-                                mail_val = ""
-                                if cliente_row is not None and pd.notnull(cliente_row.get('mail')):
-                                    mail_val = str(cliente_row.get('mail', '')).strip()
-                                mail_url = f"mailto:{mail_val}" if mail_val else ""
-                                
-                                btn_style = (
-                                    "display:inline-flex;align-items:center;justify-content:center;"
-                                    "padding:8px 4px;border-radius:8px;text-decoration:none;"
-                                    "font-size:14px;font-weight:500;flex:1;text-align:center;"
-                                    "min-height:38px;border:1px solid #ddd;color:#333;background:#f8f9fa;"
-                                )
-                                btn_disabled = btn_style + "opacity:0.35;pointer-events:none;color:#999;"
-                                
-                                html_btns = f'<div style="display:flex;gap:6px;margin:4px 0 2px 0;">'
-                                html_btns += f'<a href="{nav_url}" target="_blank" style="{btn_style}">🚗 Vai</a>'
-                                if tel_url:
-                                    html_btns += f'<a href="{tel_url}" style="{btn_style}">📱 Chiama</a>'
-                                else:
-                                    html_btns += f'<span style="{btn_disabled}">📱 Chiama</span>'
-                                if mail_url:
-                                    html_btns += f'<a href="{mail_url}" style="{btn_style}">📧 Mail</a>'
-                                else:
-                                    html_btns += f'<span style="{btn_disabled}">📧 Mail</span>'
-                                html_btns += '</div>'
-                                st.markdown(html_btns, unsafe_allow_html=True)
-                                
-                                # Scheda cliente (richiede Streamlit per navigazione)
-                                if st.button("👤 Scheda cliente", key=f"scheda_{t['id']}", use_container_width=True):
-                                    st.session_state.cliente_selezionato = t['nome_cliente']
-                                    st.session_state.active_tab = "👤 Anagrafica"
-                                    st.rerun()
-                            
-                            else:
-                                # FORM REPORT APERTO
-                                st.markdown(f"### 📝 Report Visita: {t['nome_cliente']}")
-                                st.caption(f"📍 {t.get('indirizzo', '')}")
-                                
-                                # Mostra storico precedente se presente
-                                storico_attuale = ""
-                                if cliente_row is not None and pd.notnull(cliente_row.get('storico_report')):
-                                    storico_attuale = str(cliente_row.get('storico_report', ''))
-                                    if storico_attuale.strip():
-                                        with st.expander("📜 Storico report precedenti"):
-                                            st.text(storico_attuale)
-                                
-                                # Form per nuovo report
-                                nuovo_report = st.text_area(
-                                    "✍️ Scrivi il report della visita:",
-                                    placeholder="Es: Incontrato Mario Rossi, discusso nuovo ordine, richiesta preventivo per...",
-                                    height=120,
-                                    key=f"report_text_{t['id']}"
-                                )
-                                
-                                col_save, col_skip, col_cancel = st.columns(3)
-                                
-                                with col_save:
-                                    if st.button("💾 Salva e Completa", key=f"save_report_{t['id']}", type="primary", use_container_width=True):
-                                        # Prepara nuovo storico con data
-                                        data_oggi = ora_italiana.strftime('%d/%m/%Y')
-                                        if nuovo_report.strip():
-                                            nuovo_storico = f"[{data_oggi}] {nuovo_report.strip()}"
-                                            if storico_attuale.strip():
-                                                nuovo_storico = f"{nuovo_storico}\n\n{storico_attuale}"
-                                        else:
-                                            nuovo_storico = storico_attuale
-                                        
-                                        # Aggiorna database
-                                        update_cliente(t['id'], {
-                                            'ultima_visita': ora_italiana.date().isoformat(),
-                                            'storico_report': nuovo_storico
-                                        })
-                                        st.session_state.visitati_oggi.append(t['nome_cliente'])
-                                        st.session_state.cliente_report_aperto = None
-                                        st.session_state.reload_data = True
-                                        st.success("✅ Visita registrata con report!")
-                                        time_module.sleep(0.5)
-                                        st.rerun()
-                                
-                                with col_skip:
-                                    if st.button("⏭️ Salta Report", key=f"skip_report_{t['id']}", use_container_width=True):
-                                        # Salva senza report
-                                        update_cliente(t['id'], {
-                                            'ultima_visita': ora_italiana.date().isoformat()
-                                        })
-                                        st.session_state.visitati_oggi.append(t['nome_cliente'])
-                                        st.session_state.cliente_report_aperto = None
-                                        st.session_state.reload_data = True
-                                        st.rerun()
-                                
-                                with col_cancel:
-                                    if st.button("❌ Annulla", key=f"cancel_report_{t['id']}", use_container_width=True):
-                                        st.session_state.cliente_report_aperto = None
-                                        st.rerun()
-                
-                # Navigazione completa
-                if tappe_oggi:
-                    st.divider()
-                    tappe_rimanenti = [t for t in tappe_oggi if t['nome_cliente'] not in st.session_state.visitati_oggi]
-                    if tappe_rimanenti:
-                        waypoints = "|".join([f"{t['latitude']},{t['longitude']}" for t in tappe_rimanenti[:-1]])
-                        dest = f"{tappe_rimanenti[-1]['latitude']},{tappe_rimanenti[-1]['longitude']}"
-                        origin = f"{config.get('lat_base', 41.9028)},{config.get('lon_base', 12.4964)}"
-                        url = f"https://www.google.com/maps/dir/?api=1&origin={origin}&destination={dest}&waypoints={waypoints}&travelmode=driving"
-                        st.link_button(f"🗺️ NAVIGA ({len(tappe_rimanenti)} tappe)", url, use_container_width=True, type="primary")
-                    else:
-                        st.success("🎉 Hai completato tutte le visite programmate!")
-                
-                # === SEZIONE VISITE FUORI GIRO ===
-                st.divider()
-                nomi_nel_giro = [t['nome_cliente'] for t in tappe_oggi]
-                visitati_fuori_giro = [v for v in st.session_state.visitati_oggi if v not in nomi_nel_giro]
-                
-                # Mostra clienti visitati fuori giro
-                if visitati_fuori_giro:
-                    st.subheader("➕ Visite Fuori Giro")
-                    for nome_vfg in visitati_fuori_giro:
-                        cliente_vfg = df[df['nome_cliente'] == nome_vfg]
-                        if not cliente_vfg.empty:
-                            cliente_vfg = cliente_vfg.iloc[0]
-                            with st.container(border=True):
-                                col_vfg1, col_vfg2 = st.columns([4, 1])
-                                col_vfg1.markdown(f"### ✅ {nome_vfg}")
-                                if cliente_vfg.get('indirizzo'):
-                                    col_vfg1.caption(f"📍 {cliente_vfg['indirizzo']}")
-                                if col_vfg2.button("👤", key=f"vfg_scheda_{nome_vfg}", help="Scheda"):
-                                    st.session_state.cliente_selezionato = nome_vfg
-                                    st.session_state.active_tab = "👤 Anagrafica"
-                                    st.rerun()
-                
-                # Form per aggiungere visita fuori giro
-                with st.expander("➕ Registra visita a cliente fuori giro"):
-                    clienti_non_visitati = [c for c in df['nome_cliente'].tolist() if c not in st.session_state.visitati_oggi] if not df.empty and 'nome_cliente' in df.columns else []
-                    cliente_extra = st.selectbox("Seleziona cliente:", [""] + sorted(clienti_non_visitati), key="cliente_extra_giro")
-                    
-                    if cliente_extra:
-                        col_extra1, col_extra2 = st.columns(2)
-                        if col_extra1.button("✅ Registra Visita", type="primary", use_container_width=True):
-                            # Aggiorna ultima_visita nel database
-                            cliente_row = df[df['nome_cliente'] == cliente_extra].iloc[0]
-                            update_cliente(cliente_row['id'], {
-                                'ultima_visita': ora_italiana.date().isoformat()
-                            })
-                            st.session_state.visitati_oggi.append(cliente_extra)
-                            st.session_state.reload_data = True
-                            st.success(f"✅ Visita a {cliente_extra} registrata!")
-                            st.rerun()
-                        
-                        if col_extra2.button("👤 Vai alla Scheda", use_container_width=True):
-                            st.session_state.cliente_selezionato = cliente_extra
-                            st.session_state.active_tab = "👤 Anagrafica"
-                            st.rerun()
-                
-                # Riepilogo finale
-                st.divider()
-                tot_visitati = len(st.session_state.visitati_oggi)
-                tot_giro = len(tappe_oggi)
-                tot_fuori = len(visitati_fuori_giro)
-                
-                st.markdown(f"""
-                ### 📊 Riepilogo Giornata
-                | | |
-                |---|---|
-                | ✅ **Visitati totali** | **{tot_visitati}** |
-                | 🚗 Nel giro | {tot_visitati - tot_fuori} / {tot_giro} |
-                | ➕ Fuori giro | {tot_fuori} |
-                """)
-                
-                # Stato Google Maps
-                with st.expander("🔧 Stato Google Maps", expanded=False):
+                # Stato motore percorsi
+                routing_check = get_routing_backend()
+                with st.expander(f"🔧 Stato {routing_check.etichetta if routing_check else 'Google Maps'}", expanded=False):
                     route_info_check = st.session_state.get('_route_info')
-                    google_err = st.session_state.get('_google_last_error', '')
+                    google_err = st.session_state.get('_route_errore', '')
                     if route_info_check and route_info_check.get('polyline'):
-                        st.success(f"✅ **Percorso ottimizzato con Google Maps**\n\n"
-                                  f"🛣️ {round(route_info_check['distance_m']/1000, 1)} km reali · "
-                                  f"⏱️ {route_info_check['duration_s']//60} min guida")
+                        km_check = round(route_info_check['distance_m']/1000, 1)
+                        if route_info_check.get('backend') == 'locale':
+                            # Linea d'aria × fattore di deviazione: non sono km stradali
+                            riga_km = f"📐 ~{km_check} km stimati · ⏱️ ~{route_info_check['duration_s']//60} min guida (stima)"
+                        else:
+                            riga_km = f"🛣️ {km_check} km reali · ⏱️ {route_info_check['duration_s']//60} min guida"
+                        st.success(f"✅ **Percorso ottimizzato con {routing_check.etichetta if routing_check else 'Google Maps'}**\n\n{riga_km}")
+                    elif routing_check is not None and routing_check.nome == 'osrm':
+                        st.warning(f"⚠️ **Server OSRM non raggiungibile**\n\n"
+                                  f"- URL: {OSRM_URL}\n"
+                                  f"- Errore: {google_err[:150] if google_err else 'nessuno registrato'}")
                     elif GOOGLE_MAPS_API_KEY:
                         st.warning(f"⚠️ **API Key presente ma percorso non disponibile**\n\n"
                                   f"Possibili cause:\n"
@@ -3241,13 +4025,10 @@ def main_app():
                 if cliente_extra:
                     if st.button("✅ Registra Visita", type="primary"):
                         cliente_row = df[df['nome_cliente'] == cliente_extra].iloc[0]
-                        update_cliente(cliente_row['id'], {
-                            'ultima_visita': ora_italiana.date().isoformat()
-                        })
-                        st.session_state.visitati_oggi.append(cliente_extra)
-                        st.session_state.reload_data = True
-                        st.success(f"✅ Visita a {cliente_extra} registrata!")
-                        st.rerun()
+                        if registra_visita(cliente_row['id'], ora_italiana.date(), 'VISITA'):
+                            st.session_state.visitati_oggi.append(cliente_extra)
+                            st.success(f"✅ Visita a {cliente_extra} registrata!")
+                            st.rerun()
         else:
             st.warning(f"🏖️ Oggi è {giorni_nomi[idx_g]} - non lavorativo")
     
@@ -3343,7 +4124,18 @@ def main_app():
                     data_fine = st.date_input("📆 A:", value=ora_italiana.date(), key="data_fine_storico")
             
             if not df.empty and 'ultima_visita' in df.columns:
-                df_storico = df[df['ultima_visita'].notna()].copy()
+                # Tutte le visite del periodo dalla tabella visite (anche di clienti rivisitati dopo);
+                # senza tabella si ricade su ultima_visita
+                visite_periodo = _memo_sessione(
+                    'visite_periodo', (data_inizio, data_fine, st.session_state.get('df_version', 0)),
+                    lambda: fetch_visite_periodo(data_inizio, data_fine)
+                )
+                if visite_periodo is not None:
+                    df_storico = visite_periodo.merge(
+                        df[['id', 'nome_cliente', 'indirizzo', 'stato_cliente']], left_on='cliente_id', right_on='id'
+                    ).rename(columns={'data_visita': 'ultima_visita'})
+                else:
+                    df_storico = df[df['ultima_visita'].notna()].copy()
                 
                 if not df_storico.empty:
                     df_storico['data_visita'] = df_storico['ultima_visita'].dt.date
@@ -3370,7 +4162,7 @@ def main_app():
                             st.bar_chart(visite_per_giorno.set_index('data_visita')['visite'])
                         
                         st.caption(f"📋 Clienti visitati ({len(df_visitati)})")
-                        for _, row in df_visitati.iterrows():
+                        for i_st, (_, row) in enumerate(df_visitati.iterrows()):
                             with st.container(border=True):
                                 col_st1, col_st2, col_st3 = st.columns([3, 2, 1])
                                 col_st1.markdown(f"**{row['nome_cliente']}**")
@@ -3380,7 +4172,7 @@ def main_app():
                                 icona = colori_stato.get(stato, '⚪')
                                 col_st2.write(f"{icona} {stato}")
                                 col_st2.caption(f"📅 {row['ultima_visita'].strftime('%d/%m/%Y %H:%M') if pd.notnull(row['ultima_visita']) else 'N/D'}")
-                                if col_st3.button("👤", key=f"storico_{row['id']}", help="Apri scheda"):
+                                if col_st3.button("👤", key=f"storico_{row['id']}_{i_st}", help="Apri scheda"):
                                     st.session_state.cliente_selezionato = row['nome_cliente']
                                     st.session_state.active_tab = "👤 Anagrafica"
                                     st.rerun()
@@ -3434,8 +4226,7 @@ def main_app():
             st.session_state.giorno_da_scambiare = None
         
         # Inizializza scambi salvati (dizionario: chiave=settimana, valore=lista di scambi)
-        if 'scambi_giorni' not in st.session_state:
-            st.session_state.scambi_giorni = load_scambi_giorni()
+        dati_scambi_giorni()
         
         col_nav1, col_nav2, col_nav3, col_nav4, col_nav5 = st.columns([1, 1, 2, 1, 1])
         
@@ -3491,9 +4282,9 @@ def main_app():
                 st.rerun()
         
         # CALCOLA AGENDA OTTIMIZZATA (escludendo giorni in ferie singoli)
-        agenda_settimana = calcola_agenda_settimanale(
-            df, 
-            config, 
+        agenda_settimana = dati_agenda_settimana(
+            df,
+            config,
             st.session_state.esclusi_oggi if st.session_state.current_week_index == 0 else [],
             st.session_state.current_week_index
         )
@@ -3512,9 +4303,10 @@ def main_app():
         
         # Se settimana corrente: sovrascrive OGGI con il giro SALVATO (coerente con Giro Oggi)
         # Questo va DOPO gli scambi, così il giorno di oggi mostra sempre il giro persistito
+        giro_salvato_agenda = None
         if st.session_state.current_week_index == 0:
             oggi_str_agenda = ora_italiana.strftime('%Y-%m-%d')
-            giro_salvato_agenda = load_giro_giorno(oggi_str_agenda)
+            giro_salvato_agenda = dati_giro_salvato(oggi_str_agenda)
             if giro_salvato_agenda and giro_salvato_agenda.get('ids'):
                 tappe_salvate = ricostruisci_tappe_da_ids(df, giro_salvato_agenda['ids'], config)
                 if tappe_salvate:
@@ -3622,12 +4414,18 @@ def main_app():
                             if st.button("🗺️", key=f"mappa_{data_giorno}", help="Mappa", use_container_width=True):
                                 tappe_per_mappa = tappe_giorno
                                 route_per_mappa = None
-                                if GOOGLE_MAPS_API_KEY and len(tappe_giorno) >= 2:
+                                # Oggi: riusa il percorso salvato col giro, se le tappe non sono cambiate
+                                if is_oggi:
+                                    route_per_mappa = route_salvata_per_ids(giro_salvato_agenda, [t['id'] for t in tappe_giorno])
+                                if route_per_mappa:
+                                    route_per_mappa = dict(route_per_mappa)
+                                    st.session_state._route_info = route_per_mappa
+                                elif get_routing_backend() is not None and len(tappe_giorno) >= 2:
                                     blat = float(config.get('lat_base', 0))
                                     blon = float(config.get('lon_base', 0))
                                     if blat != 0 and blon != 0:
-                                        tappe_per_mappa, route_per_mappa = ottimizza_ordine_con_google(
-                                            tappe_giorno, blat, blon, GOOGLE_MAPS_API_KEY)
+                                        tappe_per_mappa, route_per_mappa = ottimizza_ordine_percorso(
+                                            tappe_giorno, blat, blon, get_routing_backend())
                                         st.session_state._route_info = route_per_mappa
                                 st.session_state.mappa_giorno_selezionato = {
                                     'data': data_giorno,
@@ -3718,6 +4516,10 @@ def main_app():
     
     # --- TAB: MAPPA ---
     elif st.session_state.active_tab == "🗺️ Mappa":
+        # Librerie mappa: caricate solo quando si apre questa tab
+        import folium
+        from streamlit_folium import st_folium
+
         st.header("🗺️ Mappa Clienti")
         
         # Inizializza stato mappa
@@ -3735,8 +4537,8 @@ def main_app():
             st.session_state.geo_lat = None
             st.session_state.geo_lon = None
         
-        # Leggi GPS da query params (scritti dal componente JS)
-        gps_data = read_gps_from_url()
+        # Posizione dal componente GPS (resta in ascolto mentre la tab è aperta)
+        gps_data = gps_nuova_posizione("mappa_gps", segui=True)
         if gps_data:
             st.session_state.geo_lat = gps_data['latitude']
             st.session_state.geo_lon = gps_data['longitude']
@@ -3759,126 +4561,154 @@ def main_app():
                 lat_center = sum(t['latitude'] for t in tappe) / len(tappe)
                 lon_center = sum(t['longitude'] for t in tappe) / len(tappe)
                 
-                m = folium.Map(location=[lat_center, lon_center], zoom_start=12)
-                
-                # Raccogli tutti i punti per fit_bounds
-                all_points = []
-                
-                # Posizione utente
-                try:
-                    from folium.plugins import LocateControl
-                    LocateControl(auto_start=True, strings={"title": "La mia posizione"}).add_to(m)
-                except:
-                    pass
-                
-                # Marker posizione GPS se disponibile
-                if st.session_state.geo_lat and st.session_state.geo_lon:
-                    folium.Marker(
-                        [st.session_state.geo_lat, st.session_state.geo_lon],
-                        popup="📍 La mia posizione",
-                        tooltip="📍 IO SONO QUI",
-                        icon=folium.Icon(color='blue', icon='user', prefix='fa')
-                    ).add_to(m)
-                
                 # Punto di partenza (base)
                 lat_base = float(config.get('lat_base', lat_center))
                 lon_base = float(config.get('lon_base', lon_center))
-                folium.Marker(
-                    [lat_base, lon_base],
-                    popup="🏠 Partenza",
-                    tooltip="🏠 BASE",
-                    icon=folium.Icon(color='green', icon='home', prefix='fa')
-                ).add_to(m)
-                all_points.append([lat_base, lon_base])
-                
-                # Tappe numerate con tooltip (nome) e popup (dettagli)
-                coords_percorso = [[lat_base, lon_base]]
-                lookup_tappe = {}  # per match click
-                
-                for idx, tappa in enumerate(tappe, 1):
-                    lat = tappa['latitude']
-                    lon = tappa['longitude']
-                    nome = tappa['nome_cliente']
-                    indirizzo = tappa.get('indirizzo', '')
-                    ora = tappa.get('ora_arrivo', '--:--')
-                    ritardo = tappa.get('ritardo', 0)
-                    dist_km = tappa.get('distanza_km', 0)
-                    
-                    if ritardo >= 14:
-                        color = 'red'
-                    elif ritardo >= 7:
-                        color = 'orange'
-                    elif ritardo >= 0:
-                        color = 'blue'
-                    else:
-                        color = 'green'
-                    
-                    badge = '🔴' if ritardo >= 14 else '🟡' if ritardo >= 0 else '🟢'
-                    
-                    popup_html = f"""<div style="min-width:200px">
-                    <b>{idx}. {nome}</b><br>
-                    📍 {indirizzo}<br>
-                    ⏰ Arrivo: {ora}<br>
-                    🚗 {dist_km} km<br>
-                    {badge} Ritardo: {ritardo}gg
-                    </div>"""
-                    
-                    folium.Marker(
-                        [lat, lon],
-                        popup=folium.Popup(popup_html, max_width=280),
-                        tooltip=f"{idx}. {nome}",
-                        icon=folium.DivIcon(
-                            html=f'<div style="font-size:12pt;color:white;background:{color};border-radius:50%;width:26px;height:26px;text-align:center;line-height:26px;font-weight:bold;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);">{idx}</div>'
-                        )
-                    ).add_to(m)
-                    
-                    coords_percorso.append([lat, lon])
-                    all_points.append([lat, lon])
-                    lookup_tappe[f"{lat:.6f},{lon:.6f}"] = tappa
                 
-                # Linea percorso — usa percorso stradale Google se disponibile
+                # Linea percorso — usa percorso stradale Google se disponibile (e calcolato per queste tappe)
                 route_info = st.session_state.get('_route_info')
+                if not route_valida_per_tappe(route_info, tappe):
+                    route_info = None
+                
+                # Poi il percorso salvato col giro del giorno
+                if not route_info:
+                    giro_del_giorno = dati_giro_salvato(data_giorno.strftime('%Y-%m-%d'))
+                    route_salvata = route_salvata_per_ids(giro_del_giorno, [t['id'] for t in tappe])
+                    if route_salvata:
+                        route_info = dict(route_salvata)
+                        st.session_state._route_info = route_info
                 
                 # Se non abbiamo la polyline Google, richiedila automaticamente
-                if (not route_info or not route_info.get('polyline')) and GOOGLE_MAPS_API_KEY and len(tappe) >= 2:
+                if (not route_info or not route_info.get('polyline')) and get_routing_backend() is not None and len(tappe) >= 2:
                     try:
-                        tappe_opt, route_info_new = ottimizza_ordine_con_google(
-                            tappe, lat_base, lon_base, GOOGLE_MAPS_API_KEY)
+                        tappe_opt, route_info_new = ottimizza_ordine_percorso(
+                            tappe, lat_base, lon_base, get_routing_backend())
                         if route_info_new and route_info_new.get('polyline'):
                             route_info = route_info_new
                             st.session_state._route_info = route_info
                             # Aggiorna tappe con ordine ottimizzato
                             giorno_info['tappe'] = tappe_opt
                             tappe = tappe_opt
-                            # Ricostruisci coords_percorso
-                            coords_percorso = [[lat_base, lon_base]]
-                            for t in tappe:
-                                coords_percorso.append([t['latitude'], t['longitude']])
                     except Exception:
                         pass
                 
-                if route_info and route_info.get('polyline'):
+                # Raccogli tutti i punti per fit_bounds
+                all_points = [[lat_base, lon_base]] + [[t['latitude'], t['longitude']] for t in tappe]
+                
+                # Zoom per la semplificazione della polyline
+                route_id = id_percorso(route_info)
+                zoom_salvato = st.session_state.get('_mappa_giro_zoom')
+                if route_id and zoom_salvato and zoom_salvato[0] == route_id:
+                    zoom_percorso = int(zoom_salvato[1])
+                else:
+                    zoom_percorso = zoom_per_bounds(all_points)
+                
+                # Mappa già costruita con gli stessi dati → riusala (niente ricostruzione a ogni click)
+                chiave_mappa = (
+                    str(data_giorno), tuple((t['id'], t.get('ora_arrivo'), t.get('distanza_km')) for t in tappe),
+                    route_id, zoom_percorso if route_id else None,
+                    st.session_state.geo_lat, st.session_state.geo_lon, lat_base, lon_base
+                )
+                m = mappa_da_cache('giro', chiave_mappa)
+                if m is None:
+                    m = mappa_renderizzata(location=[lat_center, lon_center], zoom_start=12)
+                    
+                    # Posizione utente
                     try:
-                        road_coords = decode_google_polyline(route_info['polyline'])
-                        folium.PolyLine(road_coords, color='#4285F4', weight=4, opacity=0.85).add_to(m)
+                        from folium.plugins import LocateControl
+                        LocateControl(auto_start=True, strings={"title": "La mia posizione"}).add_to(m)
                     except:
+                        pass
+                    
+                    # Marker posizione GPS se disponibile
+                    if st.session_state.geo_lat and st.session_state.geo_lon:
+                        folium.Marker(
+                            [st.session_state.geo_lat, st.session_state.geo_lon],
+                            popup="📍 La mia posizione",
+                            tooltip="📍 IO SONO QUI",
+                            icon=folium.Icon(color='blue', icon='user', prefix='fa')
+                        ).add_to(m)
+                    
+                    folium.Marker(
+                        [lat_base, lon_base],
+                        popup="🏠 Partenza",
+                        tooltip="🏠 BASE",
+                        icon=folium.Icon(color='green', icon='home', prefix='fa')
+                    ).add_to(m)
+                    
+                    # Tappe numerate con tooltip (nome) e popup (dettagli)
+                    coords_percorso = [[lat_base, lon_base]]
+                    
+                    for idx, tappa in enumerate(tappe, 1):
+                        lat = tappa['latitude']
+                        lon = tappa['longitude']
+                        nome = tappa['nome_cliente']
+                        indirizzo = tappa.get('indirizzo', '')
+                        ora = tappa.get('ora_arrivo', '--:--')
+                        ritardo = tappa.get('ritardo', 0)
+                        dist_km = tappa.get('distanza_km', 0)
+                        
+                        if ritardo >= 14:
+                            color = 'red'
+                        elif ritardo >= 7:
+                            color = 'orange'
+                        elif ritardo >= 0:
+                            color = 'blue'
+                        else:
+                            color = 'green'
+                        
+                        badge = '🔴' if ritardo >= 14 else '🟡' if ritardo >= 0 else '🟢'
+                        
+                        popup_html = f"""<div style="min-width:200px">
+                        <b>{idx}. {nome}</b><br>
+                        📍 {indirizzo}<br>
+                        ⏰ Arrivo: {ora}<br>
+                        🚗 {dist_km} km<br>
+                        {badge} Ritardo: {ritardo}gg
+                        </div>"""
+                        
+                        folium.Marker(
+                            [lat, lon],
+                            popup=folium.Popup(popup_html, max_width=280),
+                            tooltip=f"{idx}. {nome}",
+                            icon=folium.DivIcon(
+                                html=f'<div style="font-size:12pt;color:white;background:{color};border-radius:50%;width:26px;height:26px;text-align:center;line-height:26px;font-weight:bold;border:2px solid white;box-shadow:0 1px 3px rgba(0,0,0,0.3);">{idx}</div>'
+                            )
+                        ).add_to(m)
+                        
+                        coords_percorso.append([lat, lon])
+                    
+                    if route_id:
+                        try:
+                            # Geometria semplificata per lo zoom corrente (cache per percorso + zoom)
+                            road_coords = semplifica_percorso(route_id, zoom_percorso, route_info['polyline'])
+                            folium.PolyLine(road_coords, color='#4285F4', weight=4, opacity=0.85).add_to(m)
+                        except:
+                            coords_percorso.append([lat_base, lon_base])
+                            folium.PolyLine(coords_percorso, color='blue', weight=3, opacity=0.7, dash_array='10').add_to(m)
+                    else:
                         coords_percorso.append([lat_base, lon_base])
                         folium.PolyLine(coords_percorso, color='blue', weight=3, opacity=0.7, dash_array='10').add_to(m)
-                else:
-                    coords_percorso.append([lat_base, lon_base])
-                    folium.PolyLine(coords_percorso, color='blue', weight=3, opacity=0.7, dash_array='10').add_to(m)
+                    
+                    # Fit bounds per mostrare tutto il percorso
+                    if all_points and len(all_points) >= 2:
+                        m.fit_bounds(all_points, padding=[30, 30])
+                    
+                    salva_mappa_cache('giro', chiave_mappa, m)
                 
                 # Mostra mappa e cattura click
-                if route_info and route_info.get('polyline'):
-                    st.caption("🛣️ Percorso stradale reale (Google Maps)")
+                if route_info and route_info.get('backend') == 'locale':
+                    st.caption("📐 Percorso stimato (motore percorsi locale)")
+                elif route_info and route_info.get('polyline'):
+                    st.caption(f"🛣️ Percorso stradale reale ({'OSRM' if route_info.get('backend') == 'osrm' else 'Google Maps'})")
                 else:
                     st.caption("📐 Percorso in linea retta (attiva Google Maps API per strade reali)")
                 
-                # Fit bounds per mostrare tutto il percorso
-                if all_points and len(all_points) >= 2:
-                    m.fit_bounds(all_points, padding=[30, 30])
-                
-                map_data = st_folium(m, width=None, height=500, use_container_width=True, key="mappa_giro")
+                # Solo click e zoom tornano a Python: il pan non provoca rerun
+                map_data = st_folium(m, width=None, height=500, use_container_width=True, key="mappa_giro",
+                                     render=not m.renderizzata, returned_objects=["last_object_clicked", "zoom"])
+                if map_data and map_data.get('zoom') and route_id:
+                    st.session_state._mappa_giro_zoom = (route_id, map_data['zoom'])
                 
                 # Link Google Maps navigazione
                 if tappe:
@@ -3970,9 +4800,6 @@ def main_app():
             geo_lat = st.session_state.geo_lat
             geo_lon = st.session_state.geo_lon
             
-            if not geo_lat:
-                render_gps_button("mappa_gps_btn")
-            
             # --- FILTRI ---
             col_f1, col_f2, col_f3, col_f4 = st.columns(4)
             with col_f1:
@@ -4006,27 +4833,13 @@ def main_app():
                 (df_filtered['longitude'] != 0)
             ]
             
+            # Classificazione urgenza (vettoriale, riusata da filtro e marker)
+            urgenza_df = classifica_urgenza_clienti(df_filtered)
+            df_filtered = df_filtered.join(urgenza_df)
+            
             # Filtro urgenza
             if filtro_urgenza != "Tutti":
-                rows_keep = []
-                for idx_r, row in df_filtered.iterrows():
-                    ultima = row.get('ultima_visita')
-                    freq = int(row.get('frequenza_giorni', 30))
-                    if pd.isnull(ultima) or (hasattr(ultima, 'year') and ultima.year < 2001):
-                        cat = "🔵 Mai visitati"
-                    else:
-                        ultima_date = ultima.date() if hasattr(ultima, 'date') else ultima
-                        prossima = ultima_date + timedelta(days=freq)
-                        ritardo_gg = (ora_italiana.date() - prossima).days
-                        if ritardo_gg > 0:
-                            cat = "🔴 In ritardo"
-                        elif ritardo_gg >= -7:
-                            cat = "🟡 In scadenza"
-                        else:
-                            cat = "🟢 In regola"
-                    if cat == filtro_urgenza:
-                        rows_keep.append(idx_r)
-                df_filtered = df_filtered.loc[rows_keep]
+                df_filtered = df_filtered[df_filtered['cat'] == filtro_urgenza]
             
             # Filtro città
             if filtro_citta != "Tutte":
@@ -4036,9 +4849,26 @@ def main_app():
             pos_lat = geo_lat or float(config.get('lat_base', 39.22))
             pos_lon = geo_lon or float(config.get('lon_base', 9.12))
             
-            df_filtered['distanza_km'] = df_filtered.apply(
-                lambda row: haversine(pos_lat, pos_lon, row['latitude'], row['longitude']), axis=1
-            )
+            df_filtered['distanza_km'] = haversine_np(pos_lat, pos_lon, df_filtered['latitude'], df_filtered['longitude'])
+            if 'indirizzo' not in df_filtered.columns:
+                df_filtered['indirizzo'] = ''
+            
+            # Opzioni di rendering
+            with st.expander("⚙️ Opzioni mappa", expanded=False):
+                modo_mappa = st.radio(
+                    "Rendering clienti",
+                    ["Auto", "📍 Marker", "⚡ GeoJSON", "🔭 Area visibile"],
+                    horizontal=True, key="modo_mappa_clienti",
+                    help=f"Auto: marker singoli fino a {SOGLIA_MARKER_GEOJSON} clienti, poi un unico layer GeoJSON (più leggero su smartphone); "
+                         f"oltre {SOGLIA_VIEWPORT} clienti carica solo l'area visibile, con i conteggi per zona quando la mappa è lontana"
+                )
+                copertura_mappa = st.selectbox(
+                    "Copertura territorio",
+                    ["Nessuna", "🔥 Densità clienti", "🔥 Clienti in ritardo", "▦ Griglia urgenza"],
+                    key="copertura_mappa_clienti",
+                    help="Overlay precalcolato su tutti i clienti geolocalizzati (non dipende dai filtri)"
+                )
+                misura_mappa = st.checkbox("⏱️ Misura tempo di costruzione e peso della mappa", key="misura_mappa_clienti")
             
             # Filtro raggio (solo se attivato)
             if usa_raggio:
@@ -4053,94 +4883,136 @@ def main_app():
                 st.caption(f"🏠 Posizione base · **{len(df_filtered)} clienti** · Premi 📍 per usare il GPS")
             
             if not df_filtered.empty:
-                # Costruisci mappa
-                m = folium.Map(location=[pos_lat, pos_lon], zoom_start=12 if geo_lat else 9)
-                all_client_points = [[pos_lat, pos_lon]]  # includi posizione utente
-                
-                # Locate control (pulsante GPS nativo nella mappa)
-                try:
-                    from folium.plugins import LocateControl
-                    LocateControl(
-                        auto_start=True,
-                        strings={"title": "Mostra la mia posizione"}
-                    ).add_to(m)
-                except:
-                    pass
-                
-                # Marker posizione utente
-                folium.Marker(
-                    [pos_lat, pos_lon],
-                    popup="📍 La mia posizione",
-                    tooltip="📍 IO SONO QUI",
-                    icon=folium.Icon(color='blue', icon='user', prefix='fa')
-                ).add_to(m)
-                
-                # Cerchio raggio (solo se filtro attivo)
-                if usa_raggio:
-                    folium.Circle(
-                        [pos_lat, pos_lon],
-                        radius=raggio_km * 1000,
-                        color='blue', fill=True, fillOpacity=0.05, weight=1
-                    ).add_to(m)
-                
-                # Marker clienti con colore per urgenza
-                for _, row in df_filtered.iterrows():
-                    lat_c = row['latitude']
-                    lon_c = row['longitude']
-                    nome_c = row['nome_cliente']
-                    ind_c = row.get('indirizzo', '') or ''
-                    dist_c = row.get('distanza_km', 0)
-                    visitare = str(row.get('visitare', 'SI')).upper()
-                    
-                    # Ritardo e colore marker
-                    ultima = row.get('ultima_visita')
-                    freq = int(row.get('frequenza_giorni', 30))
-                    if visitare != 'SI':
-                        color = 'lightgray'
-                        ritardo_str = "Fuori giro"
-                        badge = "⚪"
-                    elif pd.isnull(ultima) or (hasattr(ultima, 'year') and ultima.year < 2001):
-                        ritardo_str = "Mai visitato"
-                        badge = "🔵"
-                        color = 'blue'
+                # Clienti con colore per urgenza
+                if modo_mappa == "🔭 Area visibile" or (modo_mappa == "Auto" and len(df_filtered) > SOGLIA_VIEWPORT):
+                    modalita_layer = 'viewport'
+                elif modo_mappa == "⚡ GeoJSON" or (modo_mappa == "Auto" and len(df_filtered) > SOGLIA_MARKER_GEOJSON):
+                    modalita_layer = 'geojson'
+                else:
+                    modalita_layer = 'marker'
+                
+                # Mappa già costruita con stessi filtri, posizione e dati → riusala (niente ricostruzione a ogni click).
+                # In modalità area visibile la mappa base è leggera e i clienti arrivano col feature group.
+                t_build = time_module.perf_counter()
+                chiave_mappa = (filtro_stato, filtro_urgenza, filtro_citta, usa_raggio, raggio_km if usa_raggio else None,
+                                round(pos_lat, 5), round(pos_lon, 5), st.session_state.get('df_version', 0), modalita_layer,
+                                copertura_mappa)
+                m = mappa_da_cache('clienti', chiave_mappa) if modalita_layer != 'viewport' else None
+                mappa_riusata = m is not None
+                if m is None:
+                    if modalita_layer == 'viewport':
+                        m = folium.Map(location=[pos_lat, pos_lon], zoom_start=12 if geo_lat else 9)
                     else:
-                        ultima_date = ultima.date() if hasattr(ultima, 'date') else ultima
-                        prossima = ultima_date + timedelta(days=freq)
-                        ritardo_gg = (ora_italiana.date() - prossima).days
-                        if ritardo_gg > 0:
-                            ritardo_str = f"In ritardo di {ritardo_gg}gg"
-                            badge = "🔴"
-                            color = 'red'
-                        elif ritardo_gg >= -7:
-                            ritardo_str = f"Scade tra {abs(ritardo_gg)}gg"
-                            badge = "🟡"
-                            color = 'orange'
-                        else:
-                            ritardo_str = f"OK (tra {abs(ritardo_gg)}gg)"
-                            badge = "🟢"
-                            color = 'green'
+                        m = mappa_renderizzata(location=[pos_lat, pos_lon], zoom_start=12 if geo_lat else 9)
+                    all_client_points = [[pos_lat, pos_lon]]  # includi posizione utente
                     
-                    popup_html = f"""<div style="min-width:180px;font-size:13px;">
-                    <b>{nome_c}</b><br>
-                    📍 {ind_c}<br>
-                    🚗 {dist_c:.1f} km da te<br>
-                    {badge} {ritardo_str}
-                    </div>"""
+                    # Locate control (pulsante GPS nativo nella mappa)
+                    try:
+                        from folium.plugins import LocateControl
+                        LocateControl(
+                            auto_start=True,
+                            strings={"title": "Mostra la mia posizione"}
+                        ).add_to(m)
+                    except:
+                        pass
                     
+                    # Marker posizione utente
                     folium.Marker(
-                        [lat_c, lon_c],
-                        popup=folium.Popup(popup_html, max_width=250),
-                        tooltip=f"{nome_c} ({dist_c:.1f}km)",
-                        icon=folium.Icon(color=color, icon='briefcase', prefix='fa')
+                        [pos_lat, pos_lon],
+                        popup="📍 La mia posizione",
+                        tooltip="📍 IO SONO QUI",
+                        icon=folium.Icon(color='blue', icon='user', prefix='fa')
                     ).add_to(m)
-                    all_client_points.append([lat_c, lon_c])
-                
-                # Fit bounds per mostrare tutti i clienti
-                if len(all_client_points) >= 2:
-                    m.fit_bounds(all_client_points, padding=[30, 30])
+                    
+                    # Cerchio raggio (solo se filtro attivo)
+                    if usa_raggio:
+                        folium.Circle(
+                            [pos_lat, pos_lon],
+                            radius=raggio_km * 1000,
+                            color='blue', fill=True, fillOpacity=0.05, weight=1
+                        ).add_to(m)
+                    
+                    if modalita_layer != 'viewport':
+                        aggiungi_layer_clienti(m, df_filtered, modalita_layer)
+                    
+                    all_client_points += df_filtered[['latitude', 'longitude']].values.tolist()
+                    
+                    # Overlay copertura territorio (griglia precalcolata, aggiornata in modo incrementale)
+                    if copertura_mappa != "Nessuna":
+                        tipo_copertura = {"🔥 Densità clienti": 'heatmap', "🔥 Clienti in ritardo": 'heatmap_ritardo'}.get(copertura_mappa, 'griglia')
+                        aggiungi_layer_copertura(m, get_griglia_copertura(df), tipo_copertura, zoom_per_bounds(all_client_points))
+                        folium.LayerControl(collapsed=True).add_to(m)
+                    
+                    # Fit bounds per mostrare tutti i clienti
+                    if len(all_client_points) >= 2:
+                        m.fit_bounds(all_client_points, padding=[30, 30])
+                    
+                    if modalita_layer != 'viewport':
+                        salva_mappa_cache('clienti', chiave_mappa, m)
+                
+                fg_clienti = None
+                st_folium_vista = {}
+                if modalita_layer == 'viewport':
+                    # Solo i clienti dell'area visibile (bounds/zoom restituiti da st_folium), via indice spaziale
+                    indice_spaziale = _memo_sessione(
+                        'indice_spaziale', st.session_state.get('df_version', 0),
+                        lambda: costruisci_indice_spaziale(df)
+                    )
+                    firma_vista = (filtro_stato, filtro_urgenza, filtro_citta, usa_raggio, raggio_km if usa_raggio else None,
+                                   round(pos_lat, 4), round(pos_lon, 4), st.session_state.get('df_version', 0))
+                    vista = st.session_state.get('_viewport_clienti')
+                    stato_mappa = st.session_state.get('mappa_clienti')
+                    if vista and vista['firma'] == firma_vista and bounds_da_mappa(stato_mappa) not in (None, vista.get('ignora')):
+                        vista = dict(vista, bounds=bounds_da_mappa(stato_mappa),
+                                     zoom=int(stato_mappa.get('zoom') or vista['zoom']),
+                                     center=stato_mappa.get('center') or vista.get('center'))
+                    elif not vista or vista['firma'] != firma_vista:
+                        # Prima vista con questi filtri: riquadro di tutti i clienti filtrati
+                        lat_f, lon_f = df_filtered['latitude'], df_filtered['longitude']
+                        vista = {
+                            'firma': firma_vista,
+                            'bounds': (float(lat_f.min()), float(lon_f.min()), float(lat_f.max()), float(lon_f.max())),
+                            'zoom': zoom_per_bounds([[pos_lat, pos_lon]] + df_filtered[['latitude', 'longitude']].values.tolist()),
+                            'center': None,
+                            'ignora': bounds_da_mappa(stato_mappa)  # bounds della vista precedente, non più validi
+                        }
+                    st.session_state._viewport_clienti = vista
+                    
+                    sud, ovest, nord, est = vista['bounds']
+                    etichette = cerca_in_bounds(indice_spaziale, sud, ovest, nord, est)
+                    df_vis = df_filtered[df_filtered.index.isin(etichette)]
+                    df_vis = df_vis[df_vis['latitude'].between(sud, nord) & df_vis['longitude'].between(ovest, est)]
+                    fg_clienti = layer_clienti_viewport(df_vis, vista['zoom'])
+                    if vista.get('center'):
+                        st_folium_vista = {'center': (vista['center']['lat'], vista['center']['lng']), 'zoom': vista['zoom']}
+                    dettaglio = vista['zoom'] >= ZOOM_DETTAGLIO_MAPPA and len(df_vis) <= MAX_MARKER_VIEWPORT
+                    st.caption(f"🔭 {len(df_vis)} clienti nell'area visibile" +
+                               ("" if dettaglio else " · conteggi per zona, avvicinati per vedere i singoli clienti"))
+                
+                if misura_mappa:
+                    ms_build = (time_module.perf_counter() - t_build) * 1000
+                    t_render = time_module.perf_counter()
+                    html_kb = len(m.get_root().render().encode('utf-8')) / 1024
+                    ms_render = (time_module.perf_counter() - t_render) * 1000
+                    st.caption(f"⏱️ {modalita_layer.upper()} · {len(df_filtered)} clienti · "
+                               f"{'mappa riusata' if mappa_riusata else 'costruzione'} {ms_build:.0f} ms · "
+                               f"serializzazione {ms_render:.0f} ms · HTML {html_kb:,.0f} KB")
                 
                 # Mostra mappa e cattura click
-                map_data = st_folium(m, width=None, height=500, use_container_width=True, key="mappa_clienti")
+                # Solo gli oggetti usati dalla pagina tornano a Python: fuori dall'area visibile il pan non provoca rerun
+                oggetti_mappa = ["last_object_clicked", "bounds", "zoom", "center"] if modalita_layer == 'viewport' else ["last_object_clicked"]
+                map_data = st_folium(m, width=None, height=500, use_container_width=True, key="mappa_clienti",
+                                     feature_group_to_add=fg_clienti, render=not getattr(m, 'renderizzata', False),
+                                     returned_objects=oggetti_mappa, **st_folium_vista)
+                
+                # Area visibile cambiata rispetto a quella usata per i marker → ricarica il layer
+                if modalita_layer == 'viewport' and map_data:
+                    nuovi_bounds = bounds_da_mappa(map_data)
+                    if nuovi_bounds and nuovi_bounds != vista.get('ignora') and (nuovi_bounds != vista['bounds'] or int(map_data.get('zoom') or vista['zoom']) != vista['zoom']):
+                        st.session_state._viewport_clienti = dict(vista, bounds=nuovi_bounds,
+                                                                  zoom=int(map_data.get('zoom') or vista['zoom']),
+                                                                  center=map_data.get('center'))
+                        st.rerun()
                 
                 # Rileva click su marker
                 clicked = map_data.get('last_object_clicked') if map_data else None
@@ -4149,16 +5021,10 @@ def main_app():
                     click_lon = clicked.get('lng', 0)
                     
                     # Trova il cliente più vicino al punto cliccato
-                    min_d = float('inf')
-                    found_nome = None
-                    for _, row in df_filtered.iterrows():
-                        d = haversine(click_lat, click_lon, row['latitude'], row['longitude'])
-                        if d < min_d:
-                            min_d = d
-                            found_nome = row['nome_cliente']
-                    
-                    if found_nome and min_d < 1:  # entro 1km
-                        st.session_state.mappa_cliente_cliccato = found_nome
+                    dists = haversine_np(click_lat, click_lon, df_filtered['latitude'], df_filtered['longitude'])
+                    i_min = int(np.argmin(dists))
+                    if dists[i_min] < 1:  # entro 1km
+                        st.session_state.mappa_cliente_cliccato = df_filtered['nome_cliente'].iloc[i_min]
                 
                 # === SCHEDA CLIENTE CLICCATO ===
                 if st.session_state.mappa_cliente_cliccato:
@@ -4258,7 +5124,7 @@ def main_app():
                 with col_qf2:
                     q_citta = st.selectbox("Città:", ["Tutte"] + sorted(df['citta'].dropna().unique().tolist()), key="q_filtro_citta")
                 with col_qf3:
-                    q_cerca = st.text_input("🔍 Cerca:", key="q_cerca_nome", placeholder="Nome cliente...")
+                    q_cerca = st.text_input("🔍 Cerca:", key="q_cerca_nome", placeholder="Nome, indirizzo, città, telefono...")
                 
                 df_quick = df.copy()
                 if q_filtro == "Nel giro":
@@ -4268,9 +5134,12 @@ def main_app():
                 if q_citta != "Tutte":
                     df_quick = df_quick[df_quick['citta'] == q_citta]
                 if q_cerca:
-                    df_quick = df_quick[df_quick['nome_cliente'].str.contains(q_cerca, case=False, na=False)]
-                
-                df_quick = df_quick.sort_values('nome_cliente')
+                    # Ricerca indicizzata, tollerante agli errori, ordinata per rilevanza
+                    rango = {cid: i for i, (cid, _) in enumerate(cerca_clienti(get_indice_ricerca(df), q_cerca, limite=200))}
+                    df_quick = df_quick[df_quick['id'].isin(rango)]
+                    df_quick = df_quick.iloc[df_quick['id'].map(rango).to_numpy().argsort()]
+                else:
+                    df_quick = df_quick.sort_values('nome_cliente')
                 
                 st.write(f"**{len(df_quick)} clienti**")
                 
@@ -4279,18 +5148,14 @@ def main_app():
                 with col_all1:
                     if st.button("✅ Tutti nel giro", key="q_tutti_si", use_container_width=True):
                         ids_da_attivare = df_quick['id'].tolist()
-                        for cid in ids_da_attivare:
-                            update_cliente(cid, {'visitare': 'SI'})
-                        st.session_state.reload_data = True
+                        update_clienti(ids_da_attivare, {'visitare': 'SI'})
                         st.success(f"✅ {len(ids_da_attivare)} clienti attivati!")
                         time_module.sleep(0.5)
                         st.rerun()
                 with col_all2:
                     if st.button("❌ Tutti fuori giro", key="q_tutti_no", use_container_width=True):
                         ids_da_disattivare = df_quick['id'].tolist()
-                        for cid in ids_da_disattivare:
-                            update_cliente(cid, {'visitare': 'NO'})
-                        st.session_state.reload_data = True
+                        update_clienti(ids_da_disattivare, {'visitare': 'NO'})
                         st.warning(f"❌ {len(ids_da_disattivare)} clienti disattivati!")
                         time_module.sleep(0.5)
                         st.rerun()
@@ -4317,17 +5182,27 @@ def main_app():
                         )
                         if nuovo_stato != attivo:
                             update_cliente(cid, {'visitare': 'SI' if nuovo_stato else 'NO'})
-                            st.session_state.reload_data = True
                             st.rerun()
             
             # === 1. BARRA RICERCA CLIENTE ===
             col_filtro1, col_filtro2, col_filtro3 = st.columns([2, 1, 1])
             
             with col_filtro1:
-                # Ricerca cliente
-                nomi_tutti = [""] + sorted(df['nome_cliente'].tolist()) if 'nome_cliente' in df.columns else [""]
-                idx = nomi_tutti.index(st.session_state.cliente_selezionato) if st.session_state.cliente_selezionato in nomi_tutti else 0
-                scelto = st.selectbox("🔍 Cerca cliente:", nomi_tutti, index=idx)
+                # Ricerca cliente: testo libero sull'indice (nome, indirizzo, città, telefono, referente) → elenco per rilevanza
+                q_anagrafica = st.text_input("🔍 Cerca cliente:", key="q_cerca_anagrafica",
+                                             placeholder="Nome, indirizzo, città, telefono, referente...")
+                if q_anagrafica:
+                    indice_ricerca = get_indice_ricerca(df)
+                    nomi_tutti = [""] + [indice_ricerca['docs'][cid][0] for cid, _ in cerca_clienti(indice_ricerca, q_anagrafica)]
+                    if len(nomi_tutti) == 1:
+                        st.caption("Nessun cliente trovato")
+                else:
+                    nomi_tutti = _memo_sessione(
+                        'nomi_ordinati', st.session_state.get('df_version', 0),
+                        lambda: [""] + sorted(df['nome_cliente'].tolist()) if 'nome_cliente' in df.columns else [""]
+                    )
+                idx = nomi_tutti.index(st.session_state.cliente_selezionato) if st.session_state.cliente_selezionato in nomi_tutti else (1 if q_anagrafica and len(nomi_tutti) > 1 else 0)
+                scelto = st.selectbox("Cliente:", nomi_tutti, index=idx, label_visibility="collapsed")
             
             with col_filtro2:
                 # Filtro per stato cliente
@@ -4474,12 +5349,10 @@ def main_app():
                         if is_nel_giro:
                             if st.button("❌ Togli dal giro", key=f"toggle_giro_{cliente['id']}", use_container_width=True):
                                 update_cliente(cliente['id'], {'visitare': 'NO'})
-                                st.session_state.reload_data = True
                                 st.rerun()
                         else:
                             if st.button("✅ Metti nel giro", key=f"toggle_giro_{cliente['id']}", use_container_width=True, type="primary"):
                                 update_cliente(cliente['id'], {'visitare': 'SI'})
-                                st.session_state.reload_data = True
                                 st.rerun()
                     
                     # === DIAGNOSTICA: perché nel/non nel giro ===
@@ -4554,7 +5427,6 @@ def main_app():
                         if pd.notnull(appuntamento_attuale):
                             if st.button("🗑️ Rimuovi Appuntamento", key=f"rimuovi_app_{cliente['id']}", use_container_width=True):
                                 update_cliente(cliente['id'], {'appuntamento': None})
-                                st.session_state.reload_data = True
                                 st.success("✅ Appuntamento rimosso!")
                                 st.rerun()
                     
@@ -4584,7 +5456,6 @@ def main_app():
                             appuntamento_datetime = datetime.combine(data_appuntamento, ora_appuntamento)
                             
                             update_cliente(cliente['id'], {'appuntamento': appuntamento_datetime.isoformat()})
-                            st.session_state.reload_data = True
                             st.success(f"✅ Appuntamento fissato per il {data_appuntamento.strftime('%d/%m/%Y')} alle {ora_appuntamento.strftime('%H:%M')}!")
                             st.rerun()
                     
@@ -4619,12 +5490,27 @@ def main_app():
                     storico_raw = str(cliente.get('storico_report', '') or '')
                     note_cliente = str(cliente.get('note', '') or '')
                     
-                    # Conta report
-                    report_entries = [r.strip() for r in storico_raw.split('\n\n') if r.strip()] if storico_raw.strip() else []
+                    # Storico dalla tabella visite, a pagine; vecchio blob solo se non ancora migrato
+                    chiave_pagine = f"storico_mostrati_{cliente['id']}"
+                    n_mostrati = st.session_state.get(chiave_pagine, VISITE_PER_PAGINA)
+                    risultato_storico = _memo_sessione(
+                        'storico_cliente', (cliente['id'], n_mostrati, st.session_state.get('df_version', 0)),
+                        lambda: fetch_visite_cliente(cliente['id'], limite=n_mostrati)
+                    )
+                    if risultato_storico is not None and (risultato_storico[1] > 0 or not storico_raw.strip()):
+                        report_entries = [
+                            {'data_testo': pd.to_datetime(v['data_visita']).strftime('%d/%m/%Y'),
+                             'tipo': v.get('tipo') or '', 'testo': v.get('testo') or ''}
+                            for v in risultato_storico[0]
+                        ]
+                        n_report = risultato_storico[1]
+                    else:
+                        report_entries = parse_storico_report(storico_raw)
+                        n_report = len(report_entries)
                     
                     col_storico_h, col_storico_count = st.columns([3, 1])
                     col_storico_h.markdown("### 📜 Storico Report")
-                    col_storico_count.metric("Report", len(report_entries))
+                    col_storico_count.metric("Report", n_report)
                     
                     # Note generali (se presenti)
                     if note_cliente.strip():
@@ -4637,31 +5523,9 @@ def main_app():
                     
                     if report_entries:
                         for idx_rep, entry in enumerate(report_entries):
-                            # Parsa data e tipo dal formato [dd/mm/YYYY] [TIPO] testo
-                            entry_text = entry.strip()
-                            
-                            # Estrai data
-                            data_rep = ""
-                            tipo_rep = ""
-                            testo_rep = entry_text
-                            
-                            if entry_text.startswith('['):
-                                # Cerca prima parentesi chiusa per la data
-                                end_data = entry_text.find(']')
-                                if end_data > 0:
-                                    data_rep = entry_text[1:end_data]
-                                    resto = entry_text[end_data+1:].strip()
-                                    
-                                    # Cerca tipo [VISITA] o [TELEFONATA]
-                                    if resto.startswith('['):
-                                        end_tipo = resto.find(']')
-                                        if end_tipo > 0:
-                                            tipo_rep = resto[1:end_tipo]
-                                            testo_rep = resto[end_tipo+1:].strip()
-                                        else:
-                                            testo_rep = resto
-                                    else:
-                                        testo_rep = resto
+                            data_rep = entry['data_testo']
+                            tipo_rep = entry['tipo']
+                            testo_rep = entry['testo']
                             
                             # Icona per tipo
                             if 'TELEFONATA' in tipo_rep.upper():
@@ -4688,10 +5552,15 @@ def main_app():
                                 elif header_line:
                                     st.markdown(header_line)
                                 else:
-                                    st.markdown(testo_rep if testo_rep else entry_text)
+                                    st.markdown(testo_rep)
                             
                             if idx_rep < len(report_entries) - 1:
                                 st.markdown("---")
+                        
+                        if len(report_entries) < n_report:
+                            if st.button(f"📜 Mostra altri ({n_report - len(report_entries)})", key=f"storico_altri_{cliente['id']}", use_container_width=True):
+                                st.session_state[chiave_pagine] = n_mostrati + VISITE_PER_PAGINA
+                                st.rerun()
                     else:
                         st.caption("Nessun report registrato. Usa la sezione sottostante per registrare la prima visita.")
                 
@@ -4725,21 +5594,12 @@ def main_app():
                         if st.button("✅ REGISTRA VISITA", type="primary", use_container_width=True):
                             # Crea report con tipo
                             tipo_label = "VISITA" if "Visita" in tipo_visita else "TELEFONATA"
-                            nuovo_report = f"[{data_visita.strftime('%d/%m/%Y')}] [{tipo_label}] {report_visita}"
-                            vecchio = str(cliente.get('storico_report', '') or '')
-                            storico = nuovo_report + "\n\n" + vecchio if vecchio.strip() else nuovo_report
-                            
-                            update_cliente(cliente['id'], {
-                                'ultima_visita': data_visita.isoformat(),
-                                'storico_report': storico
-                            })
-                            
-                            if scelto not in st.session_state.visitati_oggi:
-                                st.session_state.visitati_oggi.append(scelto)
-                            
-                            st.session_state.reload_data = True
-                            st.success(f"✅ {tipo_label} registrata!")
-                            st.rerun()
+                            if registra_visita(cliente['id'], data_visita, tipo_label, report_visita):
+                                if scelto not in st.session_state.visitati_oggi:
+                                    st.session_state.visitati_oggi.append(scelto)
+                                
+                                st.success(f"✅ {tipo_label} registrata!")
+                                st.rerun()
                 
                 # --- Colonna Promemoria ---
                 with col_promemoria:
@@ -4763,13 +5623,11 @@ def main_app():
                         
                         if col_prom1.button("💾 Salva", use_container_width=True, type="primary"):
                             update_cliente(cliente['id'], {'promemoria': nuovo_promemoria})
-                            st.session_state.reload_data = True
                             st.success("✅ Salvato!")
                             st.rerun()
                         
                         if col_prom2.button("🗑️ Cancella", use_container_width=True):
                             update_cliente(cliente['id'], {'promemoria': ''})
-                            st.session_state.reload_data = True
                             st.success("✅ Cancellato!")
                             st.rerun()
                 
@@ -4800,7 +5658,6 @@ def main_app():
                                         'latitude': new_coords[0],
                                         'longitude': new_coords[1]
                                     })
-                                    st.session_state.reload_data = True
                                     st.success(f"✅ Coordinate: {new_coords[0]:.6f}, {new_coords[1]:.6f}")
                                     st.rerun()
                                 else:
@@ -4826,7 +5683,6 @@ def main_app():
                                             update_data['provincia'] = addr_info['provincia']
                                     
                                     update_cliente(cliente['id'], update_data)
-                                    st.session_state.reload_data = True
                                     st.success("✅ Posizione salvata!")
                                     st.rerun()
                                 else:
@@ -4866,7 +5722,6 @@ def main_app():
                         longitudine = c2.number_input("Longitudine", value=float(lon_attuale), format="%.6f", key=f"lon_{cliente['id']}")
                         
                         note = st.text_area("Note", cliente.get('note', ''), height=80, key=f"note_{cliente['id']}")
-                        storico = st.text_area("Storico Report", cliente.get('storico_report', ''), height=120, key=f"storico_{cliente['id']}")
                         
                         if st.form_submit_button("💾 Salva Modifiche", use_container_width=True, type="primary"):
                             update_data = {
@@ -4884,12 +5739,10 @@ def main_app():
                                 'contatto': contatto,
                                 'latitude': latitudine,
                                 'longitude': longitudine,
-                                'note': note,
-                                'storico_report': storico
+                                'note': note
                             }
                             
                             if update_cliente(cliente['id'], update_data):
-                                st.session_state.reload_data = True
                                 st.success(f"✅ Salvato! Nel giro: {visitare}")
                                 time_module.sleep(0.5)
                                 st.rerun()
@@ -4904,7 +5757,6 @@ def main_app():
                         if st.button("❌ ELIMINA CLIENTE", type="primary"):
                             delete_cliente(cliente['id'])
                             st.session_state.cliente_selezionato = None
-                            st.session_state.reload_data = True
                             st.rerun()
         else:
             st.info("Nessun cliente presente. Vai su ➕ Nuovo per aggiungerne uno.")
@@ -4931,45 +5783,22 @@ def main_app():
         st.subheader("📍 Posizione GPS")
         st.caption("Usa il GPS del dispositivo oppure incolla le coordinate da Google Maps")
         
-        # Controlla se ci sono coordinate GPS dai query params
-        gps_data = read_gps_from_url()
-        if gps_data and 'gps_acquisito_nuovo' not in st.session_state:
-            st.session_state.gps_acquisito_nuovo = True
-            # Reverse geocoding per ottenere indirizzo
-            addr = reverse_geocode(gps_data['latitude'], gps_data['longitude'])
-            if addr:
-                st.session_state.nuovo_cliente_indirizzo = addr.get('via', '')
-                st.session_state.nuovo_cliente_cap = addr.get('cap', '')
-                st.session_state.nuovo_cliente_citta = addr.get('citta', '')
-                st.session_state.nuovo_cliente_provincia = addr.get('provincia', '')
-            st.session_state.nuovo_cliente_lat = gps_data['latitude']
-            st.session_state.nuovo_cliente_lon = gps_data['longitude']
-            clear_gps_from_url()
-            st.rerun()
-        
         col_gps1, col_gps2 = st.columns([1, 1])
-        
+
         with col_gps1:
-            # Pulsante GPS nativo del browser
-            render_gps_button("nuovo_cliente")
-            if st.button("🔄 Conferma posizione GPS", use_container_width=True, 
-                         help="Dopo aver premuto 'Rileva GPS', premi qui per caricare la posizione"):
-                gps_check = read_gps_from_url()
-                if gps_check:
-                    with st.spinner("🔄 Ricerca indirizzo..."):
-                        addr = reverse_geocode(gps_check['latitude'], gps_check['longitude'])
-                    if addr:
-                        st.session_state.nuovo_cliente_indirizzo = addr.get('via', '')
-                        st.session_state.nuovo_cliente_cap = addr.get('cap', '')
-                        st.session_state.nuovo_cliente_citta = addr.get('citta', '')
-                        st.session_state.nuovo_cliente_provincia = addr.get('provincia', '')
-                    st.session_state.nuovo_cliente_lat = gps_check['latitude']
-                    st.session_state.nuovo_cliente_lon = gps_check['longitude']
-                    clear_gps_from_url()
-                    st.success("✅ Posizione GPS acquisita!")
-                    st.rerun()
-                else:
-                    st.warning("⚠️ Premi prima '📍 Rileva Posizione GPS' e poi questo pulsante")
+            # Pulsante GPS nativo del browser: la posizione arriva direttamente come valore
+            gps_data = gps_nuova_posizione("nuovo_cliente")
+            if gps_data:
+                with st.spinner("🔄 Ricerca indirizzo..."):
+                    addr = reverse_geocode(gps_data['latitude'], gps_data['longitude'])
+                if addr:
+                    st.session_state.nuovo_cliente_indirizzo = addr.get('via', '')
+                    st.session_state.nuovo_cliente_cap = addr.get('cap', '')
+                    st.session_state.nuovo_cliente_citta = addr.get('citta', '')
+                    st.session_state.nuovo_cliente_provincia = addr.get('provincia', '')
+                st.session_state.nuovo_cliente_lat = gps_data['latitude']
+                st.session_state.nuovo_cliente_lon = gps_data['longitude']
+                st.success("✅ Posizione GPS acquisita!")
 
         with col_gps2:
             # Input manuale coordinate (può essere compilato da GPS o manualmente)
@@ -5102,7 +5931,6 @@ def main_app():
                         st.session_state.nuovo_cliente_lat = None
                         st.session_state.nuovo_cliente_lon = None
                         
-                        st.session_state.reload_data = True
                         st.success(f"✅ Cliente {nome} creato!")
                         time_module.sleep(1)
                         st.rerun()
@@ -5256,7 +6084,6 @@ def main_app():
                                 ok = assegna_clienti_a_agente(clienti_sel, agenti[idx_ag]['user_id'], team_info['team_id'])
                                 if ok:
                                     st.toast(f"✅ {len(clienti_sel)} clienti assegnati a {agente_dest}")
-                                    st.session_state.reload_data = True
                                     time_module.sleep(0.5)
                                     st.rerun()
                         
@@ -5264,7 +6091,6 @@ def main_app():
                             if clienti_sel and st.button("🔓 Rimuovi assegnazione"):
                                 rimuovi_assegnazione(clienti_sel)
                                 st.toast("✅ Assegnazione rimossa")
-                                st.session_state.reload_data = True
                                 time_module.sleep(0.5)
                                 st.rerun()
                     else:
@@ -5337,6 +6163,7 @@ def main_app():
             with tab_import:
                 st.subheader("📥 Importa Clienti nel Team")
                 st.caption("Carica un file Excel con i clienti da assegnare agli agenti.")
+                job_team_attivo = pannello_job('import_team')
                 
                 uploaded = st.file_uploader("Scegli file Excel", type=['xlsx', 'xls'], key="import_team")
                 
@@ -5348,12 +6175,9 @@ def main_app():
                         
                         st.caption("Colonne riconosciute: nome cliente, indirizzo, citta, cap, provincia, cellulare, email, note, visitare, frequenza_giorni, latitude, longitude")
                         
-                        if st.button("📥 Importa nel Team", type="primary"):
-                            with st.spinner("Importazione in corso..."):
-                                count = importa_clienti_team(df_imp, team_info['team_id'])
-                            st.success(f"✅ {count} clienti importati nel team!")
-                            st.session_state.reload_data = True
-                            time_module.sleep(1)
+                        if st.button("📥 Importa nel Team", type="primary", disabled=job_team_attivo):
+                            user_id = get_user_id()
+                            avvia_job('import_team', righe_import_team(df_imp, team_info['team_id'], user_id), user_id)
                             st.rerun()
                     except Exception as e:
                         st.error(f"❌ Errore lettura file: {e}")
@@ -5372,41 +6196,20 @@ def main_app():
         
         st.info(f"📍 **Posizione attuale:** {citta_attuale} ({lat_attuale:.6f}, {lon_attuale:.6f})")
         
-        # Controlla se ci sono coordinate GPS dai query params (per la base)
-        gps_data_config = read_gps_from_url()
-        if gps_data_config:
-            with st.spinner("🔄 Aggiornamento posizione base da GPS..."):
-                addr_info = reverse_geocode(gps_data_config['latitude'], gps_data_config['longitude'])
-                citta_nome = addr_info['citta'] if addr_info and addr_info.get('citta') else "Posizione GPS"
-            
-            config['citta_base'] = citta_nome
-            config['lat_base'] = gps_data_config['latitude']
-            config['lon_base'] = gps_data_config['longitude']
-            save_config(config)
-            st.session_state.config = config
-            clear_gps_from_url()
-            st.success(f"✅ Posizione base aggiornata via GPS: {citta_nome}")
-            st.rerun()
-        
         # Opzione 0: GPS
         with st.expander("📍 Usa GPS per impostare posizione base"):
-            render_gps_button("config_base")
-            if st.button("🔄 Conferma posizione GPS come base", use_container_width=True, type="primary",
-                         help="Dopo aver premuto 'Rileva GPS', premi qui"):
-                gps_check = read_gps_from_url()
-                if gps_check:
-                    addr_info = reverse_geocode(gps_check['latitude'], gps_check['longitude'])
+            gps_data_config = gps_nuova_posizione("config_base")
+            if gps_data_config:
+                with st.spinner("🔄 Aggiornamento posizione base da GPS..."):
+                    addr_info = reverse_geocode(gps_data_config['latitude'], gps_data_config['longitude'])
                     citta_nome = addr_info['citta'] if addr_info and addr_info.get('citta') else "Posizione GPS"
-                    config['citta_base'] = citta_nome
-                    config['lat_base'] = gps_check['latitude']
-                    config['lon_base'] = gps_check['longitude']
-                    save_config(config)
-                    st.session_state.config = config
-                    clear_gps_from_url()
-                    st.success(f"✅ Base aggiornata: {citta_nome}")
-                    st.rerun()
-                else:
-                    st.warning("⚠️ Premi prima il pulsante GPS, poi conferma qui")
+                config['citta_base'] = citta_nome
+                config['lat_base'] = gps_data_config['latitude']
+                config['lon_base'] = gps_data_config['longitude']
+                save_config(config)
+                st.session_state.config = config
+                st.success(f"✅ Base aggiornata: {citta_nome}")
+                st.rerun()  # la posizione attuale mostrata sopra va ridisegnata
         
         # Opzione 1: Inserisci città
         col_part1, col_part2 = st.columns(2)
@@ -5620,6 +6423,7 @@ def main_app():
         st.divider()
         st.subheader("🌍 Rigenera Coordinate GPS")
         st.info("Se le coordinate non sono state importate correttamente, puoi rigenerarle dagli indirizzi.")
+        job_geo_attivo = pannello_job('geocodifica')
         
         if not df.empty:
             # Mostra clienti senza coordinate
@@ -5634,41 +6438,11 @@ def main_app():
                     if len(senza_coord) > 20:
                         st.write(f"... e altri {len(senza_coord) - 20}")
                 
-                if st.button("🌍 RIGENERA TUTTE LE COORDINATE", type="primary", use_container_width=True):
-                    progress = st.progress(0)
-                    status = st.empty()
-                    
-                    successi = 0
-                    errori = 0
-                    
-                    for idx, (_, row) in enumerate(senza_coord.iterrows()):
-                        indirizzo = row.get('indirizzo', '')
-                        if indirizzo:
-                            status.text(f"Geocoding: {row['nome_cliente']}...")
-                            coords = get_coords(indirizzo)
-                            
-                            if coords:
-                                # Aggiorna nel database
-                                update_cliente(row['id'], {
-                                    'latitude': coords[0],
-                                    'longitude': coords[1]
-                                })
-                                successi += 1
-                            else:
-                                errori += 1
-                            
-                            # Rate limiting LocationIQ (2 req/sec)
-                            time_module.sleep(0.5)
-                        else:
-                            errori += 1
-                        
-                        progress.progress((idx + 1) / len(senza_coord))
-                    
-                    progress.empty()
-                    status.empty()
-                    
-                    st.success(f"✅ Completato! {successi} coordinate rigenerate, {errori} errori")
-                    st.session_state.reload_data = True
+                if st.button("🌍 RIGENERA TUTTE LE COORDINATE", type="primary", use_container_width=True, disabled=job_geo_attivo):
+                    avvia_job('geocodifica', [
+                        {'id': int(row['id']), 'nome': row['nome_cliente'], 'indirizzo': str(row.get('indirizzo') or '') if pd.notna(row.get('indirizzo')) else ''}
+                        for _, row in senza_coord.iterrows()
+                    ])
                     st.rerun()
             else:
                 st.success("✅ Tutti i clienti hanno coordinate valide!")
@@ -5676,6 +6450,7 @@ def main_app():
         st.divider()
         st.subheader("🏙️ Aggiorna Città Clienti")
         st.info("Se hai clienti senza il campo città compilato, puoi aggiornarlo automaticamente dalle coordinate GPS.")
+        job_citta_attivo = pannello_job('citta')
         
         if not df.empty:
             # Assicurati che la colonna citta esista
@@ -5698,56 +6473,42 @@ def main_app():
                     if len(senza_citta) > 20:
                         st.write(f"... e altri {len(senza_citta) - 20}")
                 
-                if st.button("🏙️ AGGIORNA TUTTE LE CITTÀ", type="primary", use_container_width=True):
-                    progress = st.progress(0)
-                    status = st.empty()
-                    
-                    successi = 0
-                    errori = 0
-                    
-                    for idx, (_, row) in enumerate(senza_citta.iterrows()):
-                        status.text(f"Cercando città per: {row['nome_cliente']}...")
-                        
-                        try:
-                            # Reverse geocoding
-                            addr = reverse_geocode(float(row['latitude']), float(row['longitude']))
-                            
-                            if addr and addr.get('citta'):
-                                # Aggiorna nel database
-                                update_data = {'citta': addr['citta']}
-                                
-                                # Aggiorna anche altri campi se vuoti
-                                if not row.get('indirizzo') and addr.get('via'):
-                                    update_data['indirizzo'] = addr['via']
-                                if not row.get('cap') and addr.get('cap'):
-                                    update_data['cap'] = addr['cap']
-                                if not row.get('provincia') and addr.get('provincia'):
-                                    update_data['provincia'] = addr['provincia']
-                                
-                                update_cliente(row['id'], update_data)
-                                successi += 1
-                            else:
-                                errori += 1
-                        except Exception as e:
-                            errori += 1
-                        
-                        # Rate limiting LocationIQ (2 req/sec)
-                        time_module.sleep(0.5)
-                        
-                        progress.progress((idx + 1) / len(senza_citta))
-                    
-                    progress.empty()
-                    status.empty()
-                    
-                    st.success(f"✅ Completato! {successi} città aggiornate, {errori} errori")
-                    st.session_state.reload_data = True
-                    time_module.sleep(1)
+                if st.button("🏙️ AGGIORNA TUTTE LE CITTÀ", type="primary", use_container_width=True, disabled=job_citta_attivo):
+                    avvia_job('citta', [
+                        {'id': int(row['id']), 'nome': row['nome_cliente'],
+                         'lat': float(row['latitude']), 'lon': float(row['longitude']),
+                         # campi da compilare anche loro se il reverse geocoding li trova
+                         'vuoti': [c for c in ('indirizzo', 'cap', 'provincia') if pd.isna(row.get(c)) or not row.get(c)]}
+                        for _, row in senza_citta.iterrows()
+                    ])
                     st.rerun()
             else:
                 st.success("✅ Tutti i clienti hanno la città compilata!")
         
+        st.divider()
+        st.subheader("📜 Storico Visite")
+        st.info("Lo storico report è salvato nella tabella **visite** (una riga per visita). I vecchi report testuali dei clienti vanno migrati una sola volta.")
+        
+        if not df.empty and 'storico_report' in df.columns:
+            con_storico = int((df['storico_report'].fillna('').astype(str).str.strip() != '').sum())
+            if con_storico > 0:
+                st.caption(f"📄 {con_storico} clienti hanno uno storico testuale (i clienti già migrati vengono saltati)")
+                if st.button("📦 MIGRA STORICO REPORT", use_container_width=True):
+                    progress = st.progress(0)
+                    try:
+                        n_clienti_migr, n_visite_migr = migra_storico_report(df, progress)
+                        progress.empty()
+                        st.success(f"✅ Migrati {n_clienti_migr} clienti ({n_visite_migr} visite)")
+                        _segna_dati_modificati()
+                    except Exception as e:
+                        progress.empty()
+                        st.error(f"❌ Migrazione non riuscita (tabella visite creata? vedi sql/001_visite.sql): {str(e)}")
+            else:
+                st.success("✅ Nessuno storico testuale da migrare")
+        
         st.divider()
         st.subheader("📥 Importa Clienti da CSV")
+        job_csv_attivo = pannello_job('import_csv')
         
         st.info("""
         **Formato CSV richiesto:**
@@ -5807,125 +6568,11 @@ def main_app():
                 # Pulsante importazione
                 col_imp1, col_imp2 = st.columns(2)
                 
-                if col_imp1.button("🚀 IMPORTA TUTTI I CLIENTI", type="primary", use_container_width=True):
+                if col_imp1.button("🚀 IMPORTA TUTTI I CLIENTI", type="primary", use_container_width=True, disabled=job_csv_attivo):
                     user_id = get_user_id()
-                    
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    successi = 0
-                    errori = 0
-                    errori_dettagli = []
-                    
-                    for idx, row in df_import.iterrows():
-                        try:
-                            # Funzione helper per estrarre valori
-                            def get_val(col_name, default=''):
-                                val = row.get(col_name)
-                                if pd.isna(val) or val is None or str(val).lower() == 'nan':
-                                    return default
-                                return str(val).strip()
-                            
-                            def get_float(col_name):
-                                val = row.get(col_name)
-                                if pd.isna(val) or val is None:
-                                    return None
-                                try:
-                                    return float(str(val).replace(',', '.'))
-                                except:
-                                    return None
-                            
-                            # Estrai nome cliente
-                            nome = get_val('nome cliente')
-                            
-                            if not nome:
-                                errori += 1
-                                errori_dettagli.append(f"Riga {idx+2}: Nome cliente mancante")
-                                continue
-                            
-                            # Converti latitude/longitude
-                            lat = get_float('latitude')
-                            lon = get_float('longitude')
-                            
-                            # Converti data ultima visita
-                            ultima_visita = None
-                            data_str = get_val('ultima visita')
-                            if data_str:
-                                try:
-                                    data_str = data_str.split(' ')[0]
-                                    ultima_visita = datetime.strptime(data_str, '%d/%m/%Y').isoformat()
-                                except:
-                                    try:
-                                        ultima_visita = datetime.strptime(data_str, '%Y-%m-%d').isoformat()
-                                    except:
-                                        pass
-                            
-                            # Converti frequenza
-                            freq = 30
-                            freq_val = row.get('frequenza giorni') or row.get('frequenza (giorni)')
-                            if pd.notna(freq_val):
-                                try:
-                                    freq = int(float(freq_val))
-                                except:
-                                    pass
-                            
-                            # Prepara dati cliente
-                            cliente = {
-                                'user_id': user_id,
-                                'nome_cliente': nome,
-                                'indirizzo': get_val('indirizzo'),
-                                'citta': get_val('citta'),
-                                'cap': get_val('cap'),
-                                'provincia': get_val('provincia'),
-                                'latitude': lat,
-                                'longitude': lon,
-                                'frequenza_giorni': freq,
-                                'ultima_visita': ultima_visita,
-                                'visitare': get_val('visitare', 'SI').upper(),
-                                'storico_report': get_val('storico report'),
-                                'telefono': get_val('telefono'),
-                                'cellulare': get_val('cellulare'),
-                                'mail': get_val('mail'),
-                                'contatto': get_val('contatto'),
-                                'referente': get_val('referente'),
-                                'note': get_val('note'),
-                                'stato_cliente': get_val('stato cliente', 'CLIENTE ATTIVO')
-                            }
-                            
-                            # Rimuovi valori vuoti (tranne user_id e nome_cliente)
-                            cliente_clean = {k: v for k, v in cliente.items() 
-                                           if v is not None and v != ''}
-                            cliente_clean['user_id'] = user_id
-                            cliente_clean['nome_cliente'] = nome
-                            
-                            # Inserisci nel database
-                            supabase.table('clienti').insert(cliente_clean).execute()
-                            successi += 1
-                            
-                        except Exception as e:
-                            errori += 1
-                            errori_dettagli.append(f"Riga {idx+2}: {str(e)[:50]}")
-                        
-                        # Aggiorna progress bar
-                        progress = (idx + 1) / len(df_import)
-                        progress_bar.progress(progress)
-                        status_text.text(f"Importazione: {idx+1}/{len(df_import)} ({successi} ✅ | {errori} ❌)")
-                    
-                    # Risultato finale
-                    progress_bar.empty()
-                    status_text.empty()
-                    
-                    if successi > 0:
-                        st.success(f"🎉 **Importazione completata!**")
-                        st.write(f"✅ Importati: **{successi}** clienti")
-                        if errori > 0:
-                            st.write(f"❌ Errori: **{errori}**")
-                            with st.expander("Dettagli errori"):
-                                for err in errori_dettagli[:20]:
-                                    st.write(f"- {err}")
-                        
-                        # Ricarica dati
-                        st.session_state.reload_data = True
+                    elementi = righe_import_csv(df_import, user_id)
+                    if any(not el.get('_errore') for el in elementi):
+                        avvia_job('import_csv', elementi, user_id)
                         st.rerun()
                     else:
                         st.error("❌ Nessun cliente importato. Controlla il formato del file.")
@@ -5964,14 +6611,15 @@ def main_app():
                     key="exp_giro_cliente"
                 )
             
-            # Applica filtri
-            df_export = df.copy()
+            # Applica filtri (solo maschera: nessuna copia del DataFrame)
+            mask_export = pd.Series(True, index=df.index)
             if exp_stato != "Tutti":
-                df_export = df_export[df_export['stato_cliente'] == exp_stato]
+                mask_export &= df['stato_cliente'] == exp_stato
             if exp_giro == "Solo nel giro (SI)":
-                df_export = df_export[df_export['visitare'] == 'SI']
+                mask_export &= df['visitare'] == 'SI'
             elif exp_giro == "Solo fuori giro (NO)":
-                df_export = df_export[df_export['visitare'] != 'SI']
+                mask_export &= df['visitare'] != 'SI'
+            n_export = int(mask_export.sum())
             
             # Seleziona colonne da esportare
             with st.expander("⚙️ Seleziona colonne"):
@@ -5985,129 +6633,118 @@ def main_app():
                 
                 colonne_sel = st.multiselect(
                     "Colonne da includere:",
-                    [c for c in colonne_disponibili if c in df_export.columns],
-                    default=[c for c in colonne_default if c in df_export.columns],
+                    [c for c in colonne_disponibili if c in df.columns],
+                    default=[c for c in colonne_default if c in df.columns],
                     key="colonne_export_clienti"
                 )
             
-            st.info(f"📊 **{len(df_export)} clienti** pronti per l'esportazione")
-            
-            col_btn1, col_btn2 = st.columns(2)
+            st.info(f"📊 **{n_export} clienti** pronti per l'esportazione")
             
-            with col_btn1:
-                if not df_export.empty and colonne_sel:
-                    df_to_export = df_export[colonne_sel].copy()
-                    # Formatta date
-                    if 'ultima_visita' in df_to_export.columns:
-                        df_to_export['ultima_visita'] = pd.to_datetime(df_to_export['ultima_visita']).dt.strftime('%d/%m/%Y')
-                    
-                    csv = df_to_export.to_csv(index=False)
-                    st.download_button(
-                        "📥 Scarica CSV",
-                        csv,
-                        f"clienti_export_{ora_italiana.strftime('%Y%m%d')}.csv",
-                        "text/csv",
-                        use_container_width=True
-                    )
-            
-            with col_btn2:
-                if not df_export.empty and colonne_sel:
-                    df_to_export = df_export[colonne_sel].copy()
-                    if 'ultima_visita' in df_to_export.columns:
-                        df_to_export['ultima_visita'] = pd.to_datetime(df_to_export['ultima_visita']).dt.strftime('%d/%m/%Y')
-                    
-                    # Crea Excel in memoria
-                    output = io.BytesIO()
-                    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                        df_to_export.to_excel(writer, index=False, sheet_name='Clienti')
-                    output.seek(0)
-                    
-                    st.download_button(
-                        "📥 Scarica Excel",
-                        output,
-                        f"clienti_export_{ora_italiana.strftime('%Y%m%d')}.xlsx",
-                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
-                    )
+            if n_export and colonne_sel:
+                def _genera_export_clienti(formato):
+                    righe = righe_da_dataframe(df.loc[mask_export, colonne_sel], {'ultima_visita': data_export})
+                    if formato == 'csv':
+                        return genera_csv(colonne_sel, righe)
+                    return genera_excel([('Clienti', colonne_sel, righe)])
+                
+                pulsanti_export(
+                    'clienti',
+                    (st.session_state.get('df_version', 0), exp_stato, exp_giro, tuple(colonne_sel)),
+                    f"clienti_export_{ora_italiana.strftime('%Y%m%d')}",
+                    _genera_export_clienti
+                )
         
         # --- TAB ESPORTA AGENDA ---
         with tab_exp2:
-            st.write("**Esporta l'agenda settimanale ottimizzata**")
+            st.write("**Esporta l'agenda ottimizzata (una o più settimane)**")
             
-            # Selezione settimana
+            # Selezione settimana iniziale e orizzonte
             col_sett1, col_sett2 = st.columns(2)
             with col_sett1:
                 settimana_exp = st.selectbox(
-                    "Seleziona settimana:",
+                    "Dalla settimana:",
                     ["Settimana corrente", "Prossima settimana", "Tra 2 settimane"],
                     key="settimana_export"
                 )
+            with col_sett2:
+                n_settimane_exp = st.number_input(
+                    "Numero di settimane:", min_value=1, max_value=8, value=1, step=1,
+                    key="n_settimane_export",
+                    help="Le settimane successive tengono conto delle visite già pianificate nelle precedenti"
+                )
             
             offset_map = {"Settimana corrente": 0, "Prossima settimana": 1, "Tra 2 settimane": 2}
             offset = offset_map.get(settimana_exp, 0)
-            
-            # Calcola agenda
-            agenda_exp = calcola_agenda_settimanale(df, config, [], offset)
-            
-            # Prepara dati per export
-            righe_agenda = []
-            giorni_nomi_full = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
-            
             oggi = ora_italiana.date()
             lunedi = oggi - timedelta(days=oggi.weekday()) + timedelta(weeks=offset)
             
-            for giorno_idx, tappe in agenda_exp.items():
-                data_giorno = lunedi + timedelta(days=giorno_idx)
-                for i, tappa in enumerate(tappe, 1):
-                    righe_agenda.append({
-                        'Giorno': giorni_nomi_full[giorno_idx],
-                        'Data': data_giorno.strftime('%d/%m/%Y'),
-                        'Ordine': i,
-                        'Ora Arrivo': tappa.get('ora_arrivo', ''),
-                        'Cliente': tappa.get('nome_cliente', ''),
-                        'Indirizzo': tappa.get('indirizzo', ''),
-                        'Tipo': 'Appuntamento' if '📌' in tappa.get('tipo_tappa', '') else 'Giro',
-                        'Distanza (km)': round(tappa.get('distanza_km', 0), 1)
-                    })
-            
-            df_agenda_exp = pd.DataFrame(righe_agenda)
-            
-            tot_visite = len(df_agenda_exp)
-            tot_km = df_agenda_exp['Distanza (km)'].sum() if not df_agenda_exp.empty else 0
-            
-            st.info(f"📊 **{tot_visite} visite** programmate | ~{tot_km:.0f} km totali")
-            
-            if not df_agenda_exp.empty:
-                with st.expander("👀 Anteprima agenda"):
-                    st.dataframe(df_agenda_exp, use_container_width=True)
-                
-                col_ag1, col_ag2 = st.columns(2)
-                
-                with col_ag1:
-                    csv_agenda = df_agenda_exp.to_csv(index=False)
-                    st.download_button(
-                        "📥 Scarica CSV",
-                        csv_agenda,
-                        f"agenda_{lunedi.strftime('%Y%m%d')}.csv",
-                        "text/csv",
-                        use_container_width=True
-                    )
-                
-                with col_ag2:
-                    output_ag = io.BytesIO()
-                    with pd.ExcelWriter(output_ag, engine='openpyxl') as writer:
-                        df_agenda_exp.to_excel(writer, index=False, sheet_name='Agenda')
-                    output_ag.seek(0)
+            # L'agenda si calcola solo su richiesta e resta valida finché dati, config e periodo non cambiano
+            chiave_agenda_exp = (
+                st.session_state.get('df_version', 0),
+                hashlib.md5(repr(sorted(config.items(), key=lambda x: str(x[0]))).encode()).hexdigest(),
+                oggi, offset, int(n_settimane_exp)
+            )
+            agenda_exp_salvata = st.session_state.get('_agenda_export')
+            settimane_exp = None
+            if agenda_exp_salvata is not None and agenda_exp_salvata[0] == chiave_agenda_exp:
+                settimane_exp = agenda_exp_salvata[1]
+            elif st.button("⚙️ Calcola agenda", key="calcola_agenda_export", use_container_width=True):
+                giorni_nomi_full = ["Lunedì", "Martedì", "Mercoledì", "Giovedì", "Venerdì", "Sabato", "Domenica"]
+                with st.spinner(f"Pianificazione di {int(n_settimane_exp)} settimana/e..."):
+                    settimane_exp = []
+                    for lunedi_sett, agenda_sett in calcola_agenda_multisettimana(df, config, int(n_settimane_exp), [], offset, oggi=ora_italiana.date()):
+                        righe_sett = []
+                        for giorno_idx, tappe in agenda_sett.items():
+                            data_giorno = lunedi_sett + timedelta(days=giorno_idx)
+                            for i, tappa in enumerate(tappe, 1):
+                                righe_sett.append([
+                                    giorni_nomi_full[giorno_idx],
+                                    data_giorno.strftime('%d/%m/%Y'),
+                                    i,
+                                    tappa.get('ora_arrivo', ''),
+                                    tappa.get('nome_cliente', ''),
+                                    tappa.get('indirizzo', ''),
+                                    'Appuntamento' if '📌' in tappa.get('tipo_tappa', '') else 'Giro',
+                                    round(tappa.get('distanza_km', 0), 1)
+                                ])
+                        settimane_exp.append((lunedi_sett, righe_sett))
+                st.session_state['_agenda_export'] = (chiave_agenda_exp, settimane_exp)
+            
+            colonne_agenda = ['Giorno', 'Data', 'Ordine', 'Ora Arrivo', 'Cliente', 'Indirizzo', 'Tipo', 'Distanza (km)']
+            
+            if settimane_exp is not None:
+                tot_visite = sum(len(righe) for _, righe in settimane_exp)
+                tot_km = sum(r[-1] for _, righe in settimane_exp for r in righe)
+                
+                st.info(f"📊 **{tot_visite} visite** programmate in {len(settimane_exp)} settimana/e | ~{tot_km:.0f} km totali")
+                
+                if tot_visite:
+                    with st.expander("👀 Anteprima agenda"):
+                        for lunedi_sett, righe_sett in settimane_exp:
+                            st.caption(f"Settimana dal {lunedi_sett.strftime('%d/%m/%Y')} — {len(righe_sett)} visite")
+                            if righe_sett:
+                                st.dataframe(pd.DataFrame(righe_sett, columns=colonne_agenda), use_container_width=True)
+                    
+                    def _genera_export_agenda(formato):
+                        if formato == 'csv':
+                            return genera_csv(
+                                ['Settimana'] + colonne_agenda,
+                                ([lunedi_sett.strftime('%d/%m/%Y')] + r for lunedi_sett, righe_sett in settimane_exp for r in righe_sett)
+                            )
+                        # Un foglio per settimana
+                        return genera_excel([
+                            (f"Settimana {lunedi_sett.strftime('%d-%m-%Y')}", colonne_agenda, righe_sett)
+                            for lunedi_sett, righe_sett in settimane_exp
+                        ])
                     
-                    st.download_button(
-                        "📥 Scarica Excel",
-                        output_ag,
-                        f"agenda_{lunedi.strftime('%Y%m%d')}.xlsx",
-                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        use_container_width=True
+                    pulsanti_export(
+                        'agenda',
+                        chiave_agenda_exp,
+                        f"agenda_{lunedi.strftime('%Y%m%d')}" + (f"_{int(n_settimane_exp)}sett" if n_settimane_exp > 1 else ""),
+                        _genera_export_agenda
                     )
-            else:
-                st.warning("📭 Nessuna visita programmata per questa settimana")
+                else:
+                    st.warning("📭 Nessuna visita programmata nel periodo selezionato")
         
         # --- TAB ESPORTA REPORT VISITE ---
         with tab_exp3:
@@ -6127,60 +6764,50 @@ def main_app():
                     key="exp_data_fine"
                 )
             
-            # Filtra visite nel periodo
-            if not df.empty and 'ultima_visita' in df.columns:
-                df_report = df[df['ultima_visita'].notna()].copy()
+            # Una riga per visita della tabella visite (anche più visite dello stesso cliente);
+            # il file si genera solo al click
+            if not df.empty:
+                visite_exp = _memo_sessione(
+                    'visite_export', (data_inizio_exp, data_fine_exp, st.session_state.get('df_version', 0)),
+                    lambda: fetch_visite_periodo(data_inizio_exp, data_fine_exp, con_testo=True)
+                )
                 
-                if not df_report.empty:
-                    df_report['data_visita'] = df_report['ultima_visita'].dt.date
-                    df_report_filtered = df_report[
-                        (df_report['data_visita'] >= data_inizio_exp) & 
-                        (df_report['data_visita'] <= data_fine_exp)
-                    ].sort_values('ultima_visita', ascending=False)
-                    
-                    # Prepara dati per export
-                    cols_report = ['nome_cliente', 'indirizzo', 'provincia', 'ultima_visita', 'stato_cliente', 'storico_report']
-                    cols_presenti = [c for c in cols_report if c in df_report_filtered.columns]
-                    df_report_exp = df_report_filtered[cols_presenti].copy()
-                    df_report_exp.columns = ['Cliente', 'Indirizzo', 'Provincia', 'Data Visita', 'Stato', 'Report'][:len(cols_presenti)]
-                    if 'Data Visita' in df_report_exp.columns:
-                        df_report_exp['Data Visita'] = pd.to_datetime(df_report_exp['Data Visita']).dt.strftime('%d/%m/%Y')
+                if visite_exp is not None:
+                    cols_clienti = [c for c in ('id', 'nome_cliente', 'indirizzo', 'provincia', 'stato_cliente') if c in df.columns]
+                    df_report = visite_exp.merge(df[cols_clienti], left_on='cliente_id', right_on='id')
+                    cols_report = ['nome_cliente', 'indirizzo', 'provincia', 'data_visita', 'tipo', 'stato_cliente', 'testo']
+                    nomi_report = {'nome_cliente': 'Cliente', 'indirizzo': 'Indirizzo', 'provincia': 'Provincia',
+                                   'data_visita': 'Data Visita', 'tipo': 'Tipo', 'stato_cliente': 'Stato', 'testo': 'Report'}
+                    cols_presenti = [c for c in cols_report if c in df_report.columns]
+                    intestazioni = [nomi_report[c] for c in cols_presenti]
+                    n_report = len(df_report)
                     
-                    st.info(f"📊 **{len(df_report_exp)} visite** nel periodo selezionato")
+                    st.info(f"📊 **{n_report} visite** nel periodo selezionato")
                     
-                    if not df_report_exp.empty:
+                    if n_report:
                         with st.expander("👀 Anteprima report"):
-                            st.dataframe(df_report_exp.head(20), use_container_width=True)
+                            # fetch_visite_periodo restituisce già le visite dalla più recente
+                            df_anteprima = df_report[cols_presenti].head(20).copy()
+                            df_anteprima.columns = intestazioni
+                            df_anteprima['Data Visita'] = df_anteprima['Data Visita'].dt.strftime('%d/%m/%Y')
+                            st.dataframe(df_anteprima, use_container_width=True)
                         
-                        col_rep1, col_rep2 = st.columns(2)
-                        
-                        with col_rep1:
-                            csv_report = df_report_exp.to_csv(index=False)
-                            st.download_button(
-                                "📥 Scarica CSV",
-                                csv_report,
-                                f"report_visite_{data_inizio_exp.strftime('%Y%m%d')}_{data_fine_exp.strftime('%Y%m%d')}.csv",
-                                "text/csv",
-                                use_container_width=True
-                            )
+                        def _genera_export_report(formato):
+                            righe = righe_da_dataframe(df_report[cols_presenti], {'data_visita': data_export})
+                            if formato == 'csv':
+                                return genera_csv(intestazioni, righe)
+                            return genera_excel([('Report Visite', intestazioni, righe)])
                         
-                        with col_rep2:
-                            output_rep = io.BytesIO()
-                            with pd.ExcelWriter(output_rep, engine='openpyxl') as writer:
-                                df_report_exp.to_excel(writer, index=False, sheet_name='Report Visite')
-                            output_rep.seek(0)
-                            
-                            st.download_button(
-                                "📥 Scarica Excel",
-                                output_rep,
-                                f"report_visite_{data_inizio_exp.strftime('%Y%m%d')}_{data_fine_exp.strftime('%Y%m%d')}.xlsx",
-                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                use_container_width=True
-                            )
+                        pulsanti_export(
+                            'report',
+                            (st.session_state.get('df_version', 0), data_inizio_exp, data_fine_exp),
+                            f"report_visite_{data_inizio_exp.strftime('%Y%m%d')}_{data_fine_exp.strftime('%Y%m%d')}",
+                            _genera_export_report
+                        )
                     else:
                         st.warning("📭 Nessuna visita nel periodo selezionato")
                 else:
-                    st.warning("📭 Nessuna visita registrata")
+                    st.warning("⚠️ Tabella visite non disponibile: esegui sql/001_visite.sql e migra lo storico report")
             else:
                 st.warning("📭 Nessun dato disponibile")
         
@@ -6192,208 +6819,52 @@ def main_app():
         st.subheader("🔍 Debug Algoritmo Giro")
         st.caption("Analisi dettagliata di come vengono calcolati i giri")
         
-        if st.button("🔍 Esegui Diagnostica Completa", type="primary", use_container_width=True):
-            with st.spinner("Analisi in corso..."):
-                debug_lines = []
-                
-                # 1. CLIENTI TOTALI
-                debug_lines.append(f"## 📊 Stato Clienti")
-                debug_lines.append(f"- **Totale clienti nel DB:** {len(df)}")
-                
-                if df.empty:
-                    debug_lines.append("❌ NESSUN CLIENTE NEL DATABASE")
-                else:
-                    # Visitare
-                    n_si = len(df[df['visitare'] == 'SI']) if 'visitare' in df.columns else 0
-                    n_no = len(df) - n_si
-                    debug_lines.append(f"- **Visitare = SI:** {n_si}")
-                    debug_lines.append(f"- **Visitare = NO:** {n_no}")
-                    
-                    # Coordinate
-                    df_si = df[df['visitare'] == 'SI'] if 'visitare' in df.columns else df
-                    df_si_coord = df_si[
-                        (df_si['latitude'].notna()) & 
-                        (df_si['longitude'].notna()) &
-                        (df_si['latitude'] != 0) &
-                        (df_si['longitude'] != 0)
-                    ]
-                    n_senza_coord = len(df_si) - len(df_si_coord)
-                    debug_lines.append(f"- **Con coordinate GPS:** {len(df_si_coord)}")
-                    if n_senza_coord > 0:
-                        debug_lines.append(f"- ⚠️ **SENZA coordinate (esclusi dal giro):** {n_senza_coord}")
-                        senza = df_si[
-                            (df_si['latitude'].isna()) | (df_si['longitude'].isna()) |
-                            (df_si['latitude'] == 0) | (df_si['longitude'] == 0)
-                        ]['nome_cliente'].tolist()[:10]
-                        for s in senza:
-                            debug_lines.append(f"  - ❌ {s}")
-                    
-                    # 2. ANALISI FREQUENZE E SCADENZE
-                    debug_lines.append(f"\n## ⏰ Scadenze Clienti")
-                    oggi_dbg = ora_italiana.date()
-                    lunedi_dbg = oggi_dbg - timedelta(days=oggi_dbg.weekday())
-                    fine_sett_dbg = lunedi_dbg + timedelta(days=6)
-                    giorni_lav_dbg = config.get('giorni_lavorativi', [0,1,2,3,4])
-                    if isinstance(giorni_lav_dbg, str):
-                        giorni_lav_dbg = [int(x) for x in giorni_lav_dbg.strip('{}').split(',')]
-                    
-                    n_scaduti = 0
-                    n_questa_sett = 0
-                    n_pross_sett = 0
-                    n_lontani = 0
-                    n_mai = 0
-                    clienti_dettaglio = []
-                    
-                    for _, r in df_si_coord.iterrows():
-                        nome = r['nome_cliente']
-                        freq = int(r.get('frequenza_giorni', 30))
-                        ultima = r.get('ultima_visita')
-                        
-                        if pd.isnull(ultima) or (hasattr(ultima, 'year') and ultima.year < 2001):
-                            n_mai += 1
-                            clienti_dettaglio.append((nome, "Mai visitato", 100, "🔴"))
-                        else:
-                            u = ultima.date() if hasattr(ultima, 'date') else ultima
-                            pv = u + timedelta(days=freq)
-                            
-                            # Aggiusta weekend
-                            if pv.weekday() == 5:
-                                for _d in range(1,8):
-                                    _c = pv - timedelta(days=_d)
-                                    if _c.weekday() in giorni_lav_dbg:
-                                        pv = _c; break
-                            elif pv.weekday() == 6:
-                                for _d in range(1,8):
-                                    _c = pv + timedelta(days=_d)
-                                    if _c.weekday() in giorni_lav_dbg:
-                                        pv = _c; break
-                            
-                            rit = (oggi_dbg - pv).days
-                            
-                            # Stessa formula dell'algoritmo reale
-                            if rit > 90:
-                                _urg = min(100, 88 + min(rit - 90, 120) / 10)
-                            elif rit > 30:
-                                _urg = 75 + (rit - 30) * 0.22
-                            elif rit > 7:
-                                _urg = 58 + (rit - 7) * 0.74
-                            elif rit > 0:
-                                _urg = 48 + rit * 1.4
-                            elif rit >= -3:
-                                _urg = 40 + (3 + rit) * 2.5
-                            elif rit >= -7:
-                                _urg = 30 + (7 + rit) * 2.5
-                            elif rit >= -14:
-                                _urg = 20 + (14 + rit) * 1.4
-                            else:
-                                _urg = max(5, 20 + rit / 5)
-                            
-                            if pv <= oggi_dbg:
-                                n_scaduti += 1
-                                clienti_dettaglio.append((nome, f"SCADUTO {rit}gg ({pv.strftime('%d/%m')})", _urg, "🔴"))
-                            elif pv <= fine_sett_dbg:
-                                n_questa_sett += 1
-                                clienti_dettaglio.append((nome, f"Questa sett ({pv.strftime('%d/%m')})", _urg, "🟡"))
-                            elif pv <= fine_sett_dbg + timedelta(days=7):
-                                n_pross_sett += 1
-                                clienti_dettaglio.append((nome, f"Pross sett ({pv.strftime('%d/%m')})", _urg, "🟠"))
-                            else:
-                                n_lontani += 1
-                                clienti_dettaglio.append((nome, f"Lontano ({pv.strftime('%d/%m')})", _urg, "⚪"))
-                    
-                    debug_lines.append(f"- 🔴 **Già scaduti:** {n_scaduti}")
-                    debug_lines.append(f"- 🟡 **Scadono questa settimana:** {n_questa_sett}")
-                    debug_lines.append(f"- 🟠 **Scadono prossima settimana:** {n_pross_sett}")
-                    debug_lines.append(f"- ⚪ **Lontani (>2 sett):** {n_lontani}")
-                    debug_lines.append(f"- 🔵 **Mai visitati:** {n_mai}")
-                    debug_lines.append(f"- **TOTALE nel pool:** {n_scaduti + n_questa_sett + n_pross_sett + n_mai}")
-                    
-                    # 3. GIRO SALVATO
-                    debug_lines.append(f"\n## 💾 Giro Salvato")
-                    giro_s = load_giro_giorno(oggi_dbg.strftime('%Y-%m-%d'))
-                    if giro_s:
-                        debug_lines.append(f"- Versione: {giro_s.get('v', '?')}")
-                        debug_lines.append(f"- Data: {giro_s.get('data', '?')}")
-                        debug_lines.append(f"- Clienti: {len(giro_s.get('ids', []))}")
-                        debug_lines.append(f"- Variante: {giro_s.get('variante', 0)}")
-                        debug_lines.append(f"- Esclusi: {giro_s.get('esclusi', [])}")
-                        debug_lines.append(f"- Timestamp: {giro_s.get('ts', '?')}")
-                        if giro_s.get('v', 0) < 16:
-                            debug_lines.append(f"- ⚠️ **VERSIONE VECCHIA** — verrà ricalcolato")
-                    else:
-                        debug_lines.append("- Nessun giro salvato per oggi → verrà calcolato da zero")
-                    
-                    # 4. CONFIGURAZIONE
-                    debug_lines.append(f"\n## ⚙️ Configurazione")
-                    debug_lines.append(f"- Giorni lavorativi: {giorni_lav_dbg}")
-                    durata_v = int(config.get('durata_visita', 45))
-                    h_ini = config.get('h_inizio', '09:00')
-                    h_fin = config.get('h_fine', '18:00')
-                    debug_lines.append(f"- Orari: {h_ini} - {h_fin}, visita: {durata_v}min, velocità: 50km/h")
-                    debug_lines.append(f"- Visite stimate/giorno: ~{max(4, int(420 / (durata_v + 15)))} (calcolate dal tempo reale)")
-                    debug_lines.append(f"- Variante: {st.session_state.get('variante_giro', 0)}")
-                    debug_lines.append(f"- Esclusi oggi: {st.session_state.get('esclusi_oggi', [])}")
-                    debug_lines.append(f"- Giorno settimana: {oggi_dbg.weekday()} ({['Lun','Mar','Mer','Gio','Ven','Sab','Dom'][oggi_dbg.weekday()]})")
-                    
-                    giorni_calcolo_dbg = [g for g in giorni_lav_dbg if (lunedi_dbg + timedelta(days=g)) >= oggi_dbg]
-                    debug_lines.append(f"- Giorni rimasti settimana: {giorni_calcolo_dbg} → {len(giorni_calcolo_dbg)} zone")
-                    
-                    # 5. CALCOLA GIRO E MOSTRA RISULTATO
-                    debug_lines.append(f"\n## 🗺️ Giro Calcolato (da zero)")
-                    try:
-                        variante_dbg = st.session_state.get('variante_giro', 0)
-                        esclusi_dbg = st.session_state.get('esclusi_oggi', [])
-                        agenda_dbg = calcola_agenda_settimanale(df, config, esclusi_dbg, settimana_offset=0, variante=variante_dbg)
-                        
-                        for g_idx in sorted(agenda_dbg.keys()):
-                            tappe = agenda_dbg[g_idx]
-                            giorno_data = lunedi_dbg + timedelta(days=g_idx)
-                            g_nome = ['Lun','Mar','Mer','Gio','Ven','Sab','Dom'][g_idx]
-                            if g_idx in giorni_lav_dbg:
-                                is_oggi = " ← OGGI" if g_idx == oggi_dbg.weekday() else ""
-                                debug_lines.append(f"\n**{g_nome} {giorno_data.strftime('%d/%m')}{is_oggi}:** {len(tappe)} visite")
-                                for t in tappe:
-                                    debug_lines.append(f"  - {t['nome_cliente']} (urg: {t.get('urgenza', '?')}, {t.get('distanza_km', '?')}km)")
-                            
-                    except Exception as e:
-                        debug_lines.append(f"❌ Errore calcolo: {str(e)}")
-                    
-                    # 6. CLIENTI MANCANTI
-                    debug_lines.append(f"\n## ❓ Clienti nel Giro ma NON nell'Agenda")
-                    nomi_in_agenda = set()
-                    try:
-                        for g_idx, tappe in agenda_dbg.items():
-                            for t in tappe:
-                                nomi_in_agenda.add(t['nome_cliente'])
-                    except:
-                        pass
-                    
-                    clienti_mancanti = [(n, desc, urg, ico) for n, desc, urg, ico in clienti_dettaglio 
-                                       if n not in nomi_in_agenda and urg >= 25]
-                    if clienti_mancanti:
-                        debug_lines.append(f"**{len(clienti_mancanti)} clienti con urgenza ≥25 NON pianificati:**")
-                        for nome, desc, urg, ico in sorted(clienti_mancanti, key=lambda x: -x[2])[:20]:
-                            debug_lines.append(f"  - {ico} **{nome}** — {desc} (urg:{urg})")
-                    else:
-                        debug_lines.append("✅ Tutti i clienti urgenti sono nell'agenda")
-                
-                st.markdown("\n".join(debug_lines))
-                
-                # Bottone per forzare ricalcolo
-                st.divider()
-                if st.button("🔄 FORZA RICALCOLO GIRO (cancella giro salvato)", type="primary"):
-                    try:
-                        user_id = get_user_id()
-                        supabase.table('clienti').delete().eq('user_id', user_id).eq('nome_cliente', '__GIRO_SALVATO__').execute()
-                        st.session_state._forza_ricalcolo = True
-                        st.session_state.variante_giro = 0
-                        st.session_state._route_cache_key = None
-                        st.session_state.reload_data = True
-                        st.success("✅ Giro salvato eliminato! Torna su 🚀 Giro Oggi per vedere il nuovo giro.")
-                        time_module.sleep(1)
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Errore: {e}")
+        # Traccia dell'ultimo calcolo vero (Giro Oggi / Agenda): niente ricalcolo qui
+        if st.session_state.get('_traccia_pianificatore') is None:
+            st.info("Nessun giro calcolato in questa sessione: apri 🚀 Giro Oggi o 📅 Agenda, oppure calcola qui la settimana corrente.")
+            if st.button("🔍 Calcola la settimana con traccia", type="primary", use_container_width=True):
+                with st.spinner("Analisi in corso..."):
+                    traccia_dbg = {}
+                    variante_dbg = st.session_state.get('variante_giro', 0)
+                    esclusi_dbg = st.session_state.get('esclusi_oggi', [])
+                    calcola_agenda_settimanale(df, config, esclusi_dbg, settimana_offset=0, variante=variante_dbg,
+                                               routing=get_routing_backend_pianificazione(), oggi=ora_italiana.date(),
+                                               traccia=traccia_dbg)
+                    memorizza_traccia_pianificatore("🔍 Debug", traccia_dbg, variante_dbg, esclusi_dbg)
+                st.rerun()
+        else:
+            mostra_traccia_pianificatore(st.session_state._traccia_pianificatore, len(df))
+        
+        # Giro salvato per oggi
+        giro_s = dati_giro_salvato(ora_italiana.strftime('%Y-%m-%d'))
+        righe_giro = ["## 💾 Giro Salvato"]
+        if giro_s:
+            righe_giro.append(f"- Versione: {giro_s.get('v', '?')}")
+            righe_giro.append(f"- Data: {giro_s.get('data', '?')}")
+            righe_giro.append(f"- Clienti: {len(giro_s.get('ids', []))}")
+            righe_giro.append(f"- Variante: {giro_s.get('variante', 0)}")
+            righe_giro.append(f"- Esclusi: {giro_s.get('esclusi', [])}")
+            righe_giro.append(f"- Timestamp: {giro_s.get('ts', '?')}")
+            if giro_s.get('v', 0) < 16:
+                righe_giro.append(f"- ⚠️ **VERSIONE VECCHIA** — verrà ricalcolato")
+        else:
+            righe_giro.append("- Nessun giro salvato per oggi → verrà calcolato da zero")
+        st.markdown("\n".join(righe_giro))
+        
+        # Bottone per forzare ricalcolo
+        if st.button("🔄 FORZA RICALCOLO GIRO (cancella giro salvato)", type="primary"):
+            try:
+                user_id = get_user_id()
+                supabase.table('clienti').delete().eq('user_id', user_id).eq('nome_cliente', '__GIRO_SALVATO__').execute()
+                st.session_state._forza_ricalcolo = True
+                st.session_state.variante_giro = 0
+                st.session_state._route_cache_key = None
+                st.session_state.reload_data = True
+                st.success("✅ Giro salvato eliminato! Torna su 🚀 Giro Oggi per vedere il nuovo giro.")
+                time_module.sleep(1)
+                st.rerun()
+            except Exception as e:
+                st.error(f"Errore: {e}")
         
         st.divider()
         st.subheader("🗑️ Elimina Tutti i Dati")
@@ -6415,16 +6886,25 @@ def main_app():
     st.caption("🚀 **Giro Visite CRM Pro** - Versione SaaS 8.0")
 
 # --- RUN APP ---
-init_auth_state()
+misure_rerun = avvia_misure_rerun()
+try:
+    init_auth_state()
 
-if st.session_state.user is None:
-    login_page()
-else:
-    try:
-        main_app()
-    except Exception as e:
-        st.error(f"⚠️ Si è verificato un errore. Ricarica la pagina.")
-        with st.expander("Dettagli errore (per supporto)"):
-            st.code(str(e))
-        if st.button("🔄 Ricarica App"):
-            st.rerun()
+    if st.session_state.user is None:
+        login_page()
+    else:
+        try:
+            main_app()
+        except Exception as e:
+            st.error(f"⚠️ Si è verificato un errore. Ricarica la pagina.")
+            with st.expander("Dettagli errore (per supporto)"):
+                st.code(str(e))
+            if st.button("🔄 Ricarica App"):
+                st.rerun()
+except BaseException:
+    # st.rerun()/st.stop(): il rerun si chiude qui, le sue chiamate restano nei totali di sessione
+    chiudi_misure_rerun(misure_rerun, interrotto=True)
+    raise
+rerun_misurato = chiudi_misure_rerun(misure_rerun)
+if rerun_misurato:
+    pannello_prestazioni(rerun_misurato)
@@ -0,0 +1,81 @@
+"""
+Profilo dei tempi di import all'avvio (python -X importtime).
+
+    python bench/importtime.py            # report dei moduli di primo livello
+    python bench/importtime.py --top 30
+
+Misura in un processo nuovo ciò che app.py importa in testa e, a parte, i moduli
+che carichiamo solo quando servono (folium, streamlit_folium, requests).
+Esce con codice 1 se uno di questi torna tra gli import di primo livello di app.py.
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+# Moduli da non importare in testa ad app.py (caricati nelle funzioni/tab che li usano)
+MODULI_LAZY = ('folium', 'streamlit_folium', 'requests')
+
+
+def import_di_primo_livello(path=APP):
+    """Nomi dei moduli importati a livello di modulo in app.py"""
+    albero = ast.parse(open(path, encoding='utf-8').read())
+    moduli = []
+    for nodo in albero.body:
+        if isinstance(nodo, ast.Import):
+            moduli += [a.name for a in nodo.names]
+        elif isinstance(nodo, ast.ImportFrom) and nodo.module:
+            moduli.append(nodo.module)
+    return moduli
+
+
+def profilo_import(moduli):
+    """({modulo: µs cumulativi}, µs totali) importando i moduli in un processo nuovo"""
+    codice = '; '.join(f'import {m}' for m in moduli)
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', codice],
+                         capture_output=True, text=True, check=True).stderr
+    cumulativi, totale = {}, 0
+    for riga in out.splitlines():
+        campi = riga.split('|')
+        if not riga.startswith('import time:') or len(campi) != 3:
+            continue
+        try:
+            cumulativo = int(campi[1])
+        except ValueError:
+            continue  # intestazione
+        nome = campi[2].rstrip()
+        cumulativi[nome.strip()] = cumulativo
+        if not nome.startswith('  ') and nome.strip() in moduli:
+            totale += cumulativo  # solo i moduli chiesti, non quelli già contati dentro un altro
+    # Un modulo già importato da un altro (es. requests da folium) compare solo nel primo
+    return {m: cumulativi.get(m, 0) for m in moduli}, totale
+
+
+def stampa(titolo, profilo, top):
+    tempi, totale = profilo
+    print(f"\n{titolo}: {totale / 1000:.0f} ms")
+    for nome, us in sorted(tempi.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {us / 1000:8.1f} ms  {nome}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    in_testa = sorted({m.split('.')[0] for m in import_di_primo_livello()})
+    stampa("Import in testa ad app.py (ogni nuovo processo)", profilo_import(in_testa), args.top)
+    stampa("Import lazy (solo al primo uso)", profilo_import(MODULI_LAZY), args.top)
+
+    tornati = [m for m in in_testa if m in MODULI_LAZY]
+    if tornati:
+        print(f"\n❌ Import pesanti di nuovo in testa ad app.py: {', '.join(tornati)}")
+        sys.exit(1)
+    print("\n✅ Nessun modulo lazy importato in testa ad app.py")
+
+
+if __name__ == '__main__':
+    main()
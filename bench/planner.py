@@ -0,0 +1,293 @@
+"""
+Benchmark del pianificatore e dei solutori TSP su clienti sintetici (offline, riproducibile).
+
+    python bench/planner.py                                  # tutti i casi, 50 → 20.000 clienti
+    python bench/planner.py --dimensioni 50 200 1000 --casi agenda kmeans_geo
+    python bench/planner.py --confronta bench/risultati/planner-20250310-101500.json
+
+I clienti sono generati con un seme fisso attorno a città italiane reali (frequenze,
+ultime visite, mai visitati, appuntamenti nella settimana, ferie nello scenario
+agenda_ferie) con data di riferimento fissa. Ogni caso gira in un processo separato
+con timeout: tempo (minimo su --ripetizioni), picco di memoria (tracemalloc, passata a
+parte), km della settimana e tappe per giorno. I risultati vanno in bench/risultati/*.json.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RADICE)
+
+from giro_engine import (  # noqa: E402
+    calcola_agenda_settimanale, costruisci_anello, due_opt, haversine, held_karp_tsp, kmeans_geo,
+    nn_2opt_tsp, raccogli_clienti_agenda,
+)
+
+DIR_RISULTATI = os.path.join(RADICE, 'bench', 'risultati')
+OGGI = date(2025, 3, 10)  # lunedì: tutta la settimana è pianificabile
+SEME = 42
+
+DIMENSIONI = [50, 200, 1000, 5000, 20000]
+DIMENSIONI_GIRO = [8, 12, 20, 40]       # clienti in un giorno (costruisci_anello, due_opt)
+DIMENSIONI_HELD_KARP = [6, 8, 10, 12]
+DIMENSIONI_NN_2OPT = [12, 25, 50, 100]
+CASI = ['agenda', 'agenda_ferie', 'kmeans_geo', 'costruisci_anello', 'due_opt', 'held_karp_tsp', 'nn_2opt_tsp']
+
+# (città, provincia, lat, lon, peso, raggio km): area di un agente con base a Bologna
+CITTA = [
+    ('BOLOGNA', 'BO', 44.4949, 11.3426, 10, 6), ('IMOLA', 'BO', 44.3533, 11.7141, 3, 3),
+    ('MODENA', 'MO', 44.6471, 10.9252, 7, 5), ('CARPI', 'MO', 44.7834, 10.8847, 3, 3),
+    ('SASSUOLO', 'MO', 44.5432, 10.7840, 2, 3), ('REGGIO EMILIA', 'RE', 44.6983, 10.6312, 7, 5),
+    ('PARMA', 'PR', 44.8015, 10.3279, 8, 5), ('PIACENZA', 'PC', 45.0526, 9.6930, 4, 4),
+    ('FERRARA', 'FE', 44.8381, 11.6198, 5, 4), ('RAVENNA', 'RA', 44.4184, 12.2035, 6, 5),
+    ('FAENZA', 'RA', 44.2855, 11.8835, 2, 3), ('FORLÌ', 'FC', 44.2227, 12.0407, 5, 4),
+    ('CESENA', 'FC', 44.1391, 12.2431, 4, 4), ('RIMINI', 'RN', 44.0678, 12.5695, 6, 5),
+    ('RICCIONE', 'RN', 43.9995, 12.6560, 2, 2), ('PESARO', 'PU', 43.9098, 12.9131, 4, 4),
+    ('MANTOVA', 'MN', 45.1564, 10.7914, 3, 3), ('CREMONA', 'CR', 45.1332, 10.0227, 3, 3),
+    ('ROVIGO', 'RO', 45.0703, 11.7900, 2, 3), ('PADOVA', 'PD', 45.4064, 11.8768, 7, 5),
+    ('VERONA', 'VR', 45.4384, 10.9916, 8, 6), ('FIRENZE', 'FI', 43.7696, 11.2558, 9, 6),
+    ('PRATO', 'PO', 43.8777, 11.1022, 4, 3), ('PISTOIA', 'PT', 43.9303, 10.9078, 2, 3),
+    ('PORRETTA TERME', 'BO', 44.1567, 10.9765, 1, 4), ('VIGNOLA', 'MO', 44.4806, 11.0110, 1, 2),
+]
+FREQUENZE = [14, 21, 30, 30, 30, 45, 60, 90]
+GIORNI = ["Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom"]
+
+
+def genera_clienti(n, seme=SEME, oggi=OGGI):
+    """DataFrame di n clienti con le stesse colonne di fetch_clienti (solo quelle usate dal pianificatore)"""
+    rng = np.random.default_rng(seme)
+    pesi = np.array([c[4] for c in CITTA], dtype=float)
+    idx_citta = rng.choice(len(CITTA), size=n, p=pesi / pesi.sum())
+    righe = []
+    for i, ic in enumerate(idx_citta):
+        nome_c, prov, lat0, lon0, _, raggio = CITTA[ic]
+        # Dispersione gaussiana attorno al centro (km → gradi)
+        dlat, dlon = rng.normal(0, raggio / 2, 2) / 111.0
+        lat, lon = lat0 + dlat, lon0 + dlon / np.cos(np.radians(lat0))
+        freq = int(rng.choice(FREQUENZE))
+        if rng.random() < 0.08:
+            ultima = pd.NaT  # mai visitato
+        else:
+            ultima = pd.Timestamp(oggi - timedelta(days=int(rng.integers(0, 2 * freq + 1))))
+        righe.append({
+            'id': i + 1,
+            'nome_cliente': f"CLIENTE {i + 1:05d} {nome_c}",
+            'indirizzo': f"Via Sintetica {int(rng.integers(1, 200))}",
+            'citta': nome_c,
+            'provincia': prov,
+            'latitude': round(float(lat), 6),
+            'longitude': round(float(lon), 6),
+            'cellulare': f"3{int(rng.integers(10**8, 10**9))}",
+            'visitare': 'NO' if rng.random() < 0.03 else 'SI',
+            'frequenza_giorni': freq,
+            'ultima_visita': ultima,
+            'appuntamento': None,
+        })
+    # Appuntamenti: qualcuno nella settimana di riferimento (orari 9:00-16:30), qualcuno dopo
+    n_app = min(8, max(1, n // 100))
+    for j, i in enumerate(rng.choice(n, size=min(n, n_app + 2), replace=False)):
+        giorno = int(rng.integers(0, 5)) + (0 if j < n_app else 14)
+        ora = datetime.combine(oggi + timedelta(days=giorno), datetime.min.time()) + \
+            timedelta(minutes=540 + 30 * int(rng.integers(0, 16)))
+        righe[i]['appuntamento'] = ora.strftime('%Y-%m-%dT%H:%M')
+    df = pd.DataFrame(righe)
+    df['ultima_visita'] = pd.to_datetime(df['ultima_visita'])
+    return df
+
+
+def config_benchmark(ferie=False, oggi=OGGI):
+    """Configurazione utente tipo (base Bologna, 9-18 con pausa 13-14, visite da 45'); ferie giovedì-venerdì"""
+    config = {
+        'citta_base': 'BOLOGNA', 'lat_base': 44.4949, 'lon_base': 11.3426,
+        'h_inizio': '09:00', 'h_fine': '18:00', 'pausa_inizio': '13:00', 'pausa_fine': '14:00',
+        'durata_visita': 45, 'giorni_lavorativi': [0, 1, 2, 3, 4], 'attiva_ferie': ferie,
+    }
+    if ferie:
+        lunedi = oggi - timedelta(days=oggi.weekday())
+        config['ferie_inizio'] = (lunedi + timedelta(days=3)).isoformat()
+        config['ferie_fine'] = (lunedi + timedelta(days=4)).isoformat()
+    return config
+
+
+def km_giro(tappe, base_lat, base_lon):
+    """Km in linea d'aria base → tappe → base"""
+    punti = [(base_lat, base_lon)] + [(t['latitude'], t['longitude']) for t in tappe] + [(base_lat, base_lon)]
+    return sum(haversine(a[0], a[1], b[0], b[1]) for a, b in zip(punti, punti[1:])) if tappe else 0.0
+
+
+def punti_giro(clienti, n, rng):
+    """I n clienti più vicini a un cliente a caso (un giorno di visite realistico)"""
+    centro = clienti[int(rng.integers(len(clienti)))]
+    return sorted(clienti, key=lambda c: haversine(c['lat'], c['lon'], centro['lat'], centro['lon']))[:n]
+
+
+def matrice_minuti(punti):
+    """Matrice dei minuti di guida stimati (50 km/h) tra i punti"""
+    return [[haversine(a['lat'], a['lon'], b['lat'], b['lon']) / 50 * 60 for b in punti] for a in punti]
+
+
+def prepara_caso(caso, n):
+    """(funzione da misurare, funzione che estrae le metriche dal risultato). Il setup non è cronometrato."""
+    config = config_benchmark(ferie=caso == 'agenda_ferie')
+    base_lat, base_lon = config['lat_base'], config['lon_base']
+    rng = np.random.default_rng(SEME + n)
+
+    if caso in ('agenda', 'agenda_ferie'):
+        df = genera_clienti(n)
+
+        def metriche(agenda):
+            km = {GIORNI[g]: round(km_giro(t, base_lat, base_lon), 1) for g, t in agenda.items() if t}
+            return {
+                'km_settimana': round(sum(km.values()), 1),
+                'km_per_giorno': km,
+                'tappe_per_giorno': {GIORNI[g]: len(t) for g, t in agenda.items() if t},
+                'tappe_totali': sum(len(t) for t in agenda.values()),
+                'appuntamenti': sum(1 for t in agenda.values() for x in t if 'APPUNTAMENTO' in x['tipo_tappa']),
+            }
+        return (lambda: calcola_agenda_settimanale(df, config, oggi=OGGI)), metriche
+
+    clienti = raccogli_clienti_agenda(genera_clienti(max(n, 200)), config, oggi=OGGI)
+    if caso == 'kmeans_geo':
+        punti = clienti[:n]
+        k = max(4, min(len(punti) // 5, len(punti) // 6 + 10))  # come le zone del pianificatore
+        return (lambda: kmeans_geo(punti, k)), \
+            lambda r: {'k': k, 'dimensioni_zone_max': max(len(g) for g in r[0])}
+    if caso in ('costruisci_anello', 'due_opt'):
+        giro = punti_giro(clienti, n, rng)
+        rng.shuffle(giro)
+        fn = costruisci_anello if caso == 'costruisci_anello' else due_opt
+
+        def metriche(ordine):
+            km = km_giro([{'latitude': c['lat'], 'longitude': c['lon']} for c in ordine], base_lat, base_lon)
+            return {'km_giro': round(km, 2)}
+        return (lambda: fn(giro, base_lat, base_lon)), metriche
+    if caso in ('held_karp_tsp', 'nn_2opt_tsp'):
+        matrice = matrice_minuti([{'lat': base_lat, 'lon': base_lon}] + punti_giro(clienti, n - 1, rng))
+        fn = held_karp_tsp if caso == 'held_karp_tsp' else nn_2opt_tsp
+        return (lambda: fn(matrice, start=0)), lambda r: {'minuti_giro': round(r[1], 1)}
+    raise ValueError(f"Caso sconosciuto: {caso}")
+
+
+def _misura(caso, n, ripetizioni, memoria, coda):
+    """Nel processo figlio: tempi, picco di memoria e metriche del caso"""
+    fn, metriche = prepara_caso(caso, n)
+    tempi = []
+    for _ in range(ripetizioni):
+        t0 = time.perf_counter()
+        risultato = fn()
+        tempi.append(time.perf_counter() - t0)
+    esito = {'tempo_s': round(min(tempi), 4), 'tempi_s': [round(t, 4) for t in tempi]}
+    if memoria:
+        tracemalloc.start()
+        fn()
+        esito['picco_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    esito.update(metriche(risultato))
+    coda.put(esito)
+
+
+def esegui_caso(caso, n, ripetizioni=1, memoria=True, timeout=900):
+    """Esegue un caso in un processo separato (memoria pulita, timeout)"""
+    ctx = multiprocessing.get_context('spawn')
+    coda = ctx.Queue()
+    proc = ctx.Process(target=_misura, args=(caso, n, ripetizioni, memoria, coda))
+    proc.start()
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+        return {'caso': caso, 'n': n, 'timeout_s': timeout}
+    if coda.empty():
+        return {'caso': caso, 'n': n, 'errore': f"processo terminato con codice {proc.exitcode}"}
+    return {'caso': caso, 'n': n, **coda.get()}
+
+
+def dimensioni_caso(caso, dimensioni):
+    if caso in ('costruisci_anello', 'due_opt'):
+        return DIMENSIONI_GIRO
+    if caso == 'held_karp_tsp':
+        return DIMENSIONI_HELD_KARP
+    if caso == 'nn_2opt_tsp':
+        return DIMENSIONI_NN_2OPT
+    return dimensioni
+
+
+def metadati(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RADICE,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'piattaforma': platform.platform(),
+        'seme': SEME,
+        'oggi': OGGI.isoformat(),
+        'ripetizioni': args.ripetizioni,
+    }
+
+
+def stampa_risultato(r, precedente=None):
+    if 'timeout_s' in r or 'errore' in r:
+        problema = r.get('errore') or f"oltre {r['timeout_s']} s"
+        print(f"  {r['caso']:<18} n={r['n']:<6} ⏱️  {problema}")
+        return
+    extra = ''
+    if 'km_settimana' in r:
+        extra = f"  {r['km_settimana']:8.1f} km  tappe {r['tappe_per_giorno']}"
+    elif 'km_giro' in r:
+        extra = f"  {r['km_giro']:8.2f} km"
+    elif 'minuti_giro' in r:
+        extra = f"  {r['minuti_giro']:8.1f} min"
+    confronto = ''
+    if precedente and 'tempo_s' in precedente and precedente['tempo_s']:
+        confronto = f"  ({r['tempo_s'] / precedente['tempo_s']:.2f}x)"
+    memoria = f"{r['picco_mb']:8.1f} MB" if 'picco_mb' in r else ''
+    print(f"  {r['caso']:<18} n={r['n']:<6} {r['tempo_s']:9.3f} s{confronto}  {memoria}{extra}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dimensioni', type=int, nargs='+', default=DIMENSIONI,
+                        help="numero di clienti per agenda e kmeans_geo")
+    parser.add_argument('--casi', nargs='+', choices=CASI, default=CASI)
+    parser.add_argument('--ripetizioni', type=int, default=3)
+    parser.add_argument('--timeout', type=int, default=900, help="secondi massimi per caso")
+    parser.add_argument('--no-memoria', action='store_true', help="salta la passata con tracemalloc")
+    parser.add_argument('--output', help="file JSON dei risultati (default bench/risultati/planner-<data>.json)")
+    parser.add_argument('--confronta', help="JSON di un'esecuzione precedente: mostra il rapporto dei tempi")
+    args = parser.parse_args()
+
+    precedenti = {}
+    if args.confronta:
+        with open(args.confronta, encoding='utf-8') as f:
+            precedenti = {(r['caso'], r['n']): r for r in json.load(f)['risultati']}
+
+    risultati = []
+    for caso in args.casi:
+        for n in dimensioni_caso(caso, args.dimensioni):
+            r = esegui_caso(caso, n, args.ripetizioni, not args.no_memoria, args.timeout)
+            stampa_risultato(r, precedenti.get((caso, n)))
+            risultati.append(r)
+
+    output = args.output or os.path.join(DIR_RISULTATI, f"planner-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'meta': metadati(args), 'risultati': risultati}, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Risultati salvati in {os.path.relpath(output)}")
+
+
+if __name__ == '__main__':
+    main()
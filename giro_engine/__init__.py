@@ -0,0 +1,88 @@
+"""
+Motore di pianificazione dei giri, importabile senza Streamlit.
+
+    from giro_engine import calcola_agenda_settimanale, crea_routing_backend
+    agenda = calcola_agenda_settimanale(df_clienti, config, oggi=date(2025, 3, 10),
+                                        routing=crea_routing_backend('locale'))
+
+Ingressi espliciti: tabella clienti (df_clienti_da_righe), configurazione dell'utente
+(config_predefinita come base), data di riferimento e motore percorsi.
+app.py usa queste funzioni per Giro Oggi e Agenda; bench/planner.py le misura su dati
+sintetici; python -m giro_engine pianifica uno o più utenti da snapshot CSV/JSON.
+"""
+from .dati import (
+    carica_righe,
+    config_predefinita,
+    configurazioni_da_righe,
+    df_clienti_da_righe,
+    normalizza_df_clienti,
+)
+from .geo import haversine
+from .planner import (
+    calcola_agenda_multisettimana,
+    calcola_agenda_settimanale,
+    calcola_piano_giornaliero,
+    circuito_dist,
+    costruisci_anello,
+    due_opt,
+    ferie_da_config,
+    giorni_lavorativi_da_config,
+    kmeans_geo,
+    raccogli_clienti_agenda,
+    sposta_su_giorno_lavorativo,
+    urgenza_per_ritardo,
+)
+from .routing import (
+    GoogleRoutingBackend,
+    LocaleRoutingBackend,
+    OsrmRoutingBackend,
+    RoutingBackend,
+    applica_legs_a_tappe,
+    crea_routing_backend,
+    decode_google_polyline,
+    decode_polyline_array,
+    encode_google_polyline,
+    google_compute_route,
+    google_route_matrix,
+    id_percorso,
+    ottimizza_ordine_percorso,
+    route_valida_per_tappe,
+)
+from .tsp import held_karp_tsp, nn_2opt_tsp
+
+__all__ = [
+    'GoogleRoutingBackend',
+    'LocaleRoutingBackend',
+    'OsrmRoutingBackend',
+    'RoutingBackend',
+    'applica_legs_a_tappe',
+    'calcola_agenda_multisettimana',
+    'calcola_agenda_settimanale',
+    'calcola_piano_giornaliero',
+    'carica_righe',
+    'circuito_dist',
+    'config_predefinita',
+    'configurazioni_da_righe',
+    'costruisci_anello',
+    'crea_routing_backend',
+    'decode_google_polyline',
+    'decode_polyline_array',
+    'df_clienti_da_righe',
+    'due_opt',
+    'encode_google_polyline',
+    'ferie_da_config',
+    'giorni_lavorativi_da_config',
+    'google_compute_route',
+    'google_route_matrix',
+    'haversine',
+    'held_karp_tsp',
+    'id_percorso',
+    'kmeans_geo',
+    'nn_2opt_tsp',
+    'normalizza_df_clienti',
+    'ottimizza_ordine_percorso',
+    'raccogli_clienti_agenda',
+    'route_valida_per_tappe',
+    'sposta_su_giorno_lavorativo',
+    'urgenza_per_ritardo',
+]
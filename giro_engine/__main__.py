@@ -0,0 +1,218 @@
+"""
+Pianificazione da riga di comando, senza Streamlit: uno o più utenti da snapshot del database.
+
+    python -m giro_engine --clienti clienti.csv --config config_utente.csv
+    python -m giro_engine --clienti clienti.json --config config.json --data 2025-03-10 --settimane 4
+    python -m giro_engine --clienti clienti.csv --utenti u1 u2 --giorno --routing osrm --ottimizza
+    python -m giro_engine --clienti clienti.csv --processi 4 --formato csv --uscita tappe.csv
+    python -m giro_engine --clienti clienti.csv --traccia --profilo
+
+--clienti e --config sono export delle tabelle clienti e config_utente (CSV, JSON o JSONL).
+Le righe clienti vengono divise per utente sulla colonna --colonna-utente (user_id, o
+agente_id per gli agenti di un team). Una sola riga di config vale per tutti; chi non ha
+config usa quella predefinita. Il piano (JSON, o CSV con una riga per tappa) va su --uscita
+o sullo standard output, il riepilogo per utente sullo standard error.
+"""
+import argparse
+import contextvars
+import cProfile
+import csv
+import json
+import os
+import pstats
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+from time import perf_counter
+
+import pandas as pd
+
+from . import (
+    calcola_agenda_multisettimana, calcola_agenda_settimanale, calcola_piano_giornaliero, carica_righe,
+    config_predefinita, configurazioni_da_righe, crea_routing_backend, df_clienti_da_righe,
+    ottimizza_ordine_percorso,
+)
+
+COLONNE_CSV = ['utente', 'data', 'ordine', 'id', 'nome_cliente', 'citta', 'ora_arrivo', 'tipo_tappa',
+               'distanza_km', 'urgenza', 'ritardo']
+
+
+def per_json(v):
+    """Tipi numpy/pandas/date → tipi JSON (anche nelle chiavi dei dict)"""
+    if isinstance(v, dict):
+        return {k if isinstance(k, str) else str(per_json(k)): per_json(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple, set)):
+        return [per_json(x) for x in v]
+    if v is pd.NaT or (isinstance(v, float) and v != v):
+        return None
+    if isinstance(v, (date, time)):
+        return v.isoformat()
+    if hasattr(v, 'item'):  # scalari numpy
+        return v.item()
+    return v
+
+
+def dividi_per_utente(righe, colonna, utenti=None):
+    """{utente: righe}; senza la colonna tutte le righe vanno sotto None"""
+    gruppi = {}
+    for riga in righe:
+        utente = riga.get(colonna)
+        if utenti and str(utente) not in utenti:
+            continue
+        gruppi.setdefault(utente, []).append(riga)
+    return gruppi
+
+
+def config_utente(configurazioni, utente):
+    """Config dell'utente, quella unica dello snapshot o quella predefinita"""
+    if utente in configurazioni:
+        return configurazioni[utente]
+    if len(configurazioni) == 1:
+        return next(iter(configurazioni.values()))
+    if configurazioni:
+        print(f"⚠️ Nessuna config per {utente}: uso quella predefinita", file=sys.stderr)
+    return config_predefinita()
+
+
+def pianifica_utente(utente, righe, config, opzioni):
+    """Piano di un utente su opzioni['settimane'] settimane (o solo il giorno di riferimento)"""
+    t0 = perf_counter()
+    df = df_clienti_da_righe(righe)
+    oggi = opzioni['oggi']
+    routing = crea_routing_backend(opzioni['routing'], google_api_key=opzioni['google_api_key'],
+                                   osrm_url=opzioni['osrm_url'])
+    traccia = {} if opzioni['traccia'] else None
+    lunedi = oggi - timedelta(days=oggi.weekday())
+
+    if df.empty:
+        settimane = []
+    elif opzioni['giorno']:
+        tappe = calcola_piano_giornaliero(df, oggi.weekday(), config, variante=opzioni['variante'], routing=routing,
+                                          oggi=oggi, traccia=traccia)
+        settimane = [(lunedi, {oggi.weekday(): tappe})]
+    elif opzioni['settimane'] == 1:
+        settimane = [(lunedi, calcola_agenda_settimanale(df, config, variante=opzioni['variante'], routing=routing,
+                                                         oggi=oggi, traccia=traccia))]
+    else:
+        # La traccia c'è solo per la singola settimana
+        settimane = calcola_agenda_multisettimana(df, config, opzioni['settimane'], variante=opzioni['variante'],
+                                                  routing=routing, oggi=oggi)
+
+    base_lat, base_lon = float(config.get('lat_base', 41.9028)), float(config.get('lon_base', 12.4964))
+    giorni = []
+    for inizio_settimana, agenda in settimane:
+        for g in sorted(agenda):
+            tappe, route = agenda[g], None
+            if opzioni['ottimizza'] and len(tappe) >= 2:
+                tappe, route = ottimizza_ordine_percorso(tappe, base_lat, base_lon, routing)
+            giorno = {'data': (inizio_settimana + timedelta(days=g)).isoformat(), 'tappe': tappe,
+                      'km': round(sum(t['distanza_km'] for t in tappe), 1)}
+            if route:
+                giorno['km_percorso'] = round(route['distance_m'] / 1000, 1)
+                giorno['min_guida'] = route['duration_s'] // 60
+            giorni.append(giorno)
+
+    piano = {'utente': utente, 'clienti': len(df), 'giorni': giorni,
+             'tappe': sum(len(g['tappe']) for g in giorni), 'km': round(sum(g['km'] for g in giorni), 1),
+             'ms': round((perf_counter() - t0) * 1000, 1)}
+    if routing is not None and routing.last_error:
+        piano['errore_routing'] = routing.last_error
+    if traccia is not None:
+        piano['traccia'] = traccia
+    return per_json(piano)
+
+
+def _pianifica(lavoro):
+    # Contesto nuovo per utente: l'errore di routing di un utente non passa al successivo
+    return contextvars.Context().run(pianifica_utente, *lavoro)
+
+
+def stampa_riepilogo(piano):
+    giorni_con_tappe = sum(1 for g in piano['giorni'] if g['tappe'])
+    print(f"👤 {piano['utente']}: {piano['clienti']} clienti → {piano['tappe']} tappe in {giorni_con_tappe} giorni, "
+          f"{piano['km']} km ({piano['ms']:.0f} ms)", file=sys.stderr)
+    if piano.get('errore_routing'):
+        print(f"   ⚠️ {piano['errore_routing']}", file=sys.stderr)
+    tempi = (piano.get('traccia') or {}).get('tempi_ms')
+    if tempi:
+        print("   " + ", ".join(f"{fase} {ms:.1f} ms" for fase, ms in tempi.items()), file=sys.stderr)
+
+
+def scrivi_csv(piani, f):
+    scrittore = csv.DictWriter(f, fieldnames=COLONNE_CSV, extrasaction='ignore')
+    scrittore.writeheader()
+    for piano in piani:
+        for giorno in piano['giorni']:
+            for i, t in enumerate(giorno['tappe'], start=1):
+                scrittore.writerow({**t, 'utente': piano['utente'], 'data': giorno['data'], 'ordine': i})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m giro_engine', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clienti', required=True, help="snapshot della tabella clienti (.csv, .json, .jsonl)")
+    parser.add_argument('--config', help="snapshot di config_utente (.csv, .json, .jsonl); default configurazione predefinita")
+    parser.add_argument('--colonna-utente', default='user_id', help="colonna che divide i clienti per utente (default user_id)")
+    parser.add_argument('--utenti', nargs='+', help="pianifica solo questi utenti")
+    # Oggi in ora italiana, come ora_italiana in app.py (il server gira in UTC)
+    parser.add_argument('--data', type=date.fromisoformat, default=(datetime.now() + timedelta(hours=1)).date(),
+                        help="data di riferimento AAAA-MM-GG (default oggi, ora italiana)")
+    parser.add_argument('--settimane', type=int, default=1, help="settimane da pianificare a partire da quella di --data")
+    parser.add_argument('--giorno', action='store_true', help="solo il giro del giorno di --data (come Giro Oggi)")
+    parser.add_argument('--variante', type=int, default=0)
+    parser.add_argument('--routing', choices=['nessuno', 'locale', 'osrm', 'google'], default='nessuno',
+                        help="motore percorsi per gli orari (default stima interna del pianificatore)")
+    parser.add_argument('--ottimizza', action='store_true', help="riordina ogni giorno con matrice tempi + TSP del motore percorsi")
+    parser.add_argument('--osrm-url', default=os.environ.get('OSRM_URL', 'http://router.project-osrm.org'))
+    parser.add_argument('--google-api-key', default=os.environ.get('GOOGLE_MAPS_API_KEY', ''),
+                        help="default variabile d'ambiente GOOGLE_MAPS_API_KEY")
+    parser.add_argument('--traccia', action='store_true', help="aggiunge la traccia del pianificatore (tempi per fase, esiti)")
+    parser.add_argument('--processi', type=int, default=1, help="utenti pianificati in parallelo")
+    parser.add_argument('--profilo', action='store_true', help="cProfile in un solo processo, le 25 funzioni più costose su stderr")
+    parser.add_argument('--formato', choices=['json', 'csv'], default='json')
+    parser.add_argument('--uscita', help="file di uscita (default standard output)")
+    args = parser.parse_args(argv)
+
+    if args.ottimizza and args.routing == 'nessuno':
+        parser.error("--ottimizza richiede un motore percorsi (--routing locale, osrm o google)")
+    gruppi = dividi_per_utente(carica_righe(args.clienti), args.colonna_utente,
+                               {str(u) for u in args.utenti} if args.utenti else None)
+    if not gruppi:
+        print("❌ Nessun cliente da pianificare", file=sys.stderr)
+        return 1
+    configurazioni = configurazioni_da_righe(carica_righe(args.config)) if args.config else {}
+    opzioni = {'oggi': args.data, 'settimane': max(1, args.settimane), 'giorno': args.giorno,
+               'variante': args.variante, 'routing': args.routing, 'ottimizza': args.ottimizza,
+               'osrm_url': args.osrm_url, 'google_api_key': args.google_api_key, 'traccia': args.traccia}
+    lavori = [(utente, righe, config_utente(configurazioni, utente), opzioni) for utente, righe in gruppi.items()]
+
+    t0 = perf_counter()
+    if args.profilo:
+        profilo = cProfile.Profile()
+        piani = profilo.runcall(lambda: [_pianifica(l) for l in lavori])
+        pstats.Stats(profilo, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    elif args.processi > 1 and len(lavori) > 1:
+        with ProcessPoolExecutor(max_workers=args.processi) as pool:
+            piani = list(pool.map(_pianifica, lavori))
+    else:
+        piani = [_pianifica(l) for l in lavori]
+    for piano in piani:
+        stampa_riepilogo(piano)
+    print(f"✅ {len(piani)} utenti in {perf_counter() - t0:.1f} s", file=sys.stderr)
+
+    f = open(args.uscita, 'w', encoding='utf-8', newline='') if args.uscita else sys.stdout
+    try:
+        if args.formato == 'csv':
+            scrivi_csv(piani, f)
+        else:
+            meta = {'data': args.data.isoformat(), 'settimane': opzioni['settimane'], 'giorno': args.giorno,
+                    'routing': args.routing, 'generato_il': datetime.now().isoformat(timespec='seconds')}
+            json.dump({'meta': meta, 'piani': piani}, f, ensure_ascii=False, indent=2, default=str)
+            f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
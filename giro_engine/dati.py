@@ -0,0 +1,133 @@
+"""
+Tabella clienti e configurazione utente: normalizzazione e lettura da snapshot.
+
+df_clienti_da_righe fa sulle righe di Supabase quello che serve al pianificatore (record
+speciali esclusi, date e numeri convertiti); la CLI legge le stesse righe da file CSV,
+JSON o JSONL esportati dal database.
+"""
+import json
+import os
+
+import pandas as pd
+
+
+def normalizza_df_clienti(df):
+    """Tipi e default delle colonne clienti (date, coordinate, frequenza, visitare, stato, città)"""
+    # Converti colonne datetime
+    if 'ultima_visita' in df.columns:
+        df['ultima_visita'] = pd.to_datetime(df['ultima_visita'], errors='coerce')
+    else:
+        df['ultima_visita'] = pd.NaT
+
+    if 'appuntamento' in df.columns:
+        df['appuntamento'] = pd.to_datetime(df['appuntamento'], errors='coerce')
+    else:
+        df['appuntamento'] = pd.NaT
+
+    # Converti coordinate
+    if 'latitude' in df.columns:
+        df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
+    else:
+        df['latitude'] = 0.0
+
+    if 'longitude' in df.columns:
+        df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
+    else:
+        df['longitude'] = 0.0
+
+    # Frequenza giorni
+    if 'frequenza_giorni' in df.columns:
+        df['frequenza_giorni'] = pd.to_numeric(df['frequenza_giorni'], errors='coerce').fillna(30).astype(int)
+    else:
+        df['frequenza_giorni'] = 30
+
+    # Campo visitare - IMPORTANTE per il giro
+    if 'visitare' in df.columns:
+        df['visitare'] = df['visitare'].fillna('SI').astype(str).str.upper().str.strip()
+    else:
+        df['visitare'] = 'SI'
+
+    # Stato cliente
+    if 'stato_cliente' in df.columns:
+        df['stato_cliente'] = df['stato_cliente'].fillna('CLIENTE ATTIVO')
+    else:
+        df['stato_cliente'] = 'CLIENTE ATTIVO'
+
+    # Città
+    if 'citta' in df.columns:
+        df['citta'] = df['citta'].fillna('')
+    else:
+        df['citta'] = ''
+
+    return df
+
+
+def df_clienti_da_righe(righe):
+    """DataFrame clienti dalle righe del server, senza i record speciali"""
+    if not righe:
+        return pd.DataFrame()
+    df = pd.DataFrame(righe)
+
+    # Escludi record speciali (usati per storage interno)
+    df = df[~df['nome_cliente'].str.startswith('__', na=False)]
+
+    return normalizza_df_clienti(df)
+
+
+def config_predefinita():
+    """Configurazione usata finché l'utente non salva la propria"""
+    return {
+        'citta_base': 'Roma',
+        'lat_base': 41.9028,
+        'lon_base': 12.4964,
+        'h_inizio': '09:00',
+        'h_fine': '18:00',
+        'pausa_inizio': '13:00',
+        'pausa_fine': '14:00',
+        'durata_visita': 45,
+        'giorni_lavorativi': [0, 1, 2, 3, 4],
+        'attiva_ferie': False,
+        'ferie_inizio': None,
+        'ferie_fine': None
+    }
+
+
+def carica_righe(path):
+    """Righe (lista di dict) da uno snapshot .csv, .json (lista o {"righe": [...]}) o .jsonl"""
+    estensione = os.path.splitext(path)[1].lower()
+    if estensione == '.csv':
+        # Tutto testo (niente id o telefoni in float per colpa di una cella vuota): date e
+        # numeri li converte normalizza_df_clienti, gli id numerici tornano interi
+        righe = pd.read_csv(path, dtype=str, keep_default_na=False).to_dict('records')
+        for riga in righe:
+            for k, v in riga.items():
+                riga[k] = (int(v) if k == 'id' and v.isdigit() else v) if v != '' else None
+        return righe
+    with open(path, encoding='utf-8') as f:
+        if estensione == '.jsonl':
+            return [json.loads(riga) for riga in f if riga.strip()]
+        dati = json.load(f)
+    if isinstance(dati, dict):
+        dati = dati.get('righe', dati.get('data', [dati]))
+    return list(dati)
+
+
+def _valore_config(chiave, valore):
+    """Valore di config_utente letto da CSV: 'true'/'false' → bool,
+    giorni lavorativi '{0,1,2}' o '[0, 1, 2]' → lista"""
+    if chiave == 'attiva_ferie' and isinstance(valore, str):
+        return valore.strip().lower() in ('true', 't', '1', 'si', 'sì')
+    if chiave == 'giorni_lavorativi' and isinstance(valore, str):
+        return [int(x) for x in valore.strip('{}[] ').split(',') if x.strip()]
+    return valore
+
+
+def configurazioni_da_righe(righe):
+    """{user_id: config} dalle righe di config_utente, completate con config_predefinita().
+    Una sola riga senza user_id vale per tutti (chiave None)"""
+    configurazioni = {}
+    for riga in righe:
+        config = config_predefinita()
+        config.update({k: v for k, v in ((k, _valore_config(k, v)) for k, v in riga.items()) if v is not None})
+        configurazioni[riga.get('user_id')] = config
+    return configurazioni
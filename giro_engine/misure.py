@@ -0,0 +1,36 @@
+"""
+Misure delle chiamate di rete (opt-in).
+
+Le chiamate si registrano nella lista della ContextVar chiamate_rerun, se qualcuno l'ha
+impostata: app.py lo fa per ogni rerun con ?perf=1 o con l'interruttore admin, la CLI
+e i job in background no. Con la ContextVar vuota misura_chiamata non fa nulla.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+chiamate_rerun = contextvars.ContextVar('chiamate_rerun', default=None)
+
+
+def registra_chiamata(categoria, operazione, ms, byte=0, cache=False, firma=None, dettaglio=''):
+    """Aggiunge una chiamata alle misure correnti (niente se le misure sono spente)"""
+    chiamate = chiamate_rerun.get()
+    if chiamate is None:
+        return
+    chiamate.append({'categoria': categoria, 'operazione': operazione, 'ms': ms, 'byte': byte,
+                     'cache': cache, 'firma': firma or operazione, 'dettaglio': dettaglio})
+
+
+@contextmanager
+def misura_chiamata(categoria, operazione, dettaglio=''):
+    """Cronometra il blocco come una chiamata esterna; il chiamante può impostare m['byte']"""
+    m = {'byte': 0}
+    if chiamate_rerun.get() is None:
+        yield m
+        return
+    t0 = time.perf_counter()
+    try:
+        yield m
+    finally:
+        registra_chiamata(categoria, operazione, (time.perf_counter() - t0) * 1000,
+                          byte=m['byte'], dettaglio=dettaglio)
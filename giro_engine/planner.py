@@ -0,0 +1,966 @@
+"""
+Pianificatore dell'agenda settimanale (v10 — K-Means geografico + appuntamento come baricentro).
+
+Funzioni pure: prendono il DataFrame clienti, la configurazione dell'utente e la data di
+riferimento, senza Streamlit né database. Le usa app.py e si possono misurare con
+bench/planner.py.
+
+Traccia: passando traccia={} a calcola_agenda_settimanale il dizionario viene riempito
+con i tempi per fase, le dimensioni del pool, i giorni disponibili, le iterazioni del
+k-means, le zone e l'esito di ogni cliente (pianificato in quale giorno, o perché no).
+Senza traccia il costo è qualche chiamata a perf_counter.
+"""
+from datetime import date, datetime, time, timedelta
+from math import atan2, degrees as math_degrees
+from time import perf_counter
+
+import pandas as pd
+
+from .geo import haversine
+
+
+def ferie_da_config(config):
+    """(inizio, fine) delle ferie se attive nella configurazione, altrimenti (None, None)"""
+    ferie_inizio, ferie_fine = None, None
+    if config.get('attiva_ferie', False):
+        try:
+            fi, ff = config.get('ferie_inizio'), config.get('ferie_fine')
+            if fi:
+                ferie_inizio = datetime.strptime(str(fi)[:10], '%Y-%m-%d').date() if isinstance(fi, str) else (fi.date() if hasattr(fi, 'date') else fi)
+            if ff:
+                ferie_fine = datetime.strptime(str(ff)[:10], '%Y-%m-%d').date() if isinstance(ff, str) else (ff.date() if hasattr(ff, 'date') else ff)
+        except:
+            pass
+    return ferie_inizio, ferie_fine
+
+
+def giorni_lavorativi_da_config(config):
+    """Giorni lavorativi (0=lunedì) dalla configurazione, anche in formato '{0,1,2}'"""
+    giorni_lavorativi = config.get('giorni_lavorativi', [0, 1, 2, 3, 4])
+    if isinstance(giorni_lavorativi, str):
+        giorni_lavorativi = [int(x) for x in giorni_lavorativi.strip('{}').split(',')]
+    return giorni_lavorativi
+
+
+def sposta_su_giorno_lavorativo(data, giorni_lavorativi, ferie_inizio=None, ferie_fine=None):
+    """Se la data cade in un giorno non lavorativo o in ferie, la sposta sul lavorativo più vicino
+    (sabato → indietro, domenica → avanti, altri giorni → il più vicino, prima indietro)"""
+    def in_ferie(d):
+        return bool(ferie_inizio and ferie_fine and ferie_inizio <= d <= ferie_fine)
+
+    weekday = data.weekday()
+    if weekday in giorni_lavorativi and not in_ferie(data):
+        return data
+    for delta in range(1, 8):
+        if weekday == 5:
+            candidate = [data - timedelta(days=delta)]
+        elif weekday == 6:
+            candidate = [data + timedelta(days=delta)]
+        else:
+            candidate = [data - timedelta(days=delta), data + timedelta(days=delta)]
+        for candidata in candidate:
+            if candidata.weekday() in giorni_lavorativi and not in_ferie(candidata):
+                return candidata
+    return data
+
+
+def urgenza_per_ritardo(giorni_ritardo):
+    """Urgenza PROPORZIONALE ai giorni reali di ritardo rispetto alla prossima visita"""
+    if giorni_ritardo > 90:
+        return min(100, 88 + min(giorni_ritardo - 90, 120) / 10)
+    elif giorni_ritardo > 30:
+        return 75 + (giorni_ritardo - 30) * 0.22
+    elif giorni_ritardo > 7:
+        return 58 + (giorni_ritardo - 7) * 0.74
+    elif giorni_ritardo > 0:
+        return 48 + giorni_ritardo * 1.4
+    elif giorni_ritardo >= -3:
+        return 40 + (3 + giorni_ritardo) * 2.5
+    elif giorni_ritardo >= -7:
+        return 30 + (7 + giorni_ritardo) * 2.5
+    elif giorni_ritardo >= -14:
+        return 20 + (14 + giorni_ritardo) * 1.4
+    return max(5, 20 + giorni_ritardo / 5)
+
+
+def _cronometra(traccia, fase, t0):
+    """Somma a traccia['tempi_ms'][fase] il tempo trascorso da t0; ritorna l'istante attuale"""
+    ora = perf_counter()
+    if traccia is not None:
+        tempi = traccia.setdefault('tempi_ms', {})
+        tempi[fase] = tempi.get(fase, 0.0) + (ora - t0) * 1000
+    return ora
+
+
+def _esito(traccia, c, esito, motivo, **extra):
+    """Registra nella traccia perché il cliente c è stato tenuto o scartato (l'ultimo esito vince)"""
+    if traccia is not None:
+        voce = traccia.setdefault('clienti', {}).setdefault(c['id'], {'nome': c['nome']})
+        voce.update(esito=esito, motivo=motivo, **extra)
+
+
+def raccogli_clienti_agenda(df, config, esclusi=[], oggi=None, traccia=None):
+    """Clienti pianificabili (nel giro, geolocalizzati) con prossima visita, urgenza e appuntamento già calcolati.
+    oggi: data di riferimento per ritardi e urgenze (default: data di sistema)
+    traccia: se è un dict, vi registra i clienti scartati e il motivo"""
+    if df.empty:
+        return []
+
+    base_lat = float(config.get('lat_base', 41.9028))
+    base_lon = float(config.get('lon_base', 12.4964))
+    giorni_lavorativi = giorni_lavorativi_da_config(config)
+    ferie_inizio, ferie_fine = ferie_da_config(config)
+    oggi = oggi or date.today()
+
+    tutti = []
+    for _, r in df.iterrows():
+        if str(r.get('visitare', 'SI')).upper() != 'SI':
+            _esito(traccia, {'id': r['id'], 'nome': r['nome_cliente']}, 'scartato', "fuori giro (visitare = NO)")
+            continue
+        if r['nome_cliente'] in esclusi:
+            _esito(traccia, {'id': r['id'], 'nome': r['nome_cliente']}, 'scartato', "escluso a mano")
+            continue
+        lat, lon = r.get('latitude'), r.get('longitude')
+        if pd.isna(lat) or pd.isna(lon) or lat == 0 or lon == 0:
+            _esito(traccia, {'id': r['id'], 'nome': r['nome_cliente']}, 'scartato', "senza coordinate")
+            continue
+
+        citta = str(r.get('citta', '') or '').strip().upper() or 'ALTRO'
+        freq = int(r.get('frequenza_giorni', 30))
+        ultima = r.get('ultima_visita')
+
+        if pd.isnull(ultima) or (hasattr(ultima, 'year') and ultima.year < 2001):
+            giorni_ritardo = 999
+            urgenza = 85.0  # Alta ma non massima — clienti scaduti 90+ giorni competono
+            prossima_visita = None
+        else:
+            ultima_date = ultima.date() if hasattr(ultima, 'date') else ultima
+            if isinstance(ultima_date, str):
+                try:
+                    ultima_date = datetime.strptime(ultima_date[:10], '%Y-%m-%d').date()
+                except:
+                    ultima_date = oggi
+            # Aggiusta se cade in giorno non lavorativo
+            prossima_visita = sposta_su_giorno_lavorativo(
+                ultima_date + timedelta(days=freq), giorni_lavorativi, ferie_inizio, ferie_fine
+            )
+            giorni_ritardo = (oggi - prossima_visita).days
+            urgenza = urgenza_per_ritardo(giorni_ritardo)
+
+        # Parse appuntamento
+        app_raw = r.get('appuntamento')
+        app_parsed = None
+        if pd.notna(app_raw):
+            if hasattr(app_raw, 'date') and hasattr(app_raw, 'hour'):
+                app_parsed = app_raw
+            elif isinstance(app_raw, str) and app_raw.strip():
+                s = app_raw.strip()
+                for sl, fmt in [(16, '%Y-%m-%dT%H:%M'), (19, '%Y-%m-%dT%H:%M:%S'),
+                                (19, '%Y-%m-%d %H:%M:%S'), (10, '%Y-%m-%d')]:
+                    try:
+                        app_parsed = datetime.strptime(s[:sl], fmt)
+                        break
+                    except:
+                        continue
+
+        flat, flon = float(lat), float(lon)
+
+        tutti.append({
+            'id': r['id'],
+            'nome': r['nome_cliente'],
+            'lat': flat, 'lon': flon,
+            'ind': r.get('indirizzo', ''),
+            'citta': citta,
+            'cell': str(r.get('cellulare', '')),
+            'app': app_parsed,
+            'dist_base': haversine(base_lat, base_lon, flat, flon),
+            'urgenza': urgenza,
+            'giorni_ritardo': giorni_ritardo,
+            'frequenza': freq,
+            'prossima_visita': prossima_visita
+        })
+    return tutti
+
+
+def kmeans_geo(punti, k, max_iter=50, seed=0, statistiche=None):
+    """K-Means su (lat, lon) dei clienti. Ritorna (k gruppi, k centri).
+    seed sceglie il punto di partenza dell'inizializzazione (settimana + variante);
+    statistiche (dict) riceve n, k, iterazioni e se l'algoritmo è arrivato a convergenza"""
+    if statistiche is not None:
+        statistiche.update(n=len(punti), k=k, iterazioni=0, convergenza=True)
+    if len(punti) <= k:
+        gruppi = [[p] for p in punti] + [[] for _ in range(k - len(punti))]
+        return gruppi, [(p['lat'], p['lon']) for p in punti] + [(0.0, 0.0)] * (k - len(punti))
+
+    # Init: farthest-first, punto di partenza ruota con settimana + variante
+    start_idx = seed % len(punti)
+    centers = [(punti[start_idx]['lat'], punti[start_idx]['lon'])]
+    # Distanza minima di ogni punto dai centri scelti, aggiornata solo col nuovo centro
+    min_dist = [haversine(p['lat'], p['lon'], centers[0][0], centers[0][1]) for p in punti]
+    for _ in range(k - 1):
+        max_min_d, best = 0, 0
+        for i, min_d in enumerate(min_dist):
+            if min_d > max_min_d:
+                max_min_d = min_d
+                best = i
+        centers.append((punti[best]['lat'], punti[best]['lon']))
+        clat, clon = centers[-1]
+        for i, p in enumerate(punti):
+            d = haversine(p['lat'], p['lon'], clat, clon)
+            if d < min_dist[i]:
+                min_dist[i] = d
+
+    convergenza = False
+    for iterazione in range(max_iter):
+        clusters = [[] for _ in range(k)]
+        for p in punti:
+            min_d, best = float('inf'), 0
+            for i, (clat, clon) in enumerate(centers):
+                d = haversine(p['lat'], p['lon'], clat, clon)
+                if d < min_d:
+                    min_d = d
+                    best = i
+            clusters[best].append(p)
+
+        new_centers = []
+        for i, cl in enumerate(clusters):
+            if cl:
+                new_centers.append((
+                    sum(c['lat'] for c in cl) / len(cl),
+                    sum(c['lon'] for c in cl) / len(cl)
+                ))
+            else:
+                new_centers.append(centers[i])
+
+        if all(abs(a[0]-b[0]) < 0.001 and abs(a[1]-b[1]) < 0.001
+               for a, b in zip(centers, new_centers)):
+            convergenza = True
+            break
+        centers = new_centers
+
+    if statistiche is not None:
+        statistiche.update(iterazioni=iterazione + 1, convergenza=convergenza)
+    return clusters, centers
+
+
+def circuito_dist(percorso, blat, blon):
+    """Km in linea d'aria del giro base → tappe → base"""
+    if not percorso:
+        return 0
+    d = haversine(blat, blon, percorso[0]['lat'], percorso[0]['lon'])
+    for i in range(len(percorso) - 1):
+        d += haversine(percorso[i]['lat'], percorso[i]['lon'],
+                       percorso[i+1]['lat'], percorso[i+1]['lon'])
+    d += haversine(percorso[-1]['lat'], percorso[-1]['lon'], blat, blon)
+    return d
+
+
+def due_opt(percorso, blat, blon):
+    """Migliora l'ordine del giro con 2-opt (prima inversione che accorcia, max 500 passate)"""
+    if len(percorso) < 3:
+        return percorso
+    p = list(percorso)
+    improved = True
+    it = 0
+    while improved and it < 500:
+        improved = False
+        best_d = circuito_dist(p, blat, blon)
+        for i in range(len(p) - 1):
+            for j in range(i + 2, len(p)):
+                nuovo = p[:i+1] + p[i+1:j+1][::-1] + p[j+1:]
+                d = circuito_dist(nuovo, blat, blon)
+                if d < best_d - 0.01:
+                    p = nuovo
+                    best_d = d
+                    improved = True
+                    break
+            if improved:
+                break
+        it += 1
+    p_rev = list(reversed(p))
+    if circuito_dist(p_rev, blat, blon) < circuito_dist(p, blat, blon):
+        p = p_rev
+    return p
+
+
+def costruisci_anello(clienti_g, blat, blon):
+    """Giro più corto tra quattro ordini di partenza (sweep, vicino più vicino) ottimizzati con 2-opt"""
+    if len(clienti_g) <= 2:
+        return sorted(clienti_g, key=lambda c: -c['dist_base'])
+
+    # Strategia 1: Angular sweep attorno al centroide
+    cx = sum(c['lat'] for c in clienti_g) / len(clienti_g)
+    cy = sum(c['lon'] for c in clienti_g) / len(clienti_g)
+    s1 = sorted(clienti_g, key=lambda c: math_degrees(atan2(c['lat']-cx, c['lon']-cy)) % 360)
+
+    # Strategia 2: NN dal più lontano
+    farthest = max(clienti_g, key=lambda c: c['dist_base'])
+    s2 = [farthest]
+    rem = [c for c in clienti_g if c is not farthest]
+    plat, plon = farthest['lat'], farthest['lon']
+    while rem:
+        min_d = float('inf')
+        best = -1
+        for idx, c in enumerate(rem):
+            d = haversine(plat, plon, c['lat'], c['lon'])
+            if d < min_d:
+                min_d = d
+                best = idx
+        picked = rem.pop(best)
+        s2.append(picked)
+        plat, plon = picked['lat'], picked['lon']
+
+    # Strategia 3: Angular sweep dalla base
+    s3 = sorted(clienti_g, key=lambda c: math_degrees(atan2(c['lat']-blat, c['lon']-blon)) % 360)
+
+    # Strategia 4: NN DALLA BASE (la più naturale per un venditore)
+    s4 = []
+    rem4 = list(clienti_g)
+    plat4, plon4 = blat, blon
+    while rem4:
+        min_d = float('inf')
+        best = -1
+        for idx, c in enumerate(rem4):
+            d = haversine(plat4, plon4, c['lat'], c['lon'])
+            if d < min_d:
+                min_d = d
+                best = idx
+        picked = rem4.pop(best)
+        s4.append(picked)
+        plat4, plon4 = picked['lat'], picked['lon']
+
+    migliore = None
+    migliore_d = float('inf')
+    for strat in [s1, s2, s3, s4]:
+        opt = due_opt(strat, blat, blon)
+        d = circuito_dist(opt, blat, blon)
+        if d < migliore_d:
+            migliore_d = d
+            migliore = opt
+    return migliore
+
+
+def calcola_agenda_settimanale(df, config, esclusi=[], settimana_offset=0, variante=0, routing=None, clienti=None, oggi=None,
+                               traccia=None):
+    """
+    ALGORITMO v10 — K-Means geografico + appuntamento come baricentro.
+
+    1. Pool: clienti scaduti o in scadenza entro 10 giorni + mai visitati
+    2. APPUNTAMENTO = BARICENTRO: se c'è un appuntamento, quel giorno prende
+       i clienti del pool PIÙ VICINI all'appuntamento (ignora le zone)
+    3. GIORNI SENZA APP: K-Means su pool rimanente → zone compatte
+    4. Google Maps ottimizza l'ORDINE dentro ogni giorno (TSP + polyline)
+    5. Rotazione settimanale zone ↔ giorni
+
+    clienti: lista già preparata da raccogli_clienti_agenda (es. per più settimane
+    di fila), altrimenti viene costruita da df.
+    oggi: data di riferimento (settimana corrente, giorni già passati); default data di sistema.
+    traccia: dict da riempire con la spiegazione del calcolo (vedi docstring del modulo).
+    """
+    if clienti is None and df.empty:
+        return {}
+    t0 = perf_counter()
+
+    base_lat = float(config.get('lat_base', 41.9028))
+    base_lon = float(config.get('lon_base', 12.4964))
+    durata_visita = int(config.get('durata_visita', 45))
+    giorni_lavorativi = giorni_lavorativi_da_config(config)
+
+    # Ferie
+    ferie_attive = config.get('attiva_ferie', False)
+    ferie_inizio, ferie_fine = ferie_da_config(config)
+
+    # Orari
+    def get_time(val, default):
+        if val is None: return default
+        if isinstance(val, str):
+            try: return datetime.strptime(val[:5], '%H:%M').time()
+            except: return default
+        return val if hasattr(val, 'hour') else default
+
+    ora_inizio = get_time(config.get('h_inizio'), time(9, 0))
+    ora_fine = get_time(config.get('h_fine'), time(18, 0))
+    pausa_da = get_time(config.get('pausa_inizio'), time(13, 0))
+    pausa_a = get_time(config.get('pausa_fine'), time(14, 0))
+
+    oggi = oggi or date.today()
+    lunedi = oggi - timedelta(days=oggi.weekday()) + timedelta(weeks=settimana_offset)
+    fine_settimana = lunedi + timedelta(days=6)
+
+    agenda = {g: [] for g in range(7)}
+
+    # Parametri temporali per simulazione giro
+    ore_disponibili = (datetime.combine(oggi, ora_fine) - datetime.combine(oggi, ora_inizio)).seconds / 60  # in minuti
+    pausa_min = (datetime.combine(oggi, pausa_a) - datetime.combine(oggi, pausa_da)).seconds / 60
+    minuti_lavoro = ore_disponibili - pausa_min  # minuti netti
+    velocita_media = 50  # km/h media stradale
+
+    # Stima visite/giorno per calcoli intermedi (il vero limite è il tempo simulato)
+    max_visite = max(4, int(minuti_lavoro / (durata_visita + 15)))  # 15min spostamento medio
+
+    # ========================================
+    # 1. RACCOGLI CLIENTI + PARSE APPUNTAMENTI
+    # ========================================
+    # Copie: i campi di settimana (is_app, ora_app) non devono restare sui clienti condivisi
+    if clienti is None:
+        clienti = raccogli_clienti_agenda(df, config, esclusi, oggi, traccia)
+    tutti = [dict(c) for c in clienti]
+    if traccia is not None:
+        traccia.update(settimana=lunedi.isoformat(), max_visite=max_visite, n_clienti=len(tutti))
+        for c in tutti:
+            _esito(traccia, c, 'scartato', "non selezionato", urgenza=round(c['urgenza'], 1),
+                   prossima_visita=c['prossima_visita'].isoformat() if c.get('prossima_visita') else None)
+
+    if not tutti:
+        _cronometra(traccia, 'raccolta', t0)
+        return agenda
+
+    # ========================================
+    # 2. GIORNI DISPONIBILI
+    # ========================================
+    giorni_calcolo = []
+    for g in giorni_lavorativi:
+        data = lunedi + timedelta(days=g)
+        in_ferie = ferie_attive and ferie_inizio and ferie_fine and ferie_inizio <= data <= ferie_fine
+        if not in_ferie:
+            giorni_calcolo.append(g)
+
+    giorni = [g for g in giorni_calcolo
+              if (settimana_offset > 0 or (lunedi + timedelta(days=g)) >= oggi)]
+    if traccia is not None:
+        traccia['giorni'] = {g: ('disponibile' if g in giorni else 'già passato' if g in giorni_calcolo else 'ferie')
+                             for g in giorni_lavorativi}
+    t0 = _cronometra(traccia, 'raccolta', t0)
+
+    if not giorni:
+        return agenda
+
+    # n_giorni = giorni RIMANENTI (non tutti i lavorativi!)
+    # Così il pool viene diviso solo sui giorni che verranno effettivamente mostrati
+    n_giorni = len(giorni)
+
+    # ========================================
+    # 3. SEPARA APPUNTAMENTI
+    # ========================================
+    app_per_giorno = {}
+    nomi_app = set()
+
+    for c in tutti:
+        app = c.get('app')
+        if app is not None and hasattr(app, 'date'):
+            data_app = app.date()
+            if lunedi <= data_app <= lunedi + timedelta(days=6):
+                g = data_app.weekday()
+                if g not in app_per_giorno:
+                    app_per_giorno[g] = []
+                c['ora_app'] = app.strftime('%H:%M')
+                c['is_app'] = True
+                app_per_giorno[g].append(c)
+                nomi_app.add(c['nome'])
+                _esito(traccia, c, 'scartato', "appuntamento in un giorno non pianificabile (ferie, passato o festivo)")
+
+    # ========================================
+    # 4. COSTRUISCI POOL — TUTTI i clienti da visitare
+    # ========================================
+    scaduti = []
+    mai_visitati = []
+    non_ancora = []  # clienti con prossima visita lontana
+    numero_settimana = lunedi.isocalendar()[1]
+
+    for c in tutti:
+        if c['nome'] in nomi_app:
+            continue
+        pv = c.get('prossima_visita')
+        if pv is None:
+            # Mai visitato → SEMPRE nel pool
+            mai_visitati.append(c)
+        elif pv <= fine_settimana:
+            # Scaduto o scade questa settimana → priorità massima
+            scaduti.append(c)
+        elif pv <= fine_settimana + timedelta(days=14):
+            # Scade entro 2 settimane → nel pool con priorità minore
+            scaduti.append(c)
+        else:
+            # Scade oltre 2 settimane → tenere come riserva
+            non_ancora.append(c)
+            _esito(traccia, c, 'scartato', "prossima visita oltre 2 settimane (riserva non usata)")
+
+    # Ordina scaduti per urgenza (i più urgenti prima)
+    scaduti.sort(key=lambda c: -c['urgenza'])
+
+    # Mai visitati: includi TUTTI
+    mai_visitati.sort(key=lambda c: c['dist_base'])
+
+    # Pool: TUTTI gli scaduti + TUTTI i mai visitati (nessun taglio)
+    # Il max_visite per giorno farà da filtro naturale
+    pool = scaduti + mai_visitati
+
+    # Se restano pochi slot, aggiungi anche i "non ancora" come riserva
+    cap_settimana = max_visite * n_giorni
+    riserva_usata = len(pool) < cap_settimana and bool(non_ancora)
+    if riserva_usata:
+        non_ancora.sort(key=lambda c: -c['urgenza'])
+        pool += non_ancora
+
+    # Ordine: urgenza decrescente, poi distanza dalla base crescente
+    # Questo garantisce che k-means trovi zone compatte
+    pool.sort(key=lambda c: (-c['urgenza'], c['dist_base']))
+    if traccia is not None:
+        traccia['pool'] = {
+            'appuntamenti': len(nomi_app), 'scaduti_o_in_scadenza': len(scaduti), 'mai_visitati': len(mai_visitati),
+            'riserva': len(non_ancora), 'riserva_usata': riserva_usata, 'totale': len(pool), 'capienza_settimana': cap_settimana,
+        }
+        for c in pool:
+            _esito(traccia, c, 'scartato', "nel pool ma non selezionato")
+    t0 = _cronometra(traccia, 'pool', t0)
+
+    if not pool and not app_per_giorno:
+        return agenda
+
+    # ========================================
+    # 5. K-MEANS GEOGRAFICO SUL POOL → ZONE COMPATTE (kmeans_geo)
+    # ========================================
+    # Cluster il POOL sui giorni SENZA appuntamento
+    # Prima: gestisci i giorni con appuntamento (l'app è il baricentro)
+
+    # ========================================
+    # 5b. GIORNI CON APPUNTAMENTO → BARICENTRO
+    # ========================================
+    giorni_con_app = set()
+    nomi_usati_da_app = set()
+    risultati_app = {}
+    n_giorni_senza_app = n_giorni
+
+    for g_app in sorted(app_per_giorno.keys()):
+        if g_app not in giorni:
+            continue
+        tappe_app = app_per_giorno[g_app]
+        giorni_con_app.add(g_app)
+        n_giorni_senza_app -= 1
+
+        # Baricentro degli appuntamenti del giorno
+        app_lat = sum(t['lat'] for t in tappe_app) / len(tappe_app)
+        app_lon = sum(t['lon'] for t in tappe_app) / len(tappe_app)
+
+        slot = max_visite - len(tappe_app)
+
+        # Prendi dal pool INTERO i clienti più vicini all'appuntamento
+        candidati = [c for c in pool if c['nome'] not in nomi_usati_da_app]
+        candidati.sort(key=lambda c: (haversine(c['lat'], c['lon'], app_lat, app_lon), -c['urgenza']))
+        selezionati = candidati[:slot]
+
+        for c in selezionati:
+            nomi_usati_da_app.add(c['nome'])
+
+        risultati_app[g_app] = selezionati
+        if traccia is not None:
+            traccia.setdefault('giorni_appuntamento', {})[g_app] = {
+                'appuntamenti': [t['nome'] for t in tappe_app], 'vicini_aggiunti': len(selezionati),
+                'baricentro': (round(app_lat, 5), round(app_lon, 5)),
+            }
+    t0 = _cronometra(traccia, 'giorni_appuntamento', t0)
+
+    # ========================================
+    # 5c. K-MEANS SUL POOL RIMANENTE (giorni senza app)
+    # ========================================
+    pool_rimanente = [c for c in pool if c['nome'] not in nomi_usati_da_app]
+    # Crea SEMPRE molte zone (1 zona ogni ~6-8 clienti) per granularità geografica
+    # Anche con 1 solo giorno, avere più zone permette di scegliere la più compatta
+    if pool_rimanente:
+        # Almeno 4 zone, max len(pool)/5, target = pool/6
+        n_zone = max(4, min(len(pool_rimanente) // 5, len(pool_rimanente) // 6 + n_giorni_senza_app * 2))
+    else:
+        n_zone = max(1, n_giorni_senza_app)
+    n_zone = max(1, n_zone)
+
+    if len(pool_rimanente) >= n_zone and n_zone > 0:
+        statistiche = {'fase': 'zone'}
+        zone_raw, zone_centers = kmeans_geo(pool_rimanente, n_zone, seed=variante + numero_settimana, statistiche=statistiche)
+        if traccia is not None:
+            traccia.setdefault('kmeans', []).append(statistiche)
+    elif pool_rimanente:
+        zone_raw = [pool_rimanente] + [[] for _ in range(n_zone - 1)]
+        zone_centers = [(pool_rimanente[0]['lat'], pool_rimanente[0]['lon'])] + [(base_lat, base_lon)] * (n_zone - 1)
+    else:
+        zone_raw = [[] for _ in range(n_zone)]
+        zone_centers = [(base_lat, base_lon)] * n_zone
+
+    # Le zone contengono TUTTI i clienti del pool raggruppati per vicinanza.
+    # Lo step 11 selezionerà i max_visite più urgenti per ogni zona.
+    # NON bilanciare qui — spostare clienti tra zone crea giri assurdi.
+
+    # Ordina zone per angolo dalla base (così sono geograficamente ordinate)
+    zone_info = []
+    for i, z in enumerate(zone_raw):
+        if not z:
+            zone_info.append({'clienti': [], 'angle': 999 + i, 'center': zone_centers[i]})
+            continue
+        cx = sum(c['lat'] for c in z) / len(z)
+        cy = sum(c['lon'] for c in z) / len(z)
+        angle = math_degrees(atan2(cx - base_lat, cy - base_lon)) % 360
+        zone_info.append({'clienti': z, 'angle': angle, 'center': (cx, cy)})
+
+    zone_info.sort(key=lambda z: z['angle'])
+
+    # ========================================
+    # 6. VARIANTE (Rigenera): ruota assegnazione zone
+    # ========================================
+    if variante > 0 and len(zone_info) > 1:
+        shift = variante % len(zone_info)
+        zone_info = zone_info[shift:] + zone_info[:shift]
+
+    # ========================================
+    # 7. ASSEGNA ZONE → GIORNI (semplice: 1 zona migliore + vicini)
+    # ========================================
+    assegnazione = {}
+    giorni_senza_app = [g for g in giorni if g not in giorni_con_app]
+    n_gsa = len(giorni_senza_app)
+
+    if n_gsa > 0 and zone_info:
+        # Filtra zone vuote
+        zone_valide = [z for z in zone_info if z['clienti']]
+
+        # Calcola score di ogni zona: urgenza media + bonus per dimensione
+        def score_zona(z):
+            cls = z['clienti']
+            urg_media = sum(c['urgenza'] for c in cls) / len(cls)
+            # Bonus dimensione: zone con almeno max_visite clienti hanno priorità
+            bonus_size = min(len(cls) / max_visite, 1.0) * 20
+            return urg_media + bonus_size
+
+        zone_valide.sort(key=lambda z: -score_zona(z))
+
+        # Ruota zone per varietà settimanale
+        if len(zone_valide) > n_gsa:
+            shift = numero_settimana % len(zone_valide)
+            zone_valide = zone_valide[shift:] + zone_valide[:shift]
+
+        zone_usate = set()
+
+        for idx_g, g in enumerate(giorni_senza_app):
+            # Trova prima zona non usata con almeno 1 cliente
+            zona_scelta = None
+            for i, z in enumerate(zone_valide):
+                if i not in zone_usate and z['clienti']:
+                    zona_scelta = z
+                    zone_usate.add(i)
+                    break
+
+            if zona_scelta is None:
+                assegnazione[g] = {'clienti': [], 'center': (base_lat, base_lon)}
+                continue
+
+            # Centro della zona
+            cls_zona = zona_scelta['clienti']
+            cx_z = sum(c['lat'] for c in cls_zona) / len(cls_zona)
+            cy_z = sum(c['lon'] for c in cls_zona) / len(cls_zona)
+
+            # Se la zona ha meno di max_visite clienti, aggiungi vicini dalle altre zone
+            if len(cls_zona) < max_visite:
+                vicini = []
+                for i, z2 in enumerate(zone_valide):
+                    if i in zone_usate:
+                        continue
+                    for c in z2['clienti']:
+                        d = haversine(c['lat'], c['lon'], cx_z, cy_z)
+                        if d <= 20:  # solo entro 20km dal centro
+                            vicini.append((d, c, i))
+
+                vicini.sort(key=lambda x: x[0])
+                # Aggiungi vicini fino a riempire max_visite (no buffer per evitare outlier)
+                target = max_visite
+                for d, c, i_zona in vicini:
+                    if len(cls_zona) >= target:
+                        break
+                    cls_zona.append(c)
+
+            # Ricalcola centro dopo l'aggiunta
+            cx = sum(c['lat'] for c in cls_zona) / len(cls_zona)
+            cy = sum(c['lon'] for c in cls_zona) / len(cls_zona)
+
+            assegnazione[g] = {'clienti': cls_zona, 'center': (cx, cy)}
+
+    if traccia is not None:
+        giorno_zona = {id(a['clienti']): g for g, a in assegnazione.items()}
+        traccia['zone'] = [{
+            'clienti': len(z['clienti']),
+            'centro': (round(z['center'][0], 5), round(z['center'][1], 5)),
+            'angolo': round(z['angle'], 1) if z['clienti'] else None,
+            'urgenza_media': round(sum(c['urgenza'] for c in z['clienti']) / len(z['clienti']), 1) if z['clienti'] else None,
+            'giorno': giorno_zona.get(id(z['clienti'])),
+        } for z in zone_info]
+    t0 = _cronometra(traccia, 'zone', t0)
+
+    # ========================================
+    # 11. ASSEGNA CLIENTI AI GIORNI
+    # ========================================
+    # Criterio primario: DISTANZA (clienti vicini nello stesso giorno)
+    # Criterio secondario: FREQUENZA/URGENZA (chi scade prima ha priorità)
+    # Vincolo: tempo reale (orari lavoro, spostamenti, durata visita)
+
+    risultati = {}
+
+    # Clienti disponibili (esclusi quelli con appuntamento)
+    pool_per_giorni = [c for c in pool if c['nome'] not in nomi_usati_da_app]
+
+    # Gestisci prima i giorni con appuntamento
+    for giorno in giorni_calcolo:
+        data_g = lunedi + timedelta(days=giorno)
+        if giorno in risultati_app:
+            tappe_app = app_per_giorno.get(giorno, [])
+            giro_app = list(tappe_app) + risultati_app[giorno]
+            if len(giro_app) >= 3:
+                t_anello = perf_counter()
+                giro_app = costruisci_anello(giro_app, base_lat, base_lon)
+                _cronometra(traccia, 'anelli', t_anello)
+            risultati[giorno] = (data_g, giro_app)
+            for c in giro_app:
+                _esito(traccia, c, 'pianificato', "appuntamento" if c.get('is_app') else "vicino all'appuntamento", giorno=giorno)
+            for c in giro_app:
+                pool_per_giorni = [p for p in pool_per_giorni if p['nome'] != c['nome']]
+
+    # Giorni senza appuntamento
+    giorni_liberi = [g for g in giorni_calcolo if g not in risultati_app]
+    n_giorni_liberi = len(giorni_liberi)
+
+    if n_giorni_liberi > 0 and pool_per_giorni:
+        # K-means: raggruppa TUTTI i clienti in N cluster geografici
+        t0 = perf_counter()
+        if len(pool_per_giorni) >= n_giorni_liberi:
+            statistiche = {'fase': 'giorni'}
+            cluster_giorni, _ = kmeans_geo(pool_per_giorni, n_giorni_liberi, seed=variante + numero_settimana,
+                                           statistiche=statistiche)
+            if traccia is not None:
+                traccia.setdefault('kmeans', []).append(statistiche)
+        else:
+            cluster_giorni = [pool_per_giorni] + [[] for _ in range(n_giorni_liberi - 1)]
+
+        # Ordina cluster per angolo dalla base
+        cluster_con_angolo = []
+        for cl in cluster_giorni:
+            if cl:
+                cx = sum(c['lat'] for c in cl) / len(cl)
+                cy = sum(c['lon'] for c in cl) / len(cl)
+                angle = math_degrees(atan2(cx - base_lat, cy - base_lon)) % 360
+            else:
+                angle = 999
+            cluster_con_angolo.append((angle, cl))
+        cluster_con_angolo.sort(key=lambda x: x[0])
+
+        # Ruota per settimana + variante
+        shift = (numero_settimana + variante) % max(1, len(cluster_con_angolo))
+        cluster_con_angolo = cluster_con_angolo[shift:] + cluster_con_angolo[:shift]
+        _cronometra(traccia, 'kmeans_giorni', t0)
+
+        # === SIMULAZIONE TEMPO REALE per ogni giorno ===
+        def simula_giornata(clienti_candidati, data_g):
+            """Simula una giornata di lavoro e ritorna i clienti che ci stanno nel tempo."""
+            if not clienti_candidati:
+                return []
+
+            # Ordina candidati per urgenza (i più urgenti prima nella selezione)
+            candidati = sorted(clienti_candidati, key=lambda c: -c['urgenza'])
+
+            # Costruisci il giro con nearest-neighbor rispettando il tempo
+            selezionati = []
+            usati = set()
+
+            pos_lat, pos_lon = base_lat, base_lon
+            ora_corrente = datetime.combine(data_g, ora_inizio)
+            ora_limite = datetime.combine(data_g, ora_fine)
+
+            while candidati:
+                # Trova il miglior candidato: urgenza alta + vicino alla posizione corrente
+                migliore = None
+                migliore_score = -999
+
+                for c in candidati:
+                    if c['nome'] in usati:
+                        continue
+
+                    dist = haversine(pos_lat, pos_lon, c['lat'], c['lon'])
+                    tempo_viaggio_min = (dist / velocita_media) * 60
+
+                    # Score: urgenza normalizzata - penalità distanza
+                    # 1km = ~1.2 minuti = penalità proporzionale
+                    score = c['urgenza'] - tempo_viaggio_min * 1.5
+
+                    if score > migliore_score:
+                        migliore_score = score
+                        migliore = c
+
+                if migliore is None:
+                    break
+
+                # Calcola tempo necessario per questa visita
+                dist_al_cliente = haversine(pos_lat, pos_lon, migliore['lat'], migliore['lon'])
+                tempo_viaggio = (dist_al_cliente / velocita_media) * 60  # minuti
+
+                arrivo = ora_corrente + timedelta(minutes=tempo_viaggio)
+
+                # Gestisci pausa pranzo
+                if arrivo.time() >= pausa_da and arrivo.time() < pausa_a:
+                    arrivo = datetime.combine(data_g, pausa_a) + timedelta(minutes=tempo_viaggio)
+
+                fine_visita = arrivo + timedelta(minutes=durata_visita)
+
+                # Calcola tempo di ritorno alla base dopo questa visita
+                dist_ritorno = haversine(migliore['lat'], migliore['lon'], base_lat, base_lon)
+                tempo_ritorno = (dist_ritorno / velocita_media) * 60
+                ora_rientro = fine_visita + timedelta(minutes=tempo_ritorno)
+
+                # Se non c'è tempo per visitare + tornare, fermati
+                if ora_rientro > ora_limite + timedelta(minutes=15):  # 15min tolleranza
+                    break
+
+                # Accetta questa visita
+                selezionati.append(migliore)
+                usati.add(migliore['nome'])
+                candidati = [c for c in candidati if c['nome'] != migliore['nome']]
+
+                pos_lat, pos_lon = migliore['lat'], migliore['lon']
+                ora_corrente = fine_visita
+
+            return selezionati
+
+        # Assegna cluster ai giorni con simulazione tempo
+        for idx_g, giorno in enumerate(giorni_liberi):
+            data_g = lunedi + timedelta(days=giorno)
+
+            if idx_g < len(cluster_con_angolo):
+                clienti_cluster = cluster_con_angolo[idx_g][1]
+            else:
+                clienti_cluster = []
+
+            if not clienti_cluster:
+                risultati[giorno] = (data_g, [])
+                continue
+
+            # Simula la giornata: il tempo decide quanti clienti ci stanno
+            t_sim = perf_counter()
+            giro = simula_giornata(clienti_cluster, data_g)
+            _cronometra(traccia, 'simulazione', t_sim)
+            if traccia is not None:
+                traccia.setdefault('cluster_giorni', {})[giorno] = {'clienti': len(clienti_cluster), 'selezionati': len(giro)}
+                for c in clienti_cluster:
+                    _esito(traccia, c, 'scartato', f"non entra nella giornata ({len(giro)} visite di {len(clienti_cluster)} nel cluster)",
+                           giorno_cluster=giorno)
+                for c in giro:
+                    _esito(traccia, c, 'pianificato', "cluster del giorno", giorno=giorno)
+
+            # Ottimizza il percorso finale con 2-OPT
+            if len(giro) >= 3:
+                t_anello = perf_counter()
+                giro = costruisci_anello(giro, base_lat, base_lon)
+                _cronometra(traccia, 'anelli', t_anello)
+            elif len(giro) == 2:
+                d1 = circuito_dist(giro, base_lat, base_lon)
+                d2 = circuito_dist(list(reversed(giro)), base_lat, base_lon)
+                if d2 < d1:
+                    giro = list(reversed(giro))
+
+            risultati[giorno] = (data_g, giro)
+
+    # ========================================
+    # 12. CALCOLO ORARI FINALI (con tempi reali)
+    # ========================================
+    t0 = perf_counter()
+    for giorno in giorni_calcolo:
+        data_g, giro = risultati.get(giorno, (lunedi + timedelta(days=giorno), []))
+
+        tappe_finali = []
+        pos_lat, pos_lon = base_lat, base_lon
+        ora = datetime.combine(data_g, ora_inizio)
+
+        # Tempi/distanze delle tratte dal motore percorsi (se configurato), altrimenti stima interna
+        dur_m, dist_m = None, None
+        if routing is not None and giro:
+            pts_giro = [(base_lat, base_lon)] + [(c['lat'], c['lon']) for c in giro]
+            dur_m, dist_m = routing.matrix(pts_giro)
+
+        for i_c, c in enumerate(giro):
+            if dur_m is not None:
+                dist = dist_m[i_c][i_c + 1] / 1000
+                tempo = dur_m[i_c][i_c + 1] / 60
+            else:
+                dist = haversine(pos_lat, pos_lon, c['lat'], c['lon'])
+                tempo = (dist / velocita_media) * 60
+
+            if c.get('is_app'):
+                ora_arr = c.get('ora_app', '09:00')
+            else:
+                arrivo = ora + timedelta(minutes=tempo)
+                if arrivo.time() >= pausa_da and arrivo.time() < pausa_a:
+                    ora = datetime.combine(data_g, pausa_a)
+                    arrivo = ora + timedelta(minutes=tempo)
+                ora_arr = arrivo.strftime('%H:%M')
+                ora = arrivo + timedelta(minutes=durata_visita)
+
+            tappe_finali.append({
+                'id': c['id'],
+                'nome_cliente': c['nome'],
+                'latitude': c['lat'],
+                'longitude': c['lon'],
+                'indirizzo': c.get('ind', ''),
+                'cellulare': c.get('cell', ''),
+                'ora_arrivo': ora_arr,
+                'tipo_tappa': '📌 APPUNTAMENTO' if c.get('is_app') else '🚗 Giro',
+                'distanza_km': round(dist, 1),
+                'ritardo': c.get('giorni_ritardo', 0),
+                'citta': c.get('citta', ''),
+                'urgenza': c.get('urgenza', 0)
+            })
+            pos_lat, pos_lon = c['lat'], c['lon']
+
+        agenda[giorno] = tappe_finali
+
+    _cronometra(traccia, 'orari', t0)
+    if traccia is not None:
+        traccia['tempi_ms'] = {fase: round(ms, 2) for fase, ms in traccia['tempi_ms'].items()}
+    return agenda
+
+
+def calcola_piano_giornaliero(df, giorno_settimana, config, esclusi=[], variante=0, routing=None, oggi=None, traccia=None):
+    """Restituisce il piano per il giorno corrente"""
+    agenda = calcola_agenda_settimanale(df, config, esclusi, settimana_offset=0, variante=variante, routing=routing, oggi=oggi,
+                                        traccia=traccia)
+    return agenda.get(giorno_settimana, [])
+
+
+def calcola_agenda_multisettimana(df, config, n_settimane, esclusi=[], settimana_iniziale=0, variante=0, routing=None, oggi=None):
+    """
+    Agenda su più settimane consecutive: [(lunedì, agenda_settimana), ...].
+
+    I clienti vengono raccolti una volta sola; dopo ogni settimana le visite
+    pianificate sono considerate fatte, quindi prossima visita e urgenza si
+    aggiornano e la settimana dopo il pool non ripropone chi è appena stato visitato.
+    """
+    oggi = oggi or date.today()
+    clienti = raccogli_clienti_agenda(df, config, esclusi, oggi)
+    per_id = {c['id']: c for c in clienti}
+    giorni_lavorativi = giorni_lavorativi_da_config(config)
+    ferie_inizio, ferie_fine = ferie_da_config(config)
+    lunedi_corrente = oggi - timedelta(days=oggi.weekday())
+
+    settimane = []
+    for k in range(n_settimane):
+        offset = settimana_iniziale + k
+        lunedi = lunedi_corrente + timedelta(weeks=offset)
+        agenda = calcola_agenda_settimanale(
+            df, config, esclusi, settimana_offset=offset, variante=variante, routing=routing, clienti=clienti, oggi=oggi
+        )
+        settimane.append((lunedi, agenda))
+
+        # Visite simulate → nuova prossima visita per le settimane successive
+        for giorno, tappe in agenda.items():
+            data_visita = lunedi + timedelta(days=giorno)
+            for t in tappe:
+                c = per_id.get(t['id'])
+                if c is None:
+                    continue
+                c['prossima_visita'] = sposta_su_giorno_lavorativo(
+                    data_visita + timedelta(days=c['frequenza']), giorni_lavorativi, ferie_inizio, ferie_fine
+                )
+                c['giorni_ritardo'] = (oggi - c['prossima_visita']).days
+                c['urgenza'] = urgenza_per_ritardo(c['giorni_ritardo'])
+    return settimane
@@ -0,0 +1,460 @@
+"""
+Motori percorsi (Google Routes, OSRM, stima locale) e ordine delle tappe, senza Streamlit.
+
+Ogni motore espone matrix(points) e route(points) e ha la sua cache. L'errore dell'ultima
+chiamata sta nella ContextVar errore_routing, non nel motore: app.py tiene i motori in
+st.cache_resource, condivisi tra le sessioni, e ogni rerun vede solo i propri errori
+(last_error lo legge). crea_routing_backend costruisce il motore da
+parametri espliciti: app.py li prende dai secrets, la CLI (python -m giro_engine) dalle
+opzioni. Le chiamate HTTP passano da misura_chiamata (vedi misure.py).
+"""
+import contextvars
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+from .geo import haversine
+from .misure import misura_chiamata, registra_chiamata
+from .tsp import held_karp_tsp, nn_2opt_tsp
+
+# {nome motore: errore dell'ultima chiamata} nel contesto corrente ('' se è andata a buon fine)
+errore_routing = contextvars.ContextVar('errore_routing', default=None)
+
+
+def _gm_request(method, url, **kwargs):
+    """Request con retry e backoff esponenziale."""
+    import requests
+    kwargs.setdefault('timeout', 15)
+    corpo = json.dumps(kwargs.get('json'), sort_keys=True, default=str).encode()
+    dettaglio = f"{method} {url} #{hashlib.md5(corpo).hexdigest()[:8]}"
+    for attempt in range(3):
+        try:
+            with misura_chiamata('google', url.rsplit('/', 1)[-1], dettaglio=dettaglio) as m:
+                resp = requests.request(method, url, **kwargs)
+                m['byte'] = len(resp.content)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                time.sleep(1.0 * (2 ** attempt))
+                continue
+            return resp
+        except requests.exceptions.Timeout:
+            if attempt < 2:
+                time.sleep(1.0 * (2 ** attempt))
+                continue
+            raise
+    return resp
+
+
+def _segnala(segnala_errore, messaggio):
+    if segnala_errore is not None:
+        segnala_errore(messaggio)
+
+
+def google_route_matrix(points, api_key, timeout=15, segnala_errore=None):
+    """
+    Matrice NxN tempi/distanze reali via Google Routes API.
+    points: lista di (lat, lon)
+    Ritorna: (dur_matrix, dist_matrix) o (None, None)
+    segnala_errore: funzione chiamata col messaggio in caso di errore (es. backend._segnala_errore)
+    """
+    if not api_key or len(points) < 2:
+        return None, None
+    url = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
+    wps = [{"waypoint": {"location": {"latLng": {"latitude": p[0], "longitude": p[1]}}}} for p in points]
+    body = {"origins": wps, "destinations": wps, "travelMode": "DRIVE", "routingPreference": "TRAFFIC_UNAWARE"}
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Goog-Api-Key': api_key,
+        'X-Goog-FieldMask': 'originIndex,destinationIndex,duration,distanceMeters,status'
+    }
+    try:
+        resp = _gm_request('POST', url, json=body, headers=headers, timeout=timeout)
+        if resp.status_code != 200:
+            _segnala(segnala_errore, f"Route Matrix HTTP {resp.status_code}: {resp.text[:200]}")
+            return None, None
+        n = len(points)
+        dur = [[0]*n for _ in range(n)]
+        dist = [[0]*n for _ in range(n)]
+        for elem in resp.json():
+            i, j = elem.get('originIndex', 0), elem.get('destinationIndex', 0)
+            d_str = elem.get('duration', '0s')
+            dur[i][j] = int(d_str.rstrip('s')) if isinstance(d_str, str) else int(d_str)
+            dist[i][j] = int(elem.get('distanceMeters', 0))
+        return dur, dist
+    except Exception as e:
+        _segnala(segnala_errore, f"Route Matrix: {str(e)[:200]}")
+        return None, None
+
+
+def google_compute_route(origin, destination, waypoints, api_key, timeout=15, segnala_errore=None):
+    """
+    Percorso dettagliato con polyline via Google Routes API.
+    origin/destination: (lat, lon)
+    waypoints: [(lat, lon), ...]
+    Ritorna: dict con polyline, duration_s, distance_m, legs o None
+    segnala_errore: come in google_route_matrix
+    """
+    if not api_key:
+        return None
+    url = "https://routes.googleapis.com/directions/v2:computeRoutes"
+    def mkloc(p):
+        return {"location": {"latLng": {"latitude": p[0], "longitude": p[1]}}}
+    body = {
+        "origin": mkloc(origin),
+        "destination": mkloc(destination),
+        "travelMode": "DRIVE", "routingPreference": "TRAFFIC_UNAWARE",
+        "computeAlternativeRoutes": False, "polylineEncoding": "ENCODED_POLYLINE"
+    }
+    if waypoints:
+        body["intermediates"] = [mkloc(wp) for wp in waypoints]
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Goog-Api-Key': api_key,
+        'X-Goog-FieldMask': 'routes.duration,routes.distanceMeters,routes.polyline.encodedPolyline,routes.legs.duration,routes.legs.distanceMeters'
+    }
+    try:
+        resp = _gm_request('POST', url, json=body, headers=headers, timeout=timeout)
+        if resp.status_code != 200:
+            _segnala(segnala_errore, f"Compute Route HTTP {resp.status_code}: {resp.text[:200]}")
+            return None
+        routes = resp.json().get('routes', [])
+        if not routes:
+            return None
+        r = routes[0]
+        dur_s = r.get('duration', '0s')
+        total_dur = int(dur_s.rstrip('s')) if isinstance(dur_s, str) else int(dur_s)
+        legs = []
+        for leg in r.get('legs', []):
+            ld = leg.get('duration', '0s')
+            legs.append({
+                'dur_s': int(ld.rstrip('s')) if isinstance(ld, str) else int(ld),
+                'dist_m': int(leg.get('distanceMeters', 0))
+            })
+        return {
+            'polyline': r.get('polyline', {}).get('encodedPolyline', ''),
+            'duration_s': total_dur,
+            'distance_m': int(r.get('distanceMeters', 0)),
+            'legs': legs
+        }
+    except Exception as e:
+        _segnala(segnala_errore, f"Compute Route: {str(e)[:200]}")
+        return None
+
+
+def ottimizza_ordine_percorso(tappe, base_lat, base_lon, backend):
+    """
+    Prende le tappe calcolate dall'algoritmo e le RIORDINA
+    usando la matrice tempi del motore percorsi + TSP esatto.
+    Ritorna: (tappe_riordinate, route_info) — route_info ha polyline e legs.
+    Con backend None le tappe restano come sono.
+    """
+    if backend is None or len(tappe) < 2:
+        return tappe, None
+
+    # Costruisci punti: [BASE] + [tappe...]
+    pts = [(base_lat, base_lon)]
+    for t in tappe:
+        pts.append((t['latitude'], t['longitude']))
+
+    # Matrice tempi reali
+    dur_matrix, dist_matrix = backend.matrix(pts)
+    if dur_matrix is None:
+        return tappe, None
+
+    # TSP
+    n = len(pts)
+    if n <= 12:
+        order, cost = held_karp_tsp(dur_matrix, start=0)
+    else:
+        order, cost = nn_2opt_tsp(dur_matrix, start=0)
+
+    # Riordina tappe (salta indice 0 = base)
+    nuove_tappe = []
+    for idx in order:
+        if idx == 0: continue
+        ti = idx - 1
+        if 0 <= ti < len(tappe):
+            nuove_tappe.append(tappe[ti])
+
+    # Ricalcola distanze e orari nelle tappe
+    prev_lat, prev_lon = base_lat, base_lon
+    for t in nuove_tappe:
+        t['distanza_km'] = round(haversine(prev_lat, prev_lon, t['latitude'], t['longitude']), 1)
+        prev_lat, prev_lon = t['latitude'], t['longitude']
+
+    # Percorso dettagliato con polyline (anello BASE → tappe → BASE)
+    wps = [(t['latitude'], t['longitude']) for t in nuove_tappe]
+    route = backend.route([(base_lat, base_lon)] + wps + [(base_lat, base_lon)])
+
+    # Aggiorna tempi/distanze nelle tappe con dati reali del motore
+    if route:
+        route = dict(route)
+        route['ids'] = [t['id'] for t in nuove_tappe]
+        route['backend'] = backend.nome
+        route['route_id'] = id_percorso(route)
+        applica_legs_a_tappe(nuove_tappe, route.get('legs'))
+
+    return nuove_tappe, route
+
+
+def applica_legs_a_tappe(tappe, legs):
+    """Aggiorna distanza e tempo di guida di ogni tappa con i dati reali delle tratte"""
+    if not legs:
+        return tappe
+    for i, t in enumerate(tappe):
+        if i < len(legs):
+            t['distanza_km'] = round(legs[i]['dist_m'] / 1000, 1)
+            t['tempo_guida_min'] = legs[i]['dur_s'] // 60
+    return tappe
+
+
+def route_valida_per_tappe(route_info, tappe):
+    """True se il percorso è stato calcolato per queste tappe (stesso ordine)"""
+    if not route_info or not route_info.get('polyline'):
+        return False
+    ids_route = route_info.get('ids')
+    if ids_route is None:
+        return True  # percorso calcolato prima dell'introduzione degli ids
+    return list(ids_route) == [t['id'] for t in tappe]
+
+
+def decode_google_polyline(encoded):
+    """Decodifica polyline Google → [(lat, lon), ...]"""
+    return [tuple(p) for p in decode_polyline_array(encoded).tolist()]
+
+
+def encode_google_polyline(points):
+    """Codifica [(lat, lon), ...] → polyline Google (precisione 1e-5)"""
+    out = []; prev_lat = 0; prev_lng = 0
+    for lat, lng in points:
+        ilat = int(round(lat * 1e5)); ilng = int(round(lng * 1e5))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            v = ~(delta << 1) if delta < 0 else (delta << 1)
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1F)) + 63)); v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return ''.join(out)
+
+
+def decode_polyline_array(encoded):
+    """Decodifica polyline Google in un array numpy Nx2 (lat, lon) senza loop Python"""
+    if not encoded:
+        return np.empty((0, 2))
+    b = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    fine = np.flatnonzero(b < 0x20)  # ultimo chunk di ogni valore
+    if len(fine) == 0:
+        return np.empty((0, 2))
+    b = b[:fine[-1] + 1]
+    inizi = np.concatenate(([0], fine[:-1] + 1))
+    # Posizione di ogni chunk dentro il suo valore → shift di 5 bit per posizione
+    pos = np.arange(len(b)) - np.repeat(inizi, fine - inizi + 1)
+    valori = np.add.reduceat((b & 0x1F) << (5 * pos), inizi)
+    delta = np.where(valori & 1, ~(valori >> 1), valori >> 1)
+    delta = delta[:len(delta) // 2 * 2].reshape(-1, 2)
+    return np.cumsum(delta, axis=0) / 1e5
+
+
+def id_percorso(route_info):
+    """Identificativo stabile del percorso (hash della polyline codificata)"""
+    if not route_info or not route_info.get('polyline'):
+        return None
+    return route_info.get('route_id') or hashlib.md5(route_info['polyline'].encode()).hexdigest()[:16]
+
+
+class RoutingBackend:
+    """
+    Interfaccia comune dei motori percorsi.
+    matrix(points) → (dur_matrix_s, dist_matrix_m) o (None, None)
+    route(points)  → {polyline, duration_s, distance_m, legs} o None  (points = origine, tappe..., arrivo)
+    Ogni motore ha la sua cache (solo risultati validi) e il suo timeout; l'errore dell'ultima
+    chiamata è per contesto (vedi errore_routing), così un motore condiviso non lo mostra
+    alle altre sessioni.
+    """
+    nome = 'base'
+    etichetta = 'Motore percorsi'
+
+    def __init__(self, timeout=15, cache_ttl=3600, cache_max=256):
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_max = cache_max
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def last_error(self):
+        """Errore dell'ultima chiamata di questo motore nel contesto corrente ('' se riuscita)"""
+        return (errore_routing.get() or {}).get(self.nome, '')
+
+    def _segnala_errore(self, messaggio):
+        errori = dict(errore_routing.get() or {})
+        errori[self.nome] = messaggio
+        errore_routing.set(errori)
+
+    def _cache_key(self, tipo, points):
+        return (tipo,) + tuple((round(float(p[0]), 5), round(float(p[1]), 5)) for p in points)
+
+    def _cached(self, tipo, points, calcola):
+        key = self._cache_key(tipo, points)
+        now = time.time()
+        # Ogni chiamata azzera l'errore: resta solo se calcola() lo segnala
+        self._segnala_errore('')
+        with self._lock:
+            hit = self._cache.get(key)
+        if hit and now - hit[0] < self.cache_ttl:
+            registra_chiamata(self.nome, tipo, 0, cache=True)
+            return hit[1]
+        value = calcola(points)
+        ok = value is not None and not (isinstance(value, tuple) and value[0] is None)
+        if ok:
+            with self._lock:
+                if len(self._cache) >= self.cache_max:
+                    # Rimuovi la voce più vecchia
+                    oldest = min(self._cache, key=lambda k: self._cache[k][0])
+                    self._cache.pop(oldest, None)
+                self._cache[key] = (now, value)
+        return value
+
+    def matrix(self, points):
+        if len(points) < 2:
+            return None, None
+        return self._cached('matrix', points, self._matrix)
+
+    def route(self, points):
+        if len(points) < 2:
+            return None
+        return self._cached('route', points, self._route)
+
+    def _matrix(self, points):
+        raise NotImplementedError
+
+    def _route(self, points):
+        raise NotImplementedError
+
+
+class GoogleRoutingBackend(RoutingBackend):
+    """Google Routes API (computeRouteMatrix + computeRoutes)"""
+    nome = 'google'
+    etichetta = 'Google Maps'
+
+    def __init__(self, api_key, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+
+    def _matrix(self, points):
+        return google_route_matrix(points, self.api_key, timeout=self.timeout, segnala_errore=self._segnala_errore)
+
+    def _route(self, points):
+        return google_compute_route(points[0], points[-1], list(points[1:-1]), self.api_key, timeout=self.timeout,
+                                    segnala_errore=self._segnala_errore)
+
+
+class OsrmRoutingBackend(RoutingBackend):
+    """Server OSRM via HTTP (table + route), es. istanza self-hosted"""
+    nome = 'osrm'
+    etichetta = 'OSRM'
+
+    def __init__(self, base_url, profilo='driving', **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip('/')
+        self.profilo = profilo
+
+    def _coords(self, points):
+        # Formato OSRM: lon,lat;lon,lat;...
+        return ";".join(f"{p[1]},{p[0]}" for p in points)
+
+    def _get(self, servizio, points, params):
+        import requests
+        url = f"{self.base_url}/{servizio}/v1/{self.profilo}/{self._coords(points)}"
+        try:
+            with misura_chiamata('osrm', servizio, dettaglio=url[:300]) as m:
+                resp = requests.get(url, params=params, timeout=self.timeout)
+                m['byte'] = len(resp.content)
+            if resp.status_code != 200:
+                self._segnala_errore(f"OSRM {servizio} HTTP {resp.status_code}: {resp.text[:200]}")
+                return None
+            data = resp.json()
+            if data.get('code') != 'Ok':
+                self._segnala_errore(f"OSRM {servizio}: {data.get('code')} {data.get('message', '')[:150]}")
+                return None
+            return data
+        except Exception as e:
+            self._segnala_errore(f"OSRM {servizio}: {str(e)[:200]}")
+            return None
+
+    def _matrix(self, points):
+        data = self._get('table', points, {'annotations': 'duration,distance'})
+        if not data or not data.get('durations'):
+            return None, None
+        dur = [[int(round(v or 0)) for v in row] for row in data['durations']]
+        if data.get('distances'):
+            dist = [[int(round(v or 0)) for v in row] for row in data['distances']]
+        else:
+            dist = [[0] * len(points) for _ in points]
+        return dur, dist
+
+    def _route(self, points):
+        data = self._get('route', points, {'overview': 'full', 'geometries': 'polyline', 'steps': 'false'})
+        if not data or not data.get('routes'):
+            return None
+        r = data['routes'][0]
+        return {
+            'polyline': r.get('geometry', ''),
+            'duration_s': int(round(r.get('duration', 0))),
+            'distance_m': int(round(r.get('distance', 0))),
+            'legs': [{'dur_s': int(round(l.get('duration', 0))), 'dist_m': int(round(l.get('distance', 0)))}
+                     for l in r.get('legs', [])]
+        }
+
+
+class LocaleRoutingBackend(RoutingBackend):
+    """Stima offline: distanza in linea d'aria × fattore di deviazione stradale, velocità media costante"""
+    nome = 'locale'
+    etichetta = 'Stima locale'
+
+    def __init__(self, fattore_deviazione=1.3, velocita_kmh=50, **kwargs):
+        super().__init__(**kwargs)
+        self.fattore_deviazione = fattore_deviazione
+        self.velocita_kmh = velocita_kmh
+
+    def _tratta(self, a, b):
+        km = haversine(a[0], a[1], b[0], b[1]) * self.fattore_deviazione
+        return int(round(km / self.velocita_kmh * 3600)), int(round(km * 1000))
+
+    def _matrix(self, points):
+        n = len(points)
+        dur = [[0]*n for _ in range(n)]
+        dist = [[0]*n for _ in range(n)]
+        for i in range(n):
+            for j in range(i + 1, n):
+                d_s, d_m = self._tratta(points[i], points[j])
+                dur[i][j] = dur[j][i] = d_s
+                dist[i][j] = dist[j][i] = d_m
+        return dur, dist
+
+    def _route(self, points):
+        legs = []
+        for a, b in zip(points[:-1], points[1:]):
+            d_s, d_m = self._tratta(a, b)
+            legs.append({'dur_s': d_s, 'dist_m': d_m})
+        return {
+            'polyline': encode_google_polyline(points),
+            'duration_s': sum(l['dur_s'] for l in legs),
+            'distance_m': sum(l['dist_m'] for l in legs),
+            'legs': legs
+        }
+
+
+def crea_routing_backend(nome, google_api_key='', osrm_url='http://router.project-osrm.org',
+                         fattore_deviazione=1.3, velocita_kmh=50):
+    """Motore percorsi per nome ('google' | 'osrm' | 'locale'); None se 'nessuno' o senza chiave Google"""
+    nome = (nome or 'nessuno').lower()
+    if nome == 'google':
+        return GoogleRoutingBackend(google_api_key, timeout=15) if google_api_key else None
+    if nome == 'osrm':
+        return OsrmRoutingBackend(osrm_url, timeout=10)
+    if nome == 'locale':
+        return LocaleRoutingBackend(fattore_deviazione=fattore_deviazione, velocita_kmh=velocita_kmh)
+    return None
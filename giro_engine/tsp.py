@@ -0,0 +1,62 @@
+"""Ordine di visita ottimo su una matrice di costi (tempi o distanze): esatto fino a 12 punti, euristico oltre."""
+
+
+def held_karp_tsp(dist_matrix, start=0):
+    """TSP esatto Held-Karp per ≤12 punti. Ritorna (path, cost)."""
+    n = len(dist_matrix)
+    if n <= 1: return [start], 0
+    if n == 2:
+        other = 1 - start
+        return [start, other], dist_matrix[start][other] + dist_matrix[other][start]
+    INF = float('inf')
+    dp = [[INF]*n for _ in range(1 << n)]
+    parent = [[-1]*n for _ in range(1 << n)]
+    dp[1 << start][start] = 0
+    for S in range(1 << n):
+        for u in range(n):
+            if dp[S][u] == INF or not (S & (1 << u)): continue
+            for v in range(n):
+                if S & (1 << v): continue
+                nS = S | (1 << v)
+                nc = dp[S][u] + dist_matrix[u][v]
+                if nc < dp[nS][v]:
+                    dp[nS][v] = nc; parent[nS][v] = u
+    full = (1 << n) - 1
+    best_c, best_l = INF, -1
+    for u in range(n):
+        c = dp[full][u] + dist_matrix[u][start]
+        if c < best_c: best_c = c; best_l = u
+    path = []; S = full; u = best_l
+    while u != -1:
+        path.append(u); prev = parent[S][u]; S ^= (1 << u); u = prev
+    path.reverse()
+    if path and path[0] != start:
+        try:
+            idx = path.index(start); path = path[idx:] + path[:idx]
+        except: path = [start] + path
+    return path, best_c
+
+
+def nn_2opt_tsp(dist_matrix, start=0):
+    """TSP euristica NN + 2-opt per >12 punti."""
+    n = len(dist_matrix)
+    visited = [False]*n; path = [start]; visited[start] = True
+    for _ in range(n-1):
+        cur = path[-1]; best_n, best_d = -1, float('inf')
+        for j in range(n):
+            if not visited[j] and dist_matrix[cur][j] < best_d:
+                best_d = dist_matrix[cur][j]; best_n = j
+        if best_n == -1: break
+        path.append(best_n); visited[best_n] = True
+    def rc(p):
+        c = sum(dist_matrix[p[i]][p[i+1]] for i in range(len(p)-1))
+        return c + dist_matrix[p[-1]][start]
+    improved = True
+    while improved:
+        improved = False; bc = rc(path)
+        for i in range(1, len(path)-1):
+            for j in range(i+2, len(path)):
+                np2 = path[:i+1] + path[i+1:j+1][::-1] + path[j+1:]
+                if rc(np2) < bc - 1: path = np2; improved = True; break
+            if improved: break
+    return path, rc(path)
@@ -0,0 +1,56 @@
+-- Storico visite normalizzato: una riga per visita/telefonata (append-only).
+-- Sostituisce la colonna di testo clienti.storico_report, che resta solo come
+-- sorgente per la migrazione una tantum (Configurazione → Migra storico report).
+-- Da eseguire una volta nell'SQL editor di Supabase.
+
+create table if not exists public.visite (
+    id           bigint generated by default as identity primary key,
+    cliente_id   bigint not null references public.clienti(id) on delete cascade,
+    agente_id    uuid   not null default auth.uid(),
+    data_visita  date   not null,
+    tipo         text   not null default 'VISITA',    -- VISITA | TELEFONATA | NOTA
+    testo        text   not null default '',
+    origine      text   not null default 'app',      -- app | storico (migrazione)
+    creato_il    timestamptz not null default now()
+);
+
+-- Storico di un cliente (paginato, più recenti prima)
+create index if not exists visite_cliente_data_idx on public.visite (cliente_id, data_visita desc, id desc);
+-- Statistiche per periodo / agente (Dashboard, Team)
+create index if not exists visite_agente_data_idx on public.visite (agente_id, data_visita desc);
+create index if not exists visite_data_idx on public.visite (data_visita desc);
+
+alter table public.visite enable row level security;
+
+-- Visibili/scrivibili se il cliente è visibile all'utente:
+-- proprietario, agente assegnato o responsabile del team del cliente
+create or replace function public.puo_vedere_cliente(p_cliente_id bigint)
+returns boolean
+language sql stable security definer set search_path = public
+as $$
+    select exists (
+        select 1 from clienti c
+        where c.id = p_cliente_id
+          and (
+              c.user_id = auth.uid()
+              or c.agente_id = auth.uid()
+              or exists (
+                  select 1 from team_members tm
+                  where tm.team_id = c.team_id
+                    and tm.user_id = auth.uid()
+                    and tm.ruolo = 'responsabile'
+                    and tm.attivo
+              )
+          )
+    );
+$$;
+
+drop policy if exists visite_select on public.visite;
+create policy visite_select on public.visite
+    for select using (public.puo_vedere_cliente(cliente_id));
+
+drop policy if exists visite_insert on public.visite;
+create policy visite_insert on public.visite
+    for insert with check (agente_id = auth.uid() and public.puo_vedere_cliente(cliente_id));
+
+-- Append-only: nessuna policy di update/delete (le righe spariscono solo col cliente)
@@ -0,0 +1,43 @@
+-- Registrazione visita atomica lato server (richiede 001_visite.sql).
+-- Una sola chiamata: nuova riga in visite + ultima_visita del cliente, nella
+-- stessa transazione. Due dispositivi che registrano insieme non si
+-- sovrascrivono e il payload non cresce con lo storico.
+-- Ritorna solo i campi cambiati, per aggiornare il DataFrame locale.
+-- Una visita con data precedente all'ultima non sposta indietro ultima_visita.
+
+create or replace function public.registra_visita(
+    p_cliente_id bigint,
+    p_data       date,
+    p_tipo       text default 'VISITA',
+    p_testo      text default ''
+)
+returns jsonb
+language plpgsql
+security invoker                -- valgono le policy RLS di clienti e visite
+set search_path = public
+as $$
+declare
+    v_visita_id bigint;
+    v_ultima    date;
+begin
+    update clienti
+       set ultima_visita = greatest(coalesce(ultima_visita, p_data), p_data)
+     where id = p_cliente_id
+    returning ultima_visita::date into v_ultima;
+    if not found then
+        raise exception 'Cliente % non trovato o non accessibile', p_cliente_id;
+    end if;
+
+    insert into visite (cliente_id, agente_id, data_visita, tipo, testo)
+    values (p_cliente_id, auth.uid(), p_data, coalesce(nullif(p_tipo, ''), 'VISITA'), coalesce(btrim(p_testo), ''))
+    returning id into v_visita_id;
+
+    return jsonb_build_object(
+        'id', p_cliente_id,
+        'ultima_visita', v_ultima,
+        'visita_id', v_visita_id
+    );
+end;
+$$;
+
+grant execute on function public.registra_visita(bigint, date, text, text) to authenticated;
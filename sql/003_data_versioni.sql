@@ -0,0 +1,142 @@
+-- Contatore di versione dei dati per utente/team + sincronizzazione a delta.
+-- L'app legge ogni N secondi una riga per ambito ('user:<uuid>', 'team:<id>'):
+-- se la versione non è cambiata non scarica nulla, altrimenti chiede solo i
+-- clienti con aggiornato_il successivo all'ultima sincronizzazione e le righe
+-- sparite (eliminate o non più assegnate) da clienti_rimossi.
+-- I giri salvati e gli scambi giorni sono righe speciali di clienti ('__...'),
+-- quindi sono coperti dagli stessi trigger. Da eseguire una volta nell'SQL editor.
+-- aggiornato_il e rimosso_il sono clock_timestamp() (istante della scrittura, non
+-- inizio transazione) ma diventano visibili solo al commit: l'app rilegge quindi
+-- una finestra prima dell'ultima sincronizzazione e scarta le righe già applicate.
+
+-- Ultima modifica di ogni cliente (impostata dal trigger, mai dall'app)
+alter table public.clienti add column if not exists aggiornato_il timestamptz not null default now();
+create index if not exists clienti_aggiornato_il_idx on public.clienti (aggiornato_il);
+
+create table if not exists public.data_versioni (
+    ambito         text primary key,              -- user:<uuid> | team:<id>
+    versione       bigint not null default 0,
+    aggiornato_il  timestamptz not null default now()
+);
+
+-- Clienti eliminati o usciti dalla visibilità di un utente (cambio agente/team/proprietario)
+create table if not exists public.clienti_rimossi (
+    id            bigint generated by default as identity primary key,
+    cliente_id    bigint not null,
+    user_id       uuid,
+    agente_id     uuid,
+    team_id       text,
+    rimosso_il    timestamptz not null default clock_timestamp()
+);
+alter table public.clienti_rimossi alter column rimosso_il set default clock_timestamp();
+create index if not exists clienti_rimossi_data_idx on public.clienti_rimossi (rimosso_il);
+
+create or replace function public.incrementa_versione_dati(p_ambiti text[])
+returns void
+language sql security definer set search_path = public
+as $$
+    insert into data_versioni (ambito, versione, aggiornato_il)
+    select distinct a, 1, now() from unnest(p_ambiti) a where a is not null
+    on conflict (ambito) do update
+        set versione = data_versioni.versione + 1,
+            aggiornato_il = now();
+$$;
+
+create or replace function public.clienti_imposta_aggiornato_il()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.aggiornato_il := clock_timestamp();
+    return new;
+end;
+$$;
+
+drop trigger if exists clienti_aggiornato_il on public.clienti;
+create trigger clienti_aggiornato_il
+    before insert or update on public.clienti
+    for each row execute function public.clienti_imposta_aggiornato_il();
+
+create or replace function public.clienti_versione_dati()
+returns trigger
+language plpgsql security definer set search_path = public
+as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        -- Chi vedeva la riga prima deve toglierla se ora non la vede più
+        if tg_op = 'DELETE'
+           or old.user_id is distinct from new.user_id
+           or old.agente_id is distinct from new.agente_id
+           or old.team_id is distinct from new.team_id then
+            -- Stesso istante della modifica: chi vede ancora la riga (responsabile) la tiene
+            insert into clienti_rimossi (cliente_id, user_id, agente_id, team_id, rimosso_il)
+            values (old.id, old.user_id, old.agente_id, old.team_id::text,
+                    case when tg_op = 'DELETE' then clock_timestamp() else new.aggiornato_il end);
+        end if;
+        perform incrementa_versione_dati(array[
+            'user:' || old.user_id::text,
+            'user:' || old.agente_id::text,
+            'team:' || old.team_id::text
+        ]);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform incrementa_versione_dati(array[
+            'user:' || new.user_id::text,
+            'user:' || new.agente_id::text,
+            'team:' || new.team_id::text
+        ]);
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists clienti_versione_dati on public.clienti;
+create trigger clienti_versione_dati
+    after insert or update or delete on public.clienti
+    for each row execute function public.clienti_versione_dati();
+
+create or replace function public.config_versione_dati()
+returns trigger
+language plpgsql security definer set search_path = public
+as $$
+begin
+    perform incrementa_versione_dati(array['user:' || coalesce(new.user_id, old.user_id)::text]);
+    return null;
+end;
+$$;
+
+drop trigger if exists config_versione_dati on public.config_utente;
+create trigger config_versione_dati
+    after insert or update or delete on public.config_utente
+    for each row execute function public.config_versione_dati();
+
+-- Lettura: il proprio ambito utente e quello dei team di cui si è membri attivi
+alter table public.data_versioni enable row level security;
+drop policy if exists data_versioni_select on public.data_versioni;
+create policy data_versioni_select on public.data_versioni
+    for select using (
+        ambito = 'user:' || auth.uid()::text
+        or exists (
+            select 1 from team_members tm
+            where ambito = 'team:' || tm.team_id::text
+              and tm.user_id = auth.uid()
+              and tm.attivo
+        )
+    );
+
+alter table public.clienti_rimossi enable row level security;
+drop policy if exists clienti_rimossi_select on public.clienti_rimossi;
+create policy clienti_rimossi_select on public.clienti_rimossi
+    for select using (
+        user_id = auth.uid()
+        or agente_id = auth.uid()
+        or exists (
+            select 1 from team_members tm
+            -- Qualificato: team_id da solo sarebbe la colonna di team_members
+            where clienti_rimossi.team_id = tm.team_id::text
+              and tm.user_id = auth.uid()
+              and tm.ruolo = 'responsabile'
+              and tm.attivo
+        )
+    );
+-- Nessuna policy di scrittura: le tabelle sono alimentate solo dai trigger
@@ -0,0 +1,224 @@
+"""
+giro_engine importato direttamente (senza Streamlit): agenda su più settimane, TSP,
+errori dei motori percorsi e riga di comando.
+"""
+import contextvars
+import csv
+import json
+import math
+import os
+import subprocess
+import sys
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from giro_engine import (
+    OsrmRoutingBackend, calcola_agenda_multisettimana, config_predefinita, crea_routing_backend,
+    df_clienti_da_righe, haversine, held_karp_tsp, nn_2opt_tsp, ottimizza_ordine_percorso,
+)
+from giro_engine import routing as modulo_routing
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OGGI = date(2025, 3, 10)  # lunedì
+BASE = (44.4949, 11.3426)
+
+
+def righe_clienti(n, seed=0, giorni_fa=60):
+    rng = np.random.default_rng(seed)
+    return [{
+        'id': i + 1, 'nome_cliente': f"Cliente {i + 1}", 'citta': 'Bologna', 'visitare': 'SI',
+        'latitude': float(BASE[0] + rng.normal(0, 0.08)), 'longitude': float(BASE[1] + rng.normal(0, 0.08)),
+        'frequenza_giorni': 30, 'ultima_visita': (OGGI - timedelta(days=giorni_fa)).isoformat(),
+    } for i in range(n)]
+
+
+def config_bologna():
+    return {**config_predefinita(), 'lat_base': BASE[0], 'lon_base': BASE[1]}
+
+
+def ids_settimana(agenda):
+    return [t['id'] for tappe in agenda.values() for t in tappe]
+
+
+# --- AGENDA SU PIÙ SETTIMANE ---
+
+def test_multisettimana_riporta_i_clienti_non_pianificati():
+    df = df_clienti_da_righe(righe_clienti(150))
+    (lunedi1, sett1), (lunedi2, sett2) = calcola_agenda_multisettimana(df, config_bologna(), 2, oggi=OGGI)
+    assert lunedi2 - lunedi1 == timedelta(weeks=1)
+    ids1, ids2 = ids_settimana(sett1), ids_settimana(sett2)
+    assert len(ids1) == len(set(ids1)) and len(ids2) == len(set(ids2))
+    # Più clienti scaduti di quanti ne stanno in una settimana: chi resta fuori passa alla successiva
+    assert 0 < len(ids1) < 150
+    assert ids2 and set(ids2) <= set(range(1, 151)) - set(ids1)
+    # Frequenza 30 giorni: chi è stato visitato la prima settimana non torna la seconda
+    assert not set(ids1) & set(ids2)
+
+
+def test_multisettimana_non_modifica_il_dataframe():
+    df = df_clienti_da_righe(righe_clienti(30))
+    prima = df.copy()
+    calcola_agenda_multisettimana(df, config_bologna(), 3, oggi=OGGI)
+    pd.testing.assert_frame_equal(df, prima)
+
+
+# --- TSP ---
+
+def matrice_distanze(n, seed):
+    rng = np.random.default_rng(seed)
+    punti = [(BASE[0] + rng.normal(0, 0.1), BASE[1] + rng.normal(0, 0.1)) for _ in range(n)]
+    return [[int(haversine(a[0], a[1], b[0], b[1]) * 1000) for b in punti] for a in punti]
+
+
+def costo_anello(matrice, percorso):
+    return sum(matrice[a][b] for a, b in zip(percorso, percorso[1:] + percorso[:1]))
+
+
+def anello_vicino_piu_vicino(matrice, start=0):
+    percorso, restanti = [start], set(range(len(matrice))) - {start}
+    while restanti:
+        prossimo = min(restanti, key=lambda j: matrice[percorso[-1]][j])
+        percorso.append(prossimo)
+        restanti.discard(prossimo)
+    return percorso
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_nn_2opt_permutazione_non_peggiore_del_vicino_piu_vicino(seed):
+    matrice = matrice_distanze(25, seed)
+    percorso, costo = nn_2opt_tsp(matrice, start=0)
+    assert percorso[0] == 0 and sorted(percorso) == list(range(25))
+    assert costo == costo_anello(matrice, percorso)
+    assert costo <= costo_anello(matrice, anello_vicino_piu_vicino(matrice))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_held_karp_ottimo_non_peggiore_dell_euristica(seed):
+    matrice = matrice_distanze(9, seed)
+    percorso, costo = held_karp_tsp(matrice, start=0)
+    assert percorso[0] == 0 and sorted(percorso) == list(range(9))
+    assert costo == costo_anello(matrice, percorso)
+    assert costo <= nn_2opt_tsp(matrice, start=0)[1]
+
+
+# --- MOTORI PERCORSI: ERRORE PER CONTESTO ---
+
+class RispostaFinta:
+    def __init__(self, status_code, dati):
+        self.status_code = status_code
+        self._dati = dati
+        self.content = json.dumps(dati).encode()
+        self.text = self.content.decode()
+
+    def json(self):
+        return self._dati
+
+
+def tappe_prova(n=3):
+    return [{'id': r['id'], 'nome_cliente': r['nome_cliente'], 'latitude': r['latitude'],
+             'longitude': r['longitude'], 'distanza_km': 0} for r in righe_clienti(n, seed=1)]
+
+
+def test_osrm_non_raggiungibile_segnala_errore_e_lascia_le_tappe(monkeypatch):
+    import requests
+
+    def rifiuta(*args, **kwargs):
+        raise requests.ConnectionError("connessione rifiutata")
+    monkeypatch.setattr(requests, 'get', rifiuta)
+
+    def esegui():
+        osrm = OsrmRoutingBackend('http://osrm.invalid', timeout=1)
+        tappe = tappe_prova()
+        nuove, route = ottimizza_ordine_percorso(tappe, BASE[0], BASE[1], osrm)
+        assert route is None and nuove is tappe
+        assert osrm.last_error.startswith("OSRM table: connessione rifiutata")
+        assert modulo_routing.errore_routing.get() == {'osrm': osrm.last_error}
+
+        # Il ripiego locale riesce: il suo errore è vuoto e non tocca quello di OSRM
+        locale = crea_routing_backend('locale')
+        nuove, route = ottimizza_ordine_percorso(tappe_prova(), BASE[0], BASE[1], locale)
+        assert route is not None and route['backend'] == 'locale'
+        assert locale.last_error == ''
+        assert osrm.last_error != ''
+        return osrm
+
+    osrm = contextvars.Context().run(esegui)
+    # Un altro contesto (altra sessione/rerun) non vede l'errore, anche se il motore è lo stesso
+    assert contextvars.Context().run(lambda: osrm.last_error) == ''
+
+
+def test_osrm_chiamata_riuscita_azzera_errore(monkeypatch):
+    import requests
+    risposte = iter([RispostaFinta(503, {}),
+                     RispostaFinta(200, {'code': 'Ok', 'durations': [[0, 60], [60, 0]],
+                                         'distances': [[0, 1000], [1000, 0]]})])
+    monkeypatch.setattr(requests, 'get', lambda *args, **kwargs: next(risposte))
+
+    def esegui():
+        osrm = OsrmRoutingBackend('http://osrm.invalid', timeout=1)
+        punti = [BASE, (BASE[0] + 0.01, BASE[1])]
+        assert osrm.matrix(punti) == (None, None)
+        assert osrm.last_error.startswith("OSRM table HTTP 503")
+        assert osrm.matrix(punti)[0] == [[0, 60], [60, 0]]
+        assert osrm.last_error == ''
+    contextvars.Context().run(esegui)
+
+
+# --- RIGA DI COMANDO ---
+
+@pytest.fixture
+def snapshot_clienti(tmp_path):
+    righe = righe_clienti(12, seed=2)
+    for r in righe[6:]:
+        r['user_id'] = 'u2'
+    for r in righe[:6]:
+        r['user_id'] = 'u1'
+    percorso = tmp_path / 'clienti.csv'
+    with open(percorso, 'w', newline='', encoding='utf-8') as f:
+        scrittore = csv.DictWriter(f, fieldnames=list(righe[0]))
+        scrittore.writeheader()
+        scrittore.writerows(righe)
+    return percorso
+
+
+@pytest.fixture
+def snapshot_config(tmp_path):
+    # Una sola riga senza user_id: vale per tutti gli utenti
+    percorso = tmp_path / 'config.json'
+    percorso.write_text(json.dumps([{'lat_base': BASE[0], 'lon_base': BASE[1], 'citta_base': 'Bologna'}]),
+                        encoding='utf-8')
+    return percorso
+
+
+def test_cli_json(snapshot_clienti, snapshot_config, tmp_path):
+    uscita = tmp_path / 'piano.json'
+    esito = subprocess.run(
+        [sys.executable, '-m', 'giro_engine', '--clienti', str(snapshot_clienti), '--config', str(snapshot_config),
+         '--data', OGGI.isoformat(), '--giorno', '--routing', 'locale', '--ottimizza', '--uscita', str(uscita)],
+        cwd=RADICE, capture_output=True, text=True, timeout=120)
+    assert esito.returncode == 0, esito.stderr
+    piano = json.loads(uscita.read_text(encoding='utf-8'))
+    assert piano['meta']['data'] == OGGI.isoformat()
+    assert sorted(p['utente'] for p in piano['piani']) == ['u1', 'u2']
+    for p in piano['piani']:
+        assert p['clienti'] == 6
+        assert [g['data'] for g in p['giorni']] == [OGGI.isoformat()]
+        assert p['tappe'] > 0
+        if p['tappe'] >= 2:
+            assert p['giorni'][0]['km_percorso'] > 0
+        assert 'errore_routing' not in p
+    assert "✅ 2 utenti" in esito.stderr
+
+
+def test_cli_csv_su_stdout(snapshot_clienti, snapshot_config):
+    esito = subprocess.run(
+        [sys.executable, '-m', 'giro_engine', '--clienti', str(snapshot_clienti), '--config', str(snapshot_config),
+         '--data', OGGI.isoformat(), '--utenti', 'u1', '--formato', 'csv'],
+        cwd=RADICE, capture_output=True, text=True, timeout=120)
+    assert esito.returncode == 0, esito.stderr
+    righe = list(csv.DictReader(esito.stdout.splitlines()))
+    assert righe and {r['utente'] for r in righe} == {'u1'}
+    assert all(not math.isnan(float(r['distanza_km'])) for r in righe)
@@ -0,0 +1,76 @@
+"""
+Griglia di copertura della Mappa (app.py): aggiornamento incrementale.
+
+app.py è lo script Streamlit e non si può importare: le funzioni della griglia vengono
+lette dal sorgente ed eseguite con pandas/numpy, senza Streamlit.
+"""
+import ast
+import math
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+FUNZIONI = ('classifica_urgenza_clienti', '_righe_copertura', '_aggrega_righe', 'aggiorna_griglia_copertura')
+OGGI = date(2025, 3, 10)
+
+
+@pytest.fixture(scope='module')
+def griglia():
+    albero = ast.parse(open(APP, encoding='utf-8').read())
+    nodi = [n for n in albero.body if (isinstance(n, ast.FunctionDef) and n.name in FUNZIONI)
+            or (isinstance(n, ast.Assign) and any(getattr(t, 'id', None) == 'RISOLUZIONI_GRIGLIA' for t in n.targets))]
+    spazio = {'pd': pd, 'np': np, 'math': math}
+    exec(compile(ast.Module(body=nodi, type_ignores=[]), APP, 'exec'), spazio)
+    return spazio
+
+
+def clienti(n, primo_id=1):
+    rng = np.random.default_rng(primo_id)
+    return pd.DataFrame({
+        'id': np.arange(primo_id, primo_id + n),
+        'latitude': 44.49 + rng.normal(0, 0.05, n), 'longitude': 11.34 + rng.normal(0, 0.05, n),
+        'ultima_visita': pd.to_datetime('2025-01-15') + pd.to_timedelta(rng.integers(0, 50, n), unit='D'),
+        'frequenza_giorni': 30, 'visitare': 'SI',
+    })
+
+
+def celle_attese(griglia, df):
+    return griglia['aggiorna_griglia_copertura'](df, oggi=OGGI)['celle']
+
+
+def confronta(griglia, stato, df):
+    for res, attese in celle_attese(griglia, df).items():
+        ottenute = stato['celle'][res]
+        pd.testing.assert_frame_equal(ottenute.sort_index(), attese.sort_index(), check_dtype=False,
+                                      check_index_type=False)
+
+
+def test_solo_aggiunta(griglia):
+    df = clienti(20)
+    stato = griglia['aggiorna_griglia_copertura'](df, oggi=OGGI)
+    df2 = pd.concat([df, clienti(1, primo_id=100)], ignore_index=True)
+    stato2 = griglia['aggiorna_griglia_copertura'](df2, stato, oggi=OGGI)
+    assert stato2['modificati'] == 1
+    confronta(griglia, stato2, df2)
+
+
+def test_solo_rimozione(griglia):
+    df = clienti(20)
+    stato = griglia['aggiorna_griglia_copertura'](df, oggi=OGGI)
+    df2 = df[df['id'] != 5]
+    stato2 = griglia['aggiorna_griglia_copertura'](df2, stato, oggi=OGGI)
+    assert stato2['modificati'] == 1
+    confronta(griglia, stato2, df2)
+
+
+def test_modifica(griglia):
+    df = clienti(20)
+    stato = griglia['aggiorna_griglia_copertura'](df, oggi=OGGI)
+    df2 = df.copy()
+    df2.loc[df2['id'] == 3, 'latitude'] += 1.0
+    stato2 = griglia['aggiorna_griglia_copertura'](df2, stato, oggi=OGGI)
+    confronta(griglia, stato2, df2)
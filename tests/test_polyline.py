@@ -0,0 +1,118 @@
+"""
+Polyline dei percorsi: codifica/decodifica (giro_engine.routing) e semplificazione
+Douglas–Peucker della mappa (app.py, letta dal sorgente come in test_griglia_copertura).
+"""
+import ast
+import math
+import os
+from math import cos, radians
+
+import numpy as np
+import pytest
+
+from giro_engine import decode_google_polyline, decode_polyline_array, encode_google_polyline
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+# Esempio della documentazione Google (Encoded Polyline Algorithm Format)
+ESEMPIO_GOOGLE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+PUNTI_GOOGLE = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+
+@pytest.fixture(scope='module')
+def douglas_peucker():
+    albero = ast.parse(open(APP, encoding='utf-8').read())
+    nodi = [n for n in albero.body if isinstance(n, ast.FunctionDef) and n.name == 'semplifica_douglas_peucker']
+    spazio = {'np': np, 'math': math, 'cos': cos, 'radians': radians}
+    exec(compile(ast.Module(body=nodi, type_ignores=[]), APP, 'exec'), spazio)
+    return spazio['semplifica_douglas_peucker']
+
+
+def percorso_stradale(n, seed=0):
+    """Percorso a zig-zag intorno a Bologna (passi di qualche decina di metri)"""
+    rng = np.random.default_rng(seed)
+    passi = rng.normal(0, 0.0004, (n, 2)) + [0.0002, 0.0003]
+    return np.round(np.array([44.49, 11.34]) + np.cumsum(passi, axis=0), 5)
+
+
+# --- CODIFICA / DECODIFICA ---
+
+def test_esempio_google():
+    assert encode_google_polyline(PUNTI_GOOGLE) == ESEMPIO_GOOGLE
+    assert decode_google_polyline(ESEMPIO_GOOGLE) == pytest.approx(PUNTI_GOOGLE)
+
+
+def test_polyline_vuota():
+    assert encode_google_polyline([]) == ''
+    assert decode_google_polyline('') == []
+    assert decode_polyline_array('').shape == (0, 2)
+
+
+def test_punto_singolo():
+    codificata = encode_google_polyline([(44.49371, 11.34262)])
+    assert decode_google_polyline(codificata) == pytest.approx([(44.49371, 11.34262)])
+    assert decode_polyline_array(codificata).shape == (1, 2)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_andata_e_ritorno(seed):
+    punti = percorso_stradale(500, seed)
+    # Anche delta grandi e coordinate negative
+    punti = np.vstack([punti, [[-33.86882, 151.20929], [0.0, 0.0], [89.99999, -179.99999]]])
+    codificata = encode_google_polyline(punti.tolist())
+    assert np.abs(decode_polyline_array(codificata) - punti).max() < 1e-9
+    assert decode_google_polyline(codificata) == pytest.approx([tuple(p) for p in punti.tolist()])
+    assert encode_google_polyline(decode_google_polyline(codificata)) == codificata
+
+
+def test_precisione_cinque_decimali():
+    # Coordinate non arrotondate: errore massimo mezzo 1e-5
+    punti = percorso_stradale(200) + 0.0000037
+    decodificati = decode_polyline_array(encode_google_polyline(punti.tolist()))
+    assert np.abs(decodificati - punti).max() <= 0.5e-5 + 1e-12
+
+
+# --- SEMPLIFICAZIONE ---
+
+def distanza_dalla_spezzata(punti, spezzata):
+    """Distanza (stesse unità scalate di Douglas–Peucker) di ogni punto dal segmento più vicino"""
+    scala = cos(radians(float(punti[:, 0].mean())))
+    p = punti * [1, scala]
+    s = spezzata * [1, scala]
+    migliori = np.full(len(p), np.inf)
+    for a, b in zip(s[:-1], s[1:]):
+        d = b - a
+        t = np.clip(((p - a) @ d) / max(d @ d, 1e-30), 0, 1)
+        migliori = np.minimum(migliori, np.hypot(*(p - (a + t[:, None] * d)).T))
+    return migliori
+
+
+@pytest.mark.parametrize('tolleranza', [0.00005, 0.0002, 0.001])
+def test_semplificazione_entro_tolleranza(douglas_peucker, tolleranza):
+    punti = percorso_stradale(800)
+    semplificati = douglas_peucker(punti, tolleranza)
+    assert 2 <= len(semplificati) < len(punti)
+    # Estremi conservati, punti scelti tra gli originali e nell'ordine originale
+    assert (semplificati[0] == punti[0]).all() and (semplificati[-1] == punti[-1]).all()
+    indici = [int(np.flatnonzero((punti == q).all(axis=1))[0]) for q in semplificati]
+    assert indici == sorted(indici)
+    assert distanza_dalla_spezzata(punti, semplificati).max() <= tolleranza + 1e-12
+
+
+def test_tolleranza_maggiore_meno_punti(douglas_peucker):
+    punti = percorso_stradale(800)
+    lunghezze = [len(douglas_peucker(punti, t)) for t in (0.00005, 0.0002, 0.001)]
+    assert lunghezze == sorted(lunghezze, reverse=True)
+
+
+def test_casi_limite(douglas_peucker):
+    punti = percorso_stradale(50)
+    assert douglas_peucker(punti, 0) is punti
+    assert len(douglas_peucker(punti[:2], 0.001)) == 2
+    assert len(douglas_peucker(punti[:1], 0.001)) == 1
+    # Punti allineati: restano solo gli estremi
+    retta = np.column_stack([np.linspace(44.0, 44.1, 30), np.full(30, 11.3)])
+    assert douglas_peucker(retta, 1e-7).tolist() == [retta[0].tolist(), retta[-1].tolist()]
+    # Andata e ritorno sullo stesso punto (segmento degenere)
+    anello = np.array([[44.49, 11.34], [44.50, 11.35], [44.49, 11.34]])
+    assert len(douglas_peucker(anello, 0.001)) == 3
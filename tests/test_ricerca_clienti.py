@@ -0,0 +1,122 @@
+"""
+Ricerca clienti (app.py): indice trigrammi + prefissi, aggiornamento incrementale e ranking.
+
+app.py è lo script Streamlit e non si può importare: le funzioni dell'indice vengono
+lette dal sorgente ed eseguite con pandas, senza Streamlit.
+"""
+import ast
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+FUNZIONI = ('normalizza_testo_ricerca', '_trigrammi', '_token_documento', '_indice_aggiungi', '_indice_rimuovi',
+            'aggiorna_indice_ricerca', 'cerca_clienti')
+COSTANTI = ('CAMPI_RICERCA', 'MAX_CANDIDATI_PREFISSO')
+
+
+@pytest.fixture(scope='module')
+def ricerca():
+    albero = ast.parse(open(APP, encoding='utf-8').read())
+    nodi = [n for n in albero.body if (isinstance(n, ast.FunctionDef) and n.name in FUNZIONI)
+            or (isinstance(n, ast.Assign) and any(getattr(t, 'id', None) in COSTANTI for t in n.targets))]
+    spazio = {'pd': pd, 'np': np, 'math': math, 're': re}
+    exec(compile(ast.Module(body=nodi, type_ignores=[]), APP, 'exec'), spazio)
+    return spazio
+
+
+def clienti():
+    return pd.DataFrame({
+        'id': [1, 2, 3, 4, 5],
+        'nome_cliente': ['Bar Rossi', 'Ferramenta Bianchi', 'Rossini Srl', 'Alimentari Verdi', np.nan],
+        'indirizzo': ['Via Roma 1', 'Via Rossi 12', 'Piazza Maggiore 3', 'Via Emilia 40', 'Via Nanni 2'],
+        'citta': ['Bologna', 'Modena', 'Bologna', 'Parma', 'Bologna'],
+        'telefono': ['051 123456', '059 654321', np.nan, '0521 111222', '051 999000'],
+    })
+
+
+def senza_contatore(indice):
+    return {k: v for k, v in indice.items() if k != 'modificati'}
+
+
+def ids(risultati):
+    return [cid for cid, _ in risultati]
+
+
+def test_aggiornamento_incrementale_come_ricostruzione(ricerca):
+    df = clienti()
+    indice = ricerca['aggiorna_indice_ricerca'](df)
+    # Write-through: un cliente modificato, uno nuovo
+    df2 = df.copy()
+    df2.loc[df2['id'] == 2, 'nome_cliente'] = 'Ferramenta Neri'
+    df2 = pd.concat([df2, pd.DataFrame([{'id': 6, 'nome_cliente': 'Bar Neri', 'indirizzo': 'Via Po 1',
+                                          'citta': 'Ferrara', 'telefono': '0532 1'}])], ignore_index=True)
+    indice = ricerca['aggiorna_indice_ricerca'](df2, indice)
+    assert indice['modificati'] == 2
+    assert senza_contatore(indice) == senza_contatore(ricerca['aggiorna_indice_ricerca'](df2))
+    assert 'bianchi' not in indice['token']
+    assert ids(ricerca['cerca_clienti'](indice, 'neri')) == [6, 2]
+
+
+def test_rimozione_toglie_i_token(ricerca):
+    df = clienti()
+    indice = ricerca['aggiorna_indice_ricerca'](df)
+    indice = ricerca['aggiorna_indice_ricerca'](df[df['id'] != 4], indice)
+    assert indice['modificati'] == 1
+    assert 4 not in indice['docs']
+    # Token usati solo dal cliente rimosso: fuori da vocabolario, elenco ordinato e trigrammi
+    for tok in ('alimentari', 'verdi', 'emilia', 'parma'):
+        assert tok not in indice['token']
+        assert tok not in indice['token_ordinati']
+        assert all(tok not in toks for toks in indice['trigrammi'].values())
+    assert ricerca['cerca_clienti'](indice, 'verdi') == []
+    assert senza_contatore(indice) == senza_contatore(ricerca['aggiorna_indice_ricerca'](df[df['id'] != 4]))
+
+
+def test_ranking(ricerca):
+    indice = ricerca['aggiorna_indice_ricerca'](clienti())
+    cerca = ricerca['cerca_clienti']
+    # Parola intera nel nome > prefisso nel nome > parola intera nell'indirizzo
+    risultati = cerca(indice, 'rossi')
+    assert ids(risultati) == [1, 3, 2]
+    assert risultati[0][1] > risultati[1][1] > risultati[2][1]
+    # Errore di battitura: trovato per trigrammi, sotto le corrispondenze esatte
+    assert ids(cerca(indice, 'ferramneta')) == [2]
+    assert cerca(indice, 'ferramneta')[0][1] < 0.8
+    # Tutte le parole devono trovare qualcosa, anche quelle brevi
+    assert ids(cerca(indice, 'bar bo')) == [1]
+    assert cerca(indice, 'bar parma') == []
+
+
+def test_telefono_per_prefisso(ricerca):
+    indice = ricerca['aggiorna_indice_ricerca'](clienti())
+    assert set(ids(ricerca['cerca_clienti'](indice, '051'))) == {1, 5}
+    # Prefisso esatto prima, poi i numeri simili per trigrammi
+    risultati = ricerca['cerca_clienti'](indice, '0511')
+    assert ids(risultati)[0] == 1
+    assert all(p < risultati[0][1] for _, p in risultati[1:])
+
+
+def test_nome_vuoto_non_indicizzato_come_nan(ricerca):
+    indice = ricerca['aggiorna_indice_ricerca'](clienti())
+    assert 'nan' not in indice['token']
+    assert indice['docs'][5][0] == ''
+    # 'nan' trova solo Via Nanni (prefisso), non i campi vuoti
+    assert ids(ricerca['cerca_clienti'](indice, 'nan')) == [5]
+
+
+def test_tetto_candidati(ricerca):
+    n = ricerca['MAX_CANDIDATI_PREFISSO'] * 3
+    df = pd.DataFrame({'id': range(1, n + 1), 'nome_cliente': [f'Cliente {i}' for i in range(n)],
+                       'indirizzo': '', 'citta': 'Bologna', 'telefono': [f'051{i:06d}' for i in range(n)]})
+    indice = ricerca['aggiorna_indice_ricerca'](df)
+    risultati = ricerca['cerca_clienti'](indice, '051', limite=n)
+    assert len(risultati) == ricerca['MAX_CANDIDATI_PREFISSO']
+    # Le parole successive filtrano i candidati senza perdere le corrispondenze esatte
+    risultati = ricerca['cerca_clienti'](indice, 'cliente 051000007')
+    assert ids(risultati)[0] == 8
+    assert risultati[0][1] > risultati[1][1]